@@ -4,7 +4,8 @@ import os
 import sys
 import time
 import numpy as np
-from ..utils import plan,apload,platedata,utils
+import multiprocessing as mp
+from ..utils import plan,apload,platedata,utils,timing
 from . import psf,wave
 from dlnpyutils import utils as dln
 from astropy.io import fits
@@ -27,13 +28,578 @@ def errout(data):
         data[bad] = BADERR
     return data
     
+def ap2dproc_chip(i,ichip,chstr,files,psffiles,epsffiles,outdir,load,framenum,psfframeid,
+                  extract_type=1,modelpsffile=None,fluxcalfile=None,responsefile=None,
+                  wavefile=None,fixbadpix=False,recenterfit=False,recenterln2=False,
+                  refpixzero=False,fibers=None,highrej=7,lowrej=10,npolyback=0,
+                  fitsigma=False,silent=False,timer=None):
+    """
+    Extract one chip of an exposure.  This is called from AP2DPROC
+    for each chip, possibly in parallel.
+
+    Parameters
+    ----------
+    i : int
+       Index in the list of chips being processed.
+    ichip : int
+       Chip index, 0-first chip.
+    chstr : dict
+       The chip structure with header, flux, err and mask.
+    files : list
+       The ap2D files of the three chips.
+    psffiles : list
+       The apPSF files of the three chips.
+    epsffiles : list
+       The apEPSF files of the three chips.
+    outdir : str
+       The output directory.
+    load : ApLoad
+       The ApLoad object.
+    framenum : int
+       The exposure number.
+    psfframeid : str
+       The PSF exposure number.
+    timer : StageTimer, optional
+       The timer to use.  By default a new one is created.
+
+    The other parameters are the same as for AP2DPROC.
+
+    Returns
+    -------
+    ichip : int
+       Chip index.
+    outstr : dict
+       The extracted spectra with header, flux, err and mask.
+    ymodel : numpy array
+       The 2D model, None if not available.
+    timer : StageTimer
+       The timing information for this chip.
+
+    Example
+    -------
+
+    ichip,outstr,ymodel,timer = ap2dproc_chip(0,0,chstr,files,psffiles,epsffiles,
+                                              outdir,load,framenum,psfframeid,extract_type=4)
+
+    """
+
+    chiptag = ['a','b','c']
+    if timer is None:
+        timer = timing.StageTimer('ap2dproc_chip',chip=chiptag[ichip])
+    leadstr = 'AP2D: '
+    t1 = time.time()
+    ifile = files[ichip] 
+         
+         
+    # Chip trace filename
+    ipsffile = psffiles[ichip] 
+    iepsffile = epsffiles[ichip] 
+         
+    # Cutput file
+    outfile = outdir+load.prefix+'1D-'+chiptag[ichip]+'-'+str(framenum)+'.fits'  # output file output file 
+         
+    if not silent: 
+        if i > 0 : 
+            print('')
+        print(' processing chip '+chiptag[ichip]+' - '+os.path.basename(ifile))
+        print('  psf file = '+ipsffile)
+     
+         
+    # Fix the bad pixels and "unfixable" pixels
+    #------------------------------------------
+    timer.start('load')
+    if fixbadpix:
+        chstr = ap2dproc_fixpix(chstr)
+         
+    ###################################################################
+    # Need to remove the littrow ghost and secondary ghost here!!!!!!!!
+    ###################################################################
+         
+    # Restore the trace structure
+    tracestr = fits.getdata(ipsffile,1)
+         
+    # Fibers to extract
+    if fibers is not None: 
+        if max(fibers) > len(tracestr)-1: 
+            error = 'max(fibers) is larger than the number of fibers in psf file.' 
+            if not silent: 
+                print('halt: '+error)
+            raise ValueError(error)
+         
+    # Measuring the trace shift
+    timer.start('traceshift')
+    if recenterfit:
+        im = chstr['flux']
+        sz = im.shape
+        npix = sz[1] 
+        nfibers = len(tracestr) 
+        # The red chip has problems on the left side,
+        #  so use columns farther to the right
+        if ichip == 0: 
+            xmid = npix*0.75 
+        else: 
+            xmid = npix*0.5 
+             
+        medspec = np.median(im[xmid-50:xmid+50,:],dim=1) 
+        gdpix , = np.where(medspec > 0.5*max(medspec),ngdpix) 
+        if ngdpix <= 20: 
+            # We're probably trying to process a dark as object or flat
+            # I'm not sure if 20 is the right number but seems to work with darks
+            if not silent: 
+                print('no signal was seen on any fibers for chip ',ichip)
+            xshift = 0.0
+        else: 
+            medht = np.median(medspec[gdpix]) > 0.5*max(medspec) 
+                     
+            tpar = fltarr(nfibers*3) 
+            yfib = fltarr(nfibers) 
+            for l in range(nfibers): 
+                yfib[l]=poly(xmid,tracestr[l].coef) 
+                 
+            tpar[0:3*nfibers-3:3] = medht 
+            #tpar[1:3*nfibers-2:3] = xsol[xmid,:]tpar[1:3*nfibers-2:3] = xsol[xmid,:] 
+            tpar[1:3*nfibers-2:3] = yfib 
+            #tpar[2:3*nfibers-1:3] = np.median(sigma2[xmid,:])tpar[2:3*nfibers-1:3] = np.median(sigma2[xmid,:]) 
+            tpar[2:3*nfibers-1:3] = 1.0 #1.51.5 
+            x = findgen(npix) 
+            temp = gfunc(x,tpar) 
+            mask1d = int(medspec > 0.5*max(medspec)) 
+            #xcorlb,temp,medspec,20,xsh,mask=mask1dxcorlb,temp,medspec,20,xsh,mask=mask1d 
+                     
+            lag = findgen(9)-4 
+            xc = c_correlate(temp,medspec*mask1d,lag) 
+            bestind = first_el(maxloc(xc)) 
+            fitlo = (bestind-2) > 0 
+            fithi = (bestind+2) < 20 
+            estimates = [xc[bestind],lag[bestind],1,np.median(xc)] 
+            yfit = mpfitpeak(lag[fitlo:fithi],xc[fitlo:fithi],par,nterms=4,gaussian=True,positive=True,estimates=estimates) 
+            xshift = par[1] 
+             
+            if not silent: 
+                print('recentering shift = %.3f ' % xshift)
+                
+            # this is an ADDITIVE offset!
+             
+    # Calculate the trace shift ln2level header values
+    if recenterln2: 
+        head_psf = headfits(ipsffile,exten=0) 
+        ln2level_psf = head_psf['ln2level']
+        ln2level_im = chstr['header']['ln2level']
+                
+        if nln2level_psf > 0 and nln2level_im > 0:
+            # The slope of trace shift vs. ln2level is (from green chip):  0.0117597
+            # Fits from check_traceshift.def 
+            # linear: coef=[ -1.02611, 0.0117597]
+            # quadratic:  coef=[-3.33460, 0.0613117, -0.000265449]
+            # A higher LN2LEVEL shifts the fibers DOWNWARDS
+            xshift = (ln2level_im - ln2level_psf) * (-0.0117597) 
+            if not silent : 
+                print('Recentering shift = %.3f' % xshift)
+
+            # this is an ADDITIVE offset!
+                     
+        # Don't have ln2levels
+        else: 
+            if nln2level_psf == 0 and not silent: 
+                print('Do NOT have header LN2LEVEL for PSF exposure')
+            if nln2level_im == 0 and not silent: 
+                print('Do NOT have header LN2LEVEL for this exposure')
+            if not silent: 
+                print('CANNOT calculate fiber shift from LN2LEVEL in headers')
+             
+    # Reset the zeropoint threshold using the reference pixels
+    if refpixzero: 
+        medref = np.median( [ chstr.flux[:,0:3], transpose(chstr.flux[0:3,:]), chstr.flux[:,2044:2047], transpose(chstr.flux[2044:2047,:]) ]) 
+        if not silent: 
+            print('setting image zeropoint using reference pixels.  subtracting ',str(medref))
+            chstr['flux'] -= medref 
+             
+    # Initialize the output header
+    #-----------------------------
+    timer.start('extract')
+    head = chstr['header']
+    head['LONGSTRN'] = 'OGIP 1.0'    # allows us to use long/continued strings     
+    head['PSFFILE'] = ipsffile,' PSF file used' 
+    leadstr = 'AP2D: ' 
+    pyvers = sys.version.split()[0]
+    head['V_APRED'] = plan.getgitvers(),'APOGEE software version' 
+    head['APRED'] = load.apred,'APOGEE Reduction version' 
+    head['HISTORY'] = leadstr+time.asctime()
+    import socket
+    #head['HISTORY'] = leadstr+os.getlogin()+' on '+socket.gethostname()
+    head['HISTORY'] = leadstr+getpass.getuser()+' on '+socket.gethostname()
+    import platform
+    head['HISTORY'] = leadstr+'Python '+pyvers+' '+platform.system()+' '+platform.release()+' '+platform.architecture()[0]
+    # add reduction pipeline version to the header
+    head['HISTORY'] = leadstr+' APOGEE Reduction Pipeline Version: '+load.apred
+    head['HISTORY'] = leadstr+'Output file:'
+    head['HISTORY'] = leadstr+' HDU1 - Image (ADU)'
+    head['HISTORY'] = leadstr+' HDU2 - Error (ADU)'
+    if (extract_type == 1): 
+        head['HISTORY'] = leadstr+' HDU3 - Flag mask (bitwise OR combined)'
+        head['HISTORY'] = leadstr+'        1 - bad pixels'
+        head['HISTORY'] = leadstr+'        2 - cosmic ray'
+        head['HISTORY'] = leadstr+'        4 - saturated'
+        head['HISTORY'] = leadstr+'        8 - unfixable'
+    else: 
+        head['HISTORY'] = leadstr+' HDU3 - Flag mask'
+        head['HISTORY'] = leadstr+'        0 - good pixels'
+        head['HISTORY'] = leadstr+'        1 - bad pixels'
+    if wavefile is not None:
+        head['HISTORY'] = leadstr+' HDU4 - Wavelengths (Ang)'
+        head['HISTORY'] = leadstr+' HDU5 - Wavelength coefficients'
+         
+    outstr = None
+    ymodel = None
+             
+    # Extraction type
+    #----------------
+                 
+    # Boxcar extraction
+    #------------------
+    if extract_type==1:
+        if not silent: 
+            print('Using Boxcar Extraction')
+
+        raise ValueError('Not Translated yet')
+             
+        # Update header
+        head['HISTORY'] = leadstr+'Extract_type=1 - Using Boxcar Extraction'
+        head['EXTRTYPE'] = 1,'Extraction Type' 
+                 
+        # Recenter, shift the traces recenter, shift the traces 
+        if recenterfit or recenterln2: 
+            tracestr['coef'][0] += xshift 
+            tracestr['gaussy'] += xshift 
+            if recenterfit and not recenterln2: 
+                head['HISTORY'] = leadstr+' /RECENTERFIT set, shifting traces by %0.3f' % xshift
+            if keyword_set(recenterln2) : 
+                head['HISTORY'] = leadstr+' /RECENTERLN2 set, shifting traces by %0.3f' % xshift
+                 
+        # Extract the fibers
+        outstr = apextract(chstr,tracestr,fibers=fibers)
+        
+    # PSF image extraction
+    #---------------------
+    elif extract_type==2:
+        if not silent: 
+            print('Using PSF Image Extraction')
+         
+        raise ValueError('Not Translated yet')
+
+        # Load the PSF image
+        psfim,head_psfim = fits.getdata(ipsffile,2,header=True)
+             
+        # Update header
+        head['HISTORY'] = leadstr+'Extract_type=2 - Using PSF Image extraction'
+        head['EXTRTYPE'] = 2,'Extraction Type' 
+             
+        # Recenter, shift the traces and the psf image
+        if keyword_set(recenterfit) or keyword_set(recenterln2): 
+            tracestr.coef[0] += xshift 
+            tracestr.gaussy += xshift 
+            psfim0 = psfim 
+            psfim = imdrizzle(psfim0,0.0,xshift)  # shift the image with imdrizzle
+            if keyword_set(recenterfit) and not keyword_set(recenterln2) : 
+                head['HISTORY'] = leadstr+' /RECENTERFIT set, shifting traces by %0.3f' % xshift
+            if keyword_set(recenterln2) : 
+                head['HISTORY'] = leadstr+' /RECENTERLN2 set, shifting traces by %0.3f' % xshift
+             
+        # Extract the fibers
+        outstr,ymodel = apextractpsf(chstr,tracestr,psfim,model=ymodel,fibers=fibers)
+         
+    # Gaussian psf fitting
+    #---------------------
+    #   Maybe use the idlspec2d extraction code for this
+    elif extract_type==3:
+        if not silent: 
+            print('Esing Gaussian PSF fitting Extraction')
+
+        raise ValueError('Not Translated yet')
+        
+        # Update header
+        head['HISTORY'] = leadstr+'Extract_type=3 - Using Gaussian PSF fitting Extraction'
+        head['EXTRTYPE'] = 3,'Extraction Type' 
+         
+        # The idlspec2d programs expect the fibers to run along the y
+        # transposing the arrays for now
+         
+        # Get the idlspec2d-style trace and widthset information
+        tset_coeff,tset_head = fits.getdata(ipsffile,3,header=True)
+        tset = {'func':str(tset_head['func']),'xmin':tset_head['xmin'],
+                'xmax':tset_head['xmax'],'coeff':tset_coeff} 
+        wset_coeff,wset_head = fits.getdata(ipsffile,4,header=True)
+        widthset = {'func':str(wset_head['func']),'xmin':wset_head['xmin'],
+                    'xmax':wset_head['xmax'],'coeff':wset_coeff} 
+        proftype = wset_head.get('proftype') 
+         
+        # Get the trace and sigma arrays
+        ycen,xsol,xx,sigma2 = None,None,None,None
+        traceset2xy, tset, ycen, xsol 
+        traceset2xy, widthset, xx, sigma2 
+         
+        # Get the images ready
+        img = frame[ichip]['flux'].astype(float).T
+        ivar = ( 1.0/frame[ichip]['err'].astype(float)**2 ).T
+        mask = frame[ichip]['mask'].T
+        mask = 1-( ((mask and 1) == 1) or ((mask and 4) == 4) or ((mask and 8) == 8) ) 
+         
+        # Recenter the traces
+        if recenterfit or recenterln2: 
+            # Need to add this to the traces
+            xsol += xshift 
+            if recenterfit and not recenterln2: 
+                head['HISTORY'] = leadstr+' /recenterfit set, shifting traces by %0.3f' % xshift
+            if recenterln2: 
+                head['HISTORY'] = leadstr+' /recenterln2 set, shifting traces by %0.3f' % xshift
+         
+        #-------------------------------------------------------------
+        # Extract the spectra
+        #-------------------------------------------------------------
+        # since the gaussian is not a good fit use a lower
+        #  order background
+        npoly = npolyback 
+        wfixed = [1]   # keep the sigmas fixed
+        if fitsigma:
+            wfixed = [1,1]  # fit sigma 
+     
+        # Only extract fibers
+        if len(fibers) > 0: 
+            xsol = xsol[:,fibers] 
+            sigma2 = sigma2[:,fibers] 
+     
+        #splog, 'extracting arc'splog, 'extracting arc' 
+        ymodel = ap_extract_image(img, ivar, xsol, sigma2,
+                               flux, fluxivar, proftype=proftype,
+                               wfixed=wfixed, highrej=highrej,
+                               lowrej=lowrej, npoly=npoly, relative=1,
+                               reject=[0.1, 0.6, 0.6],
+                               mask=mask,chisq=chisq)
+         
+        # transpose the model
+        ymodel = ymodel.T
+         
+        # Create outstr
+        #  bad pixels have fluxivar=0, they are given high err
+        #  mask make it: 0-good, 1-bad
+        outstr = {'flux':flux, 'err':1/(np.sqrt(np.maximum(fluxivar,1e-12))), 'mask':fluxivar.astype(int)*0} 
+        outstr['mask'] = (fluxivar == 0)  # pixels with fluxivar=0 are bad
+        # negative pixels
+        #bd , = np.where(outstr.flux < 0,nbd)
+        #if nbd > 0:
+        #  outstr.flux[bd] = 0
+        #  outstr.err[bd] = 1e6
+        #  outstr.mask[bd] = 1  # maybe give this a different value
+        # 
+        # Fix reference pixels
+        outstr['flux'][0:4,:] = 0 
+        outstr['flux'][2040:2048,:] = 0 
+        outstr['err'][0:4,:] = BADERR 
+        outstr['err'][2040:2048,:] = BADERR 
+        outstr['mask'][0:4,:] = 1 
+        outstr['mask'][2040:2048,:] = 1 
+     
+    # Empirical PSF Extraction
+    #-------------------------
+    if extract_type==4:
+        if not silent: 
+            print('Using Empirical PSF extraction')
+        # Copied from holtz/approcess.pro
+        if epsffiles[ichip] != savedepsffiles[ichip]:
+            # Load Empirical PSF data
+            if not silent:
+                print('Loading empirical PSF data from '+iepsffile)
+            epsf = psf.loadepsf(iepsffile)
+            # Save for later
+            epsfchip[ichip] = epsf
+            savedepsffiles[ichip] = epsffiles[ichip] 
+        else:
+            epsf = epsfchip[ichip]
+        if fibers is None:
+            #fibers = [e['fiber'] for e in epsf]
+            fibers = np.arange(len(epsf))
+     
+        # Update header
+        head['HISTORY'] = leadstr+'Extract_type=4 - Using Empirical PSF Extraction'
+        head['EXTRTYPE'] = 4,'Extraction Type' 
+     
+        # Recenter, shift the traces and the psf image
+        if recenterfit or recenterln2: 
+            # Shift the image with imdrizzle
+            #  on a copy, the saved EPSF is memory-mapped
+            #  the shift is part of the cache key of the copy
+            epsf = epsf.copy(tag=('shift','%.4f' % xshift))
+            for l in range(len(epsf)): 
+                epsf.img[l,0:epsf.height[l],:] = imdrizzle(epsf.trace(l),0.0,xshift) 
+     
+            if recenterfit and not recenterln2: 
+                head['HISTORY'] = leadstr+' /recenterfit set, shifting traces by %.3f' % xshift
+            if recenterln2: 
+                head['HISTORY'] = leadstr+' /recenterln2 set, shifting traces by %.3f' % xshift
+
+        outstr,back,ymodel = psf.extract(chstr,epsf,scat=True)
+
+ 
+    # Model PSF extraction
+    #---------------------
+    elif extract_type==5:
+        if not silent: 
+            print('Using Model PSF extraction')
+     
+        # Update header
+        head['HISTORY'] = leadstr+'Extract_type=5 - Model PSF Extraction'
+        head['EXTRTYPE'] = 5,'Extraction Type' 
+
+        if modelpsffile is None:
+            raise ValueError('Need Model PSF file for Model PSF Extraction')
+        modelpsfid = os.path.basename(modelpsffile)
+        modelpsffile1 = load.filename('PSFModel',num=modelpsfid,chips=True).replace('PSFModel-','PSFModel-'+chiptag[ichip]+'-')
+        head['HISTORY'] = 'Model PSF file: '+modelpsffile1
+        tracefile = load.filename('ETrace',num=psfframeid,chips=True).replace('ETrace-','ETrace-'+chiptag[ichip]+'-')
+        chstr['header'] = head
+        epsffile1 = epsffiles[ichip]
+        outstr,back,ymodel = psf.extractwing(chstr,modelpsffile1,epsffile1,tracefile)
+        head = outstr['header']
+ 
+    t2 = time.time()
+    #import pdb; pdb.set_trace()
+ 
+ 
+    # Do the fiber-to-fiber throughput corrections and relative
+    #   flux calibration
+    #----------------------------------------------------------
+    timer.start('fluxcal')
+    if fluxcalfile is not None:
+        # restore the relative flux calibration correction file
+        if not silent: 
+            print('Flux calibrating with ',os.path.dirname(fluxcalfile)+'/'+load.prefix+'Flux-'+os.path.basename(fluxcalfile))
+        fluxcalfiles = [os.path.dirname(fluxcalfile)+'/'+load.prefix+'Flux-'+ch+'-'+os.path.basename(fluxcalfile)+'.fits' for ch in chiptag]
+        fluxcal,fluxcal_head = fits.getdata(fluxcalfiles[ichip],header=True)
+        outstr['flux'] /= fluxcal.T          # correct flux
+        bderr = (outstr['err'] == BADERR) 
+        nbd = np.sum(bderr)
+        outstr['err'] /= fluxcal.T           # correct error
+        if np.sum(bderr) > 0: 
+            outstr['err'][bderr] = BADERR 
+        bd = (np.isfinite(outstr['flux']) == False)
+        nbd = np.sum(bd)
+        if nbd > 0: 
+            outstr['flux'][bd] = 0. 
+            outstr['err'][bd] = BADERR 
+            outstr['mask'][bd] = 1 
+ 
+        # Update header
+        head['HISTORY'] = leadstr+'Flux Calibrating the spectra with:'
+        head['HISTORY'] = leadstr+fluxcalfiles[ichip]
+        head['FLUXFILE'] = fluxcalfile,' Flux Calibration file used' 
+ 
+    # Response curve calibration
+    #---------------------------
+    if responsefile is not None: 
+        # Restore the relative flux calibration correction file
+        if not silent: 
+            print('response calibrating with ',os.path.dirname(responsefile)+'/'+load.prefix+'flux-'+os.path.basename(responsefile))
+        responsefiles = [os.path.dirname(responsefile)+'/'+load.prefix+'response-'+ch+'-'+os.path.basename(responsefile)+'.fits' for ch in chiptag]
+        response,response_head = fits.getdata(responsefiles[ichip],header=True)
+ 
+        sz = outstr['flux'].shape
+        outstr['flux'] *= response.reshape(-1,1) + np.zeros(sz[1])      # correct flux
+        bderr = (outstr['err'] == BADERR)
+        outstr['err'] *= response.reshape(-1,1) + np.zeros(sz[1])       # correct error
+        if np.sum(bderr) > 0: 
+            outstr['err'][bderr] = BADERR 
+ 
+        # Update header
+        head['HISTORY'] = leadstr+'Applying response function:'
+        head['HISTORY'] = leadstr+responsefiles[ichip]
+        head['RESPFILE'] = responsefile,' Response file used' 
+ 
+    # Adding wavelengths
+    #-------------------
+    timer.start('wavelength')
+    if wavefile is not None:
+        wavefiles = os.path.dirname(wavefile)+'/'+load.prefix+'wave-'+chiptag+'-'+os.path.basename(wavefile)+'.fits' 
+        if not silent: 
+            print('Adding wavelengths from ',os.path.dirname(wavefile)+'/'+load.prefix+'wave-'+os.path.basename(wavefile))
+        # Get the wavelength calibration data
+        wcoef,whead = fits.getdata(wavefiles[ichip],1,header=True)
+        wim,whead2 = fits.getdata(wavefiles[ichip],2,header=True)
+        # this is now fixed in the apwave files this is now fixed in the apwave files 
+        #wim = transpose(wim)  # want it [npix, nfibers]wim = transpose(wim)   want it [npix, nfibers] 
+ 
+        head['HISTORY'] = leadstr+'Adding wavelengths from'
+        head['HISTORY'] = leadstr+wavefiles[ichip]
+        head['WAVEFILE'] = wavefile,' Wavelength Calibration file' 
+        head['WAVEHDU'] = 5,' Wavelength coef HDU' 
+
+    # Add header to structure
+    outstr['header'] = head
+ 
+    # Add fibers to structure
+    if fibers is not None:
+        outstr['fibers'] = fibers
+ 
+    # Output the 2D model spectrum
+    timer.start('model')
+    if ymodel is not None:
+        modelfile = outdir+load.prefix+'2Dmodel-'+chiptag[ichip]+'-'+str(framenum)+'.fits'  # model output file
+        if not silent: 
+            print('Writing 2D model to: ',modelfile)
+        hdu = fits.HDUList()
+        hdu.append(fits.PrimaryHDU(ymodel.astype(np.float32)))
+        hdu.writeto(modelfile,overwrite=True)
+        hdu.close()
+        #    # compress model and 2D image done in ap2d
+        #    if keyword_set(compress):
+        #      os.remove(modelfile+'.fz',/allow_nonexistent
+        #      spawn,'fpack -d -y '+modelfile 
+        #      origfile = outdir+load.prefix+'2D-'+chiptag[ichip]+'-'+framenum+'.fits'
+        #      if os.path.exists(origfile):
+        #        os.remove(origfile+'.fz',/allow_nonexistent
+        #        spawn,'fpack -d -y '+origfile
+
+    timer.stop()
+
+    return ichip,outstr,ymodel,timer
+
+
+def _ap2dproc_chip_worker(args):
+    """ Wrapper of ap2dproc_chip() for the multiprocessing pool."""
+    i,ichip,chstr,kwargs = args
+    return ap2dproc_chip(i,ichip,chstr,**kwargs)
+
+
+# Pool of the chip workers, kept between AP2DPROC calls so the
+#  worker processes keep their loaded EPSFs and extraction matrices
+_chippool = None
+_chippoolsize = 0
+
+def getchippool(nworkers):
+    """ Return the pool of chip workers, a new one is started if needed."""
+    global _chippool, _chippoolsize
+    if _chippool is None or _chippoolsize != nworkers:
+        closechippool()
+        _chippool = mp.Pool(nworkers)
+        _chippoolsize = nworkers
+    return _chippool
+
+def closechippool():
+    """ Shut down the pool of chip workers."""
+    global _chippool, _chippoolsize
+    if _chippool is not None:
+        _chippool.close()
+        _chippool.join()
+    _chippool = None
+    _chippoolsize = 0
+
+
 def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
              modelpsffile=None,outdir=None,clobber=False,fixbadpix=False,
              fluxcalfile=None,responsefile=None,wavefile=None,skywave=False,
              plugmap=0,highrej=7,lowrej=10,recenterfit=False,recenterln2=False,fitsigma=False,
              refpixzero=False,outlong=False,nowrite=False,npolyback=0,
              chips=[0,1,2],fibers=None,compress=False,verbose=False,
-             silent=False,unlock=False):
+             silent=False,unlock=False,writetiming=False,nchipworkers=1):
     """
     This program extracts a 2D APOGEE image.
     This is called from AP2D
@@ -133,6 +699,16 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
         Don't print anything to the screen. Default is False.
     unlock : boolean, optional
         Delete lock file and start fresh.  Default is False.
+    writetiming : boolean, optional
+        Write a JSON file with the time, CPU time and peak memory of
+          each processing stage next to the output files (_timing.json).
+          Default is False.
+    nchipworkers : int, optional
+        Number of processes to use to extract the chips in parallel.
+          The pool is kept for later calls, so the workers reuse their
+          loaded EPSFs and extraction matrices.  Call closechippool()
+          to shut it down.  Default is 1, the chips are done one after
+          the other.
     
     Returns
     -------
@@ -150,6 +726,8 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
     Translated to python by D.Nidever  Feb 2022  
     """
      
+    timer = timing.StageTimer('ap2dproc',file=inpfile,extract_type=extract_type)
+
     # Output directory
     if outdir is None:
         outdir = os.path.dirname(inpfile)+'/' 
@@ -234,6 +812,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
      
 
     # Parameters
+    timer.start('load')
     frame = load.ap2D(int(base))
     mjd5 = int(load.cmjd(int(base)))
     nreads = frame['a'][0].header['nread']
@@ -321,496 +900,55 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
     #--------------------------------
     # Looping through the three chips
     #--------------------------------
-    output = None
-    outmodel = None
-    outstr = None
-    ifirst = 0 
-    for i in range(len(chips)): 
-        t1 = time.time()
+    # Parameters for the chips
+    chipkws = {'files':files,'psffiles':psffiles,'epsffiles':epsffiles,'outdir':outdir,'load':load,
+               'framenum':framenum,'psfframeid':psfframeid,'extract_type':extract_type,
+               'modelpsffile':modelpsffile,'fluxcalfile':fluxcalfile,'responsefile':responsefile,
+               'wavefile':wavefile,'fixbadpix':fixbadpix,'recenterfit':recenterfit,
+               'recenterln2':recenterln2,'refpixzero':refpixzero,'fibers':fibers,'highrej':highrej,
+               'lowrej':lowrej,'npolyback':npolyback,'fitsigma':fitsigma,'silent':silent}
+    chipargs = []
+    for i in range(len(chips)):
         ichip = chips[i]   # chip index, 0-first chip
-        ifile = files[ichip] 
-             
         # The chip structure
         frame1 = frame[chiptag[ichip]]
         chstr = {'header':frame1[0].header,'flux':frame1[1].data,'err':frame1[2].data,
                  'mask':frame1[3].data}
-             
-        # Chip trace filename
-        ipsffile = psffiles[ichip] 
-        iepsffile = epsffiles[ichip] 
-             
-        # Cutput file
-        outfile = outdir+load.prefix+'1D-'+chiptag[ichip]+'-'+str(framenum)+'.fits'  # output file output file 
-             
-        if not silent: 
-            if i > 0 : 
-                print('')
-            print(' processing chip '+chiptag[ichip]+' - '+os.path.basename(ifile))
-            print('  psf file = '+ipsffile)
-         
-             
-        # Fix the bad pixels and "unfixable" pixels
-        #------------------------------------------
-        if fixbadpix:
-            chstr = ap2dproc_fixpix(chstr)
-             
-        ###################################################################
-        # Need to remove the littrow ghost and secondary ghost here!!!!!!!!
-        ###################################################################
-             
-        # Restore the trace structure
-        tracestr = fits.getdata(ipsffile,1)
-             
-        # Fibers to extract
-        if fibers is not None: 
-            if max(fibers) > len(tracestr)-1: 
-                error = 'max(fibers) is larger than the number of fibers in psf file.' 
-                if not silent: 
-                    print('halt: '+error)
-                import pdb; pdb.set_trace() 
-                return 
-             
-        # Measuring the trace shift
-        if recenterfit:
-            im = chstr['flux']
-            sz = im.shape
-            npix = sz[1] 
-            nfibers = len(tracestr) 
-            # The red chip has problems on the left side,
-            #  so use columns farther to the right
-            if ichip == 0: 
-                xmid = npix*0.75 
-            else: 
-                xmid = npix*0.5 
-                 
-            medspec = np.median(im[xmid-50:xmid+50,:],dim=1) 
-            gdpix , = np.where(medspec > 0.5*max(medspec),ngdpix) 
-            if ngdpix <= 20: 
-                # We're probably trying to process a dark as object or flat
-                # I'm not sure if 20 is the right number but seems to work with darks
-                if not silent: 
-                    print('no signal was seen on any fibers for chip ',ichip)
-                xshift = 0.0
-            else: 
-                medht = np.median(medspec[gdpix]) > 0.5*max(medspec) 
-                         
-                tpar = fltarr(nfibers*3) 
-                yfib = fltarr(nfibers) 
-                for l in range(nfibers): 
-                    yfib[l]=poly(xmid,tracestr[l].coef) 
-                     
-                tpar[0:3*nfibers-3:3] = medht 
-                #tpar[1:3*nfibers-2:3] = xsol[xmid,:]tpar[1:3*nfibers-2:3] = xsol[xmid,:] 
-                tpar[1:3*nfibers-2:3] = yfib 
-                #tpar[2:3*nfibers-1:3] = np.median(sigma2[xmid,:])tpar[2:3*nfibers-1:3] = np.median(sigma2[xmid,:]) 
-                tpar[2:3*nfibers-1:3] = 1.0 #1.51.5 
-                x = findgen(npix) 
-                temp = gfunc(x,tpar) 
-                mask1d = int(medspec > 0.5*max(medspec)) 
-                #xcorlb,temp,medspec,20,xsh,mask=mask1dxcorlb,temp,medspec,20,xsh,mask=mask1d 
-                         
-                lag = findgen(9)-4 
-                xc = c_correlate(temp,medspec*mask1d,lag) 
-                bestind = first_el(maxloc(xc)) 
-                fitlo = (bestind-2) > 0 
-                fithi = (bestind+2) < 20 
-                estimates = [xc[bestind],lag[bestind],1,np.median(xc)] 
-                yfit = mpfitpeak(lag[fitlo:fithi],xc[fitlo:fithi],par,nterms=4,gaussian=True,positive=True,estimates=estimates) 
-                xshift = par[1] 
-                 
-                if not silent: 
-                    print('recentering shift = %.3f ' % xshift)
-                    
-                # this is an ADDITIVE offset!
-                 
-        # Calculate the trace shift ln2level header values
-        if recenterln2: 
-            head_psf = headfits(ipsffile,exten=0) 
-            ln2level_psf = head_psf['ln2level']
-            ln2level_im = chstr['header']['ln2level']
-                    
-            if nln2level_psf > 0 and nln2level_im > 0:
-                # The slope of trace shift vs. ln2level is (from green chip):  0.0117597
-                # Fits from check_traceshift.def 
-                # linear: coef=[ -1.02611, 0.0117597]
-                # quadratic:  coef=[-3.33460, 0.0613117, -0.000265449]
-                # A higher LN2LEVEL shifts the fibers DOWNWARDS
-                xshift = (ln2level_im - ln2level_psf) * (-0.0117597) 
-                if not silent : 
-                    print('Recentering shift = %.3f' % xshift)
-
-                # this is an ADDITIVE offset!
-                         
-            # Don't have ln2levels
-            else: 
-                if nln2level_psf == 0 and not silent: 
-                    print('Do NOT have header LN2LEVEL for PSF exposure')
-                if nln2level_im == 0 and not silent: 
-                    print('Do NOT have header LN2LEVEL for this exposure')
-                if not silent: 
-                    print('CANNOT calculate fiber shift from LN2LEVEL in headers')
-                 
-        # Reset the zeropoint threshold using the reference pixels
-        if refpixzero: 
-            medref = np.median( [ chstr.flux[:,0:3], transpose(chstr.flux[0:3,:]), chstr.flux[:,2044:2047], transpose(chstr.flux[2044:2047,:]) ]) 
-            if not silent: 
-                print('setting image zeropoint using reference pixels.  subtracting ',str(medref))
-                chstr['flux'] -= medref 
-                 
-        # Initialize the output header
-        #-----------------------------
-        head = chstr['header']
-        head['LONGSTRN'] = 'OGIP 1.0'    # allows us to use long/continued strings     
-        head['PSFFILE'] = ipsffile,' PSF file used' 
-        leadstr = 'AP2D: ' 
-        pyvers = sys.version.split()[0]
-        head['V_APRED'] = plan.getgitvers(),'APOGEE software version' 
-        head['APRED'] = load.apred,'APOGEE Reduction version' 
-        head['HISTORY'] = leadstr+time.asctime()
-        import socket
-        #head['HISTORY'] = leadstr+os.getlogin()+' on '+socket.gethostname()
-        head['HISTORY'] = leadstr+getpass.getuser()+' on '+socket.gethostname()
-        import platform
-        head['HISTORY'] = leadstr+'Python '+pyvers+' '+platform.system()+' '+platform.release()+' '+platform.architecture()[0]
-        # add reduction pipeline version to the header
-        head['HISTORY'] = leadstr+' APOGEE Reduction Pipeline Version: '+load.apred
-        head['HISTORY'] = leadstr+'Output file:'
-        head['HISTORY'] = leadstr+' HDU1 - Image (ADU)'
-        head['HISTORY'] = leadstr+' HDU2 - Error (ADU)'
-        if (extract_type == 1): 
-            head['HISTORY'] = leadstr+' HDU3 - Flag mask (bitwise OR combined)'
-            head['HISTORY'] = leadstr+'        1 - bad pixels'
-            head['HISTORY'] = leadstr+'        2 - cosmic ray'
-            head['HISTORY'] = leadstr+'        4 - saturated'
-            head['HISTORY'] = leadstr+'        8 - unfixable'
-        else: 
-            head['HISTORY'] = leadstr+' HDU3 - Flag mask'
-            head['HISTORY'] = leadstr+'        0 - good pixels'
-            head['HISTORY'] = leadstr+'        1 - bad pixels'
-        if wavefile is not None:
-            head['HISTORY'] = leadstr+' HDU4 - Wavelengths (Ang)'
-            head['HISTORY'] = leadstr+' HDU5 - Wavelength coefficients'
-             
-        outstr = None
-        ymodel = None
-                 
-        # Extraction type
-        #----------------
-                     
-        # Boxcar extraction
-        #------------------
-        if extract_type==1:
-            if not silent: 
-                print('Using Boxcar Extraction')
-
-            raise ValueError('Not Translated yet')
-                 
-            # Update header
-            head['HISTORY'] = leadstr+'Extract_type=1 - Using Boxcar Extraction'
-            head['EXTRTYPE'] = 1,'Extraction Type' 
-                     
-            # Recenter, shift the traces recenter, shift the traces 
-            if recenterfit or recenterln2: 
-                tracestr['coef'][0] += xshift 
-                tracestr['gaussy'] += xshift 
-                if recenterfit and not recenterln2: 
-                    head['HISTORY'] = leadstr+' /RECENTERFIT set, shifting traces by %0.3f' % xshift
-                if keyword_set(recenterln2) : 
-                    head['HISTORY'] = leadstr+' /RECENTERLN2 set, shifting traces by %0.3f' % xshift
-                     
-            # Extract the fibers
-            outstr = apextract(chstr,tracestr,fibers=fibers)
-            
-        # PSF image extraction
-        #---------------------
-        elif extract_type==2:
-            if not silent: 
-                print('Using PSF Image Extraction')
-             
-            raise ValueError('Not Translated yet')
-
-            # Load the PSF image
-            psfim,head_psfim = fits.getdata(ipsffile,2,header=True)
-                 
-            # Update header
-            head['HISTORY'] = leadstr+'Extract_type=2 - Using PSF Image extraction'
-            head['EXTRTYPE'] = 2,'Extraction Type' 
-                 
-            # Recenter, shift the traces and the psf image
-            if keyword_set(recenterfit) or keyword_set(recenterln2): 
-                tracestr.coef[0] += xshift 
-                tracestr.gaussy += xshift 
-                psfim0 = psfim 
-                psfim = imdrizzle(psfim0,0.0,xshift)  # shift the image with imdrizzle
-                if keyword_set(recenterfit) and not keyword_set(recenterln2) : 
-                    head['HISTORY'] = leadstr+' /RECENTERFIT set, shifting traces by %0.3f' % xshift
-                if keyword_set(recenterln2) : 
-                    head['HISTORY'] = leadstr+' /RECENTERLN2 set, shifting traces by %0.3f' % xshift
-                 
-            # Extract the fibers
-            outstr,ymodel = apextractpsf(chstr,tracestr,psfim,model=ymodel,fibers=fibers)
-             
-        # Gaussian psf fitting
-        #---------------------
-        #   Maybe use the idlspec2d extraction code for this
-        elif extract_type==3:
-            if not silent: 
-                print('Esing Gaussian PSF fitting Extraction')
+        chipargs.append((i,ichip,chstr))
 
-            raise ValueError('Not Translated yet')
-            
-            # Update header
-            head['HISTORY'] = leadstr+'Extract_type=3 - Using Gaussian PSF fitting Extraction'
-            head['EXTRTYPE'] = 3,'Extraction Type' 
-             
-            # The idlspec2d programs expect the fibers to run along the y
-            # transposing the arrays for now
-             
-            # Get the idlspec2d-style trace and widthset information
-            tset_coeff,tset_head = fits.getdata(ipsffile,3,header=True)
-            tset = {'func':str(tset_head['func']),'xmin':tset_head['xmin'],
-                    'xmax':tset_head['xmax'],'coeff':tset_coeff} 
-            wset_coeff,wset_head = fits.getdata(ipsffile,4,header=True)
-            widthset = {'func':str(wset_head['func']),'xmin':wset_head['xmin'],
-                        'xmax':wset_head['xmax'],'coeff':wset_coeff} 
-            proftype = wset_head.get('proftype') 
-             
-            # Get the trace and sigma arrays
-            ycen,xsol,xx,sigma2 = None,None,None,None
-            traceset2xy, tset, ycen, xsol 
-            traceset2xy, widthset, xx, sigma2 
-             
-            # Get the images ready
-            img = frame[ichip]['flux'].astype(float).T
-            ivar = ( 1.0/frame[ichip]['err'].astype(float)**2 ).T
-            mask = frame[ichip]['mask'].T
-            mask = 1-( ((mask and 1) == 1) or ((mask and 4) == 4) or ((mask and 8) == 8) ) 
-             
-            # Recenter the traces
-            if recenterfit or recenterln2: 
-                # Need to add this to the traces
-                xsol += xshift 
-                if recenterfit and not recenterln2: 
-                    head['HISTORY'] = leadstr+' /recenterfit set, shifting traces by %0.3f' % xshift
-                if recenterln2: 
-                    head['HISTORY'] = leadstr+' /recenterln2 set, shifting traces by %0.3f' % xshift
-             
-            #-------------------------------------------------------------
-            # Extract the spectra
-            #-------------------------------------------------------------
-            # since the gaussian is not a good fit use a lower
-            #  order background
-            npoly = npolyback 
-            wfixed = [1]   # keep the sigmas fixed
-            if fitsigma:
-                wfixed = [1,1]  # fit sigma 
-         
-            # Only extract fibers
-            if len(fibers) > 0: 
-                xsol = xsol[:,fibers] 
-                sigma2 = sigma2[:,fibers] 
-         
-            #splog, 'extracting arc'splog, 'extracting arc' 
-            ymodel = ap_extract_image(img, ivar, xsol, sigma2,
-                                   flux, fluxivar, proftype=proftype,
-                                   wfixed=wfixed, highrej=highrej,
-                                   lowrej=lowrej, npoly=npoly, relative=1,
-                                   reject=[0.1, 0.6, 0.6],
-                                   mask=mask,chisq=chisq)
-             
-            # transpose the model
-            ymodel = ymodel.T
-             
-            # Create outstr
-            #  bad pixels have fluxivar=0, they are given high err
-            #  mask make it: 0-good, 1-bad
-            outstr = {'flux':flux, 'err':1/(np.sqrt(np.maximum(fluxivar,1e-12))), 'mask':fluxivar.astype(int)*0} 
-            outstr['mask'] = (fluxivar == 0)  # pixels with fluxivar=0 are bad
-            # negative pixels
-            #bd , = np.where(outstr.flux < 0,nbd)
-            #if nbd > 0:
-            #  outstr.flux[bd] = 0
-            #  outstr.err[bd] = 1e6
-            #  outstr.mask[bd] = 1  # maybe give this a different value
-            # 
-            # Fix reference pixels
-            outstr['flux'][0:4,:] = 0 
-            outstr['flux'][2040:2048,:] = 0 
-            outstr['err'][0:4,:] = BADERR 
-            outstr['err'][2040:2048,:] = BADERR 
-            outstr['mask'][0:4,:] = 1 
-            outstr['mask'][2040:2048,:] = 1 
-         
-        # Empirical PSF Extraction
-        #-------------------------
-        if extract_type==4:
-            if not silent: 
-                print('Using Empirical PSF extraction')
-            # Copied from holtz/approcess.pro
-            if epsffiles[ichip] != savedepsffiles[ichip]:
-                # Load Empirical PSF data
-                if not silent:
-                    print('Loading empirical PSF data from '+iepsffile)
-                epsf = psf.loadepsf(iepsffile)
-                # Save for later
-                epsfchip[ichip] = epsf
-                savedepsffiles[ichip] = epsffiles[ichip] 
-            else:
-                epsf = epsfchip[ichip]
-            if fibers is None:
-                #fibers = [e['fiber'] for e in epsf]
-                fibers = np.arange(len(epsf))
-         
-            # Update header
-            head['HISTORY'] = leadstr+'Extract_type=4 - Using Empirical PSF Extraction'
-            head['EXTRTYPE'] = 4,'Extraction Type' 
-         
-            # Recenter, shift the traces and the psf image
-            if recenterfit or recenterln2: 
-                # Shift the image with imdrizzle
-                for l in range(len(epsf)): 
-                    epsf[l]['img'] = imdrizzle(epsf[l]['img'],0.0,xshift) 
-         
-                if recenterfit and not recenterln2: 
-                    head['HISTORY'] = leadstr+' /recenterfit set, shifting traces by %.3f' % xshift
-                if recenterln2: 
-                    head['HISTORY'] = leadstr+' /recenterln2 set, shifting traces by %.3f' % xshift
-
-            outstr,back,ymodel = psf.extract(chstr,epsf,outstr,scat=True)
-
-     
-        # Model PSF extraction
-        #---------------------
-        elif extract_type==5:
-            if not silent: 
-                print('Using Model PSF extraction')
-         
-            # Update header
-            head['HISTORY'] = leadstr+'Extract_type=5 - Model PSF Extraction'
-            head['EXTRTYPE'] = 5,'Extraction Type' 
+    # Process the chips in parallel
+    nchipworkers = int(np.minimum(nchipworkers,len(chips)))
+    if nchipworkers > 1:
+        if not silent:
+            print('Processing '+str(len(chips))+' chips with '+str(nchipworkers)+' workers')
+        timer.start('chips')
+        pool = getchippool(nchipworkers)
+        results = pool.map(_ap2dproc_chip_worker,[a+(chipkws,) for a in chipargs])
+        timer.stop()
+        # Add the timing of the chips
+        for res in results:
+            timer.merge(res[3])
+    else:
+        results = []
+        for i,ichip,chstr in chipargs:
+            results.append(ap2dproc_chip(i,ichip,chstr,timer=timer,**chipkws))
 
-            if modelpsffile is None:
-                raise ValueError('Need Model PSF file for Model PSF Extraction')
-            modelpsfid = os.path.basename(modelpsffile)
-            modelpsffile1 = load.filename('PSFModel',num=modelpsfid,chips=True).replace('PSFModel-','PSFModel-'+chiptag[i]+'-')
-            head['HISTORY'] = 'Model PSF file: '+modelpsffile1
-            tracefile = load.filename('ETrace',num=psfframeid,chips=True).replace('ETrace-','ETrace-'+chiptag[i]+'-')
-            chstr['header'] = head
-            epsffile1 = epsffiles[i]
-            outstr,back,ymodel = psf.extractwing(chstr,modelpsffile1,epsffile1,tracefile)
-            head = outstr['header']
- 
-        t2 = time.time()
-        #import pdb; pdb.set_trace()
- 
- 
-        # Do the fiber-to-fiber throughput corrections and relative
-        #   flux calibration
-        #----------------------------------------------------------
-        if fluxcalfile is not None:
-            # restore the relative flux calibration correction file
-            if not silent: 
-                print('Flux calibrating with ',os.path.dirname(fluxcalfile)+'/'+load.prefix+'Flux-'+os.path.basename(fluxcalfile))
-            fluxcalfiles = [os.path.dirname(fluxcalfile)+'/'+load.prefix+'Flux-'+ch+'-'+os.path.basename(fluxcalfile)+'.fits' for ch in chiptag]
-            fluxcal,fluxcal_head = fits.getdata(fluxcalfiles[ichip],header=True)
-            outstr['flux'] /= fluxcal.T          # correct flux
-            bderr = (outstr['err'] == BADERR) 
-            nbd = np.sum(bderr)
-            outstr['err'] /= fluxcal.T           # correct error
-            if np.sum(bderr) > 0: 
-                outstr['err'][bderr] = BADERR 
-            bd = (np.isfinite(outstr['flux']) == False)
-            nbd = np.sum(bd)
-            if nbd > 0: 
-                outstr['flux'][bd] = 0. 
-                outstr['err'][bd] = BADERR 
-                outstr['mask'][bd] = 1 
- 
-            # Update header
-            head['HISTORY'] = leadstr+'Flux Calibrating the spectra with:'
-            head['HISTORY'] = leadstr+fluxcalfiles[ichip]
-            head['FLUXFILE'] = fluxcalfile,' Flux Calibration file used' 
- 
-        # Response curve calibration
-        #---------------------------
-        if responsefile is not None: 
-            # Restore the relative flux calibration correction file
-            if not silent: 
-                print('response calibrating with ',os.path.dirname(responsefile)+'/'+load.prefix+'flux-'+os.path.basename(responsefile))
-            responsefiles = [os.path.dirname(responsefile)+'/'+load.prefix+'response-'+ch+'-'+os.path.basename(responsefile)+'.fits' for ch in chiptag]
-            response,response_head = fits.getdata(responsefiles[ichip],header=True)
- 
-            sz = outstr['flux'].shape
-            outstr['flux'] *= response.reshape(-1,1) + np.zeros(sz[1])      # correct flux
-            bderr = (outstr['err'] == BADERR)
-            outstr['err'] *= response.reshape(-1,1) + np.zeros(sz[1])       # correct error
-            if np.sum(bderr) > 0: 
-                outstr['err'][bderr] = BADERR 
- 
-            # Update header
-            head['HISTORY'] = leadstr+'Applying response function:'
-            head['HISTORY'] = leadstr+responsefiles[ichip]
-            head['RESPFILE'] = responsefile,' Response file used' 
- 
-        # Adding wavelengths
-        #-------------------
-        if wavefile is not None:
-            wavefiles = os.path.dirname(wavefile)+'/'+load.prefix+'wave-'+chiptag+'-'+os.path.basename(wavefile)+'.fits' 
-            if not silent: 
-                print('Adding wavelengths from ',os.path.dirname(wavefile)+'/'+load.prefix+'wave-'+os.path.basename(wavefile))
-            # Get the wavelength calibration data
-            wcoef,whead = fits.getdata(wavefiles[ichip],1,header=True)
-            wim,whead2 = fits.getdata(wavefiles[ichip],2,header=True)
-            # this is now fixed in the apwave files this is now fixed in the apwave files 
-            #wim = transpose(wim)  # want it [npix, nfibers]wim = transpose(wim)   want it [npix, nfibers] 
- 
-            head['HISTORY'] = leadstr+'Adding wavelengths from'
-            head['HISTORY'] = leadstr+wavefiles[ichip]
-            head['WAVEFILE'] = wavefile,' Wavelength Calibration file' 
-            head['WAVEHDU'] = 5,' Wavelength coef HDU' 
-    
-        # Add header to structure
-        outstr['header'] = head
- 
-        # Add fibers to structure
-        if fibers is not None:
-            outstr['fibers'] = fibers
- 
-        # Output the 2D model spectrum
+    # Add to output structure
+    output = {}
+    outmodel = None
+    for ichip,outstr,ymodel,ctimer in results:
+        output[ichip] = outstr
         if ymodel is not None:
-            modelfile = outdir+load.prefix+'2Dmodel-'+chiptag[ichip]+'-'+str(framenum)+'.fits'  # model output file
-            if not silent: 
-                print('Writing 2D model to: ',modelfile)
-            hdu = fits.HDUList()
-            hdu.append(fits.PrimaryHDU(ymodel.astype(np.float32)))
-            hdu.writeto(modelfile,overwrite=True)
-            hdu.close()
-            #    # compress model and 2D image done in ap2d
-            #    if keyword_set(compress):
-            #      os.remove(modelfile+'.fz',/allow_nonexistent
-            #      spawn,'fpack -d -y '+modelfile 
-            #      origfile = outdir+load.prefix+'2D-'+chiptag[ichip]+'-'+framenum+'.fits'
-            #      if os.path.exists(origfile):
-            #        os.remove(origfile+'.fz',/allow_nonexistent
-            #        spawn,'fpack -d -y '+origfile
+            if outmodel is None:
+                outmodel = {}
+            outmodel[ichip] = ymodel
 
-        # Add to output structure
-        if ifirst == 0: 
-            output = {ichip:outstr}
-            if ymodel is not None: 
-                outmodel = {ichip:ymodel}
-            ifirst = 1 
-        else: 
-            output[ichip] = outstr
-            if ymodel is not None:
-                outmodel[ichip] = ymodel
-
-  
     # Now we have output structure with three chips, each with tags header, flux, err, mask
  
     # Add wavelength information to the frame structure
     #--------------------------------------------------
     # Loop through the chips
+    timer.start('wavelength')
     if wavefile is not None:
         for k in range(2+1): 
             # Get the wavelength calibration data
@@ -840,6 +978,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
  
     # Write output file
     #------------------
+    timer.start('write')
     if not nowrite:
  
         for i in range(len(chips)): 
@@ -854,10 +993,10 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
  
             # HDU0 - header only
             hdu = fits.HDUList()
-            hdu.append(fits.PrimaryHDU(header=head))
+            hdu.append(fits.PrimaryHDU(header=frame_wave[ichip]['header']))
  
             # HDU1 - Flux
-            flux = frame_wave[i]['flux']
+            flux = frame_wave[ichip]['flux']
             if outlong:
                 flux = np.round(flux).astype(int)
             else:
@@ -868,7 +1007,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
             hdu[1].header['BUNIT'] = 'Flux (ADU)'
  
             # HDU2 - error
-            err = errout(frame_wave[i]['err']) 
+            err = errout(frame_wave[ichip]['err']) 
             if outlong:
                 err = np.round(err).astype(np.int32) 
             else:
@@ -879,7 +1018,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
             hdu[2].header['BUNIT'] = 'Error (ADU)'
  
             # HDU3 - mask
-            mask = frame_wave[i]['mask']
+            mask = frame_wave[ichip]['mask']
             mask = mask.astype(np.int16)
             hdu.append(fits.ImageHDU(mask.T))
             hdu[3].header['CTYPE1'] = 'Pixel'
@@ -899,7 +1038,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
  
             if wavefile is not None:
                 # HDU4 - Wavelengths
-                wave = frame_wave[i]['wavelength']
+                wave = frame_wave[ichip]['wavelength']
                 hdu.append(fits.ImageHDU(wave.T))
                 hdu[4].header['CTYPE1'] = 'Pixel'
                 hdu[4].header['CTYPE2'] = 'Fiber'
@@ -907,7 +1046,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
  
                 # HDU5 - Wavelength solution coefficients [DOUBLE]
                 #-------------------------------------------------
-                wcoef = frame_wave[i]['wcoef'].astype(float)
+                wcoef = frame_wave[ichip]['wcoef'].astype(float)
                 hdu.append(fits.ImageHDU(wcoef.T))
                 hdu[5].header['CTYPE1'] = 'Pixel'
                 hdu[5].header['CTYPE2'] = 'Parameters'
@@ -922,6 +1061,11 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
             hdu.writeto(outfile,overwrite=True)
             hdu.close()
 
+    # Per-stage timing record
+    if writetiming:
+        timefile = outdir+load.prefix+'1D-'+str(framenum)+'_timing.json'
+        timer.save(timefile,silent=silent)
+
     # Remove the lock file
     if os.path.exists(lockfile):
         os.remove(lockfile)
@@ -933,7 +1077,7 @@ def ap2dproc(inpfile,psffile,extract_type=1,apred=None,telescope=None,load=None,
 
 
 def ap2d(planfiles,verbose=False,clobber=False,exttype=4,mapper_data=None,
-         calclobber=False,psflibrary=False,unlock=False):  
+         calclobber=False,psflibrary=False,unlock=False,nchipworkers=1,writetiming=False):  
     """
     This program processes 2D APOGEE spectra.  It extracts the
     spectra.
@@ -957,6 +1101,13 @@ def ap2d(planfiles,verbose=False,clobber=False,exttype=4,mapper_data=None,
         Use the PSF library.  Default is False.
     unlock : boolean, optional
         Delete lock file and start fresh.  Default is False.
+    nchipworkers : int, optional
+        Number of processes to use to extract the three chips
+          in parallel.  The same workers are used for all of the
+          exposures.  Default is 1.
+    writetiming : boolean, optional
+        Write the per-stage timing record of each exposure next to
+          the ap1D files (_timing.json).  Default is False.
 
     Returns
     -------
@@ -1040,26 +1191,21 @@ def ap2d(planfiles,verbose=False,clobber=False,exttype=4,mapper_data=None,
             usepsflibrary = False
         if usepsflibrary:
             print('Using PSF library')
-            # You can do "domeflattrace --mjdplate" where mjdplate could be
-            # e.g. 59223-9244, or "domeflattrace --planfile", with absolute
-            # path of planfile
+            # Match the science exposures to the PSF library flats in-process,
+            # the lookup table is cached between planfiles
             # force single domeflat if a short visit or domelibrary=='single'
+            from . import psfFlatTrace
             observatory = planstr['telescope'][0:3]
-            if str(psflibrary) == 'single' or str(planpsflibrary) == 'single' or len(planstr['APEXP']) <= 3: 
-                out = subprocess.check_output(['psflibrary',observatory,'--planfile',planfile,'--s'],shell=False)
-            else: 
-                out = subprocess.check_output(['psflibrary',observatory,'--planfile',planfile],shell=False)
-            out = out.decode().split('\n')
-            nout = len(out) 
-            # parse the output parse the output 
-            lo = dln.grep(out,'^PSF FLAT RESULTS:',index=True)[0]
-            hi = np.where((np.char.array(out)=='') & (np.arange(nout) > lo))[0][0]
-            if lo == -1 or hi == -1: 
-                print('Problem running psflibrary for '+planfile+'. Skipping this planfile.')
-                continue 
-            outarr = [o.split() for o in out[lo+1:hi]]
-            ims = np.array([int(o[0]) for o in outarr])
-            psfflatims = np.array([int(o[1]) for o in outarr])
+            single = (str(psflibrary) == 'single' or str(planpsflibrary) == 'single' or len(planstr['APEXP']) <= 3)
+            gd, = np.where(planstr['APEXP']['flavor'] == 'object')
+            ims = planstr['APEXP']['name'][gd]
+            try:
+                psfflatnums,ims = psfFlatTrace.findBestFlatSequence(observatory=observatory, ims=ims, single=single)
+            except (Exception,SystemExit) as e:
+                print('Problem running psflibrary for '+planfile+': '+str(e)+'. Skipping this planfile.')
+                continue
+            ims = np.atleast_1d(ims).astype(int)
+            psfflatims = np.zeros(len(ims),int)+psfflatnums
             # update planstr
             vals,ind1,ind2 = np.intersect1d(apexp['name'],ims,return_indices=True)
             planstr['APEXP']['psfid'][ind1] = psfflatims[ind2] 
@@ -1292,15 +1438,17 @@ def ap2d(planfiles,verbose=False,clobber=False,exttype=4,mapper_data=None,
                 file_mkdir,outdir 
             if fluxtest==False or planstr['APEXP']['flavor'][j]=='flux': 
                 ap2dproc(inpfile,tracefile,exttype,load=load,outdir=outdir,unlock=unlock,modelpsffile=modelpsffile,
-                         wavefile=wavefile,skywave=skywave,plugmap=plugmap,clobber=clobber,compress=True)
+                         wavefile=wavefile,skywave=skywave,plugmap=plugmap,clobber=clobber,compress=True,
+                         nchipworkers=nchipworkers,writetiming=writetiming)
             elif waveid > 0: 
                 ap2dproc(inpfile,tracefile,exttype,load=load,outdir=outdir,unlock=unlock,modelpsffile=modelpsffile,
                          fluxcalfile=fluxfile,responsefile=responsefile,
-                         wavefile=wavefile,skywave=skywave,plugmap=plugmap,clobber=clobber,compress=True)
+                         wavefile=wavefile,skywave=skywave,plugmap=plugmap,clobber=clobber,compress=True,
+                         nchipworkers=nchipworkers,writetiming=writetiming)
             else:
                 ap2dproc(inpfile,tracefile,exttype,load=load,outdir=outdir,unlock=unlock,modelpsffile=modelpsffile,
                          fluxcalfile=fluxfile,responsefile=responsefile,
-                         clobber=clobber,compress=True)
+                         clobber=clobber,compress=True,nchipworkers=nchipworkers,writetiming=writetiming)
  
         # Now add in wavelength calibration information, with shift from
         #  FPI or sky lines
@@ -1354,6 +1502,7 @@ def ap2d(planfiles,verbose=False,clobber=False,exttype=4,mapper_data=None,
         utils.writelog(logfile,'AP2D: '+os.path.basename(planfile)+('%.1f' % (time.time()-t0)))
  
     del epsfchip 
+    closechippool()
 
     print('AP2D finished')
     dt = time.time()-t0 
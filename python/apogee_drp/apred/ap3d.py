@@ -15,13 +15,23 @@ import sys
 import numpy as np
 import warnings
 import time
+import getpass
+import socket
+import platform
+import tempfile
+import subprocess
+import hashlib
+import functools
+import multiprocessing as mp
+from collections import OrderedDict
 from astropy.io import fits
+from astropy.time import Time
 from astropy.table import Table, Column
 from astropy import modeling
 from glob import glob
 from scipy.signal import medfilt
 from scipy.ndimage.filters import median_filter,gaussian_filter1d
-from scipy.optimize import curve_fit, least_squares
+from scipy.optimize import curve_fit, least_squares, lsq_linear
 from scipy.special import erf
 from scipy.interpolate import interp1d
 #from numpy.polynomial import polynomial as poly
@@ -30,13 +40,24 @@ from scipy.interpolate import interp1d
 #from sdss_access.path import path
 import traceback
 from dlnpyutils import utils as dln,bindata
-from ..utils import plan,apload,utils,apzip
+from numba import njit
+from ..utils import plan,apload,utils,apzip,bitmask,timing
 from . import mjdcube
 
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 
+# Pixel mask bit definitions
+pixmask = bitmask.PixelBitMask()
+
+# Error value for bad pixels
+BADERR = 1.0000000e+10
+
+def maskval(name):
+    """ Return the integer PIXMASK bit value for a flag name, e.g. 'CRPIX'."""
+    return int(pixmask.getval(name))
+
 
 
 def ap3dproc_lincorr(slc_in,lindata,linhead):
@@ -48,13 +69,15 @@ def ap3dproc_lincorr(slc_in,lindata,linhead):
     The polynomial should take the observed counts and convert
     them into corrected counts, i.e.
     counts_correct = poly(counts_obs,coef)
+
+    The slice can be a single row [Nx,Nreads] or a block of
+    rows [Nx,Nrows,Nreads].  For the per-pixel coefficients
+    lindata must have the same leading dimensions as the slice,
+    i.e. [Nx,3] or [Nx,Nrows,3].
     """
 
     readtime = 10.0   # the time between reads
 
-    lny,lnx = slc_in.shape
-    nreads = sz[1]
-
     szlin = lindata.shape
 
     # Each pixel separately
@@ -79,34 +102,23 @@ def ap3dproc_lincorr(slc_in,lindata,linhead):
         # x = observed counts
         # y = corrected counts
 
-        coef0 = lindata[:,0].repeat(nreads).reshape(2048,nreads)
-        coef1 = lindata[:,1].repeat(nreads).reshape(2048,nreads)
-        coef2 = lindata[:,2].repeat(nreads).reshape(2048,nreads)        
+        # the coefficients broadcast over the reads
+        coef0 = lindata[...,0][...,None].astype(slc_in.dtype)
+        coef1 = lindata[...,1][...,None].astype(slc_in.dtype)
+        coef2 = lindata[...,2][...,None].astype(slc_in.dtype)
         slc_out = coef0 + coef1*slc_in + coef2*slc_in**2
 
     # Each output separately
     #------------------------
     else:
         # a separate coefficient for each output (512 columns)
-        coef0 = np.zeros((2048,nreads),float)
-        coef1 = np.zeros((2048,nreads),float)
-        coef2 = np.zeros((2048,nreads),float)
-        corr = np.zeros((2048,nreads),float)
-        npar = szlin[1]
-        # loop over quadrants
+        #  expand to the columns and broadcast over the other dimensions
+        bshape = (2048,)+(1,)*(slc_in.ndim-1)
+        coef0 = np.repeat(lindata[:,0],512).reshape(bshape).astype(slc_in.dtype)
+        coef1 = np.repeat(lindata[:,1],512).reshape(bshape).astype(slc_in.dtype)
+        coef2 = np.repeat(lindata[:,2],512).reshape(bshape).astype(slc_in.dtype)
         slc_out = slc_in.copy()
-        for i in range(4):
-            corr[512*i:512*i+512,:] = lindata[i,0]
-            x = slc_in[512*i:512*i+512,:]
-            for j in range(npar-1):
-                corr[512*i:512*i+512,:] += lindata[i,j+1]*x
-                x *= slc_in[512*i:512*i+512,:]
-        slc_out = slc_in*corr
-        for i in range(4):
-            coef0[512*i:512*i+512,:] = lindata[i,0]
-            coef1[512*i:512*i+512,:] = lindata[i,1]
-            coef2[512*i:512*i+512,:] = lindata[i,2]
-        slc_out = coef0 + coef1*slc_in + coef2*slc_in**2
+        slc_out[0:2048] = coef0 + coef1*slc_in[0:2048] + coef2*slc_in[0:2048]**2
     
     return slc_out
 
@@ -115,28 +127,156 @@ def ap3dproc_lincorr(slc_in,lindata,linhead):
 def ap3dproc_darkcorr(slc_in,darkslc,darkhead):
     """
     This subroutine does the Dark correction for a slice
-    darkslc is a 2048xNreads array that gives the dark counts
+    darkslc is a 2048xNreads (or 2048xNrowsxNreads) array that
+    gives the dark counts
 
     To get the dark current just multiply the dark count rate
     by the time for each read
     """
 
-    nreads = slc_in.shape[1]
+    nreads = slc_in.shape[-1]
 
     # Just subtract the darkslc
-    # subtract each read at a time in case we still have the reference pixels
+    # only the first 2048 columns in case we still have the reference output
+    #  in the floating point type of the slice, as in ap3dproc_lindarkcorr()
     slc_out = slc_in.copy()
-    for i in range(nreads):
-        slc_out[0:2048,i] -= darkslc[:,i]
+    slc_out[0:2048,...] -= darkslc[...,0:nreads].astype(slc_in.dtype)
 
     return slc_out
 
 
-def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=False,noise=17.0,crfix=False):
+@njit
+def ap3dproc_lindarkkernel(slc,coef,dolin,dark,dodark):
+    """ Numba kernel for the linearity and dark correction of a block, done in place."""
+    nx,ny,nreads = slc.shape
+    nx = min(nx,2048)   # skip the reference output
+    ncy = coef.shape[1]
+    for i in range(nx):
+        for j in range(ny):
+            jc = j if ncy > 1 else 0
+            c0 = coef[i,jc,0]
+            c1 = coef[i,jc,1]
+            c2 = coef[i,jc,2]
+            for k in range(nreads):
+                x = slc[i,j,k]
+                if dolin:
+                    x = c0 + c1*x + c2*(x*x)
+                if dodark:
+                    x -= dark[i,j,k]
+                slc[i,j,k] = x
+
+
+def ap3dproc_lindarkcorr(slc,lindata=None,darkslc=None):
+    """
+    Linearity and dark correction of a slice or block in a single pass
+    over the data.  This gives the same result as ap3dproc_lincorr()
+    followed by ap3dproc_darkcorr() but it works in place and does not
+    create the coefficient and temporary arrays.  The coefficients and
+    dark counts are cast to the type of the slice, so a float32 slice
+    is corrected in float32 in both versions.
+
+    The flat field is not applied here, it is still divided into the
+    sampled 2D image because the CR and saturation detection need the
+    counts in ADU.
+
+    Parameters
+    ----------
+    slc : numpy array
+       The slice [Nx,Nreads] or block of rows [Nx,Nrows,Nreads].  It must
+         be a floating point array and is modified in place.
+    lindata : numpy array, optional
+       The linearity coefficients, either per pixel [Nx,3] or [Nx,Nrows,3]
+         or per output [4,3].
+    darkslc : numpy array, optional
+       The dark counts for the slice [Nx,Nreads] or [Nx,Nrows,Nreads].
+
+    Returns
+    -------
+    slc : numpy array
+       The corrected slice.
+
+    Example
+    -------
+
+    slc = ap3dproc_lindarkcorr(slc,lindata,darkslc)
+
+    """
+
+    slc3 = slc if slc.ndim==3 else slc[:,None,:]
+    nreads = slc3.shape[-1]
+
+    # Linearity coefficients, [2048,1,3] or [2048,Nrows,3]
+    if lindata is not None:
+        if lindata.shape[0]==2048:
+            coef = lindata if lindata.ndim==3 else lindata[:,None,:]
+        else:
+            coef = np.repeat(lindata,512,axis=0)[:,None,:]
+        coef = np.ascontiguousarray(coef,slc.dtype)
+    else:
+        coef = np.zeros((2048,1,3),slc.dtype)
+    # Dark counts
+    if darkslc is not None:
+        dark = darkslc if darkslc.ndim==3 else darkslc[:,None,:]
+        dark = np.ascontiguousarray(dark[...,0:nreads],slc.dtype)
+    else:
+        dark = np.zeros((1,1,1),slc.dtype)
+
+    ap3dproc_lindarkkernel(slc3,coef,lindata is not None,dark,darkslc is not None)
+
+    return slc
+
+
+def ap3dproc_nanmedian(data):
+    """
+    Median along the last axis (the reads) ignoring NaNs.
+
+    This gives the same result as np.nanmedian(data,axis=-1) but uses
+    a single sort of the whole array, which is much faster than the
+    masked array machinery nanmedian uses for short axes.
+    All-NaN pixels return NaN.
+    """
+
+    nreads = data.shape[-1]
+    # NaNs are sorted to the end
+    sdata = np.sort(data,axis=-1)
+    ngood = nreads-np.sum(np.isnan(data),axis=-1)
+    lo = np.maximum((ngood-1)//2,0)
+    hi = np.maximum(ngood//2,0)
+    med = 0.5*(np.take_along_axis(sdata,lo[...,None],axis=-1)[...,0] +
+               np.take_along_axis(sdata,hi[...,None],axis=-1)[...,0])
+    if np.ndim(med)==0:
+        if ngood==0:
+            med = np.nan
+    else:
+        med[ngood==0] = np.nan
+    return med
+
+
+def ap3dproc_medfilt(data,width):
+    """
+    Running median filter along the last axis (the reads) ignoring NaNs.
+    The data are padded with copies of the edge values so the output
+    has the same shape as the input.
+    """
+
+    nreads = data.shape[-1]
+    width = int(np.minimum(width,nreads))
+    if width < 2:
+        return data.copy()
+    pad = [(0,0)]*(data.ndim-1) + [(width//2,(width-1)//2)]
+    pdata = np.pad(data,pad,mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(pdata,width,axis=-1)
+    return ap3dproc_nanmedian(windows)
+
+
+def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=None,noise=17.0,crfix=False,
+                   verbose=False):
     """
     This subroutine fixes cosmic rays in a slice of the datacube.
     The last dimension in the slice should be the Nreads, i.e.
-    [Npix,Nreads].
+    [Npix,Nreads] for a single row or [Nx,Ny,Nreads] for a block
+    of rows or a whole plane.  All of the operations are done on
+    the whole array at once.
 
     Parameters:
     dCounts        The difference of neighboring pairs of reads.
@@ -160,17 +300,13 @@ def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=False,noise=17.0,cr
 
     """
 
-    npix,nreads = dCounts.shape
+    dCounts = np.asarray(dCounts)
+    if np.issubdtype(dCounts.dtype,np.floating)==False:
+        dCounts = dCounts.astype(float)
+    shape = dCounts.shape[:-1]
+    nreads = dCounts.shape[-1]
     # nreads is actually Nreads-1
 
-    # Initialize the CRSTR with 50 CRs, will trim later
-    #  don't know Y right now
-    dtype = np.dtype([('x',int),('y',int),('read',int),('counts',float),('nsigma',float),('globalsigma',float),
-                      ('fixed',bool),('localsigma',float),('fixerror',float),('neicheck',bool)])
-    crstr = np.zeros(100,dtype)
-    #crstr_data_def = {X:0L,Y:0L,READ:0L,COUNTS:0.0,NSIGMA:0.0,GLOBALSIGMA:0.0,FIXED:0,LOCALSIGMA:0.0,FIXERROR:0.0,NEICHECK:0}
-    #crstr = {NCR:0L,DATA:REPLICATE(crstr_data_def,50)}
-
     # Initializing dCounts_fixed
     dCounts_fixed = dCounts.copy()
 
@@ -178,28 +314,30 @@ def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=False,noise=17.0,cr
     #-----------------------------------
     # Get median dCounts for each pixel
     #-----------------------------------
-    med_dCounts = np.nanmedian(dCounts,axis=1)    # NAN are automatically ignored
+    med_dCounts = ap3dproc_nanmedian(dCounts)    # NAN are automatically ignored
 
     # Check if any medians are NAN
     #  would happen if all dCounts in a pixel are NAN
     med_dCounts[~np.isfinite(med_dCounts)] = 0.0    # set to zero
-    
+
     # Number of non-saturated, "good" reads
-    totgd = np.sum(np.isfinite(dCounts),axis=1)
+    totgd = np.sum(np.isfinite(dCounts),axis=-1)
 
     # If we only have 2 good Counts then we might need to use
     # the minimum dCounts in case there is a CR
-    ind2, = np.where(totgd == 2)
-    nind2 = len(ind2)
-    for j in range(nind2):
-        min_dCounts = np.min(dCounts[ind2[j],:],axis=1)
-        max_dCounts = np.max(dCounts[ind2[j],:],axis=1)
+    ind2 = (totgd == 2)
+    nind2 = np.sum(ind2)
+    if nind2 > 0:
+        min_dCounts = np.nanmin(dCounts[ind2],axis=-1)
+        max_dCounts = np.nanmax(dCounts[ind2],axis=-1)
         # If they are too different then use the lower value
         #  probably because of a CR
-        if (max_dCounts-min_dCounts)/np.maximum(min_dCounts,1e-4) > 0.3:
-            med_dCounts[ind2[j]] = np.maximum(min_dCounts,1e-4)
+        med_ind2 = med_dCounts[ind2]
+        usemin = (max_dCounts-min_dCounts)/np.maximum(min_dCounts,1e-4) > 0.3
+        med_ind2[usemin] = np.maximum(min_dCounts[usemin],1e-4)
+        med_dCounts[ind2] = med_ind2
 
-    med_dCounts2D = med_dCounts.repeat(nreads).reshape((npix,nreads))   # 2D version
+    med_dCounts2D = med_dCounts[...,None]   # broadcasts over the reads
 
 
     #-----------------------------------------------------
@@ -209,41 +347,36 @@ def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=False,noise=17.0,cr
 
     smbin = np.minimum(11, nreads)    # in case Nreads is small
     if nreads > smbin:
-        sm_dCounts = medfilt2d(dCounts,smbin,axis=2)
+        sm_dCounts = ap3dproc_medfilt(dCounts,smbin)
     else:
-        sm_dCounts = med_dCounts2D
+        sm_dCounts = np.broadcast_to(med_dCounts2D,dCounts.shape).copy()
 
     # We need to deal with reads near saturated reads carefully
     # otherwise the median will be over less reads
     # For now this is okay, at worst the median will be over smbin/2 reads
-        
+
     # If there are still some NAN then replace them with the global
     # median dCounts for that pixel.  These are probably saturated
     # so it probably doesn't matter
-    bdnan, = np.where(np.finite(sm_dCounts) == False)
-    nbdnan = len(bdnan)
-    if nbdnan>0:
-        sm_dCounts[bdnan] = med_dCounts2D[bdnan]
+    bdnan = ~np.isfinite(sm_dCounts)
+    if np.sum(bdnan)>0:
+        sm_dCounts[bdnan] = np.broadcast_to(med_dCounts2D,dCounts.shape)[bdnan]
 
     #--------------------------------------
     # Variability from median (fractional)
     #--------------------------------------
-    variability = dln.mad(dCounts-med_dCounts2D,axis=1,zero=True)
+    #  same as dln.mad(...,zero=True)
+    variability = 1.482602218505602*ap3dproc_nanmedian(np.abs(dCounts-med_dCounts2D))
     variability = variability / np.maximum(med_dCounts, 0.001)  # make it a fractional variability
-    bdvar, = np.where(np.finite(variability) == False)
-    nbdvar = len(bdar)
-    if nbdvar>0:
-        variability[bdvar] = 0.0  # all NAN
-    if nind2>0:
-        variability[ind2] = 0.5    # high variability for only 2 good dCounts
+    variability[~np.isfinite(variability)] = 0.0  # all NAN
+    variability[ind2] = 0.5    # high variability for only 2 good dCounts
 
     #----------------------------------
     # Get sigma dCounts for each pixel
     #----------------------------------
-    #sig_dCounts = mad(dCounts,dim=2)
     # subtract smoothed version to remove any transparency variations
     # saturated reads (NAN in dCounts) are automatically ignored
-    sig_dCounts = dln.mad(dCounts-sm_dCounts,axis=1,zero=True)
+    sig_dCounts = 1.482602218505602*ap3dproc_nanmedian(np.abs(dCounts-sm_dCounts))
     sig_dCounts = np.maximum(sig_dCounts, noise)   # needs to be at least above the noise
 
     # Check if any sigma are NAN
@@ -251,156 +384,1155 @@ def ap3dproc_crfix(dCounts,satmask,sigthresh=10,onlythisread=False,noise=17.0,cr
     sig_dCounts[~np.isfinite(sig_dCounts)] = noise   # set to noise level
 
     # Pixels with only 2 good dCounts, set sigma to 30%
-    for j in range(nind2):
-        sig_dCounts[ind2[j]] = np.maximum(0.3*med_dCounts[ind2[j]], noise)
+    sig_dCounts[ind2] = np.maximum(0.3*med_dCounts[ind2], noise)
+
+    sig_dCounts2D = sig_dCounts[...,None]   # broadcasts over the reads
 
-    sig_dCounts2D = sig_dCounts.repeat(nreads).reshape((npix,nreads))   # 2D version
-    
     #-----------
     # Find CRs
     #-----------
     # threshold for number of sigma above (local) median
-    nsig_thresh = np.maximum(nsig_thresh, 3)    # 3 at a minimum
+    nsig_thresh = np.maximum(sigthresh, 3)    # 3 at a minimum
 
     # Saturated dCounts (NANs) are automatically ignored
-    nsigma_slc = (dCounts-sm_dCounts)/sig_dCounts2D
-    bd1D, = np.where( ( nsigma_slc > nsig_thresh ) &
-                      ( dCounts > noise*nsig_thresh ))
-    nbd1D = len(bd1D)
-    
-    if verbose: print(str(nbd1D)+' CRs found')
-
-    ### DLN GOT TO HERE  8/6/2020
+    with np.errstate(invalid='ignore'):
+        nsigma_slc = (dCounts-sm_dCounts)/sig_dCounts2D
+        bd = ( nsigma_slc > nsig_thresh ) & ( dCounts > noise*nsig_thresh )
+
+    # ONLYTHISREAD
+    #  for checking neighboring pixels in the iterative part
+    #  onlythisread is the read index, while the CR index is a dCounts index
+    #  the dCounts index+1 is the read index for the CR
+    if onlythisread is not None:
+        readind = np.arange(nreads)+1
+        bd &= (np.abs(readind-np.asarray(onlythisread)[...,None]) <= 1)
+
+    nbd = np.sum(bd)
+    if verbose: print(str(nbd)+' CRs found')
+
+    # CR mask, number of CRs and read indices for each pixel
+    crnum = np.sum(bd,axis=-1)
+    mask = (crnum > 0).astype(int)
+    crindex = np.zeros(shape+(10,),int)-1
 
-    
     # Some CRs found
-    if nbd1D>0:
-        bd2D = array_indices(dCounts,bd1D)
-        bdx = bd2D[0,:]  # column
-        bdr = bd2D[1,:]  # read
-
-        # Correct the CRs and correct the pixels
-        for j in range(nbd1D):
-            ibdx = (bdx[j])[0]
-            ibdr = (bdr[j])[0]
-
-            dCounts_pixel = dCounts[ibdx,:]
-
-            # ONLYTHISREAD
-            #  for checking neighboring pixels in the iterative part
-            #--------------
-            if len(onlythisread) > 0:
-                # onlthisread is the read index, while ibdr is a dCounts index
-                # ibdr+1 is the read index for this CR
-                if (ibdr+1) < onlythisread[0]-1 or (ibdr+1) > onlythisread[0]+1:
-                    import pdb; pdb.set_trace()
-
-
-            # Calculate Local Median and Local Sigma
-            #----------------------------------------
-            #   Use a local median/sigma so the affected CR dCount is not included
-            # more than 2 good dCounts and Nreads>smbin
-            if (totgd[ibdx] > 2) and (nreads > smbin):
-                dCounts_pixel[ibdr] = np.nan  # don't use affected dCounts    
-    
-                maxind = nreads-1
-                if satmask[ibdx,0] == 1:
-                    maxind = satmask[ibdx,1]-2  # don't include saturated reads (NANs)
-                lor = np.maximum((ibdr-smbin/2),0)
-                hir = np.minumum( (lor + smbin-1), maxind )
-                if (hir == maxind):
-                    lor = np.maximum((hir-smbin+1),0)
-    
-                # -- Local median dCounts --
-                #  make sure the indices make sense
-                #if (lor < 0 or hir < 0 or hir <= lor) then import pdb; pdb.set_trace()
-                if (lor < 0 or hir < 0 or hir <= lor):
-                    local_med_dCounts = med_dCounts[ibdx]
-                else:
-                    local_med_dCounts = np.median(dCounts_pixel[lor:hir])
-    
-                # If local median dCounts is NAN use all reads
-                if np.isfinite(local_med_dCounts) == False:
-                    local_med_dCounts = med_dCounts[ibdx]
-                # If still NaN then set to 0.0
-                if np.isfinite(local_med_dCounts) == False:
-                    local_med_dCounts = 0.0
-    
-                # -- Local sigma dCounts --
-                local_sigma = dln.mad(dCounts_pixel[lor:hir]-local_med_dCounts,zero=True)
-    
-                # If local sigma dCounts is NAN use all reads
-                #   this should never actually happen
-                if np.isfinite(local_sigma) == False:
-                    local_sigma = sig_dCounts[ibdx]
-                # If still NaN then set to noise
-                if np.isfinite(local_sigma) == False:
-                    local_sigma = noise
-                
-            # Only 2 good dCounts OR Nreads<smbin
-            else:
-                local_med_dCounts = med_dCounts[ibdx]
-                local_sigma = sig_dCounts[ibdx]
-
-
-            local_med_dCounts = med_dCounts[ibdx]
-            local_sigma = sig_dCounts[ibdx]
-
-            # Fix the CR
-            #------------
-            if keyword_set(crfix):
-                if keyword_set(verbose):
-                    print(' Fixing CR at Column '+str(ibdx)+' Read '+str(ibdr+1))
-
-                # Replace with smoothed dCounts, i.e. median of neighbors
-                dCounts_fixed[ibdx,ibdr] = local_med_dCounts       # fix CR dCounts
-                #dCounts_fixed[ibdx,ibdr] = sm_dCounts[ibdx,ibdr]   # fix CR dCounts
-
-                # Error in the fix
-                #   by taking median of smbin neighboring reads we reduce the error by ~1/sqrt(smbin)
-                fixerror = local_sigma/sqrt(smbin-1)   # -1 because the CR read is in there
-
-
-            # CRSTR stuff
-            #--------------
-
-            # Expand CR slots in CRSTR
-            if crstr.ncr == len(crstr['data']):
-                old_crstr = crstr
-                nold = len(old_crstr['data'])
-                crstr = {'ncr':0,'data':np.repeat(crstr_data_def,nold+50)}
-                STRUCT_ASSIGN,old_crstr,crstr   # source, destination
-                old_crstr = None
-
-            # Add CR to CRSTR
-            crstr['data'][crstr.ncr].x = ibdx
-            crstr['data'][crstr.ncr].read = ibdr+1  # ibdr is dCounts index, +1 to get read
-            crstr['data'][crstr.ncr].counts = dCounts[ibdx,ibdr] - sm_dCounts[ibdx,ibdr]
-            crstr['data'][crstr.ncr].nsigma = nsigma_slc[ibdx,ibdr]
-            crstr['data'][crstr.ncr].globalsigma = sig_dCounts[ibdx]
-            if crfix:
-                crstr['data'][crstr.ncr].fixed = 1
-            crstr['data'][crstr.ncr].localsigma = local_sigma
-            if crfix:
-                crstr['data'][crstr.ncr].fixerror = fixerror
-            crstr.ncr += 1
+    if nbd > 0:
+        bdind = np.nonzero(bd)
+        bdr = bdind[-1]       # dCounts index
+        pixind = bdind[:-1]   # pixel indices
+        bdx = pixind[0]       # column
+        if len(pixind) > 1:
+            bdy = pixind[1]   # row
+            # Order the CRs by row, column and read
+            order = np.lexsort((bdr,bdx,bdy))
+            bdr,bdx,bdy = bdr[order],bdx[order],bdy[order]
+            pixind = (bdx,bdy)
+        else:
+            bdy = np.zeros(nbd,int)
+
+        # Read indices for each pixel, up to 10 CRs per pixel
+        crrank = (np.cumsum(bd,axis=-1)-1)[bd]
+        gdrank = (crrank < 10)
+        crindex[tuple(b[gdrank] for b in bdind[:-1])+(crrank[gdrank],)] = bdind[-1][gdrank]+1
+
+        # Use the global median dCounts and sigma of the pixel
+        local_med_dCounts = med_dCounts[pixind]
+        local_sigma = sig_dCounts[pixind]
+
+        # Fix the CRs
+        #------------
+        if crfix:
+            # Replace with median dCounts
+            dCounts_fixed[pixind+(bdr,)] = local_med_dCounts       # fix CR dCounts
+
+            # Error in the fix
+            #   by taking median of smbin neighboring reads we reduce the error by ~1/sqrt(smbin)
+            fixerror = local_sigma/np.sqrt(smbin-1)   # -1 because the CR read is in there
+
+        # CRSTR stuff
+        #--------------
+        dtype = np.dtype([('x',int),('y',int),('read',int),('counts',float),('nsigma',float),('globalsigma',float),
+                          ('fixed',bool),('localsigma',float),('fixerror',float),('neicheck',bool)])
+        data = np.zeros(nbd,dtype)
+        data['x'] = bdx
+        data['y'] = bdy
+        data['read'] = bdr+1  # bdr is dCounts index, +1 to get read
+        data['counts'] = dCounts[pixind+(bdr,)] - sm_dCounts[pixind+(bdr,)]
+        data['nsigma'] = nsigma_slc[pixind+(bdr,)]
+        data['globalsigma'] = sig_dCounts[pixind]
+        data['localsigma'] = local_sigma
+        if crfix:
+            data['fixed'] = True
+            data['fixerror'] = fixerror
+        crstr = {'ncr':nbd,'data':data}
+
+    else:
+        crstr = {'ncr':0}   # blank structure
 
     #  Replace the dCounts with CRs with the median smoothed values
     #    other methods could be used to "fix" the affected read,
     #    e.g. polynomial fitting/interpolation, Gaussian smoothing, etc.
 
-    # Now trim CRSTR
-    if crstr.ncr>0:
-        old_crstr = crstr
-        crstr = {'ncr':old_crstr.ncr,'data':old_crstr['data'][0:old_crstr['ncr']]}
-        old_crstr = None
+    return crstr, dCounts_fixed, med_dCounts, mask, crindex, crnum, variability
+
+
+def ap3dproc_block(slc,mask,bpmim=None,littrowim=None,persistim=None,lindata=None,
+                   linhead=None,darkslc=None,darkhead=None,saturation=65000,noise=17.0,
+                   nocr=False,crfix=True,satfix=True,rd3satfix=False,yoffset=0,dtype='float64',
+                   usenumba=False,timer=None,verbose=False):
+    """
+    Process a block of rows of the datacube.
+
+    This does the bad pixel/Littrow/persistence flagging, saturation
+    detection, linearity and dark correction, CR detection and fixing
+    and saturation fixing for all the pixels in the block at once.
+
+    Parameters
+    ----------
+    slc : numpy array
+       The block of the datacube [Nx,Nrows,Nreads].
+    mask : numpy array
+       The mask for the block [Nx,Nrows].
+    bpmim : numpy array, optional
+       The bad pixel mask for the block [2048,Nrows].
+    littrowim : numpy array, optional
+       The Littrow ghost mask for the block [2048,Nrows].
+    persistim : numpy array, optional
+       The persistence mask for the block [2048,Nrows].
+    lindata : numpy array, optional
+       The linearity coefficients, either [2048,Nrows,3] for each
+         pixel or [4,3] for each output.
+    linhead : header, optional
+       The linearity header.
+    darkslc : numpy array, optional
+       The dark counts for the block [2048,Nrows,Nreads].
+    darkhead : header, optional
+       The dark header.
+    saturation : float, optional
+       The saturation level.  Default is 65000.
+    noise : float, optional
+       The readnoise in ADU for dCounts.  Default is 17.0.
+    nocr : boolean, optional
+       Do not detect cosmic rays.  Default is False.
+    crfix : boolean, optional
+       Fix cosmic rays.  Default is True.
+    satfix : boolean, optional
+       Fix saturated pixels.  Default is True.
+    rd3satfix : boolean, optional
+       Fix saturated pixels for 3 reads.  Default is False.
+    yoffset : int, optional
+       The row index of the first row of the block.  Default is 0.
+    dtype : str, optional
+       The floating point type used for the processing, 'float64'
+         or 'float32'.  Default is 'float64'.
+    usenumba : boolean, optional
+       Use the fused numba kernel for the linearity and dark correction.
+         Default is False.
+    timer : StageTimer, optional
+       Timer to add the time of the linearity, dark, CR and saturation
+         stages to.
+    verbose : boolean, optional
+       Verbose output to the screen.  Default is False.
+
+    Returns
+    -------
+    slc_fixed : numpy array
+       The fixed block [Nx,Nrows,Nreads].
+    mask : numpy array
+       The updated mask [Nx,Nrows].
+    satmask : numpy array
+       The saturation mask [Nx,Nrows,3].
+    med_dCounts : numpy array
+       The median dCounts for each pixel [Nx,Nrows].
+    variability : numpy array
+       The fractional variability for each pixel [Nx,Nrows].
+    sat_extrap_error : numpy array
+       The saturation extrapolation error [Nx,Nrows].
+    crstr : dict
+       The cosmic ray structure for the block.
+
+    Example
+    -------
+
+    out = ap3dproc_block(cube[:,0:32,:].astype(float),mask[:,0:32])
+
+    """
+
+    slc = np.array(slc,dtype)  # working copy
+    nx,nrows,nreads = slc.shape
+    # the mask might not include the reference output columns
+    nmaskx = mask.shape[0]
+    mask0 = mask
+    mask = np.zeros((nx,nrows),int)
+    mask[0:nmaskx] = mask0
+    readind = np.arange(nreads)
+    if timer is None:
+        timer = timing.StageTimer('ap3dproc_block')
+
+    satmask = np.zeros((nx,nrows,3),int)       # 1st plane is 0/1 mask, 2nd plane is which read
+                                               #   it saturated on, 3rd plane is # of
+                                               #   saturated reads
+    variability = np.zeros((nx,nrows),dtype)   # fractional variability for each pixel
+    sat_extrap_error = np.zeros((nx,nrows),dtype)   # saturation extrapolation error
+
+    #---------------------------------
+    # Flag BAD pixels
+    #---------------------------------
+    if bpmim is not None:
+        bdpix = (bpmim > 0)
+        slc[0:2048][bdpix] = 0.0  # set them to zero
+        mask[0:2048][bdpix] |= bpmim[bdpix].astype(mask.dtype)
+
+    #---------------------------------
+    # Flag LITTROW ghost pixels, but don't change data values
+    #---------------------------------
+    if littrowim is not None:
+        mask[0:2048][littrowim == 1] |= maskval('LITTROW_GHOST')
+
+    #---------------------------------
+    # Flag persistence pixels, but don't change data values
+    #---------------------------------
+    if persistim is not None:
+        persistim = persistim.astype(int)
+        mask[0:2048][(persistim & 1) > 0] |= maskval('PERSIST_HIGH')
+        mask[0:2048][(persistim & 2) > 0] |= maskval('PERSIST_MED')
+        mask[0:2048][(persistim & 4) > 0] |= maskval('PERSIST_LOW')
+
+    #---------------------------------
+    # Detect and Flag Saturated reads
+    #---------------------------------
+    #  The saturated pixels are detected in the reference subtraction
+    #  step and fixed to 65535.
+    satslc = (slc > saturation)
+    satpix = np.any(satslc,axis=-1)
+    nbdsat = np.sum(satpix)
+    if nbdsat > 0:
+        # Figure out at which Read (NOT dCounts) each pixel saturated
+        minsatread = np.argmax(satslc,axis=-1)   # first saturated read
+        nsatreads = np.sum(satslc,axis=-1)       # number of sat reads
+
+        # Make sure that all subsequent reads to a saturated read are
+        # considered "bad" and set to NAN
+        slc[satpix[...,None] & (readind >= minsatread[...,None])] = np.nan
+
+        # Update satmask
+        satmask[...,0] = satpix                        # mask
+        satmask[...,1] = np.where(satpix,minsatread,0) # 1st saturated read, NOT dcounts
+        satmask[...,2] = nsatreads                     # # of saturated reads
+
+        # Update mask
+        mask[satpix] |= maskval('SATPIX')     # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
+
+    #----------------------
+    # Linearity correction
+    #----------------------
+    # This needs to be done BEFORE the pixels are "fixed" because
+    # it needs to operate on the ORIGINAL counts, not the corrected
+    # ones.
+    #-----------------
+    # Dark correction
+    #-----------------
+    # Each read will have a different amount of dark counts in it
+    if usenumba and (lindata is not None or darkslc is not None):
+        with timer.stage('lindark'):
+            slc = ap3dproc_lindarkcorr(slc,lindata,darkslc)
     else:
-        crstr = {'ncr':0}   # blank structure
+        if lindata is not None:
+            with timer.stage('lincorr'):
+                slc = ap3dproc_lincorr(slc,lindata,linhead)
+        if darkslc is not None:
+            with timer.stage('dark'):
+                slc = ap3dproc_darkcorr(slc,darkslc,darkhead)
+
+    #------------------------------------------------
+    # Find difference of neighboring reads, dCounts
+    #------------------------------------------------
+    #  a difference with 1 or 2 NaN will also be NAN
+    dCounts = slc[...,1:] - slc[...,:-1]
+
+    #----------------------------
+    # Detect and Fix cosmic rays
+    #----------------------------
+    if nocr==False and nreads>2:
+        with timer.stage('cr'):
+            out = ap3dproc_crfix(dCounts,satmask,noise=noise,crfix=crfix,verbose=verbose)
+        crstr, dCounts, med_dCounts, crmask, crindex, crnum, variability = out
+
+        # Some CRs detected, add to the mask and add the row offset
+        if crstr['ncr'] > 0:
+            crstr['data']['y'] += yoffset
+            mask[0:2048][crmask[0:2048]==1] |= maskval('CRPIX')
+
+    # Only 2 reads, CANNOT detect or fix CRs
+    else:
+        if nreads > 2:
+            med_dCounts = ap3dproc_nanmedian(dCounts)
+            med_dCounts[~np.isfinite(med_dCounts)] = 0.0
+        else:
+            med_dCounts = dCounts[...,0].copy()
+        crstr = {'ncr':0}
+
+    #----------------------
+    # Fix Saturated reads
+    #----------------------
+    #  do this after CR fixing, so we don't have to worry about CRs here
+    #  set their dCounts to med_dCounts
+    if nbdsat > 0:
+        with timer.stage('sat'):
+            # Have enough reads (>2) to fix pixels
+            if (nreads > 2):
 
+                # Total number of good dCounts for each pixel
+                totgd = np.sum(np.isfinite(dCounts),axis=-1)
 
-    return crstr, dCounts_fixed, med_dCounts, mask, crindex, crnum, variability
+                # Unfixable pixels
+                #------------------
+                #  Need 2 good dCounts to be able to "safely" fix a saturated pixel
+                thresh_dcounts = 2
+                if rd3satfix and nreads==3:
+                    thresh_dcounts = 1  # fixing 3 reads
+                unfixable = (totgd < thresh_dcounts)
+                if np.sum(unfixable) > 0:
+                    dCounts[unfixable,:] = 0.0
+                    mask[unfixable] |= maskval('UNFIXABLE')       # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
+
+                # Fixable Pixels
+                #-----------------
+                fixable = (totgd >= thresh_dcounts) & (satmask[...,0] == 1)
+                nfixable = np.sum(fixable)
+
+                # The saturated dCounts of all the fixable pixels
+                #   if the first read is saturated then we start with
+                #   the first dCounts
+                if nfixable > 0:
+                    lr = np.maximum(minsatread-1,0)
+                    fixreads = fixable[...,None] & (readind[:-1] >= lr[...,None])
+
+                    # "Fix" the saturated pixels
+                    #----------------------------
+                    if satfix:
+                        # Fix the pixels
+                        #   set dCounts to med_dCounts for that pixel
+                        dCounts[fixreads] = np.broadcast_to(med_dCounts[...,None],dCounts.shape)[fixreads]
+
+                        # Saturation extrapolation error
+                        var_dCounts = variability[fixable] * np.maximum(med_dCounts[fixable],0.0001)   # variability in dCounts
+                        sat_extrap_error[fixable] = var_dCounts * satmask[...,2][fixable]            # Sigma of extrapolated counts, multipy by Nextrap
+
+                    # Do NOT fix the saturated pixels
+                    #---------------------------------
+                    else:
+                        dCounts[fixreads] = 0.0    # set saturated dCounts to zero
+
+                # It might be better to use the last good value from sm_dCounts
+                # rather than the straight median of all reads
+
+            # Only 2 reads, can't fix anything
+            else:
+                mask[satpix] |= maskval('UNFIXABLE')     # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
+                dCounts[~np.isfinite(dCounts)] = 0.0     # set saturated reads to zero
+
+    #------------------------------------
+    # Reconstruct the SLICE from dCounts
+    #------------------------------------
+    slc0 = slc[...,0].copy()  # first read
+    slc0[~np.isfinite(slc0)] = 0.0   # NAN in first read, set to 0.0
+
+    unfmask = ((mask & maskval('UNFIXABLE')) == maskval('UNFIXABLE'))  # unfixable
+    slc0[unfmask] = 0.0                 # set unfixable pixels to zero
+
+    slc_fixed = np.repeat(slc0[...,None],nreads,axis=-1)
+    slc_fixed[...,1:] += np.cumsum(dCounts,axis=-1)
+
+    #------------------------------------
+    # Final median of each "fixed" pixel
+    #------------------------------------
+    if nreads > 2:
+        # Unfixable pixels are left at 0.0
+
+        # If NOT fixing saturated pixels, then we need to
+        # temporarily set saturated reads to NAN
+        #  Leave unfixable pixels at 0.0
+        temp_dCounts = dCounts
+        if satfix==False:
+            bdsat = (satmask[...,0] == 1) & (unfmask == False)
+            if np.sum(bdsat) > 0:
+                temp_dCounts = dCounts.copy()
+                temp_dCounts[bdsat[...,None] & (readind[1:] >= satmask[...,1][...,None])] = np.nan
+
+        med_dCounts = ap3dproc_nanmedian(temp_dCounts)    # NAN are automatically ignored
+        med_dCounts[~np.isfinite(med_dCounts)] = 0.0
+
+    # Only 2 reads
+    else:
+        med_dCounts = dCounts[...,0].copy()
+
+    if verbose:
+        print('Rows '+str(yoffset+1)+'-'+str(yoffset+nrows)+'  Nsat/NCR = '+
+              str(int(np.sum(satmask[...,0])))+'/'+str(int(crstr['ncr'])))
+
+    return slc_fixed, mask[0:nmaskx], satmask, med_dCounts, variability, sat_extrap_error, crstr
+
+
+def ap3dproc_readcube(ifile,maxread=None,reads=None,cubefile=None,silent=True):
+    """
+    Read a raw APOGEE datacube one read at a time.
+
+    Both the 3D datacube and the one-read-per-extension formats are
+    supported.  Each read is decoded on its own and copied into the
+    output cube so only one read is held in memory at a time.  If
+    cubefile is given the output cube is an np.memmap backed by that
+    file, so the full cube never needs to be held in memory.
+
+    Parameters
+    ----------
+    ifile : str
+       The filename of the raw datacube.
+    maxread : int, optional
+       The maximum number of reads to use.  Default is to use all reads.
+    reads : list, optional
+       Only read these reads (0-based, negative indices count from the
+         last read).  Default is to read all reads.
+    cubefile : str, optional
+       Filename of the memory-mapped file to use for the output cube.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is True.
+
+    Returns
+    -------
+    cube : numpy array
+       The datacube [Ny,Nx,Nreads] as a 32-bit integer array or memmap.
+    head : header
+       The primary header.
+
+    Example
+    -------
+
+    cube,head = ap3dproc_readcube('apR-a-12345678.fits')
+
+    """
+
+    # Use sections so the data are decoded (and scaled) one read at a time
+    #  and not cached in the HDU
+    hdu = fits.open(ifile)
+    head = hdu[0].header.copy()
+    # DATACUBE, [Nreads,Ny,Nx]
+    if head['NAXIS']==3:
+        readsec = [(hdu[0].section,k) for k in range(head['NAXIS3'])]
+        ny,nx = hdu[0].shape[1:]
+    # Extensions
+    #  the primary unit should be empty
+    else:
+        readsec = [(h.section,slice(None)) for h in hdu[1:]]
+        ny,nx = hdu[1].shape if len(hdu)>1 else (0,0)
+    nreads = len(readsec)
+
+    # Only 1 read
+    if nreads < 2:
+        hdu.close()
+        error = 'ONLY 1 read.  Need at least two'
+        raise ValueError(error)
+
+    # allow user to specify maximum number of reads to use (e.g., in the
+    #   case of calibration exposures that may be overexposed in some chip
+    if maxread:
+        if maxread < nreads:
+            nreads = maxread
+    readsec = readsec[0:nreads]
+    # Only some of the reads
+    if reads is not None:
+        readind = np.unique(np.atleast_1d(reads) % nreads)
+        readsec = [readsec[k] for k in readind]
+        nreads = len(readsec)
+
+    # Initializing the cube
+    #  long is big enough and takes up less memory than float
+    if cubefile is not None:
+        cube = np.memmap(cubefile,dtype=np.int32,mode='w+',shape=(ny,nx,nreads))
+    else:
+        cube = np.zeros((ny,nx,nreads),np.int32)
+
+    # Read in the reads one at a time
+    for k in range(nreads):
+        if silent==False:
+            print('Reading read '+str(k+1)+'/'+str(nreads))
+        section,index = readsec[k]
+        cube[:,:,k] = section[index]
+        # What do we do with the extension headers???
+        # We could make a header structure or array
+    del readsec
+    hdu.close()
+
+    return cube,head
+
+
+def ap3dproc_blocksize(nx,nreads,maxmem,nbuffers=20):
+    """
+    Number of rows per block that keeps the block processing within
+    a memory budget.
+
+    Parameters
+    ----------
+    nx : int
+       Number of columns in the datacube.
+    nreads : int
+       Number of reads in the datacube.
+    maxmem : float
+       The memory budget in GB.
+    nbuffers : int, optional
+       The number of float64 [Nx,Nrows,Nreads] sized temporary arrays
+         that ap3dproc_block uses at its peak.  Default is 20.
+
+    Returns
+    -------
+    blocksize : int
+       The number of rows per block, at least 1.
+
+    Example
+    -------
+
+    blocksize = ap3dproc_blocksize(2048,60,2.0)
+
+    """
+    rowbytes = nx*nreads*8*nbuffers
+    return int(np.maximum(maxmem*1e9 // rowbytes,1))
+
+
+def ap3dproc_blockcalib(calib,y0,y1,nreads):
+    """ Get the calibration data for a block of rows [y0:y1]."""
+    bcalib = {}
+    # No calibration data for the reference output
+    if y0 >= 2048:
+        return bcalib
+    for name in ['bpmim','littrowim','persistim']:
+        if calib.get(name) is not None:
+            bcalib[name] = calib[name][:,y0:y1]
+    lindata = calib.get('lindata')
+    if lindata is not None:
+        if lindata.ndim == 3:
+            bcalib['lindata'] = lindata[:,y0:y1,:]
+        else:
+            # One set of coefficients per output (512 columns each)
+            lin = lindata[np.arange(y0,y1)//512,:]
+            bcalib['lindata'] = np.broadcast_to(lin[np.newaxis,:,:],(2048,y1-y0,lin.shape[1]))
+    if calib.get('darkcube') is not None:
+        bcalib['darkslc'] = calib['darkcube'][:,y0:y1,0:nreads]
+        bcalib['darkhead'] = calib.get('darkhead')
+    return bcalib
+
+
+# Data shared with the ap3dproc_blocks worker processes
+_blockdata = {}
+
+def _ap3dproc_block_init(cubefile,shape,dtype,mask,calib,kwargs):
+    """ Initialize an ap3dproc_blocks worker process."""
+    _blockdata['cube'] = np.memmap(cubefile,dtype=dtype,mode='r+',shape=shape)
+    _blockdata['mask'] = mask
+    _blockdata['calib'] = calib
+    _blockdata['kwargs'] = kwargs
+
+def _ap3dproc_block_worker(yrange):
+    """ Process one block of rows in an ap3dproc_blocks worker process."""
+    y0,y1 = yrange
+    cube = _blockdata['cube']
+    nreads = cube.shape[2]
+    bcalib = ap3dproc_blockcalib(_blockdata['calib'],y0,y1,nreads)
+    out = ap3dproc_block(cube[:,y0:y1,:],_blockdata['mask'][:,y0:y1],yoffset=y0,
+                         **bcalib,**_blockdata['kwargs'])
+    # Put fixed block back into the shared cube
+    cube[:,y0:y1,:] = np.round( out[0] )        # round to closest integer, LONG type
+    cube.flush()
+    return out[1:]
+
+
+def ap3dproc_blocks(cube,mask,calib,blocksize=32,nworkers=1,tmpdir=None,silent=False,**kwargs):
+    """
+    Process the datacube in blocks of rows, optionally in parallel.
+
+    The cube is split into blocks of rows which are processed with
+    ap3dproc_block().  With nworkers>1 the cube is copied to a
+    memory-mapped file and the blocks are processed by a pool of
+    worker processes that write their fixed blocks directly into it.
+    The per-block outputs are merged in row order so the results are
+    the same for any number of workers.
+
+    Parameters
+    ----------
+    cube : numpy array
+       The datacube [Nx,Ny,Nreads].  This is updated in place with the
+         fixed values.
+    mask : numpy array
+       The mask [Nx,Ny].  If the cube also has the reference output
+         columns (Ny=2560) these are processed in their own blocks
+         without the calibration data and are not in the output mask.
+    calib : dict
+       The calibration data: bpmim, littrowim, persistim, lindata,
+         darkcube and darkhead.  Missing or None entries are not used.
+    blocksize : int, optional
+       The number of rows per block.  Default is 32.
+    nworkers : int, optional
+       The number of worker processes.  Default is 1.
+    tmpdir : str, optional
+       The directory for the temporary memory-mapped cube file when
+         nworkers>1.  Default is the system temporary directory.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+    **kwargs
+       Other keywords passed to ap3dproc_block(), e.g. saturation,
+         noise, nocr, crfix, satfix, rd3satfix and verbose.
+
+    Returns
+    -------
+    cube : numpy array
+       The fixed datacube [Nx,Ny,Nreads].
+    mask : numpy array
+       The updated mask.
+    satmask : numpy array
+       The saturation mask [Nx,Ny,3].
+    med_dCounts_im : numpy array
+       The median dCounts for each pixel [Nx,Ny].
+    variability_im : numpy array
+       The fractional variability for each pixel [Nx,Ny].
+    sat_extrap_error : numpy array
+       The saturation extrapolation error [Nx,Ny].
+    crstr : dict
+       The cosmic ray structure.
+
+    Example
+    -------
+
+    out = ap3dproc_blocks(cube,mask,{'darkcube':darkcube},nworkers=8)
+
+    """
+
+    nx,ny,nreads = cube.shape
+    # The reference output columns start a new block
+    nmy = mask.shape[1]
+    yranges = [(y0,np.minimum(y0+blocksize,nmy)) for y0 in range(0,nmy,blocksize)]
+    yranges += [(y0,np.minimum(y0+blocksize,ny)) for y0 in range(nmy,ny,blocksize)]
+    nworkers = int(np.maximum(np.minimum(nworkers,len(yranges)),1))
+    inmask = mask
+    if ny > nmy:
+        mask = np.zeros((nx,ny),inmask.dtype)
+        mask[:,0:nmy] = inmask
+
+    # Process the blocks serially
+    if nworkers == 1:
+        out = []
+        for y0,y1 in yranges:
+            if silent==False and not kwargs.get('verbose'):
+                if (y0 // 500) != (y1 // 500):
+                    print(str(y1)+'/'+str(ny))
+            bcalib = ap3dproc_blockcalib(calib,y0,y1,nreads)
+            bout = ap3dproc_block(cube[:,y0:y1,:],mask[:,y0:y1],yoffset=y0,**bcalib,**kwargs)
+            cube[:,y0:y1,:] = np.round( bout[0] )        # round to closest integer, LONG type
+            out.append(bout[1:])
+
+    # Process the blocks with a pool of workers
+    #  the timer can't be shared with the workers
+    else:
+        kwargs.pop('timer',None)
+        if silent==False:
+            print('Using '+str(nworkers)+' workers')
+        fd,cubefile = tempfile.mkstemp(prefix='ap3dcube',suffix='.dat',dir=tmpdir)
+        os.close(fd)
+        try:
+            mcube = np.memmap(cubefile,dtype=cube.dtype,mode='w+',shape=cube.shape)
+            mcube[...] = cube
+            mcube.flush()
+            pool = mp.Pool(nworkers,initializer=_ap3dproc_block_init,
+                           initargs=(cubefile,cube.shape,cube.dtype,mask,calib,kwargs))
+            out = pool.map_async(_ap3dproc_block_worker,yranges,chunksize=1).get()  # in row order
+            pool.close()
+            pool.join()
+            cube[...] = mcube
+            del mcube
+        finally:
+            if os.path.exists(cubefile): os.remove(cubefile)
+
+    # Merge the blocks, in row order
+    #-------------------------------
+    satmask = np.zeros((nx,ny,3),int)          # 1st plane is 0/1 mask, 2nd plane is which read
+                                               #   it saturated on, 3rd plane is # of
+                                               #   saturated reads
+    med_dCounts_im = np.zeros((nx,ny),float)   # the median dCounts for each pixel
+    variability_im = np.zeros((nx,ny),float)   # fractional variability for each pixel
+    sat_extrap_error = np.zeros((nx,ny),float) # saturation extrapolation error
+    crdata = []
+    for (y0,y1),bout in zip(yranges,out):
+        mask_slc,satmask_slc,med_dCounts_slc,variability_slc,sat_extrap_slc,crstr_slc = bout
+        mask[:,y0:y1] = mask_slc
+        satmask[:,y0:y1,:] = satmask_slc
+        med_dCounts_im[:,y0:y1] = med_dCounts_slc
+        variability_im[:,y0:y1] = variability_slc
+        sat_extrap_error[:,y0:y1] = sat_extrap_slc
+        if crstr_slc['ncr'] > 0:
+            crdata.append(crstr_slc['data'])
+    if ny > nmy:
+        inmask[...] = mask[:,0:nmy]
+        mask = inmask
+
+    # Combine the CRs from all of the blocks
+    if len(crdata) > 0:
+        crdata = np.hstack(crdata)
+        crstr = {'ncr':len(crdata),'data':crdata}
+    else:
+        crstr = {'ncr':0}
+
+    return cube, mask, satmask, med_dCounts_im, variability_im, sat_extrap_error, crstr
+
+
+def ap3dproc_criter(cube,mask,satmask,crstr,noise=17.0,crfix=True,sigthresh=6,maxiter=6,
+                    silent=False):
+    """
+    Iterative cosmic ray detection.  The neighbors of the CRs are checked
+    for CRs at the same read (+/-1 read) with a lower Nsigma threshold,
+    and the neighbors of any new CRs are checked in the next iteration
+    until no new CRs are found.
+
+    In each iteration the CRs that have not been checked yet are dilated
+    over the 3x3 neighboring pixels and all of the candidate neighbors are
+    run through ap3dproc_crfix() together.
+
+    Parameters
+    ----------
+    cube : numpy array
+       The fixed datacube [Nx,Ny,Nreads].  This is updated in place.
+    mask : numpy array
+       The mask [Nx,Ny].  This is updated in place.
+    satmask : numpy array
+       The saturation mask [Nx,Ny,3].
+    crstr : dict
+       The cosmic ray structure.
+    noise : float, optional
+       The readnoise in ADU for dCounts.  Default is 17.0.
+    crfix : boolean, optional
+       Fix the new CRs.  Default is True.
+    sigthresh : float, optional
+       The Nsigma threshold for the neighbors.  Default is 6.
+    maxiter : int, optional
+       The maximum number of iterations.  Default is 6.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+
+    Returns
+    -------
+    cube : numpy array
+       The fixed datacube.
+    mask : numpy array
+       The updated mask.
+    crstr : dict
+       The cosmic ray structure with the new CRs added.
+
+    Example
+    -------
+
+    cube,mask,crstr = ap3dproc_criter(cube,mask,satmask,crstr,noise=noise)
+
+    """
+
+    nx,ny,nreads = cube.shape
+    if crstr['ncr'] == 0 or nreads < 3:
+        return cube,mask,crstr
+
+    # The 8 neighbors
+    dx,dy = np.meshgrid(np.arange(-1,2),np.arange(-1,2),indexing='ij')
+    dx,dy = dx.ravel(),dy.ravel()
+    center = (dx==0) & (dy==0)
+    dx,dy = dx[~center],dy[~center]
+
+    crdata = crstr['data']
+    niter = 0
+    while niter < maxiter:
+        # CRs that are left to check
+        crtocheck, = np.where(crdata['neicheck'] == False)
+        ncrtocheck = len(crtocheck)
+        if ncrtocheck == 0:
+            break
+        crdata['neicheck'][crtocheck] = True
+
+        # Dilate the CRs to the neighboring pixels, at the same read
+        candx = (crdata['x'][crtocheck][:,None] + dx[None,:]).ravel()
+        candy = (crdata['y'][crtocheck][:,None] + dy[None,:]).ravel()
+        candr = np.repeat(crdata['read'][crtocheck],len(dx))
+        #  not in the reference output
+        gd = (candx >= 0) & (candx < nx) & (candy >= 0) & (candy < mask.shape[1])
+        candx,candy,candr = candx[gd],candy[gd],candr[gd]
+        # Unique pixel/read candidates
+        key = (candx*ny+candy)*nreads+candr
+        key,uind = np.unique(key,return_index=True)
+        candx,candy,candr = candx[uind],candy[uind],candr[uind]
+        # Skip neighbors that are saturated at this read
+        readsat = (satmask[candx,candy,0] == 1) & (satmask[candx,candy,1] <= candr)
+        candx,candy,candr = candx[~readsat],candy[~readsat],candr[~readsat]
+        ncand = len(candx)
+        if ncand == 0:
+            break
+
+        # Fake "slice" of the neighboring pixels
+        #  saturated reads are NaN again, the "fixed" values are still in the cube
+        nei_slc_orig = cube[candx,candy,:].astype(float)
+        nei_slc = nei_slc_orig.copy()
+        nei_satmask = satmask[candx,candy,:]
+        nei_slc[(nei_satmask[:,0:1] == 1) & (np.arange(nreads)[None,:] >= nei_satmask[:,1:2])] = np.nan
+        nei_dCounts = nei_slc[:,1:] - nei_slc[:,:-1]
+
+        # Detect CRs with the lower threshold
+        out = ap3dproc_crfix(nei_dCounts,nei_satmask,sigthresh=sigthresh,onlythisread=candr,
+                             noise=noise,crfix=crfix)
+        nei_crstr,nei_dCounts_fixed,med_nei_dCounts = out[0:3]
+        if nei_crstr['ncr'] == 0:
+            break
+
+        # Add the neighbor information
+        newdata = nei_crstr['data']
+        ind = newdata['x'].copy()         # index in the nei slice
+        newdata['x'] = candx[ind]         # actual column index
+        newdata['y'] = candy[ind]         # actual row index
+        # Remove CRs that are already known, or found more than once
+        newkey = (newdata['x']*ny+newdata['y'])*nreads+newdata['read']
+        oldkey = (crdata['x']*ny+crdata['y'])*nreads+crdata['read']
+        newkey,uind = np.unique(newkey,return_index=True)
+        keep = ~np.isin(newkey,oldkey)
+        newdata,ind = newdata[uind[keep]],ind[uind[keep]]
+        nnew = len(newdata)
+        if nnew == 0:
+            break
+
+        # Fix the CRs in the cube
+        #  start from the fixed dCounts in the cube, which still have the
+        #  extrapolated saturated reads, and replace the new CR dCounts
+        if crfix:
+            pix = newdata['x']*ny+newdata['y']
+            upix,pind = np.unique(pix,return_inverse=True)
+            ux,uy = upix//ny,upix % ny
+            slc = cube[ux,uy,:].astype(float)
+            dCounts = slc[:,1:] - slc[:,:-1]
+            dCounts[pind,newdata['read']-1] = med_nei_dCounts[ind]
+            slc_fixed = np.repeat(slc[:,0:1],nreads,axis=1)
+            slc_fixed[:,1:] += np.cumsum(dCounts,axis=1)
+            cube[ux,uy,:] = np.round( slc_fixed )      # round to integer
+        mask[newdata['x'],newdata['y']] |= maskval('CRPIX')
+
+        # Add to the total CRSTR
+        newdata['neicheck'] = False
+        crdata = np.hstack((crdata,newdata))
+        if silent==False:
+            print(str(nnew)+' new CRs found in iteration '+str(niter+1))
+        niter += 1
+
+    crstr = {'ncr':len(crdata),'data':crdata}
+
+    return cube,mask,crstr
+
+
+@njit
+def ap3dproc_utrsums(cube,gdreads,lastread):
+    """ Numba kernel for the up-the-ramp least squares sums of each pixel."""
+    ny,nx,nreads = cube.shape
+    nr = len(gdreads)
+    sumn = np.zeros((ny,nx),np.float64)
+    sumt = np.zeros((ny,nx),np.float64)
+    sums = np.zeros((ny,nx),np.float64)
+    sumts = np.zeros((ny,nx),np.float64)
+    sumt2 = np.zeros((ny,nx),np.float64)
+    for i in range(ny):
+        for j in range(nx):
+            for k in range(nr):
+                s = cube[i,j,gdreads[k]]
+                t = gdreads[k]
+                if t < lastread[i,j] and np.isfinite(s):
+                    sumn[i,j] += 1
+                    sumt[i,j] += t
+                    sums[i,j] += s
+                    sumts[i,j] += t*s
+                    sumt2[i,j] += t*t
+    return sumn,sumt,sums,sumts,sumt2
+
+
+def ap3dproc_sample(cube,gdreads,satmask=None,satfix=True,uptheramp=False,nfowler=10,
+                    noise=12.0,gainim=None,usenumba=False,dtype='float64'):
+    """
+    Collapse the datacube with up-the-ramp or Fowler sampling.
+
+    For up-the-ramp sampling a line is fit to the reads of each pixel
+    with least squares in a single pass over the cube.
+    If satfix is False, the saturated reads of each pixel are left
+    out of the fit.  Fowler sampling uses the mean of the first and
+    last nfowler good reads.
+
+    Parameters
+    ----------
+    cube : numpy array
+       The datacube [Ny,Nx,Nreads].
+    gdreads : numpy array
+       The indices of the good reads.
+    satmask : numpy array, optional
+       The saturation mask [Ny,Nx,3].  Only used for up-the-ramp
+         sampling when satfix is False.
+    satfix : boolean, optional
+       The saturated pixels were fixed.  Default is True.
+    uptheramp : boolean, optional
+       Use up-the-ramp sampling instead of Fowler.  Default is False.
+    nfowler : int, optional
+       The number of reads to use for Fowler sampling.  Default is 10.
+    noise : float, optional
+       The readnoise in ADU.  Default is 12.
+    gainim : numpy array, optional
+       The gain image [2048,2048] in electrons/ADU.  Default is 1.
+    usenumba : boolean, optional
+       Use the numba-compiled kernel for the up-the-ramp sums.  Default is False.
+    dtype : str, optional
+       The floating point type of the read planes.  The sums are
+         always accumulated in float64.  Default is 'float64'.
+
+    Returns
+    -------
+    im : numpy array
+       The collapsed image in ADU.
+    sample_var : numpy array
+       The variance (ADU^2) from the sampling, i.e. sample_noise^2,
+         for the first 2048 columns.  For up-the-ramp this includes
+         the Poisson noise.
+    nfowler_used : int
+       The number of Fowler reads used (0 for up-the-ramp).
+    slope : numpy array
+       The fitted count rate per read (up-the-ramp only, None for Fowler).
+    intercept : numpy array
+       The fitted zeropoint (up-the-ramp only, None for Fowler).
+
+    Example
+    -------
+
+    im,sample_var,nfowler_used,slope,intercept = ap3dproc_sample(cube,gdreads,uptheramp=True)
+
+    """
+
+    ny,nx,nreads = cube.shape
+    gdreads = np.atleast_1d(gdreads)
+    ngdreads = len(gdreads)
+
+    # Fowler Sampling
+    #------------------
+    if not uptheramp:
+        # Make sure that Nfowler isn't too large
+        nfowler_used = int(np.minimum(nfowler,ngdreads//2))
+
+        # Use the mean of Nfowler reads
+        gd_beg = gdreads[0:nfowler_used]                 # beginning sample
+        gd_end = gdreads[ngdreads-nfowler_used:ngdreads] # end sample
+        im_beg = np.mean(cube[:,:,gd_beg],axis=2,dtype=np.float64)
+        im_end = np.mean(cube[:,:,gd_end],axis=2,dtype=np.float64)
+
+        # Subtract beginning from end
+        im = im_end - im_beg
+
+        # Noise contribution to the variance
+        sample_noise = noise * np.sqrt(2.0/nfowler_used)
+        sample_var = np.zeros((ny,np.minimum(nx,2048)),float)+sample_noise**2
+        return im, sample_var, nfowler_used, None, None
+
+    # Up-the-ramp sampling
+    #---------------------
+    # Fit a line to the reads for each pixel
+    #   dCounts are noisier than the actual reads by sqrt(2)
+    #   See Rauscher et al.(2007) Eqns.3
+    # Calculating the slope for each pixel
+    #  t is the exptime, s is the signal
+    #  we will use the read index for t
+    tread = gdreads.astype(float)
+    # Reads at or after this read are not used for each pixel
+    lastread = np.zeros((ny,nx),float)+nreads
+    if satfix==False and satmask is not None:
+        satpix = (satmask[:,:,0] == 1)
+        lastread[satpix] = satmask[:,:,1][satpix]
+
+    if usenumba:
+        sumn,sumt,sums,sumts,sumt2 = ap3dproc_utrsums(cube,gdreads,lastread)
+    else:
+        sumn = np.zeros((ny,nx),float)   # number of reads used
+        sumt = np.zeros((ny,nx),float)   # SUM t
+        sums = np.zeros((ny,nx),float)   # SUM s
+        sumts = np.zeros((ny,nx),float)  # SUM t*s
+        sumt2 = np.zeros((ny,nx),float)  # SUM t^2
+        for k in range(ngdreads):
+            s = cube[:,:,gdreads[k]].astype(dtype)
+            use = (tread[k] < lastread) & np.isfinite(s)
+            s[~use] = 0.0
+            sumn += use
+            sumt += use*tread[k]
+            sums += s
+            sumts += tread[k]*s
+            sumt2 += use*tread[k]**2
+
+    # The slope in Counts per read, similar to med_dCounts_im
+    with np.errstate(invalid='ignore',divide='ignore'):
+        slope = (sumn*sumts - sumt*sums)/(sumn*sumt2 - sumt**2)
+        intercept = (sums - slope*sumt)/sumn
+    slope[~np.isfinite(slope)] = 0.0
+    intercept[~np.isfinite(intercept)] = 0.0
+    # To get the total counts just multiply by nread
+    im = slope * (ngdreads-1)
+    # the first read doesn't really add any signal, just a zero-point
+
+    # See Equation 1 in Rauscher et al.(2007), SPIE
+    #  with m=1
+    #  noise and image/flux should be in electrons, sample_noise is in electrons
+    #  the reference output columns are not included
+    if gainim is None:
+        gainim = np.ones((ny,np.minimum(nx,2048)),float)
+    ngd = np.maximum(sumn[:,0:2048],2)   # number of reads used for each pixel
+    sample_var = ( 12*(ngd-1.)/(nreads*(ngd+1.))*noise**2 +
+                   6.*(ngd**2+1)/(5.*ngd*(ngd+1))*np.maximum(im[:,0:2048]*gainim,0) )
+    sample_var /= gainim**2   # convert to ADU
+
+    return im, sample_var, 0, slope, intercept
+
+
+#------------------------------
+# Calibration product caching
+#------------------------------
+#  The calibration loaders below (loaddetector, loadbpm, etc.) are cached
+#  in a process-level LRU cache keyed on (loader, path, mtime, size) so the
+#  same calibration files are not re-read for every exposure.  With a
+#  shared directory (e.g. /dev/shm/apcalcache) the arrays are also written
+#  there as .npy files and memory-mapped, so all of the processes on a
+#  node share one copy.
+
+calcache_settings = {'enabled':True, 'maxmem':4.0, 'shareddir':None}
+_calcache = OrderedDict()
+
+def calcache_setup(enabled=None,maxmem=None,shareddir=None):
+    """
+    Configure the calibration cache.
+
+    Parameters
+    ----------
+    enabled : boolean, optional
+       Turn the cache on or off.
+    maxmem : float, optional
+       Maximum memory (GB) of the arrays held in the cache.  Default is 4.
+    shareddir : str, optional
+       Directory for the shared memory-mapped copies of the arrays,
+         e.g. '/dev/shm/apcalcache'.  Set to '' to turn off sharing.
+
+    Example
+    -------
+
+    calcache_setup(maxmem=8,shareddir='/dev/shm/apcalcache')
+
+    """
+    if enabled is not None:
+        calcache_settings['enabled'] = enabled
+    if maxmem is not None:
+        calcache_settings['maxmem'] = maxmem
+    if shareddir is not None:
+        calcache_settings['shareddir'] = shareddir if shareddir != '' else None
+    if calcache_settings['enabled']==False:
+        calcache_clear()
+    else:
+        calcache_trim()
+
+def calcache_clear():
+    """ Empty the calibration cache."""
+    _calcache.clear()
+
+def calcache_nbytes(out):
+    """ Memory used by the arrays of a cached output, memory-mapped arrays are free."""
+    return np.sum([o.nbytes for o in out if isinstance(o,np.ndarray) and not isinstance(o,np.memmap)])
+
+def calcache_trim(extra=0):
+    """ Remove least recently used items until the cache is under the memory cap."""
+    maxbytes = calcache_settings['maxmem']*1e9
+    total = np.sum([calcache_nbytes(v) for v in _calcache.values()])
+    while len(_calcache)>0 and total+extra > maxbytes:
+        key,val = _calcache.popitem(last=False)
+        total -= calcache_nbytes(val)
+
+def calcache_sharedfiles(key):
+    """ Filenames of the shared copy of a cached output."""
+    tag = hashlib.md5(repr(key).encode()).hexdigest()
+    return os.path.join(calcache_settings['shareddir'],key[0]+'-'+tag)
+
+def calcache_loadshared(key):
+    """ Load a cached output from the shared directory, memory-mapped."""
+    base = calcache_sharedfiles(key)
+    if os.path.exists(base+'.done')==False:
+        return None
+    with open(base+'.done','r') as f:
+        types = f.read().split()
+    out = []
+    for i,t in enumerate(types):
+        if t=='array':
+            out.append(np.load(base+'-'+str(i)+'.npy',mmap_mode='r'))
+        elif t=='header':
+            with open(base+'-'+str(i)+'.hdr','r') as f:
+                out.append(fits.Header.fromstring(f.read()))
+        else:
+            out.append(None)
+    return tuple(out)
+
+def calcache_saveshared(key,out):
+    """ Write a loader output to the shared directory and return the memory-mapped version."""
+    base = calcache_sharedfiles(key)
+    if os.path.exists(os.path.dirname(base))==False:
+        os.makedirs(os.path.dirname(base),exist_ok=True)
+    types = []
+    for i,o in enumerate(out):
+        if isinstance(o,np.ndarray):
+            # write to a temporary name and rename so other processes never see partial files
+            tfile = base+'-'+str(i)+'.'+str(os.getpid())+'.npy'
+            np.save(tfile,o)
+            os.replace(tfile,base+'-'+str(i)+'.npy')
+            types.append('array')
+        elif isinstance(o,fits.Header):
+            with open(base+'-'+str(i)+'.hdr','w') as f:
+                f.write(o.tostring())
+            types.append('header')
+        else:
+            types.append('none')
+    tfile = base+'.done.'+str(os.getpid())
+    with open(tfile,'w') as f:
+        f.write(' '.join(types))
+    os.replace(tfile,base+'.done')
+    return calcache_loadshared(key)
+
+def calcached(func):
+    """
+    Decorator that caches the output of a calibration loading function
+    in the process-level LRU cache.  The cached arrays are read-only.
+    """
+    @functools.wraps(func)
+    def wrapper(filename,*args,**kwargs):
+        if calcache_settings['enabled']==False or type(filename) is not str or os.path.exists(filename)==False:
+            return func(filename,*args,**kwargs)
+        st = os.stat(filename)
+        key = (func.__name__,os.path.abspath(filename),st.st_mtime_ns,st.st_size)
+        # Already in the cache
+        if key in _calcache:
+            _calcache.move_to_end(key)
+            return _calcache[key]
+        out = None
+        if calcache_settings['shareddir'] is not None:
+            out = calcache_loadshared(key)
+        if out is None:
+            out = func(filename,*args,**kwargs)
+            if calcache_settings['shareddir'] is not None:
+                out = calcache_saveshared(key,out)
+        # Make the arrays read-only so the cached copies can't be modified
+        for o in out:
+            if isinstance(o,np.ndarray):
+                o.flags.writeable = False
+        # Add to the cache, if it fits
+        nbytes = calcache_nbytes(out)
+        if nbytes <= calcache_settings['maxmem']*1e9:
+            calcache_trim(nbytes)
+            _calcache[key] = out
+        return out
+    return wrapper
 
 
+@calcached
 def loaddetector(detcorr,silent=True):
     """ Load DETECTOR FILE (with gain, rdnoise and linearity correction). """
     
@@ -425,7 +1557,7 @@ def loaddetector(detcorr,silent=True):
     # Check that the file looks reasonable
     # Must be 2048x2048 or 4 and have be float
     if ((gainim.ndim==2) & (gainim.shape != (2048,2048))) | ((gainim.ndim==1) & (gainim.size != 4)) | \
-        (isinstance(gainim[0], (np.floating, float))==False):
+        (np.issubdtype(gainim.dtype,np.floating)==False):
         raise ValueError('GAIN image must be 2048x2048 or 4 FLOAT image')
   
     # If Gain is 4-element then make it an array
@@ -437,7 +1569,7 @@ def loaddetector(detcorr,silent=True):
   
     # Must be 2048x2048 or 4 and have be float
     if ((rdnoiseim.ndim==2) & (rdnoiseim.shape != (2048,2048))) | ((rdnoiseim.ndim==1) & (rdnoiseim.size != 4)) | \
-        (isinstance(rdnoiseim[0], (np.floating, float))==False):
+        (np.issubdtype(rdnoiseim.dtype,np.floating)==False):
         raise ValueError('RDNOISE image must be 2048x2048 or 4 FLOAT image')
   
     # If rdnoise is 4-element then make it an array
@@ -447,25 +1579,28 @@ def loaddetector(detcorr,silent=True):
         for k in range(4):
             rdnoiseim[:,k*512:(k+1)*512] = rdnoiseim0[k]
         
-                
-        # Check that the file looks reasonable
-        #  This should be 2048x2048x3 (each pixel) or 4x3 (each output),
-        #  where the 3 is for a quadratic polynomial
-        
-        szlin = lindata.shape
-        linokay = 0
-        if (lindata.ndim == 2 and szlin[0] == 3 and szlin[1] == 4):
-            linokay = 1
-            lindata = lindata.T  # flip
-        if (lindata.ndim == 3 and szlin[0] == 2048 and szlin[1] == 2048 and szlin[2] == 3):
-            linokay = 1
-        if linokay==0:
-            raise ValueError('Linearity correction data must be 2048x2048x3 or 4x3')
+    # Check that the file looks reasonable
+    #  This should be 2048x2048x3 (each pixel) or 4x3 (each output),
+    #  where the 3 is for a quadratic polynomial
+    #  FITS gives [3,2048,2048] and [3,4]
+    szlin = lindata.shape
+    linokay = 0
+    if (lindata.ndim == 2 and szlin[0] == 3 and szlin[1] == 4):
+        linokay = 1
+        lindata = lindata.T  # flip
+    if (lindata.ndim == 3 and szlin[0] == 3 and szlin[1] == 2048 and szlin[2] == 2048):
+        linokay = 1
+        lindata = np.moveaxis(lindata,0,2)   # [3,Ny,Nx] -> [Ny,Nx,3]
+    if (lindata.ndim == 3 and szlin[0] == 2048 and szlin[1] == 2048 and szlin[2] == 3):
+        linokay = 1
+    if linokay==0:
+        raise ValueError('Linearity correction data must be 2048x2048x3 or 4x3')
 
 
     return rdnoiseim,gainim,lindata
   
 
+@calcached
 def loadbpm(bpmcorr,silent=True):
     """ Load BAD PIXEL MASK (BPM) File """
 
@@ -492,13 +1627,12 @@ def loadbpm(bpmcorr,silent=True):
     return bpmim,bpmhead
 
 
+@calcached
 def loadlittrow(littrowcorr,silent=True):
     """ Load LITRROW MASK File """
 
-    import pdb; pdb.set_trace()
-
     # LITTROWCORR must be scalar string
-    if type(littrowcorr) is not str or np.array(littrowcorr).shape != 1:
+    if type(littrowcorr) is not str or dln.size(littrowcorr) != 1:
         error = 'LITTROWCORR must be a scalar string with the filename of the LITTROW MASK file'
         raise ValueError(error)
   
@@ -516,17 +1650,15 @@ def loadlittrow(littrowcorr,silent=True):
   
     # Check that the file looks reasonable
     #  must be 2048x2048 and have 0/1 values
-    nyl,nxl = littrowim.shape
-    littrowokay = 0
-    dum, = np.where((littrowim != 0) and( littrowim != 1))
-    nbad = len(dum)
-    if littrowim.ndim != 2 or nxl != 2048 or nyl != 2048 or nbad > 0:
+    nbad = np.sum((littrowim != 0) & (littrowim != 1))
+    if littrowim.ndim != 2 or littrowim.shape != (2048,2048) or nbad > 0:
         error = 'LITTROW MASK must be 2048x2048 with 0/1 values'
         raise ValueError(error)
 
     return littrowim,littrowhead
 
 
+@calcached
 def loadpersist(persistcorr,silent=True):
     """ Load PERSISTENCE MASK File """
   
@@ -558,6 +1690,7 @@ def loadpersist(persistcorr,silent=True):
     return persistim,persisthead
 
 
+@calcached
 def loaddark(darkcorr,silent=True):  
     """ Load DARK CORRECTION file """
 
@@ -593,7 +1726,7 @@ def loaddark(darkcorr,silent=True):
     # Datacube
     if darkhead1['NAXIS'] == 3:
         darkcube = fits.getdata(darkcorr)
-        darkcube = np.swapaxes(darkcube,2,0)  # [nreads,ny,nx] -> [ny,nx,nreads]
+        darkcube = np.transpose(darkcube,(1,2,0))  # [nreads,ny,nx] -> [ny,nx,nreads]
     # Extensions
     else:
         # Initializing the cube
@@ -603,8 +1736,8 @@ def loaddark(darkcorr,silent=True):
   
         # Read in the extensions
         hdu = fits.open(darkcorr)
-        for k in np.arange(1,nreads_dark):
-            darkcube[:,:,k-1] = hdu[k].data
+        for k in range(nreads_dark):
+            darkcube[:,:,k] = hdu[k+1].data
         hdu.close()
 
     if silent==False:
@@ -612,43 +1745,262 @@ def loaddark(darkcorr,silent=True):
   
     # Check that the file looks reasonable
     szdark = darkcube.shape
-    if (darkcube.ndim != 3 or szdark[0] < 2048 or szdark[1] != 2048):
+    if (darkcube.ndim != 3 or szdark[0] != 2048 or szdark[1] != 2048):
         error = 'Dark correction data must a 2048x2048xNreads datacube of the dark counts per pixel'
         raise ValueError(error)
     
     return darkcube,darkhead1
 
 
-def loadflat(flatcorr,silent=True):
-    """ Load FLAT FIELD CORRECTION file """
-  
-    # FLATCORR must be scalar string
-    if type(flatcorr) != str or dln.size(flatcorr) != 1:    
-        error = 'FLATCORR must be a scalar string with the filename of the flat correction file'
-        raise ValueError(error)
-  
-    # Check that the file exists
-    if os.path.exists(flatcorr)==False:
-        error = 'FLATCORR file '+flatcorr+' NOT FOUND'
-        raise ValueError(error)
-    
-    # Load the flat correction file
-    #  This needs to be 2048x2048
-    flatim,flathead = fits.getdata(flatcorr,header=True)
-  
+@calcached
+def loadflat(flatcorr,silent=True):
+    """ Load FLAT FIELD CORRECTION file """
+  
+    # FLATCORR must be scalar string
+    if type(flatcorr) != str or dln.size(flatcorr) != 1:    
+        error = 'FLATCORR must be a scalar string with the filename of the flat correction file'
+        raise ValueError(error)
+  
+    # Check that the file exists
+    if os.path.exists(flatcorr)==False:
+        error = 'FLATCORR file '+flatcorr+' NOT FOUND'
+        raise ValueError(error)
+    
+    # Load the flat correction file
+    #  This needs to be 2048x2048
+    flatim,flathead = fits.getdata(flatcorr,header=True)
+  
+    if silent==False:
+        print('Flat Field Correction file = '+flatcorr)
+  
+    # Check that the file looks reasonable
+    szflat = flatim.shape
+    if (flatim.ndim != 2 or szflat[0] != 2048 or szflat[1] != 2048):
+        error = 'Flat Field correction image must a 2048x2048 image'
+        raise ValueError(error)
+
+    return flatim,flathead
+
+
+@calcached
+def loadpersistmodel(persistmodelcorr,silent=True):
+    """ Load PERSISTENCE MODEL coefficients file """
+
+    # PERSISTMODELCORR must be scalar string
+    if type(persistmodelcorr) != str or dln.size(persistmodelcorr) != 1:
+        error = 'PERSISTMODELCORR must be a scalar string with the filename of the PERSIST MODEL file'
+        raise ValueError(error)
+
+    # Check that the file exists
+    if os.path.exists(persistmodelcorr)==False:
+        error = 'PERSISTMODELCORR file '+persistmodelcorr+' NOT FOUND'
+        raise ValueError(error)
+
+    # Load the coefficient images
+    #  HDU0 is the mask, HDU1-14 are the coefficients of the
+    #  five terms, see appersist_coeffs()
+    cc = np.zeros((15,2048,2048),float)
+    with fits.open(persistmodelcorr) as hdu:
+        if len(hdu) < 15:
+            error = 'PERSISTMODELCORR file '+persistmodelcorr+' must have 15 extensions'
+            raise ValueError(error)
+        for i in range(15):
+            cc[i] = hdu[i].data[0:2048,0:2048]
+    persistmodelhead = fits.getheader(persistmodelcorr,0)
+
+    if silent==False:
+        print('PERSIST MODEL file = '+persistmodelcorr)
+
+    return cc,persistmodelhead
+
+
+def appersist_coeffs(cc,flux,domask=True):
+    """
+    Calculate the persistence coefficients for the stimulus flux images.
+
+    Parameters
+    ----------
+    cc : numpy array
+       The persistence model coefficient images [15,2048,2048] from
+         loadpersistmodel().
+    flux : numpy array
+       The stimulus flux (CDS) images [Nstim,2048,2048] or [2048,2048].
+    domask : boolean, optional
+       Multiply the coefficients by the model mask.  Default is True.
+
+    Returns
+    -------
+    coeffs : numpy array
+       The five coefficients [5,Nstim,2048,2048] for each pixel.
+
+    """
+    flux = np.maximum(flux,0.0)
+    # Each coefficient is a + b*exp(c*flux)*flux^d, the 3rd and 5th are constants
+    coeffs = np.zeros((5,)+flux.shape,float)
+    coeffs[0] = cc[1] + cc[2]*np.exp(cc[3]*flux)*flux**cc[4]
+    coeffs[1] = cc[5] + cc[6]*np.exp(cc[7]*flux)*flux**cc[8]
+    coeffs[2] = cc[9]
+    coeffs[3] = cc[10] + cc[11]*np.exp(cc[12]*flux)*flux**cc[13]
+    coeffs[4] = cc[14]
+    if domask:
+        coeffs *= cc[0]
+    return coeffs
+
+
+def appersist_calc(coeffs,tstart,tend):
+    """
+    Calculate the persistence flux integrated between two times
+    (seconds since the end of the stimulus exposure).  The times are
+    scalars or arrays that broadcast against the stimulus axis, so all
+    stimuli are done at once.
+
+    The persistence flux per read is c0 + c1*exp(c2*reads) + c3*exp(c4*reads)
+    with reads = time/10.6, and we return flux(tend)-flux(tstart).
+    """
+    rstart = np.asarray(tstart,float)/10.6
+    rend = np.asarray(tend,float)/10.6
+    # the constant term cancels
+    with np.errstate(over='ignore',invalid='ignore'):
+        pers = coeffs[1]*(np.exp(coeffs[2]*rend)-np.exp(coeffs[2]*rstart)) + \
+               coeffs[3]*(np.exp(coeffs[4]*rend)-np.exp(coeffs[4]*rstart))
+    return pers
+
+
+def appersistmodel(ifile,histfile,persistmodelfile,bpmfile=None,correction=False,silent=False):
+    """
+    Create the persistence model for an exposure using the previous
+    exposures of the night in the apHist file (see mjdcube) and the
+    persistence model coefficients.
+
+    The stimuli are the last OBJECT exposure (of a different plate) and
+    the last DOMEFLAT in the 3 hours before the exposure.  The
+    coefficients and persistence of all stimuli are computed together
+    as one array expression over [Nstim,2048,2048].  With correction=True
+    the scaling factors of the stimuli are fit using a DARK exposure taken
+    after the stimuli.
+
+    Parameters
+    ----------
+    ifile : str
+       The filename of the exposure, e.g. apR-c-28200020.apz.
+    histfile : str
+       The apHist file for the night.
+    persistmodelfile : str
+       The persistence model coefficients file.
+    bpmfile : str, optional
+       The bad pixel mask file, only used for correction.
+    correction : boolean, optional
+       Fit the scaling factors using a prior dark.  Default is False.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+
+    Returns
+    -------
+    pmodelim : numpy array
+       The persistence model image [2048,2048] in ADU.  This is an
+         empty list if there are no prior stimulus exposures.
+    par : numpy array
+       The scaling factors for the OBJECT and DOMEFLAT persistence and
+         the constant offset.
+
+    Example
+    -------
+
+    pmodelim,ppar = appersistmodel(ifile,histfile,persistmodelfile)
+
+    """
+
+    par = np.array([1.0,1.0,0.0])
+
+    # Target exposure number
+    target_expnum = int(os.path.basename(ifile).split('-')[-1].split('.')[0])
     if silent==False:
-        print('Flat Field Correction file = '+flatcorr)
-  
-    # Check that the file looks reasonable
-    szflat = flatim.shape
-    if (flatim.ndim != 2 or szflat[0] != 2048 or szflat[1] != 2048):
-        error = 'Flat Field correction image must a 2048x2048 image'
-        raise ValueError(error)
+        print('Creating persistence correction model for '+str(target_expnum))
+
+    # Exposures in the history file
+    tab = mjdcube.histindex(histfile)
+    ind, = np.where(tab['expnum']==target_expnum)
+    if len(ind)==0:
+        print(str(target_expnum)+' NOT FOUND in '+histfile)
+        return [],par
+    ind = ind[0]
+    # seconds from the start of the first exposure
+    expstart = (tab['jd']-np.nanmin(tab['jd']))*24*3600
+    expend = expstart+tab['exptime']
+    djd = tab['jd']-tab['jd'][ind]
+    recent = (djd < 0) & (djd > -3.0/24.0)
+
+    # Stimulus exposures, the last OBJECT (of a different plate) and DOMEFLAT
+    stim = []
+    parind = []
+    objind, = np.where(recent & (tab['exptype']=='OBJECT') & (tab['plateid']!=tab['plateid'][ind]))
+    if len(objind)>0:
+        stim.append(objind[-1])
+        parind.append(0)
+    domeind, = np.where(recent & (tab['exptype']=='DOMEFLAT'))
+    if len(domeind)>0:
+        stim.append(domeind[-1])
+        parind.append(1)
+    if len(stim)==0:
+        if silent==False:
+            print('No prior OBJECT or DOMEFLAT exposure.  Not producing a persistence correction model.')
+        return [],par
+    stim = np.array(stim)
+    if silent==False:
+        for s in stim:
+            print('Using '+tab['exptype'][s]+' '+str(tab['expnum'][s]))
+
+    # Prior dark to fit the scaling factors with
+    d = None
+    if correction:
+        darkind, = np.where(recent & (tab['exptype']=='DARK') & (expstart > np.min(expstart[stim])))
+        if len(darkind)>0:
+            d = darkind[-1]
+
+    # Only load the CDS images that we need
+    rows = list(stim) + ([d] if d is not None else [])
+    tab,ims = mjdcube.loadhist(histfile,rows=rows)
+    hist = dict(zip(rows,ims))
+
+    # Coefficients for all of the stimuli at once
+    cc,cchead = loadpersistmodel(persistmodelfile)
+    flux = np.array([hist[s][0:2048,0:2048] for s in stim],float)
+    coeffs = appersist_coeffs(cc,flux,domask=True)
+    tend = expend[stim][:,None,None]
+
+    # Fit the scaling factors with a prior dark
+    if d is not None:
+        pers = appersist_calc(coeffs,expstart[d]-tend,expend[d]-tend)
+        pers[~np.isfinite(pers)] = 0.0
+        # Only use good pixels away from the edges
+        good = cc[0] > 0
+        good[:,0:4] = False
+        good[:,2044:] = False
+        good[2020:,:] = False
+        if bpmfile is not None:
+            bpmim,bpmhead = loadbpm(bpmfile)
+            good &= (bpmim == 0)
+        z = np.maximum(hist[d][0:2048,0:2048],0)[good]
+        A = np.vstack([pers[:,good],np.ones((1,np.sum(good)))]).T
+        # The scaling factors must be positive
+        res = lsq_linear(A,z,bounds=([0.0]*len(stim)+[-np.inf],[np.inf]*(len(stim)+1)))
+        par[parind] = res.x[:-1]
+        par[2] = res.x[-1]
+        if silent==False:
+            print('Correction factors = ',par)
 
-    return flatim,flathead
+    # Persistence during the target exposure
+    pers = appersist_calc(coeffs,expstart[ind]-tend,expend[ind]-tend)
+    pers[~np.isfinite(pers)] = 0.0
+    pmodelim = np.tensordot(par[parind],pers,axes=1) + par[2]
+    pmodelim = np.maximum(pmodelim,0)   # make sure it's positive
+
+    return pmodelim,par
 
 
 # refsub subtracts the reference array from each quadrant with proper flipping
+#  the reference array is [2048,512] or [2048,512,Nreads] and image is
+#  [2048,2048] or [2048,2048,Nreads]
 def aprefcorr_sub(image,ref):
     revref = np.flip(ref,axis=1)
     image[:,0:512] -= ref
@@ -659,27 +2011,36 @@ def aprefcorr_sub(image,ref):
 
 def aprefcorr(cube,head,mask,indiv=3,vert=1,horz=1,noflip=False,silent=False,
               readmask=None,lastgood=None,cds=1,plot=False,fix=False,
-              q3fix=False,keepref=False):
+              q3fix=False,keepref=False,out=None,nbatch=None):
     """
     This corrects a raw APOGEE datacube for the reference pixels
     and reference output
 
+    All of the reads (or batches of nbatch reads) are corrected at
+    once using float32 working arrays.
+
     Parameters:
-    cube       The raw APOGEE datacube with reference array.  This
-                will be updated with the reference subtracted cube.
+    cube       The raw APOGEE datacube [2048,2560,Nreads] with reference array.
     head       The header for CUBE.
+    mask       The flag mask [2048,2048].  This is updated.
     indiv=n    Subtract the individual reference arrays after nxn median filter. If 
                 If <0, subtract mean reference array. If ==0, no reference array subtraction
     /noflip    Do not flip the reference array.
     /silent    Don't print anything to the screen.
+    =out       Array to put the reference subtracted cube in [2048,2048,Nreads],
+                e.g. an np.memmap.  By default a new array is created.
+    =nbatch    Number of reads to correct at once.  Default is all reads.
 
     Returns:
-    cube is updated with the reference subtracted cube to save memory.
-    mask       The flag mask.
-    =readmask  Mask indicating if reads are bad (0-good, 1-bad)
+    out        The reference subtracted cube [2048,2048,Nreads].
+    refout     The corrected reference array [2048,512,Nreads], only
+                if keepref=True.
+    mask       The flag mask is updated.
+    =readmask  Mask indicating if reads are bad (0-good, 1-bad).  If
+                an array is input it is filled in.
 
     USAGE:
-    >>>aprefcorr,cube,head,mask
+    >>>out = aprefcorr(cube,head,mask)
 
     By J. Holtzman   2011
     Incorporated into ap3dproc.pro  D.Nidever May 2011
@@ -691,16 +2052,20 @@ def aprefcorr(cube,head,mask,indiv=3,vert=1,horz=1,noflip=False,silent=False,
     #    reference pixels, then subtract smoothed horizontal ramps
 
     # Number of reads
-    nx,ny,nread = cube.shape
+    ny,nx,nread = cube.shape
+    if nbatch is None:
+        nbatch = nread
 
     # create long output
-    out = np.zeros((2048,2048,nread),int)
+    if out is None:
+        out = np.zeros((2048,2048,nread),np.int32)
     if keepref:
-        refout = np.zeros((512,2048,nread),int)
+        refout = np.zeros((2048,512,nread),np.int32)
 
     # Ignore reference array by default
     # Default is to do CDS, vertical, and horizontal correction
-    print('in aprefcorr, indiv: '+str(indiv))
+    if silent==False:
+        print('in aprefcorr, indiv: '+str(indiv))
 
     satval = 55000
 
@@ -710,201 +2075,293 @@ def aprefcorr(cube,head,mask,indiv=3,vert=1,horz=1,noflip=False,silent=False,
     else:
         hmax = 65530
 
-    if len(mask)<=1:
+    if mask is None or np.size(mask)<=1:
         mask = np.zeros((2048,2048),int)
-    readmask = np.zeros(nread,int)
+    if readmask is None or np.size(readmask) != nread:
+        readmask = np.zeros(nread,int)
+
+    # Mean reference array
+    #---------------------
     if silent==False:
         print('Calculating mean reference')
-    meanref = np.zeros((512,2048),float)
-    nref = np.zeros((512,2048),int)
-    for i in range(nread):
-        ref = cube[2048:2560,:,i]
-
-        m = np.mean(ref[128:512-128,128:2048-128].astype(np.float64))
-        s = np.std(ref[128:512-128,128:2048-128].astype(np.float64))
-        h = np.max(ref[128:512-128,128:2048-256])
-        ref[ref>=sat] = np.nan        
-        # SLICE business is just for special fast handling, ignored if
-        #   not in header
-        card = 'SLICE%03d' % i
-        iread = head.getval(card)
-        count = len(icard)
-        if count==0:
-            iread = i+1
-        if silent==False:
-            print('reading ref: %3d %3d\r' % (i,iread))
-        # skip first read and any bad reads
-        if (iread > 1) and (m/s > snmin) and (h < hmax):
-            good, = np.where(np.isfinite(ref))
-            meanref[good] += (ref[good]-m)
-            nref[good] += 1
-            readmask[i] = 0
-        else:
-            print('Rejecting: ',i,m,s,h)
-            readmask[i] = 1
-
-    meanref /= nref
+    # Statistics of the central part of each read's reference array
+    refcen = cube[128:2048-128,2048+128:2560-128,:].astype(np.float32)
+    m = np.mean(refcen,axis=(0,1),dtype=np.float64)
+    s = np.std(refcen,axis=(0,1),dtype=np.float64)
+    h = np.max(cube[128:2048-256,2048+128:2560-128,:],axis=(0,1))
+    del refcen
+    # SLICE business is just for special fast handling, ignored if
+    #   not in header
+    ireads = np.array([head.get('SLICE%03d' % i,i+1) for i in range(nread)])
+    # skip first read and any bad reads
+    goodread = (ireads > 1) & (m/s > snmin) & (h < hmax)
+    readmask[:] = np.where(goodread,0,1)
+    if silent==False:
+        for i in np.where(goodread==False)[0]:
+            print('Rejecting: ',i,m[i],s[i],h[i])
+    meanref = np.zeros((2048,512),float)
+    nref = np.zeros((2048,512),int)
+    for b0 in range(0,nread,nbatch):
+        gdind = np.where(goodread[b0:b0+nbatch])[0]+b0
+        if len(gdind)==0: continue
+        ref = cube[:,2048:2560,gdind].astype(np.float32)
+        ref[ref>=satval] = np.nan
+        meanref += np.nansum(ref-m[gdind].astype(np.float32),axis=2)
+        nref += np.sum(np.isfinite(ref),axis=2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        meanref /= nref
+    meanref = meanref.astype(np.float32)
 
     if silent == False:
         print('Reference processing ')
 
-
-#### DLN got to here
-
-        
     # Create vertical and horizontal ramp images
-    rows = np.arange(2048,dtype=float)
-    cols = np.ones(512,dtype=int)
-    vramp = (cols.reshape(-1,1)*rows.reshape(1,-1))/2048
+    #  vertical ramps go along the rows, horizontal along the columns
+    vramp = (np.arange(2048,dtype=np.float32)/2048).reshape(-1,1,1)
     vrramp = 1-vramp
-    cols = np.arange(2048,dtype=float)
-    rows = np.ones(2048,dtype=int)
-    hramp = (cols.reshape(-1,1)*rows.reshape(1,-1))/2048
+    hramp = (np.arange(2048,dtype=np.float32)/2048).reshape(1,-1,1)
     hrramp = 1-hramp
-    clo = np.zeros(2048,float)
-    chi = np.zeros(2048,float)
 
     if cds:
-        cdsref = cube[0:2048,:,1]
+        cdsref = cube[:,0:2048,1].astype(np.float32)[:,:,None]
 
-    # Loop over the reads
-    lastgood = nread-1
-    for iread in range(nread):
+    # Saturated pixels in each read
+    #  if we have a lot of saturated pixels, note this read (but don't do anything)
+    nsatarr = np.zeros(nread,int)
+
+    # Loop over the batches of reads
+    for b0 in range(0,nread,nbatch):
+        b1 = np.minimum(b0+nbatch,nread)
+        if silent==False:
+            print('Ref processing: reads %3d-%3d' % (b0+1,b1))
 
-        # Subtract mean reference array
-        red = cube[0:2048,:,iread].astype(int)
+        red = cube[:,0:2048,b0:b1].astype(np.float32)
 
-        ### I GOT TO HERE !!!!
-    
-        sat, = np.where(red > satval)
-        nsat = len(sat)
-        if nsat > 0:
-            if iread == 0:
-                nsat0 = nsat
+        sat = (red > satval)
+        nsatarr[b0:b1] = np.sum(sat,axis=(0,1))
+        if np.sum(nsatarr[b0:b1]) > 0:
             red[sat] = 65535
-            mask[sat] = (mask[sat] or maskval('SATPIX'))
-            # if we have a lot of saturated pixels, note this read (but don't do anything)
-            if nsat > nsat0+2000:
-                if lastgood == nread-1:
-                    lastgood = iread-1
-        else:
-            nsat0 = 0
+            mask[np.any(sat,axis=2)] |= maskval('SATPIX')
         # pixels that are identically zero are bad, see these in first few reads
-        bad, = np.where(red == 0)
-        nbad = len(bad)
-        if nbad > 0:
-            mask[bad] = (mask[bad] or maskval('BADPIX'))
-        if silent==False:
-            print('Ref processing: %3d  nsat: %5d' % (iread+1,len(sat)))
-        if readmask[iread] > 0:
-            red = np.nan
-            goto,nextread
-  
-            
+        bad = np.any(red == 0,axis=2)
+        if np.sum(bad) > 0:
+            mask[bad] |= maskval('BADPIX')
+        
         # with cds keyword, subtract off first read before getting reference pixel values
         if cds:
             red -= cdsref
 
-        ref = cube[2048:2559,:,iread]
+        ref = cube[:,2048:2560,b0:b1].astype(np.float32)
         if indiv==1:
             red = aprefcorr_sub(red,ref)
             ref -= ref
         elif indiv>1:
-            ref = aprefcorr_sub(red,median(ref,indiv))
-            ref -= np.median(ref,indiv)
+            # nxn median filter of each reference array
+            medref = median_filter(ref,size=(indiv,indiv,1),mode='nearest')
+            red = aprefcorr_sub(red,medref)
+            ref -= medref
         elif indiv<0:
-            red = aprefcorr_sub(red,meanref)
-            ref -= meanref
+            red = aprefcorr_sub(red,meanref[:,:,None])
+            ref -= meanref[:,:,None]
   
         if vert:
             # Subtract vertical ramp
+            #  accumulate in float64 so the means don't depend on the batch size
             for j in range(4):
-                rlo = np.nanmean(red[2:4,j*512:(j+1)*512])
-                rhi = np.nanmean(red[2045:2048,j*512:(j+1)*512])
-                red[:,j*512:(j+1)*512] -= rlo*vrramp
-                red[:,j*512:(j+1)*512] -= rhi*vramp     
-                #if keyword_set(plot):
-                #  plot,rlo*vrramp[0,:]+rhi*vramp[0,:]
-                #  print(j,rlo,rhi 
-                #  atv,cube[0:2048,:,iread]-cube[0:2048,:,1]
-                #  atv,red
-                #  import pdb; pdb.set_trace()
-                #
+                rlo = np.nanmean(red[2:4,j*512:(j+1)*512],axis=(0,1),dtype=np.float64).astype(np.float32)
+                rhi = np.nanmean(red[2045:2048,j*512:(j+1)*512],axis=(0,1),dtype=np.float64).astype(np.float32)
+                red[:,j*512:(j+1)*512] -= rlo*vrramp + rhi*vramp
 
         # Subtract smoothed horizontal ramp
         if horz:
-            clo = np.nanmean(im[:,1:4],axis=0)
-            chi = np.nanmean(im[:,2044:2048],axis=0)
-            #clo = total(red[1:3,:],1,/nan) / ( total(finite(red[1:3,:]),1) > 1)
-            #chi = total(red[2044:2046,:],1,/nan) / ( total(finite(red[2044:2046,:]),1) > 1)
-
-        sm = 7
-        slo = medfilt(clo,sm)
-        shi = medfilt(chi,sm)
-
-        if noflip:
-            red -= (rows.reshape(-1,1)*slo.reshape(1,-1))*hrramp
-            red -= (rows.reshape(-1,1)*shi.reshape(1,-1))*hramp
-            #red -= (rows#slo)*hrramp
-            #red -= (rows#shi)*hramp
-        else:
-            #bias = (rows#slo)*hrramp+(rows#shi)*hramp
-            # just use single bias value of minimum of left and right to avoid bad regions in one
-            bias = rows.reshape(-1,1) * np.min([[slo],[shi]],axis=2).reshape(-1,1)
-            fbias = bias
-            fbias[512:1024,:] = reverse(bias[512:1024,:])
-            fbias[1536:2048,:] = reverse(bias[1536:2048,:])
-            red -= fbias
+            clo = np.nanmean(red[:,1:4],axis=1)
+            chi = np.nanmean(red[:,2044:2048],axis=1)
+            sm = 7
+            # median filter along the rows for all reads in one call
+            slo = median_filter(clo,size=(sm,1),mode='constant')
+            shi = median_filter(chi,size=(sm,1),mode='constant')
+
+            if noflip:
+                red -= slo[:,None,:]*hrramp
+                red -= shi[:,None,:]*hramp
+            else:
+                # just use single bias value of minimum of left and right to avoid bad regions in one
+                #  this is constant along the rows so it is the same flipped or not
+                red -= np.minimum(slo,shi)[:,None,:]
 
         if q3fix:
-            #fix=red
-            q3offset = np.zeros(2048,float)
-            for irow in range(2048):
-                q2m = np.median(red[923:1023,irow])
-                q3a = np.median(red[1024:1124,irow])
-                q3b = np.median(red[1435:1535,irow])
-                q4m = np.median(red[1536:1636,irow])
-                #fix[1024:1535,irow]+=((q2m-q3a)+(q4m-q3b))/2.
-                q3offset[irow] = ((q2m-q3a)+(q4m-q3b))/2.
-            #plot,q3offseta
-            #oplot,medfilt1d(q3offset,7,/edge),color=2
-            #red=fix
-            red[1024:1535,:] += medfilt1d(q3offset,7)##(fltarr(512)+1))
-            #atv,red,min=-200,max=200,/linear
-            #import pdb; pdb.set_trace()
+            q2m = np.median(red[:,923:1024],axis=1)
+            q3a = np.median(red[:,1024:1125],axis=1)
+            q3b = np.median(red[:,1435:1536],axis=1)
+            q4m = np.median(red[:,1536:1637],axis=1)
+            q3offset = ((q2m-q3a)+(q4m-q3b))/2.
+            red[:,1024:1536] += median_filter(q3offset,size=(7,1),mode='nearest')[:,None,:]
 
         # Make sure saturated pixels are set to 65535
         #  removing the reference values could have
         #  bumped them lower
-        if nsat > 0:
-            red[sat] = 65535
+        red[sat] = 65535
 
-        #nextread:
-        #reduced[:,:,iread] = red
-        #cube[0:2048,:,iread] = red  # overwrite with the ref-subtracted image
-        out[:,:,iread] = red
+        # Bad reads
+        red[:,:,readmask[b0:b1]>0] = 0
+
+        out[:,:,b0:b1] = np.round(red)
         if keepref:
-            refout[:,:,iread] = ref
+            refout[:,:,b0:b1] = np.round(ref)
+        del red,ref,sat
 
-    # Trim off the reference array
-    #cube = cube[0:2048,:,:]
+    # Last good read before a large jump in the number of saturated pixels
+    nsat0 = 0
+    lastgood = nread-1
+    for iread in range(nread):
+        if nsatarr[iread] > 0:
+            if iread == 0:
+                nsat0 = nsatarr[iread]
+            if nsatarr[iread] > nsat0+2000 and lastgood == nread-1:
+                lastgood = iread-1
+        else:
+            nsat0 = 0
 
     # mask the reference pixels
-    mask[0:4,:] = (mask[0:4,:] or maskval('BADPIX'))
-    mask[2044:2048,:] = (mask[2044:2048,:] or maskval('BADPIX'))
-    mask[:,0:4] = (mask[:,0:4] or maskval('BADPIX'))
-    mask[:,2044:2048] = (mask[:,2044:2048] or maskval('BADPIX'))
+    mask[0:4,:] |= maskval('BADPIX')
+    mask[2044:2048,:] |= maskval('BADPIX')
+    mask[:,0:4] |= maskval('BADPIX')
+    mask[:,2044:2048] |= maskval('BADPIX')
 
     if silent==False:
         print('')
         print('lastgood: ',lastgood)
 
-
     if keepref:
         return [out,refout]
     else:
         return out
 
+def ap3dproc_quicklook(ifile,outfile,detcorr=None,bpmcorr=None,nread=3,maxread=None,
+                       q3fix=False,clobber=False,silent=False):
+    """
+    Quick-look processing of a raw APOGEE datacube.  Only the first and
+    last few reads are used (correlated double sampling when nread=1)
+    and only the reference pixel and bad pixel corrections are applied.
+    No CR detection, saturation fixing or dark/flat correction is done.
+    The output has the same format as the ap3dproc output but is flagged
+    as a low-fidelity product with QUICKLOOK=T in the header.
+
+    Parameters
+    ----------
+    ifile : str
+       The raw datacube filename (.apz or .fits).
+    outfile : str
+       The output filename.
+    detcorr : str, optional
+       The detector calibration file, for the read noise and gain.
+    bpmcorr : str, optional
+       The bad pixel mask calibration file.
+    nread : int, optional
+       The number of reads to average at the beginning and end.
+         Default is 3.
+    maxread : int, optional
+       The maximum number of reads to use.  Default is all reads.
+    q3fix : boolean, optional
+       Fix the issue with the 3rd quadrant of chip c.  Default is False.
+    clobber : boolean, optional
+       Overwrite an existing output file.  Default is False.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+
+    Returns
+    -------
+    im : numpy array
+       The quick-look image [2048,2048] in ADU.  The image, error and
+         mask are written to outfile.
+
+    Example
+    -------
+
+    im = ap3dproc_quicklook('apR-a-12345678.apz','ap2Dql-a-12345678.fits',bpmcorr=bpmfile)
+
+    """
+
+    t0 = time.time()
+
+    if outfile is not None and os.path.exists(outfile) and clobber==False:
+        print('OUTFILE = ',outfile,' ALREADY EXISTS.  Set clobber to overwrite.')
+        return None
+    if silent==False:
+        print('Quick-look processing of '+ifile)
+
+    # Read only the first and last reads
+    #  the first read is always rejected by the reference correction
+    nread = int(np.maximum(nread,1))
+    reads = list(range(nread+1))+list(range(-nread,0))
+    if ifile.endswith('.apz'):
+        cube,head = apzip.unzip_to_array(ifile,maxread=maxread,reads=reads,silent=True)
+    else:
+        cube,head = ap3dproc_readcube(ifile,maxread=maxread,reads=reads,silent=True)
+
+    # Reference pixel correction
+    mask = np.zeros((2048,2048),int)
+    readmask = np.zeros(cube.shape[2],int)
+    cube = aprefcorr(cube,head,mask,readmask=readmask,q3fix=q3fix,silent=True)
+    gdreads, = np.where(readmask == 0)
+    if len(gdreads) < 2:
+        raise ValueError('Need at least 2 good reads')
+
+    # Last minus first, using the mean of nread reads at each end
+    nfowler = int(np.minimum(nread,len(gdreads)//2))
+    if detcorr is not None:
+        rdnoiseim,gainim,lindata = loaddetector(detcorr)
+        noise = np.median(rdnoiseim)
+    else:
+        noise = 12.0
+        gainim = np.ones((2048,2048),float)
+    im,sample_var,nfowler_used,slope,intercept = ap3dproc_sample(cube,gdreads,nfowler=nfowler,noise=noise)
+    im = im[:,0:2048]
+    varim = sample_var + np.maximum(im,0)/gainim   # Poisson noise in ADU
+
+    # Bad pixels
+    if bpmcorr is not None:
+        bpmim,bpmhead = loadbpm(bpmcorr)
+        bdpix = (bpmim > 0)
+        im[bdpix] = 0.0
+        mask[bdpix] |= bpmim[bdpix].astype(int)
+
+    # Write the output
+    if outfile is not None:
+        if os.path.exists(os.path.dirname(os.path.abspath(outfile)))==False:
+            os.makedirs(os.path.dirname(os.path.abspath(outfile)))
+        head['QUICKLOOK'] = (True,'Quick-look low-fidelity reduction')
+        head['QLNREAD'] = (nfowler_used,'Number of reads averaged at each end')
+        head['HISTORY'] = 'AP3D: Quick-look reduction, reference and bad pixel corrections only'
+        hdu = fits.HDUList()
+        hdu.append(fits.PrimaryHDU(header=head))
+        hdu.append(fits.ImageHDU(im.astype(np.float32)))
+        hdu[1].header['BUNIT'] = 'Flux (ADU)'
+        hdu.append(fits.ImageHDU(np.sqrt(varim).astype(np.float32)))
+        hdu[2].header['BUNIT'] = 'Error (ADU)'
+        hdu.append(fits.ImageHDU(mask))
+        hdu[3].header['BUNIT'] = 'Flag Mask (bitwise)'
+        hdu.writeto(outfile,overwrite=True)
+        hdu.close()
+        if silent==False:
+            print('Writing output to: ',outfile)
+
+    if silent==False:
+        print('dt = %.1f sec' % (time.time()-t0))
+
+    return im
+
+
+def ap3dproc_refpix(im):
+    """
+    Get the reference pixels of a read (or reads) [2048,16,...].
+    The 4 pixel wide borders are in the order bottom, left, right and top,
+    the top reference pixels are normally bad.
+    """
+    return np.concatenate((np.swapaxes(im[0:4,0:2048],0,1), im[0:2048,0:4],
+                           im[0:2048,2044:2048], np.swapaxes(im[2044:2048,0:2048],0,1)),axis=1)
+
+
 def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=None,
              persistcorr=None,persistmodelcorr=None,histcorr=None,
              flatcorr=None,crfix=True,satfix=True,rd3satfix=False,saturation=65000,
@@ -912,7 +2369,9 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
              cube=None,head=None,output=None,crstr=None,satmask=None,criter=False,
              clobber=False,cleanuprawfile=True,outlong=False,refonly=False,
              outelectrons=False,nocr=False,logfile=None,fitsdir=None,maxread=None,
-             q3fix=False,usereference=False,seq=None,unlock=False,**kwargs):
+             q3fix=False,usereference=False,seq=None,unlock=False,blocksize=32,nworkers=1,
+             maxmem=None,unzipfile=False,usenumba=False,dtype='float64',writer=None,
+             writetiming=False,quicklook=False,**kwargs):
     """
     Process a single APOGEE 3D datacube.
 
@@ -934,6 +2393,12 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
          and the file will be automatically uncompressed.
     outfile : str
        The output filename.  
+    cube : numpy array, optional
+       Input raw datacube [Ny,Nx,Nreads] to use instead of reading
+         the file, e.g. from apzip.unzip_to_array().  HEAD must also
+         be input.  Only for a single file.
+    head : header, optional
+       The header for the input CUBE.
     detcorr : str
        The filename of the detector file (containing gain,
          rdnoise, and linearity correction).
@@ -1006,6 +2471,42 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
        Verbose output to the screen.  Default is False.
     silent : boolean, optional
        Don't print anything to the screen. Default is False.
+    blocksize : int, optional
+       The number of rows of the datacube to process at once.
+         Larger blocks are faster but use more memory.  Default is 32.
+    nworkers : int, optional
+       The number of worker processes to use for processing the
+         blocks of rows in parallel.  Default is 1.
+    maxmem : float, optional
+       Streaming mode with a memory budget in GB.  The raw and
+         reference-corrected cubes are kept in memory-mapped files
+         (in the local scratch directory) and read one read at a time,
+         and the block size is reduced so that the block processing
+         fits within maxmem.  Default is to keep everything in memory.
+    unzipfile : boolean, optional
+       Decompress ".apz" files to a FITS file on disk with funpack
+         (apzip.unzip) instead of directly into memory
+         (apzip.unzip_to_array).  Default is False.
+    usenumba : boolean, optional
+       Use the numba-compiled kernels for the linearity and dark
+         correction and the up-the-ramp sums.  Default is False.
+    dtype : str, optional
+       The floating point type used for the intermediate arrays,
+         'float64' or 'float32'.  float32 halves the memory and
+         memory bandwidth, the sums are still accumulated in float64.
+         Default is 'float64'.
+    writer : function, optional
+       Function called as writer(hdu,outfile) with the output HDUList
+         instead of writing it to disk directly, e.g. to write it in a
+         background thread.  Default is None.
+    writetiming : boolean, optional
+       Write a JSON file with the time, CPU time and peak memory of each
+         processing stage next to the output file (_timing.json).
+         Default is False.
+    quicklook : boolean, optional
+       Quick-look mode, only use the first and last reads and only apply
+         the reference and bad pixel corrections (see ap3dproc_quicklook).
+         Default is False.
 
     Returns
     -------
@@ -1041,6 +2542,8 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
     SUBROUTINES:
     ap3dproc_lincorr   Does the linearity correction
     ap3dproc_darkcorr  Does the dark correction
+    ap3dproc_blocks    Processes the datacube in blocks of rows, optionally in parallel
+    ap3dproc_block     Processes a block of rows of the datacube
     ap3dproc_crfix     Detects and fixes CRs
     ap3dproc_plotting  Plots original and fixed data for pixels
                         affected by CRs or saturation (for debugging
@@ -1078,11 +2581,20 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
     t00 = time.time()
     
     nfiles = np.char.array(files).size
-    if type(files) is str:
+    if isinstance(files,str):
         files = [files]
 
     if outfile is None:
         raise ValueError('OUTFILE must have same number of elements as FILES')
+    if isinstance(outfile,str):
+        outfile = [outfile]
+
+    # Quick-look mode
+    if quicklook:
+        for f in range(nfiles):
+            ap3dproc_quicklook(files[f],outfile[f],detcorr=detcorr,bpmcorr=bpmcorr,
+                               maxread=maxread,q3fix=q3fix,clobber=clobber,silent=silent)
+        return
 
     # Default parameters
     if (nfowler is None or nfowler==0) and (uptheramp is None or uptheramp==False):      # number of reads to use at beg and end
@@ -1113,14 +2625,26 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         else:
             print('Output will be in ADU')
         print('')
-    print(str(nfiles),' File(s) input')
+    if silent==False:
+        print(str(nfiles),' File(s) input')
+
 
+    # Input datacube, only for a single file
+    incube,inhead = None,None
+    if cube is not None:
+        if nfiles > 1:
+            raise ValueError('An input datacube can only be used with a single file')
+        if head is None:
+            raise ValueError('HEAD must be input with CUBE')
+        incube,inhead = cube,head
 
     # File loop
     #------------
+    flux,cube = None,None
     for f in range(nfiles):
         t0 = time.time()
         ifile = files[f]
+        timer = timing.StageTimer('ap3dproc',file=ifile,dtype=dtype,nworkers=nworkers)
 
         if silent==False:
             if f > 0:
@@ -1143,7 +2667,7 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
                     os.remove(lockfile)
 
             if os.path.exists(os.path.dirname(lockfile))==False:
-                os.mkdirs(os.path.dirname(lockfile))
+                os.makedirs(os.path.dirname(lockfile))
             open(lockfile,'w').close()
 
 
@@ -1175,10 +2699,29 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
             error = 'FILE must have a ".fits" or ".apz" extension'
             if silent==False:
                 print(error)
+            if os.path.exists(lockfile): os.remove(lockfile)
             continue
   
+        # Streaming mode, read the cube one read at a time into a memory-mapped
+        #   file and process it in blocks that fit into the memory budget
+        cubefile,refcubefile = None,None
+        if maxmem is not None:
+            fd,cubefile = tempfile.mkstemp(prefix='ap3draw',suffix='.dat',dir=utils.localdir())
+            os.close(fd)
+            fd,refcubefile = tempfile.mkstemp(prefix='ap3dref',suffix='.dat',dir=utils.localdir())
+            os.close(fd)
+
+        timer.start('decompress')
+        # Datacube input directly
+        rawcube = None
+        if incube is not None:
+            if silent==False:
+                print('Using the input datacube')
+            rawcube,rawhead = incube,inhead
+            doapunzip = False
+
         # Compressed file input
-        if extension == 'apz':
+        elif extension == 'apz':
             if silent==False:
                 print(ifile,' is a COMPRESSED file')
 
@@ -1191,30 +2734,42 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
                 fitsdir = None
   
             # Need to decompress
+            doapunzip = False
             if os.path.exists(fitsfile)==False:
-                if silent==False:
-                    print('Decompressing with APUNZIP')
-                num = int(base[6:6+8])
-                if num < 2490000:
-                    no_checksum = 1
-                else:
-                    no_checksum = 0 
-                print('no_checksum: ', no_checksum)
-                try:
-                    apzip.unzip(ifile,clobber=True,fitsdir=fitsdir,no_checksum=True)
-                except:
-                    traceback.print_exc()
-                    print('ERROR in APUNZIP')
-                    import pdb; pdb.set_trace()
-                    continue
-                print('')
-                doapunzip = True     # we ran apunzip
+                # Decompress directly into memory
+                if unzipfile==False:
+                    if silent==False:
+                        print('Decompressing in memory')
+                    try:
+                        rawcube,rawhead = apzip.unzip_to_array(ifile,maxread=maxread,cubefile=cubefile,
+                                                               silent=(silent or not verbose))
+                    except:
+                        traceback.print_exc()
+                        print('ERROR decompressing in memory.  Trying APUNZIP')
+                # Decompress to a FITS file with funpack
+                if rawcube is None:
+                    if silent==False:
+                        print('Decompressing with APUNZIP')
+                    num = int(base[6:6+8])
+                    if num < 2490000:
+                        no_checksum = 1
+                    else:
+                        no_checksum = 0 
+                    print('no_checksum: ', no_checksum)
+                    try:
+                        apzip.unzip(ifile,clobber=True,fitsdir=fitsdir,no_checksum=True)
+                    except:
+                        traceback.print_exc()
+                        print('ERROR in APUNZIP')
+                        if os.path.exists(lockfile): os.remove(lockfile)
+                        continue
+                    print('')
+                    doapunzip = True     # we ran apunzip
 
             # Decompressed file already exists
             else:
                 if silent==False:
                     print('The decompressed file already exists')
-                doapunzip = False     # we didn't run apunzip
 
             ifile = fitsfile  # using the decompressed FITS from now on
 
@@ -1224,94 +2779,67 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
 
         # Regular FITS file input
         else:
-            ifile = ifile
             doapunzip = False
  
         if silent==False:
             if extension == 'apz' and cleanuprawfile and doapunzip == 1:
                 print('Removing recently decompressed FITS file at end of processing')
 
-  
-        # Check that the file exists
-        if os.path.exists(ifile)==False:
-            error = 'FILE '+ifile+' NOT FOUND'
-            if silent==False:
-                print('halt: '+error)
-            import pdb; pdb.set_trace()
-            continue
- 
-        # Get header
-        try:
-            head = fits.getheader(ifile)
-        except:
-            error = 'There was an error loading the HEADER for '+ifile
-            if silent==False:
-                print('halt: '+error)
-            import pdb; pdb.set_trace()
-            continue
-  
-        # Check that this is a data CUBE
-        naxis = head['NAXIS']
-        try:
-            dumim,dumhead = fits.getdata(ifile,1,header=True)
-            readokay = True
-        except:
-            readokay = False
-        if naxis != 3 and readokay==False:
-            error = 'FILE must contain a 3D DATACUBE OR image extensions'
-            if silent==False:
-                print('halt: '+error)
-            import pdb; pdb.set_trace()
-            continue
 
         # Test if the output file already exists
         if outfile is not None:
             if os.path.exists(outfile[f]) and clobber==False:
                 print('OUTFILE = ',outfile[f],' ALREADY EXISTS.  Set /clobber to overwrite.')
+                if os.path.exists(lockfile): os.remove(lockfile)
                 continue
 
-        # Read in the File
-        #-------------------
-        if os.path.exists(ifile)==False:
-            error = ifile+' NOT FOUND'
-            if silent==False:
-                print('halt: '+error)
-            import pdb; pdb.set_trace()
-            continue
-        # DATACUBE
-        if naxis==3:
-            cube,head = fits.getdata(ifile,header=True)  # uint
-        # Extensions
-        else:
-            head = fits.getheader(ifile)
-            # Figure out how many reads/extensions there are
-            #  the primary unit should be empty
-            hdu = fits.open(ifile)
-            nreads = len(hdu)-1
-  
-            # Only 1 read
-            if nreads < 2:
-                error = 'ONLY 1 read.  Need at least two'
-                raise ValueError(error)
-
-            # allow user to specify maximum number of reads to use (e.g., in the
-            #   case of calibration exposures that may be overexposed in some chip
-            if maxread:
-               if maxread < nreads:
-                  nreads = maxread
-  
-            # Initializing the cube
-            im1 = hdu[1].data
-            ny,nx = im1.shape
-            cube = np.zeros((ny,nx,nreads),int)    # long is big enough and takes up less memory than float
-  
-            # Read in the extensions
-            for k in np.arange(1,nreads+1):
-                cube[:,:,k-1] = hdu[k].data
-                # What do we do with the extension headers???
-                # We could make a header structure or array
-            hdu.close()
+        timer.start('read')
+        # Check and read the FITS file
+        if rawcube is None:
+            # Check that the file exists
+            if os.path.exists(ifile)==False:
+                error = 'FILE '+ifile+' NOT FOUND'
+                if silent==False:
+                    print('halt: '+error)
+                if os.path.exists(lockfile): os.remove(lockfile)
+                continue
+ 
+            # Get header
+            try:
+                head = fits.getheader(ifile)
+            except:
+                error = 'There was an error loading the HEADER for '+ifile
+                if silent==False:
+                    print('halt: '+error)
+                if os.path.exists(lockfile): os.remove(lockfile)
+                continue
+  
+            # Check that this is a data CUBE
+            naxis = head['NAXIS']
+            try:
+                dumim,dumhead = fits.getdata(ifile,1,header=True)
+                readokay = True
+            except:
+                readokay = False
+            if naxis != 3 and readokay==False:
+                error = 'FILE must contain a 3D DATACUBE OR image extensions'
+                if silent==False:
+                    print('halt: '+error)
+                if os.path.exists(lockfile): os.remove(lockfile)
+                continue
 
+            # Read in the File
+            #-------------------
+            if os.path.exists(ifile)==False:
+                error = ifile+' NOT FOUND'
+                if silent==False:
+                    print('halt: '+error)
+                if os.path.exists(lockfile): os.remove(lockfile)
+                continue
+            cube,head = ap3dproc_readcube(ifile,maxread=maxread,cubefile=cubefile,silent=(silent or not verbose))
+        else:
+            cube,head = rawcube,rawhead
+            rawcube = None
 
         # Dimensions of the cube
         ny,nx,nreads = cube.shape
@@ -1334,33 +2862,42 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         if nreads == 2 and satfix and silent==False:
             print('Only 2 READS. CANNOT fix Saturated pixels')
 
+        timer.start('load')
+        # Load the calibration files
+        #  the loaders are cached, see calcache_setup()
+        rdnoiseim,gainim,lindata = None,None,None
+        bpmim,littrowim,persistim = None,None,None
+        darkcube,darkhead,flatim = None,None,None
         # Load the detector file
-        rdnoiseim,gainim,lindata = loaddetector(detcorr)
+        if detcorr is not None:
+            rdnoiseim,gainim,lindata = loaddetector(detcorr)
         # Load the bad pixel mask
-        if bpmcorr:
+        if bpmcorr is not None:
             bpmim,bpmhead = loadbpm(bpmcorr)
         # Load the littrow mask file
-        if littrowcorr:
+        if littrowcorr is not None:
             littrowim,littrowhead = loadlittrow(littrowcorr)
         # Load the persistence file
-        if persistcorr:
+        if persistcorr is not None:
             persistim,persisthead = loadpersist(persistcorr)
         # Load the dark cube
-        darkcube,darkhead = loaddark(darkcorr)
+        if darkcorr is not None:
+            darkcube,darkhead = loaddark(darkcorr)
+            # Check that it has enough reads
+            nreads_dark = darkcube.shape[2]
+            if nreads_dark < nreads:
+                error = 'SUPERDARK file '+darkcorr+' does not have enough READS. Have '+str(nreads_dark)+\
+                        ' but need '+str(nreads)
+                raise ValueError(error)
         # Load the flat image
-        flatim,flathead = loadflat(flatcorr)
-
-        # Check that it has enough reads
-        _,_,nreads_dark = darkcube.shape
-        if nreads_dark < nreads:
-            error = 'SUPERDARK file '+darkcorr+' does not have enough READS. Have '+str(nreads_dark)+\
-                    ' but need '+str(nreads)
-            raise ValueError(error)
+        if flatcorr is not None:
+            flatim,flathead = loadflat(flatcorr)
 
-        if len(detcorr) > 0 or len(darkcorr) > 0 or len(flatcorr) > 0 and silent==False:
+        if (detcorr is not None or darkcorr is not None or flatcorr is not None) and silent==False:
             print('')
   
   
+        timer.start('badreads')
         #---------------------
         # Check for BAD READS
         #---------------------
@@ -1368,101 +2905,83 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
             print('Checking for bad reads')
   
         # Use the reference pixels and reference output for this
-
-        import pdb; pdb.set_trace()
-    
-        if sz[1] == 2560:
-            refout1 = np.median(cube[2048:,:,0:3<(nreads-1)],dim=3)
-            sig_refout_arr = np.zeros(nreads,float)
-            rms_refout_arr = np.zeros(nreads,float)
-  
-  
-        refpix1 = [[ np.median(cube[0:2048,0:3,0:4<nreads],axis=2) ], 
-                   [transpose( np.median(cube[0:4,:,0:4<nreads],axis=2) ) ],
-                   [transpose( np.median(cube[2044:2048,:,0:4<nreads],axis=2) ) ],
-                   [ median(cube[0:2048,2044:2048,0:4<(nreads-1)],axis=2) ]]
-        sig_refpix_arr = np.zeros(nreads,float)
+        #  the reference output is in columns 2048-2559
+        refoutput = (nx == 2560)
+        nmed = np.minimum(4,nreads)
+        refpix1 = np.median(ap3dproc_refpix(cube[:,:,0:nmed]),axis=2)
         rms_refpix_arr = np.zeros(nreads,float)
+        if refoutput:
+            refout1 = np.median(cube[:,2048:,0:nmed],axis=2)
+            rms_refout_arr = np.zeros(nreads,float)
 
         for k in range(nreads):
-            refpix = [[cube[0:2048,0:4,k]], [transpose(cube[0:4,:,k])],
-                      [transpose(cube[2044:2048,:,k])], [cube[0:2048,2044:2048,k]]]
-            refpix = float(refpix)
+            refpix = ap3dproc_refpix(cube[:,:,k]).astype(float)
   
             # The top reference pixels are normally bad
             diff_refpix = refpix - refpix1
-            sig_refpix = dln.mad(diff_refpix[:,0:11],zero=True)
-            rms_refpix = np.sqrt(np.mean(diff_refpix[:,0:11]**2))
-            
-            sig_refpix_arr[k] = sig_refpix
-            rms_refpix_arr[k] = rms_refpix
+            rms_refpix_arr[k] = np.sqrt(np.mean(diff_refpix[:,0:12]**2))
   
             # Using reference pixel output (5th output)
-            if sz[1] == 2560:
-                refout = float(cube[2048:,:,k])
+            if refoutput:
+                refout = cube[:,2048:,k].astype(float)
   
                 # The top and bottom are bad
                 diff_refout = refout - refout1
-                sig_refout = dln.mad(diff_refout[:,100:1950],zero=True)
-                rms_refout = np.sqrt(np.mean(diff_refout[:,100:1950]**2))
-                
-                sig_refout_arr[k] = sig_refout
-                rms_refout_arr[k] = rms_refout
-
-        # Use reference output and pixels
-        if sz[1] == 2560:
-            if nreads>2:
-                med_rms_refpix_arr = medfilt(rms_refpix_arr,11<nreads)
-                med_rms_refout_arr = medfilt(rms_refout_arr,11<nreads)
-            else:
-                med_rms_refpix_arr = np.zeros(nreads,float)+np.median(rms_refpix_arr)
-                med_rms_refout_arr = np.zeros(nreads,float)+np.median(rms_refout_arr)
+                rms_refout_arr[k] = np.sqrt(np.mean(diff_refout[100:1951,:]**2))
 
-            sig_rms_refpix_arr = np.maximum(dln.mad(rms_refpix_arr),1)
-            sig_rms_refout_arr = np.maximum(dln.mad(rms_refout_arr),1)
-            bdreads, = np.where( (rms_refout_arr-med_rms_refout_arr) > 10*sig_rms_refout_arr)
-            nbdreads = len(bdreads)
-  
-        # Only use reference pixels
+        # Use reference output if we have it, otherwise only the reference pixels
+        if refoutput:
+            rms_arr = rms_refout_arr
         else:
-            if nreads > 2:
-                med_rms_refpix_arr = medfilt(rms_refpix_arr,11<nreads)
-            else:
-                med_rms_refpix_arr = np.zeros(nreads,float)+np.median(rms_refpix_arr)
-                
-            sig_rms_refpix_arr = np.maximum(dln.mad(rms_refpix_arr),1)
-            bdreads, = np.where( (rms_refpix_arr-med_rms_refpix_arr) > 10*sig_rms_refpix_arr)
-            nbdreads = len(bdreads)
-    
-        if nbdreads == 0:
-            bdreads = None
+            rms_arr = rms_refpix_arr
+        if nreads > 2:
+            med_rms_arr = ap3dproc_medfilt(rms_arr,np.minimum(11,nreads))
+        else:
+            med_rms_arr = np.zeros(nreads,float)+np.median(rms_arr)
+        sig_rms_arr = np.maximum(dln.mad(rms_arr),1)
+        bdreads, = np.where( (rms_arr-med_rms_arr) > 10*sig_rms_arr)
+        nbdreads = len(bdreads)
         
         # Too many bad reads
         if nreads-nbdreads < 2:
             raise ValueError('ONLY '+str(nreads-nbdreads)+' good reads.  Need at least 2.')
 
   
+        timer.start('refcorr')
         # Reference pixel subtraction
         #----------------------------
-        tmp = aprefcorr(cube,head,mask,readmask=readmask,q3fix=q3fix,keepref=usereference)
-        cube = tmp
+        #  with usereference the reference output is kept in columns 2048-2559
+        mask = np.zeros((2048,2048),int)    # CR and saturation mask
+        nxout = 2560 if usereference else 2048
+        if refcubefile is not None:
+            refcube = np.memmap(refcubefile,dtype=np.int32,mode='w+',shape=(2048,nxout,nreads))
+        else:
+            refcube = np.zeros((2048,nxout,nreads),np.int32)
+        readmask = np.zeros(nreads,int)
+        nbatch = None
+        if maxmem is not None:   # 4 float32 working arrays of 2048x2560 per read
+            nbatch = int(np.maximum(maxmem*1e9 // (2048*2560*4*4),1))
+        tmp = aprefcorr(cube,head,mask,readmask=readmask,q3fix=q3fix,keepref=usereference,
+                        out=refcube[:,0:2048,:],nbatch=nbatch,silent=silent)
+        if usereference:
+            refcube[:,2048:,:] = tmp[1]
+        del tmp
+        cube = refcube
         
-        bdreads2, = np.where(readmask == 1)
-        nbdreads2 = len(bdreads2)
-        if nbdreads2 > 0:
-            bdreads = np.hstack((bdreads,bdreads))
-        nbdreads = len(np.unique(bdreads))
+        # Add the bad reads found by aprefcorr
+        bdreads = np.unique(np.hstack((bdreads,np.where(readmask == 1)[0])))
+        nbdreads = len(bdreads)
   
         if nbdreads > (nreads-2):
             raise ValueError('Not enough good reads')
 
-        gdreads = np.arange(nreads)
-        REMOVE,bdreads,gdreads
+        gdreads = np.setdiff1d(np.arange(nreads),bdreads)
         ngdreads = len(gdreads)
 
         # Interpolate bad reads
         if nbdreads > 0:
-            print('Read(s) '+', '.join(str(bdreads+1))+' are bad.')
+            if silent==False:
+                print('Read(s) '+', '.join([str(r+1) for r in bdreads])+' are bad.')
   
             # The bad reads are currently linearly interpolated using the
             # neighoring reads and used as if they were good.  The variance
@@ -1510,355 +3029,70 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
                 # Stuff it in the cube
                 cube[:,:,bdreads[k]] = np.round(im0)         # round to closest integer, LONG type
   
-        ny,nx = cube.shape
-  
-        # Reference subtraction ONLY
-        if refonly:
-            if silent==False:
-                print('Reference subtraction only')
-
-        
-        #-------------------------------------
-        # INTER-PIXEL CAPACITANCE CORRECTION
-        #-------------------------------------
-        
-        # Loop through each read
-        # Make left, right, top, bottom images and
-        #  use these to correct the flux for the inter-pixel capacitance
-        # make sure to treat the edgs and reference pixels correctly
-        # The "T" shape might indicate that we don't need to do the "top"
-        #  portion
-  
-  
-        # READ NOISE
-        #-----------
-        if rdnoiseim.shape>0:
-            noise = np.median(rdnoiseim)
-        else:
-            noise = 12.0  # default value
-        noise_dCounts = noise*np.sqrt(2)  # noise in dcounts
-  
-  
-        # Initialize some arrays
-        #------------------------
-        #mask = intarr(nx,ny)               # CR and saturation mask
-        #crindex = intarr(nx,ny,10)-1       # the CR read indices get put in here
-        #crnum = intarr(nx,ny)              # # of CRs per pixel
-        med_dCounts_im = np.zeros((ny,nx),float)     # the median dCounts for each pixel
-        satmask = np.zeros((ny,nx,3),int)          # 1st plane is 0/1 mask, 2nd plane is which read
-                                            #   it saturated on, 3rd plane is # of
-                                            #   saturated reads
-        variability_im = np.zeros((ny,nx),float)     # fractional variability for each pixel
-        sat_extrap_error = np.zeros((ny,nx),float)   # saturation extrapolation error 
-  
-    
-        #--------------------------------------------
-        # PROCESS EACH SLICE (one row) ONE AT A TIME
-        #--------------------------------------------
-  
-        # Here is the method.  For each pixel find the dCounts for
-        # each neighboring pair of reads.  Then find the median dCounts
-        # and the RMS (robustly).  If there are any dCounts that are
-        # many +sigma then this is a cosmic ray.  Then use the median
-        # dCounts around that read to correct the CR.
-
-        if silent==False:
-            print('Processing the datacube')
-
-        # Loop through the rows
-        for i in range(ny):
-            if verbose or debug:
-                print('Scanning Row ',str(i+1))
-            if silent==False and verbose==False and debug==False:
-                if (i+1) % 500 == 0:
-                    print(i+1,'/',ny,format='(I4,A1,I4)')
-  
-        # Slice of datacube, [Ncol,Nread]
-        #--------------------------------
-        slc = cube[:,i,:].astype(float)
-        slc_orig = slc.copy()  # original slice
- 
-        #---------------------------------
-        # Flag BAD pixels
-        #---------------------------------
-        if bpmcorr is not None:
-            bdpix, = np.where(bpmim[:,i] > 0,nbdpix)
-            nbdpix = len(bdpix)
-            if nbdpix > 0:
-                for j in range(nbdpix):
-                    slc[bdpix[j],:] = 0.0  # set them to zero
-            mask[bdpix,i] = (mask[bdpix,i] | bpmim[bdpix,i])
-  
-        #---------------------------------
-        # Flag LITTROW ghost pixels, but don't change data values
-        #---------------------------------
-        if littrowcorr is not None:
-            bdpix, = np.where(littrowim[:,i] == 1)
-            nbdpix = len(bdpix)
-            if nbdpix > 0:
-                mask[bdpix,i] = (mask[bdpix,i] | maskval('LITTROW_GHOST'))
-  
-        #---------------------------------
-        # Flag persistence pixels, but don't change data values
-        #---------------------------------
-        if persistcorr is not None:
-            bdpix, = np.where(persistim[:,i] and 1)
-            if len(bdpix) > 0:
-                mask[bdpix,i] = (mask[bdpix,i] | maskval('PERSIST_HIGH'))
-            bdpix, = np.where(persistim[:,i] and 2)
-            if len(bdpix) > 0:
-                mask[bdpix,i] = (mask[bdpix,i] | maskval('PERSIST_MED'))
-            bdpix, = np.where(persistim[:,i] and 4)
-            if len(bdpix)>0:
-                mask[bdpix,i] = (mask[bdpix,i] | maskval('PERSIST_LOW'))
-  
-        #---------------------------------
-        # Detect and Flag Saturated reads
-        #---------------------------------
-        #  The saturated pixels are detected in the reference subtraction
-        #  step and fixed to 65535.
-        bdsat, = np.where(slc > saturation)
-        if len(bdsat)>0:
-            # Flag saturated reads as NAN
-            slc[bdsat] = np.nan
-  
-            # Get 2D indices
-            bdsat2d = array_indices(slc,bdsat)
-            bdsatx = bdsat2d[0,:]      # X/column indices
-            bdsatr = bdsat2d[1,:]      # read indices
-            # bdsat is 1D array for slice(2D)
-            # bdsatx is column index for 1D med_dCounts
-  
-            # Unique pixels
-            uibdx = np.unique(bdsatx)
-            ubdsatx = bdsatx[uibdx]
-            nbdsatx = len(ubdsatx)
-  
-            # Figure out at which Read (NOT dCounts) each column saturated
-            rindex = np.ones(nx,int).reshape(-1,1) * np.arange(nreads).reshape(1,-1)     # each pixels read index
-            satmask_slc = np.zeros((nx,nreads),int)          # sat mask
-            satmask_slc[bdsatx,bdsatr] = 1                   # set saturated reads to 1
-            rindexsat = rindex*satmask_slc + \
-                        (1-satmask_slc)*999999               # okay pixels ahve 999999, sat pixels have their read index
-            minsatread = np.min(rindexsat,axis=2)              # now find the minimum for each column
-            nsatreads = np.sum(satmask_slc,axis=2)           # number of sat reads
-  
-            # Make sure that all subsequent reads to a saturated read are
-            # considered "bad" and set to NAN
-            for j in range(nbdsatx):
-                slc[ubdsatx[j],minsatread[ubdsatx[j]]:] = np.nan
-  
-            # Update satmask
-            satmask[ubdsatx,i,0] = 1                     # mask
-            satmask[ubdsatx,i,1] = minsatread[ubdsatx]   # 1st saturated read, NOT dcounts
-            satmask[ubdsatx,i,2] = nsatreads[ubdsatx]    # # of saturated reads
-  
-            # Update mask
-            mask[ubdsatx,i] = (mask[ubdsatx,i] | maskval('SATPIX'))     # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
-  
-        #----------------------
-        # Linearity correction
-        #----------------------
-        # This needs to be done BEFORE the pixels are "fixed" because
-        # it needs to operate on the ORIGINAL counts, not the corrected
-        # ones.
-        if lindata is not None:
-            if szlin[0] == 3:
-                linslc = lindata[:,i,:]
-            else:
-                linslc = lindata
-            slc_orig1 = slc           # temporary copy since we'll be overwriting it
-            slc = aplincorr(slc_orig1,linslc)
-  
-        #-----------------
-        # Dark correction
-        #-----------------
-        # Each read will have a different amount of dark counts in it
-        if darkcube is not None:
-            darkslc = darkcube[:,i,:]
-            slc_orig2 = slc  # temporary copy since we'll be overwriting it
-            slc = ap3dproc_darkcorr(slc_orig2,darkslc,darkhead)
-  
-        #------------------------------------------------
-        # Find difference of neighboring reads, dCounts
-        #------------------------------------------------
-        #  a difference with 1 or 2 NaN will also be NAN
-        dCounts = slc[:,1:sz[3]] - slc[:,0:sz[3]-1]
-  
-  
-        # SHOULD I FIX BAD READS HERE?????
-
-  
-        #----------------------------
-        # Detect and Fix cosmic rays
-        #----------------------------
-        slc_prefix = slc
-        if nocr==False and nreads>2:
-            dCounts_orig = dCounts  # temporary copy since we'll be overwriting it
-            dCounts = None
-            satmask_slc = satmask[:,i,:]
-            out = ap3dproc_crfix(dCounts_orig,satmask_slc,noise=noise,crfix=crfix)
-            crstr_slc, dCounts, med_dCounts, mask, crindex, crnum, variability_slc = out
-            
-            variability_im[:,i] = variability_slc
-  
-        # Only 2 reads, CANNOT detect or fix CRs
-        else:
-            med_dCounts = dCounts
-            crstr_slc = {'ncr':0}
-  
-        # Some CRs detected, add to CRSTR structure
-        if crstr_slc['ncr'] > 0:
-            crstr_slc['data']['y'] = i  # add the row information
-  
-            # Add to MASK
-            maskpix, = np.where(crstr_slc['data']['x'] < 2048)
-            nmaskpix = len(maskpix)
-            if nmaskpix > 0:
-                mask[crstr_slc['data'][maskpix]['x'],i] = (mask[crstr_slc['data'][maskpix]['x'],i] | maskval('CRPIX'))
-  
-            # Starting global structure
-            if len(crstr) == 0:
-                crstr = crstr_slc
-            # Add to global structure
-            else:
-                ncrtot = crstr['ncr'] + crstr_slc['ncr']
-                old_crstr = crstr
-                crstr = {'ncr':ncrtot,'data':[old_crstr.data, crstr_slc.data]}
-                crstr = None
-  
-        #----------------------
-        # Fix Saturated reads
-        #----------------------
-        #  do this after CR fixing, so we don't have to worry about CRs here
-        #  set their dCounts to med_dCounts
-        if nbdsat > 0:
-            # Have enough reads (>2) to fix pixels
-            if (nreads > 2):
-  
-                # Total number of good dCounts for each pixel
-                totgd = np.sum(finite(dCounts),axis=2)
-            
-                # Unfixable pixels
-                #------------------
-                #  Need 2 good dCounts to be able to "safely" fix a saturated pixel
-                thresh_dcounts = 2
-                if rd3satfix and nreads==3:
-                    thresh_dcounts = 1  # fixing 3 reads                       
-                unfixable, = np.where(totgd < thresh_dcounts)
-                if len(unfixable) > 0:
-                    dCounts[unfixable,:] = 0.0
-                    mask[unfixable,i] = (mask[unfixable,i] | maskval('UNFIXABLE'))                   # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
-  
-                # Fixable Pixels
-                #-----------------
-                fixable, = np.where((totgd >= thresh_dcounts) & (satmask[:,i,0] == 1))
-                nfixable = len(fixable)
-  
-                # Loop through the fixable saturated pixels
-                for j in range(nfixable):
-                    ibdsatx = fixable[j]
-                    # "Fix" the saturated pixels
-                    #----------------------------
-                    if satfix:  
-                        # Fix the pixels
-                        #   set dCounts to med_dCounts for that pixel
-                        #dCounts[bdsat] = med_dCounts[bdsatx]
-                        # if the first read is saturated then we start with
-                        #   the first dCounts
-                        dCounts[ibdsatx,(minsatread[ibdsatx]-1)>0:nreads-2] = med_dCounts[ibdsatx]
-  
-                        # Saturation extrapolation error
-                        var_dCounts = variability_im[ibdsatx,i] * (med_dCounts[ibdsatx]>0.0001)   # variability in dCounts
-                        sat_extrap_error[ibdsatx,i] = var_dCounts * satmask[ibdsatx,i,2]          # Sigma of extrapolated counts, multipy by Nextrap
+        ny,nx,nreads = cube.shape
+        if maxmem is not None:
+            blocksize = np.minimum(blocksize,ap3dproc_blocksize(ny,nreads,maxmem))
+            if silent==False:
+                print('Streaming mode, using blocks of '+str(blocksize)+' rows')
   
-                    # Do NOT fix the saturated pixels
-                    #---------------------------------
-                    else:
-                        dCounts[ibdsatx,minsatread[ibdsatx]-1:nreads-2] = 0.0    # set saturated dCounts to zero
-          
-                
-                # It might be better to use the last good value from sm_dCounts
-                # rather than the straight median of all reads
+        # Reference subtraction ONLY
+        if refonly:
+            if silent==False:
+                print('Reference subtraction only')
+            if maxmem is not None:
+                del refcube
+                for mfile in [cubefile,refcubefile]:
+                    if os.path.exists(mfile): os.remove(mfile)
+            if os.path.exists(lockfile): os.remove(lockfile)
+            continue
+        
+        #-------------------------------------
+        # INTER-PIXEL CAPACITANCE CORRECTION
+        #-------------------------------------
+        
+        # Loop through each read
+        # Make left, right, top, bottom images and
+        #  use these to correct the flux for the inter-pixel capacitance
+        # make sure to treat the edgs and reference pixels correctly
+        # The "T" shape might indicate that we don't need to do the "top"
+        #  portion
   
-            # Only 2 reads, can't fix anything
-            else:
-                mask[ubdsatx,i] = (mask[ubdsatx,i] | maskval('UNFIXABLE'))     # mask: 1-bad, 2-CR, 4-sat, 8-unfixable
-                dCounts[bdsatx] = 0.0                        # set saturated reads to zero
-   
-        #------------------------------------
-        # Reconstruct the SLICE from dCounts
-        #------------------------------------
-        slc0 = slc[:,0]  # first read
-        bdsat, = np.where(finite(slc0) == 0)  # NAN in first read, set to 0.0
-        if len(bdsat) > 0:
-            slc0[bdsat] = 0.0
-  
-        unfmask_slc = int((int(mask[:,i]) & maskval('UNFIXABLE')) == maskval('UNFIXABLE'))  # unfixable
-        slc0[0:2047] = slc0[0:2047]*(1.0-unfmask_slc)                 # set unfixable pixels to zero
-  
-        slc_fixed = slc0 # (fltarr(nreads)+1.0)
-        if nreads > 2:
-            slc_fixed[:,1:] += np.cumsum(dCounts,axis=2)
+  
+        # READ NOISE
+        #-----------
+        if rdnoiseim is not None:
+            noise = np.median(rdnoiseim)
         else:
-            slc_fixed[:,0] = slc0
-            slc_fixed[:,1] = slc0+dCounts
-    
+            noise = 12.0  # default value
+        noise_dCounts = noise*np.sqrt(2)  # noise in dcounts
   
-        #--------------------------------
-        # Put fixed slice back into cube
-        #--------------------------------
-        cube[:,i,:] = np.round( slc_fixed )        # round to closest integer, LONG type
   
-        #------------------------------------
-        # Final median of each "fixed" pixel
-        #------------------------------------
-        if nreads > 2:
-            # Unfixable pixels are left at 0.0
-  
-            # If NOT fixing saturated pixels, then we need to
-            # temporarily set saturated reads to NAN
-            #  Leave unfixable pixels at 0.0
-            temp_dCounts = dCounts
-            if satfix==False:
-                bdsat, = np.where((satmask[:,i,0] == 1) & (unfmask_slc == 0))
-                nbdsat = len(bdsat)
-                for j in range(bdsat):
-                    temp_dCounts[bdsat[j],satmask[bdsat[j],i,1]-1:] = np.nan
-      
-  
-            fmed_dCounts = np.median(temp_dCounts,axis=2)    # NAN are automatically ignored
-            bdnan, = np.where(finite(fmed_dCounts) == 0)
-            if len(bdnan) > 0:
-                import pdb; pdb.set_trace()
-                med_dCounts_im[:,i] = fmed_dCounts
-  
-        # Only 2 reads
-        else:
-            med_dCounts_im[:,i] = dCounts
-    
-        if verbose or debug:
-            nsatslc = np.sum(satmask[:,i,0])
-            if len(crstr) == 0:
-                ncrslc = 0
-            else:
-                dum, = np.where(crstr['data'].y == i)
-                ncrslc = len(dum)
-            print('Nsat/NCR = ',str(int(nsatslc)),'/',str(int(ncrslc)),' this row')
-    
+        timer.start('blocks')
+        #---------------------------------------------
+        # PROCESS THE CUBE IN BLOCKS OF ROWS AT A TIME
+        #---------------------------------------------
   
-        #----------
-        # Plotting
-        #----------
-        #debug = 1
-        pltpix, = np.where(mask[:,i] > 1)
-        npltpix = len(pltpix)
-        if keyword_set(debueg) and npltpix > 0:
-            ap3dproc_plotting(dcounts,slc_prefix,slc_fixed,mask,crstr,i,saturation)
-  
-        if len(crstr) == 0:
-            crstr = {'ncr':0}
+        # Here is the method.  For each pixel find the dCounts for
+        # each neighboring pair of reads.  Then find the median dCounts
+        # and the RMS (robustly).  If there are any dCounts that are
+        # many +sigma then this is a cosmic ray.  Then use the median
+        # dCounts around that read to correct the CR.
+        # All of the pixels in a block of rows are processed at once,
+        # and the blocks can be processed in parallel (nworkers).
+
+        if silent==False:
+            print('Processing the datacube')
+
+        calib = {'bpmim':bpmim,'littrowim':littrowim,'persistim':persistim,'lindata':lindata,
+                 'darkcube':darkcube,'darkhead':darkhead}
+        out = ap3dproc_blocks(cube,mask,calib,blocksize=blocksize,nworkers=nworkers,
+                              tmpdir=utils.localdir(),silent=silent,saturation=saturation,
+                              noise=noise_dCounts,nocr=nocr,crfix=crfix,satfix=satfix,
+                              rd3satfix=rd3satfix,dtype=dtype,usenumba=usenumba,timer=timer,
+                              verbose=(verbose or debug))
+        cube,mask,satmask,med_dCounts_im,variability_im,sat_extrap_error,crstr = out
     
+        timer.start('criter')
         #------------------------
         # Iterative CR Rejection
         #------------------------
@@ -1867,119 +3101,8 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         if criter:
             if silent==False:
                 print('Checking neighbors for CRs')
-  
-            iterflag = 0
-            niter = 0
-            while (iterflag != 1) and (crstr.ncr > 0):
-                newcr_thisloop = 0
-  
-                # CRs are left to check
-                crtocheck, = np.where(crstr.data.neicheck == 0)
-                ncrtocheck = len(crtocheck)
-                    
-                # Loop through the CRs
-                for i in range(ncrtocheck):
-                    ix = crstr.data[crtocheck[i]].x
-                    iy = crstr.data[crtocheck[i]].y
-                    ir = crstr.data[crtocheck[i]].read
-  
-                    # Look at neighboring pixels to the affected CR
-                    #   at the same read
-                    xlo = (ix-1) > 0
-                    xhi = (ix+1) < (nx-1)
-                    ylo = (iy-1) > 0
-                    yhi = (iy+1) < (ny-1)
-                    nnei = (xhi-xlo+1)*(yhi-ylo+1) - 1
-  
-                    # Create a fake "slice" of the neighboring pixels
-                    nei_slc = np.zeros((nnei,nreads),float)
-                    nei_slc_orig = np.zeros((nnei,nreads),float)  # original slc if saturated
-                    nei_cols = np.zeros(nnei,float)  # x
-                    nei_rows = np.zeros(nnei,float)  # y
-                    nei_satmask = np.zeros((nnei,3),int)
-                    count = 0
-                    for j in np.arange(xlo,xhi+1):
-                        for k in np.arange(ylo,yhi+1):
-                            # Check that the read isn't saturated for this pixel and read
-                            if satmask[j,k,0] == 1 and satmask[j,k,1] <= ir:
-                                readsat = 1
-                            else:
-                                readsat = 0
-                            # Only want neighbors
-                            if (j != ix and k != iy) and (readsat == 0):
-                                nei_slc[count,:] = cube[j,k,:].astype(float)
-                                nei_slc_orig[count,:] = cube[j,k,:].astype(float)
-                                nei_cols[count] = j
-                                nei_rows[count] = k
-                                nei_satmask[count,:] = satmask[j,k,:]
-                                # if this pixel is saturated then we need to make the saturated
-                                #   reads NAN again.  The "fixed" values are in nei_slc_orig
-                                if satmask[j,k,0] == 1:
-                                    nei_slc[count,satmask[j,k,1]:nreads] = np.nan
-                                count += 1
-  
-                    # Difference of neighboring reads, dCounts
-                    nei_dCounts = nei_slc[:,1:nreads] - nei_slc[:,0:nreads-1]
-  
-                    # Fix/detect cosmic rays
-                    ap3dproc_crfix(nei_dCounts,nei_satmask,nei_dCounts_fixed,med_nei_dCounts,nei_crstr,crfix=crfix,
-                                   noise=noise_dCounts,sigthresh=6,onlythisread=ir)
-  
-  
-                    # Some new CRs detected
-                    if nei_crstr.ncr > 0:
-                        # Add the neighbor information
-                        ind = nei_crstr.data.x             # index in the nei slice
-                        nei_crstr.data.x = nei_cols[ind]   # actual column index
-                        nei_crstr.data.y = nei_rows[ind]   # actual row index
-  
-                        # Replace NANs if there were saturated pixels
-                        bdsat, = np.where(nei_satmask[:,0] == 1)
-                        nbdsat = len(bdsat)
-                        for j in range(nbdsat):
-                            lr = nei_satmask[bdsat[j],1]-1
-                            hr = nreads-2
-                            nei_dCounts_orig = nei_slc_orig[:,1:nreads-1] - nei_slc_orig[:,0:nreads-2]  # get "original" dCounts
-                            nei_dCounts_fixed[bdsat[j],lr:hr] = nei_dCounts_orig[bdsat[j],lr:hr]            # put the original fixed valued back in
-                    
-                        # Reconstruct the SLICE from dCounts
-                        nei_slc0 = nei_slc[:,0]  # first read
-                        bdsat, = np.where(finite(nei_slc0) == 0)  # set NAN in first read to 0.0
-                        nbdsat = len(bdsat)
-                        if nbdsat > 0:
-                            nei_slc0[bdsat] = 0.0
-                        nei_slc_fixed = nei_slc0 # (fltarr(nreads)+1.0)
-                        if nreads > 2:
-                            nei_slc_fixed[:,1:] += np.cumsum(nei_dCounts_fixed,axis=2)
-                        else:
-                            nei_slc_fixed[:,0] = nei_slc0
-                            nei_slc_fixed[:,1] = nei_slc0+nei_dCounts_fixed
-  
-                        # Put fixed slc back into cube
-                        #  only update new CR pixels
-                        for j in range(nei_crstr.ncr):
-                            cube[nei_crstr.data[j].x,nei_crstr.data[j].y,:] = np.round( nei_slc_fixed[ind[j],:] )  # round to integer
-  
-                        # Update med_dCounts_im ???
-  
-                        # Add to the total CRSTR
-                        ncrtot = crstr.ncr + nei_crstr.ncr
-                        old_crstr = crstr
-                        crstr = {'ncr':ncrtot,'data':[old_crstr.data, nei_crstr.data]}
-                        old_crstr = None
-  
-                    # New CRs detected
-                    nnew = nei_crstr['ncr']
-                    newcr_thisloop += nnew
-  
-                    # This CR has been checked
-                    crstr.data[crtocheck[i]].neicheck = 1  # checked!
-  
-                # Time to stop
-                if (newcr_thisloop == 0) or (niter > 5) or (ncrtocheck == 0):
-                    iterflag = 1
-  
-                niter += 1
+            cube,mask,crstr = ap3dproc_criter(cube,mask,satmask,crstr,noise=noise_dCounts,
+                                              crfix=crfix,silent=silent)
   
   
         #-------------------------------------
@@ -1997,16 +3120,22 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         # this needs to happen before dark subtraction!!
   
   
+        timer.start('variability')
         #--------------------------------
         # Measure "variability" of data
         #--------------------------------
+        # Only the image, not the reference output
+        satmask = satmask[:,0:2048,:]
+        med_dCounts_im = med_dCounts_im[:,0:2048]
+        variability_im = variability_im[:,0:2048]
+        sat_extrap_error = sat_extrap_error[:,0:2048]
         # Use pixels with decent count rates
-        crmask = int((int(mask) & maskval('CRPIX')) == maskval('CRPIX'))
-        highpix, = np.where((satmask[:,:,0] == 0) & (crmask == 0) & (med_dCounts_im > 40))
-        nhighpix = len(highpix)
+        crmask = ((mask & maskval('CRPIX')) > 0)
+        highpix = (satmask[:,:,0] == 0) & (crmask == False) & (med_dCounts_im > 40)
+        nhighpix = np.sum(highpix)
         if nhighpix == 0:
-            highpix, = np.where((satmask[:,:,0] == 0) & (med_dCounts_im > 20))
-            nhighpix = len(highpix)
+            highpix = (satmask[:,:,0] == 0) & (med_dCounts_im > 20)
+            nhighpix = np.sum(highpix)
         if nhighpix > 0:
             global_variability = np.median(variability_im[highpix])
         else:
@@ -2033,128 +3162,51 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         #  
   
   
+        timer.start('sampling')
         #------------------------
         # COLLAPSE THE DATACUBE
         #------------------------
     
         # No gain image, using gain=1.0 for all pixels
         # gain = Electrons/ADU
-        if len(gainim)==0:
-            print('NO gain image.  Using GAIN=1')
+        if gainim is None:
+            if silent==False:
+                print('NO gain image.  Using GAIN=1')
             gainim = np.ones((2048,2048),float)
 
             
-        # Fowler Sampling
-        #------------------
-        if uptheramp == False:
-  
-            # Make sure that Nfowler isn't too large
-            Nfowler_used = Nfowler
-            if Nfowler > Nreads/2:
-                Nfowler_used = Ngdreads/2
-  
-            # Use the mean of Nfowler reads
-
-            # Beginning sample
-            gd_beg = gdreads[0:nfowler_used]
-            if len(gd_beg) == 1:
-                im_beg = cube[:,:,gd_beg]/Nfowler_used.astype(float)
-            else:
-                im_beg = np.sum(cube[:,:,gd_beg],axis=3)/Nfowler_used.astype(float)
-
-            # End sample
-            gd_end = gdreads[ngdreads-nfowler_used:ngdreads-1]
-            if len(gd_end) == 1:
-                im_end = cube[:,:,gd_end]/Nfowler_used.astype(float)
-            else:
-                im_end = np.sum(cube[:,:,gd_end],axis=3)/Nfowler_used.astype(float)
-
-            # The middle read will be used twice for 3 reads
-
-            # Subtract beginning from end
-            im = im_end - im_beg
-  
-            # Noise contribution to the variance
-            sample_noise = noise * np.sqrt(2.0/Nfowler_used)
-  
-        # Up-the-ramp sampling
-        #---------------------
-        else:
-            # For now just fit a line to each pixel
-            #  Use median dCounts for each pixel to get the flux rate, i.e. "med_dCounts_im"
-            #  then multiply by the exposure time.
-            # THIS WILL NEED TO BE IMPROVED IN THE FUTURE TO TAKE THROUGHPUT VARIATIONS
-            # INTO ACCOUNT.  FOR NOW THIS IS JUST FOR DARKS AND FLATS
-            #im = med_dCounts_im * nreads
-  
-  
-            # Fit a line to the reads for each pixel
-            #   dCounts are noisier than the actual reads by sqrt(2)
-            #   See Rauscher et al.(2007) Eqns.3
-  
-            # Calculating the slope for each pixel
-            #  t is the exptime, s is the signal
-            #  we will use the read index for t
-            sumts = np.zeros((sz[1],sz[2]),float)   # SUM t*s
-            sums = np.zeros((sz[1],sz[2]),float)    # SUM s
-            sumn = np.zeros((sz[1],sz[2]),int)    # SUM s
-            sumt = np.zeros((sz[1],sz[2]),float)   # SUM t*s
-            sumt2 = np.zeros((sz[1],sz[2]),float)   # SUM t*s
-            for k in range(ngdreads):
-                slc = cube[:,:,gdreads[k]]
-                if satfix==False:
-                    good, = np.where((satmask[:,:,0] == 0) | ((satmask[:,:,0] == 1) & (satmask[:,:,1] > i)))
-                else:
-                    good, = np.where(np.finite(slc))
-            #good = np.where(finite(slc))
-            sumts[good] += gdreads[k]*reform(slc[good])
-            sums[good] += reform(slc[good])
-            sumn[good] += 1
-            sumt[good] += gdreads[k]
-            sumt2[good] += gdreads[k]**2
-            #sumt = total(findgen(nread))     # SUM t
-            #sumt2 = total(findgen(nread)^2)  # SUM t^2
-            # The slope in Counts per read, similar to med_dCounts_im
-            #slope = (nread*sumts - sumt*sums)/(nread*sumt2 - sumt^2)
-            slope = (sumn*sumts - sumt*sums)/(sumn*sumt2 - sumt**2)
-            # To get the total counts just multiply by nread
-            im = slope * (ngdreads-1)
-            # the first read doesn't really add any signal, just a zero-point
-  
-            # See Equation 1 in Rauscher et al.(2007), SPIE
-            #  with m=1
-            #  noise and image/flux should be in electrons, sample_noise is in electrons
-            #sample_noise = sqrt( 12*(ngdreads-1.)/(nreads*(ngdreads+1.))*(noise*gainim)^2 + 6.*(ngdreads^2+1)/(5.*ngdreads*(ngdreads+1))*im*gainim )
-            sample_noise = np.sqrt( 12*(ngdreads-1.)/(nreads*(ngdreads+1.))*noise**2 +
-                                    6.*(ngdreads**2+1)/(5.*ngdreads*(ngdreads+1))*im[0:2048,:]*gainim )
-            sample_noise /= gainim  # convert to ADU
-  
-            # Noise contribution to the variance
-            #   this is only valid if the variability is zero
-            #ngdreads = nreads - nbdreads
-            #sample_noise = noise / sqrt(Ngdreads)
+        # Fowler or Up-the-ramp sampling
+        #--------------------------------
+        out = ap3dproc_sample(cube,gdreads,satmask=satmask,satfix=satfix,uptheramp=uptheramp,
+                              nfowler=nfowler,noise=noise,gainim=gainim,usenumba=usenumba,
+                              dtype=dtype)
+        im,sample_var,Nfowler_used,slope,intercept = out
 
         # With userference, subtract off the reference array to reduce/remove
         #   crosstalk. 
-        if usereference==True:
-            print('subtracting reference array...')
-            tmp = im[0:2048,0:2048]
-            ref = im[2048:2560,0:2048]
+        if usereference:
+            if silent==False:
+                print('subtracting reference array...')
+            ref = im[:,2048:2560].copy()
             # subtract smoothed horizontal structure
-            ref -= (np.zeros(512,float)+1)#medfilt1d(median(ref,dim=1),7)
-            ref = aprefcorr_sub(tmp,ref)
-            im = tmp
-            nx = 2048
+            ref -= ap3dproc_medfilt(np.median(ref,axis=1),7)[:,np.newaxis]
+            im = aprefcorr_sub(im[:,0:2048].copy(),ref)
 
+        timer.start('persistence')
         #-----------------------------------
         # Apply the Persistence Correction
         #-----------------------------------
-        if len(persistmodelcorr) > 0 and len(histcorr) > 0:
+        pmodelim,ppar = None,None
+        if persistmodelcorr is not None and histcorr is not None:
             if silent==False:
                 print('PERSIST modelcorr file = '+persistmodelcorr)
-            appersistmodel(ifile,histcorr,persistmodelcorr,pmodelim,ppar,bpmfile=bpmcorr,error=perror)
-            im -= pmodelim
+            pmodelim,ppar = appersistmodel(ifile,histcorr,persistmodelcorr,bpmfile=bpmcorr,silent=silent)
+            if pmodelim is not None and len(pmodelim) > 0:
+                im -= pmodelim
+            else:
+                pmodelim = None
 
+        timer.start('variance')
         #------------------------
         # Calculate the Variance
         #------------------------
@@ -2169,23 +3221,23 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
   
   
         # Initialize varim
-        varim = np.zeros((nx,ny),float)         # variance in ADU
+        varim = np.zeros((2048,2048),float)         # variance in ADU
   
         # 1. Poisson Noise from the image: note that the equation for UTR
         #    noise above already includes Poisson term
-        if not keyword_set(uptheramp):
-            if len(pmodelim) > 0:
+        if not uptheramp:
+            if pmodelim is not None:
                 varim += np.maximum( (im+pmodelim)/gainim , 0)
             else:
                 varim += np.maximum(im/gainim,0)
      
         # 2. Poisson Noise from dark current
-        if len(darkcube) > 0:
+        if darkcube is not None:
             darkim = darkcube[:,:,nreads-1]
             varim += np.maximum(darkim/gainim,0)
   
         # 3. Sample/read noise
-        varim += sample_noise**2         # rdnoise reduced by the sampling
+        varim += sample_var         # rdnoise reduced by the sampling
   
         # 4. Saturation error
         #      We used median(dCounts) to extrapolate the saturated pixels
@@ -2193,64 +3245,51 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         if satfix:
             varim += sat_extrap_error     # add saturation extrapolation error
         else:
-            varim = varim*(1-satmask[:,:,0]) + satmask[:,:,0]*99999999.   # saturated pixels are bad!
+            varim[satmask[:,:,0]==1] = 99999999.    # saturated pixels are bad!
         # Unfixable pixels
-        unfmask = int((int(mask) & maskval('UNFIXABLE')) == maskval('UNFIXABLE'))  # unfixable
-        varim = varim*(1-unfmask) + unfmask*99999999.         # unfixable pixels are bad!
+        unfmask = ((mask & maskval('UNFIXABLE')) > 0)
+        varim[unfmask] = 99999999.         # unfixable pixels are bad!
   
         # 5. CR error
         #     We use median of neighboring dCounts to "fix" reads with CRs
-        crmask = int((int(mask) & maskval('CRPIX')) == maskval('CRPIX'))
-        if crfix == True:
-            # loop in case there are multiple CRs per pixel
-            for i in range(crstr.ncr):
-                if crstr.data[i].x < 2048:
-                    varim[crstr.data[i].x,crstr.data[i].y]+=crstr.data[i].fixerror
-                else:
-                    varim = varim*(1-crmask) + crmask*99999999.               # pixels with CRs are bad!
+        crmask = ((mask & maskval('CRPIX')) > 0)
+        if crfix:
+            # add.at in case there are multiple CRs per pixel
+            #  not the reference output
+            if crstr['ncr'] > 0:
+                crdata = crstr['data']
+                gd = (crdata['y'] < 2048)
+                np.add.at(varim,(crdata['x'][gd],crdata['y'][gd]),crdata['fixerror'][gd])
+        else:
+            varim[crmask] = 99999999.               # pixels with CRs are bad!
   
         # Bad pixels
-        bpmmask = int((int(mask) & maskval('BADPIX')) == maskval('BADPIX'))
-        varim = varim*(1-bpmmask) + bpmmask*99999999.               # bad pixels are bad!
+        bpmmask = ((mask & maskval('BADPIX')) > 0)
+        varim[bpmmask] = 99999999.               # bad pixels are bad!
 
         # Flat field  
-        if len(flatim) > 0:
+        if flatim is not None:
             varim /= flatim**2
             im /= flatim
 
         # Now convert to ELECTRONS
-        if len(detcorr) > 0 and outelectrons==False:
+        if detcorr is not None and outelectrons:
             varim *= gainim**2
             im *= gainim
 
-        #----------------------------
-        # Construct output datacube
-        #  [image, error, mask]
-        #----------------------------
-        if len(pmodelim) > 0:
-            output = np.zeros((nx,ny,4),float)
-        else:
-            output = np.zeros((nx,ny,3),float)
-        output[:,:,0] = im
-        output[:,:,1] = np.maximum(np.sqrt(varim),1)  # must be greater than zero
-        output[:,:,2] = mask
-        if len(pmodelim)>0:
-            output[:,:,3] = pmodelim  # persistence model in ADU
-  
         #-----------------------------
         # Update header
         #-----------------------------
         leadstr = 'AP3D: '
         pyvers = sys.version.split()[0]
-        head['V_APRED'] = getvers()
-        head['HISTORY'] = leadstr+time.time()  # need better time output
-        import socket
-        head['HISTORY'] = leadstr+os.getlogin()+' on '+socket.gethostname()
-        import platform
-        head['HISTORY'] = leadstr+'python '+pyvers+' '+platform.system()+' '+platform.release()+' '+platform.architecture()[0]
-        head['HISTORY'] = leadstr+' APOGEE Reduction Pipeline Version: '+getvers()
+        head['V_APRED'] = plan.getgitvers(),'APOGEE software version'
+        head['APRED'] = os.environ.get('APOGEE_DRP_VER',''),'APOGEE Reduction version'
+        head['HISTORY'] = leadstr+time.asctime()
+        head['HISTORY'] = leadstr+getpass.getuser()+' on '+socket.gethostname()
+        head['HISTORY'] = leadstr+'Python '+pyvers+' '+platform.system()+' '+platform.release()+' '+platform.architecture()[0]
+        head['HISTORY'] = leadstr+' APOGEE Reduction Pipeline Version: '+head['APRED']
         head['HISTORY'] = leadstr+'Output File:'
-        if len(detcorr) > 0 and keyword_set(outelectrons):
+        if detcorr is not None and outelectrons:
             head['HISTORY'] = leadstr+' HDU1 - image (electrons)'
             head['HISTORY'] = leadstr+' HDU2 - error (electrons)'
         else:
@@ -2261,103 +3300,39 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         head['HISTORY'] = leadstr+'        2 - cosmic ray'
         head['HISTORY'] = leadstr+'        4 - saturated'
         head['HISTORY'] = leadstr+'        8 - unfixable'
-        if len(pmodelim) > 0:
+        if pmodelim is not None:
             head['HISTORY'] = leadstr+' HDU4 - persistence correction (ADU)'
-        head['HISTORY'] = leadstr+'Global fractional variability = '+str(string(global_variability,format='(F5.3)'))
-        maxlen = 72-strlen(leadstr)
-        # Bad pixel mask file
-        if len(bpmim) > 0:
-            line = 'BAD PIXEL MASK file="'+bpmcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Detector file
-        if len(detcorr) > 0:
-            line = 'DETECTOR file="'+detcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Dark Correction File
-        if len(darkcube) > 0:
-            line = 'Dark Current Correction file="'+darkcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Flat field Correction File
-        if len(flatim) > 0:
-            line = 'Flat Field Correction file="'+flatcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Littrow ghost mask File
-        if len(littrowim) > 0:
-            line = 'Littrow ghost mask file="'+littrowcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Persistence mask File
-        if len(persistim) > 0:
-            line = 'Persistence mask file="'+persistcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # Persistence model file
-        if len(persistmodelcorr) > 0:
-            line = 'Persistence model file="'+persistmodelcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
-        # History file
-        if len(histcorr) > 0:
-            line = 'Exposure history file="'+histcorr+'"'
-            if strlen(line) > maxlen:
-                line1 = line[0:maxlen]
-                line2 = line[maxlen:]
-                head['HISTORY'] = leadstr+line1
-                head['HISTORY'] = leadstr+line2
-            else:
-                head['HISTORY'] = leadstr+line
+        head['HISTORY'] = leadstr+'Global fractional variability = %5.3f' % global_variability
+        # Calibration files
+        #  split long lines
+        maxlen = 72-len(leadstr)
+        calfiles = [('BAD PIXEL MASK',bpmcorr,'BPMFILE'),('DETECTOR',detcorr,'DETFILE'),
+                    ('Dark Current Correction',darkcorr,'DARKFILE'),
+                    ('Flat Field Correction',flatcorr,'FLATFILE'),
+                    ('Littrow ghost mask',littrowcorr,'LITTROW'),
+                    ('Persistence mask',persistcorr,'PERSIST')]
+        if pmodelim is not None:
+            calfiles += [('Persistence model',persistmodelcorr,'PERMODEL'),
+                         ('Exposure history',histcorr,'HISTFILE')]
+        for calname,calfile,calkey in calfiles:
+            if calfile is None:
+                continue
+            line = calname+' file="'+calfile+'"'
+            for i in range(0,len(line),maxlen):
+                head['HISTORY'] = leadstr+line[i:i+maxlen]
+            head[calkey] = calfile
         # Bad pixels 
-        bpmmask = int((int(mask) & maskval('BADPIX')) == maskval('BADPIX'))
-        totbpm = np.sum(bpmmask)
+        totbpm = np.sum((mask & maskval('BADPIX')) > 0)
         head['HISTORY'] = leadstr+str(int(totbpm))+' pixels are bad'
         # Cosmic Rays
-        crmask, = np.where(int(mask) & maskval('CRPIX'),totcr)
+        totcr = np.sum((mask & maskval('CRPIX')) > 0)
         if nreads > 2:
             head['HISTORY'] = leadstr+str(int(totcr))+' pixels have cosmic rays'
         if crfix and nreads>2:
             head['HISTORY'] = leadstr+'Cosmic Rays FIXED'
         # Saturated pixels
-        satmask, = np.where(int(mask) & maskval('SATPIX'),totsat)
-        unfmask, = np.where(int(mask) & maskval('UNFIXABLE'),totunf)
+        totsat = np.sum((mask & maskval('SATPIX')) > 0)
+        totunf = np.sum((mask & maskval('UNFIXABLE')) > 0)
         totfix = totsat-totunf
         head['HISTORY'] = leadstr+str(int(totsat))+' pixels are saturated'
         if satfix and nreads>2:
@@ -2366,115 +3341,109 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
         head['HISTORY'] = leadstr+str(int(totunf))+' pixels are unfixable'
         # Sampling
         if uptheramp:
-            head['HISTORY'] = leadstr+'UP-THE-RAMP Sampling',head
+            head['HISTORY'] = leadstr+'UP-THE-RAMP Sampling'
         else:
-            head['HISTORY'] = leadstr+'Fowler Sampling, Nfowler='+str(int(Nfowler_used)),head 
+            head['HISTORY'] = leadstr+'Fowler Sampling, Nfowler='+str(int(Nfowler_used))
         # Persistence correction factor
-        if len(pmodelim) > 0 and len(ppar) > 0:
-            head['HISTORY'] = leadstr+'Persistence correction: '+' '.join(str(string(ppar,format='(G7.3)'))),head
+        if pmodelim is not None and ppar is not None and len(ppar) > 0:
+            head['HISTORY'] = leadstr+'Persistence correction: '+' '.join(['%7.3g' % p for p in ppar])
   
         # Fix EXPTIME if necessary
-        if head['NFRAMES'] != nreads:
+        if head.get('NFRAMES') != nreads:
             # NFRAMES is from ICC, NREAD is from bundler which should be correct
             exptime = nreads*10.647  # secs
             head['EXPTIME'] = exptime
-            print('not halting, but NFRAMES does not match NREADS, NFRAMES: ', head['NFRAMES'], ' NREADS: ',str(nreads),'  ', seq)
-            #print('halt: NFRAMES does not match NREADS, NFRAMES: ', sxpar(head,'NFRAMES'), ' NREADS: ',string(format='(i8)',nreads),'  ', seq
+            print('not halting, but NFRAMES does not match NREADS, NFRAMES: ', head.get('NFRAMES'),
+                  ' NREADS: ',str(nreads),'  ', seq)
 
         # Add UT-MID/JD-MID to the header
-        jd = date2jd(head['DATE-OBS'])
+        jd = Time(head['DATE-OBS'],format='isot',scale='utc').jd
         exptime = head['EXPTIME']
         jdmid = jd + (0.5*exptime)/24/3600
-        utmid = jd2date(jdmid)
+        utmid = Time(jdmid,format='jd',scale='utc').isot
         head['UT-MID'] = utmid,' Date at midpoint of exposure'
         head['JD-MID'] = jdmid,' JD at midpoint of exposure'
 
         # remove CHECKSUM
-        del head['CHECKSUM']
+        if 'CHECKSUM' in head:
+            del head['CHECKSUM']
   
+        timer.start('write')
         #----------------------------------
         # Output the final image and mask
         #----------------------------------
-        if outfile is not None:
-            ioutfile = outfile[f]
+        ioutfile = outfile[f]
   
-            # Does the output directory exist?
-            if os.path.exists(os.path.dirname(ioutfile))==False:
-                print('Creating ',os.path.dirname(ioutfile))
-                os.makedirs(os.path.dirname(ioutfile))
+        # Does the output directory exist?
+        if os.path.dirname(ioutfile) != '' and os.path.exists(os.path.dirname(ioutfile))==False:
+            print('Creating ',os.path.dirname(ioutfile))
+            os.makedirs(os.path.dirname(ioutfile))
   
-            # Test if the output file already exists
-            test = os.path.exists(ioutfile)
-
-            if silent==False:
-                print('')
-            if test == 1 and clobber:
-                print('OUTFILE = ',ioutfile,' ALREADY EXISTS.  OVERWRITING')
-            if test == 1 and clobber==False:
-                print('OUTFILE = ',ioutfile,' ALREADY EXISTS. ')
+        # Test if the output file already exists
+        if silent==False:
+            print('')
+        if os.path.exists(ioutfile) and clobber:
+            print('OUTFILE = ',ioutfile,' ALREADY EXISTS.  OVERWRITING')
     
         # Writing file
-        if test == 0 or clobber:
-            if silent==False:
-                print('Writing output to: ',ioutfile)
-            if outlong:
-                print('Saving FLUX/ERR as LONG instead of FLOAT')
-            # HDU0 - header only
-            hdu = fits.HDUList()
-            hdu.append(fits.ImageHDU(0,head))
-            #FITS_WRITE,ioutfile,0,head,message=write_error    
-            # HDU1 - flux
-            flux = output[:,:,0]
-            # replace NaNs with zeros
-            bad, = np.where(np.isfinite(flux)==False)
-            nbad = len(bad)
-            if nbad > 0:
-                flux[bad] = 0.
-            if outlong:
-                flux = np.round(flux)
-            hdu.append(fits.ImageHDU(flux,head1))
-            hdu[1].header['CTYPE1'] = 'Pixel'
-            hdu[1].header['CTYPE2'] = 'Pixel'
-            hdu[1].header['BUNIT'] = 'Flux (ADU)'
-
-            # HDU2 - error
-            #err = sqrt(reform(output[:,:,1])) > 1  # must be greater than zero
-            err = errout(output[:,:,1])
-            if outlong:
-                err = np.round(err)
-            hdu.append(fits.ImageHDU(err,head2))
-            hdu[2].header['CTYPE1'] = 'Pixel'
-            hdu[2].header['CTYPE2'] = 'Pixel'
-            hdu[2].header['BUNIT'] = 'Error (ADU)'
-
-            # HDU3 - mask
-            #flagmask = fix(reform(output[:,:,2]))
-            # don't go through conversion to float and back!
-            flagmask = mask.astype(int)
-            hdu.append(fits.ImageHDU(flagmask,head3))
-            hdu[3].header['CTYPE1'] = 'Pixel'
-            hdu[3].header['CTYPE2'] = 'Pixel'
-            hdu[3].header['BUNIT'] = 'Flag Mask (bitwise)'
-            hdu[3].header['HISTORY'] = 'Explanation of BITWISE flag mask'
-            hdu[3].header['HISTORY'] = ' 1 - bad pixels'
-            hdu[3].header['HISTORY'] = ' 2 - cosmic ray'
-            hdu[3].header['HISTORY'] = ' 4 - saturated'
-            hdu[3].header['HISTORY'] = ' 8 - unfixable'
-            #MWRFITS,flagmask,ioutfile,head3
-            #FITS_WRITE,ioutfile,output,head,/no_abort,message=write_error
-            #if write_error != '' then print('Error writing file '+write_error)
-
-            # HDU4 - persistence model
-            if len(pmodelim) > 0:
-                hdu.append(fits.ImageHDU(pmodelim))
-                hdu[4].header['CTYPE1'] = 'Pixel'
-                hdu[4].header['CTYPE2'] = 'Pixel'
-                hdu[4].header['BUNIT'] = 'Persistence correction (ADU)'
+        if silent==False:
+            print('Writing output to: ',ioutfile)
+        if outlong:
+            print('Saving FLUX/ERR as LONG instead of FLOAT')
+        # HDU0 - header only
+        hdu = fits.HDUList()
+        hdu.append(fits.PrimaryHDU(header=head))
+        # HDU1 - flux
+        flux = im
+        # replace NaNs with zeros
+        flux[np.isfinite(flux)==False] = 0.
+        if outlong:
+            flux = np.round(flux)
+        hdu.append(fits.ImageHDU(flux))
+        hdu[1].header['CTYPE1'] = 'Pixel'
+        hdu[1].header['CTYPE2'] = 'Pixel'
+        hdu[1].header['BUNIT'] = 'Flux (ADU)'
+
+        # HDU2 - error
+        #  must be greater than zero, bad pixels get BADERR
+        err = np.maximum(np.sqrt(varim),1)
+        err[(err==BADERR) | (err <= 0) | (np.isfinite(err)==False)] = BADERR
+        if outlong:
+            err = np.round(err)
+        hdu.append(fits.ImageHDU(err))
+        hdu[2].header['CTYPE1'] = 'Pixel'
+        hdu[2].header['CTYPE2'] = 'Pixel'
+        hdu[2].header['BUNIT'] = 'Error (ADU)'
+
+        # HDU3 - mask
+        # don't go through conversion to float and back!
+        flagmask = mask.astype(int)
+        hdu.append(fits.ImageHDU(flagmask))
+        hdu[3].header['CTYPE1'] = 'Pixel'
+        hdu[3].header['CTYPE2'] = 'Pixel'
+        hdu[3].header['BUNIT'] = 'Flag Mask (bitwise)'
+        hdu[3].header['HISTORY'] = 'Explanation of BITWISE flag mask'
+        hdu[3].header['HISTORY'] = ' 1 - bad pixels'
+        hdu[3].header['HISTORY'] = ' 2 - cosmic ray'
+        hdu[3].header['HISTORY'] = ' 4 - saturated'
+        hdu[3].header['HISTORY'] = ' 8 - unfixable'
+
+        # HDU4 - persistence model
+        if pmodelim is not None:
+            hdu.append(fits.ImageHDU(pmodelim))
+            hdu[4].header['CTYPE1'] = 'Pixel'
+            hdu[4].header['CTYPE2'] = 'Pixel'
+            hdu[4].header['BUNIT'] = 'Persistence correction (ADU)'
+        if writer is not None:
+            writer(hdu,ioutfile)
+        else:
+            hdu.writeto(ioutfile,overwrite=True)
+            hdu.close()
   
         # Remove the recently Decompressed file
         if extension == 'apz' and cleanuprawfile and doapunzip:
-            print('Deleting recently decompressed file ',file)
-            if os.path.exists(file): os.remove(file)
+            print('Deleting recently decompressed file ',fitsfile)
+            if os.path.exists(fitsfile): os.remove(fitsfile)
     
         # Number of saturated and CR pixels
         if silent==False:
@@ -2486,24 +3455,378 @@ def ap3dproc(files,outfile,detcorr=None,bpmcorr=None,darkcorr=None,littrowcorr=N
             print(str(int(totunf)),' pixels are unfixable')
             print('')
 
+        # Remove the memory-mapped streaming files
+        #  the returned cube stays mapped until it is deleted
+        if maxmem is not None:
+            del refcube
+            for mfile in [cubefile,refcubefile]:
+                if os.path.exists(mfile): os.remove(mfile)
+
+        # Per-stage timing record
+        if writetiming:
+            timer.save(outfile[f].replace('.fits','_timing.json'),silent=silent)
+
         if os.path.exists(lockfile): os.remove(lockfile)
   
         dt = time.time()-t0
         if silent==False:
-            print('dt = %10.f1 sec ' % dt)
+            print('dt = %10.1f sec ' % dt)
         if logfile is not None:
-            name = os.path.basename(ifile)+('%f10.2 %1x %i8 %1x %i8 %1x %i8 %i8' % (dt,totbpm,totcr,totsat,totunf))
+            name = os.path.basename(ifile)+('%10.2f %8d %8d %8d %8d' % (dt,totbpm,totcr,totsat,totunf))
             utils.writelog(logfile,name)
 
-        if nfiles > 1:
-            dt = systime(1)-t00
-            if silent==False:
-                print('dt = ',str(string(dt,format='(F10.1)')),' sec')
+    if nfiles > 1:
+        dt = time.time()-t00
+        if silent==False:
+            print('dt = %10.1f sec' % dt)
 
     return flux,cube
                 
 
-def ap3d(planfiles,verbose=False,rogue=False,clobber=False,refonly=False,unlock=False):
+def ap3dproc_compare(files,outdir=None,rdnoise=None,silent=False,**kwargs):
+    """
+    Run ap3dproc on the same exposure in float64 and float32 mode and
+    report the differences in the flux, variance and mask planes.
+
+    Parameters
+    ----------
+    files : str or list
+       The raw exposure files.
+    outdir : str, optional
+       Directory for the two sets of output files.  By default a
+         temporary directory is used and removed afterwards.
+    rdnoise : float, optional
+       The read noise (ADU) to compare the flux differences to.  By
+         default the read noise from the DETCORR file is used, or 12.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+    **kwargs
+       All other keywords are passed to ap3dproc (detcorr, bpmcorr, etc.).
+
+    Returns
+    -------
+    stats : list
+       List of dictionaries with the statistics for each file.  The
+         keys are flux_maxdiff, flux_rmsdiff, var_maxdiff, var_rmsdiff,
+         var_maxreldiff, mask_ndiff, and rdnoise.
+
+    Example
+    -------
+
+    stats = ap3dproc_compare('apR-a-12345678.apz',detcorr=detcorr,darkcorr=darkcorr)
+
+    """
+
+    files = np.atleast_1d(files)
+    tmpdir = None
+    if outdir is None:
+        tmpdir = tempfile.mkdtemp(prefix='ap3dcompare')
+        outdir = tmpdir
+    if os.path.exists(outdir)==False:
+        os.makedirs(outdir)
+
+    # Read noise
+    if rdnoise is None:
+        rdnoise = 12.0
+        if kwargs.get('detcorr') is not None:
+            rdnoiseim,gainim,lindata = loaddetector(kwargs['detcorr'])
+            rdnoise = np.median(rdnoiseim)
+
+    stats = []
+    for f in files:
+        base = os.path.basename(f).replace('apR','ap2D').replace('.apz','.fits')
+        outfiles = {}
+        for dtype in ['float64','float32']:
+            outfiles[dtype] = os.path.join(outdir,base.replace('.fits','_'+dtype+'.fits'))
+            ap3dproc(f,outfiles[dtype],dtype=dtype,clobber=True,silent=True,**kwargs)
+
+        # Load the flux, variance and mask planes
+        out = {}
+        for dtype in ['float64','float32']:
+            with fits.open(outfiles[dtype]) as hdu:
+                flux = hdu[1].data.astype(float)
+                var = hdu[2].data.astype(float)**2
+                mask = hdu[3].data.astype(int)
+            out[dtype] = (flux,var,mask)
+        flux64,var64,mask64 = out['float64']
+        flux32,var32,mask32 = out['float32']
+
+        gd = np.isfinite(flux64) & np.isfinite(flux32)
+        fdiff = np.abs(flux64[gd]-flux32[gd])
+        gd = np.isfinite(var64) & np.isfinite(var32) & (var64 > 0)
+        vdiff = np.abs(var64[gd]-var32[gd])
+        st = {'file':f, 'flux_maxdiff':np.max(fdiff), 'flux_rmsdiff':np.sqrt(np.mean(fdiff**2)),
+              'var_maxdiff':np.max(vdiff), 'var_rmsdiff':np.sqrt(np.mean(vdiff**2)),
+              'var_maxreldiff':np.max(vdiff/var64[gd]), 'mask_ndiff':int(np.sum(mask64 != mask32)),
+              'rdnoise':rdnoise}
+        stats.append(st)
+
+        if silent==False:
+            print(os.path.basename(f))
+            print('  Flux      max |diff| = %12.5g  RMS diff = %12.5g ADU' % (st['flux_maxdiff'],st['flux_rmsdiff']))
+            print('  Variance  max |diff| = %12.5g  RMS diff = %12.5g ADU^2  max rel diff = %10.3g' %
+                  (st['var_maxdiff'],st['var_rmsdiff'],st['var_maxreldiff']))
+            print('  Mask      %d pixels differ' % st['mask_ndiff'])
+            print('  Max flux difference is %10.3g of the read noise (%.2f ADU)' % (st['flux_maxdiff']/rdnoise,rdnoise))
+
+        if tmpdir is not None:
+            for dtype in outfiles:
+                if os.path.exists(outfiles[dtype]): os.remove(outfiles[dtype])
+
+    if tmpdir is not None and os.path.exists(tmpdir):
+        os.rmdir(tmpdir)
+
+    return stats
+
+
+
+def ap3d_plantasks(planfile,quicklook=False):
+    """
+    Load a plan file, check/make the calibration files and return the
+    list of chip files to process with ap3dproc.
+
+    Parameters
+    ----------
+    planfile : str
+       The plan file name.
+    quicklook : boolean, optional
+       Quick-look mode.  No calibration files are made and the apHist
+         file is not built, only the existing detector and bad pixel
+         mask files are used (see ap3dproc_quicklook).  Default is False.
+
+    Returns
+    -------
+    tasks : list
+       List of dictionaries, one per chip file, with keys planfile, mjd,
+         framenum, seq, exptype, chip, rawfile, outfile, logfile, calkey
+         and kws (the ap3dproc keywords).  calkey is a tuple of the
+         calibration files used for the chip file.
+    logfile : str
+       The Diag log file for the plan file.
+
+    Example
+    -------
+
+    tasks,logfile = ap3d_plantasks(planfile)
+
+    """
+
+    chips = ['a','b','c']
+    tasks = []
+
+    # Load the plan file
+    #--------------------
+    print('')
+    print('Plan file information:')
+    planstr = plan.load(planfile,np=True,verbose=True)
+    if 'apred_vers' not in planstr:
+        print('apred_vers not found in planfile')
+        return [],None
+    if 'telescope' not in planstr:
+        print('telescope not found in planfile')
+        return [],None
+    load = apload.ApLoad(apred=planstr['apred_vers'],telescope=planstr['telescope'])
+    logfile = load.filename('Diag',plate=planstr['plateid'],mjd=planstr['mjd'])        
+
+    # Check that we have all of the calibration IDs in the plan file
+    ids = ['detid','darkid','flatid','bpmid','littrowid','persistid','persistmodelid']
+    calid = ['Detector','Dark','Flat','BPM','Littrow','Persist','PersistModel']
+    for id1,calid1 in zip(ids,calid):
+        if id1 not in planstr:
+            print(id1+' not in planstr')
+            continue
+        print('%-10s %s' % (str(id1)+':',planstr[id1]))
+        
+    # Try to make the required calibration files (if not already made)
+    # Then check if the calibration files exist
+    #--------------------------------------
+
+    caltypes = ['det','dark','flat','bpm','littrow','persist','persistmodel']
+    calnames = ['Detector','Dark','Flat','BPM','Littrow','Persist','PersistModel']
+    for i in range(len(caltypes)):
+        caltype = caltypes[i]
+        id1 = caltype+'id'
+        calname = calnames[i]
+        if planstr[id1] != 0 and quicklook==False:
+            if load.exists(calname,num=planstr[id1]):
+                print(load.filename(calname,num=planstr[id1],chips=True)+' already exists')
+            else:
+                out = subprocess.run(['makecal','--'+calname.lower(),planstr[id1]],shell=False)
+                if load.exists(calname,num=planstr[id1])==False:
+                    raise ValueError(load.filename(calname,num=planstr[id1],chips=True)+' NOT FOUND')
+
+    # apHist file
+    if planstr['persistmodelid']>0 and quicklook==False:
+        # only the new exposures are added to an existing apHist file
+        mjdcube.mjdcube(planstr['mjd'],darkid=planstr['darkid'] if planstr['darkid']!=0 else None,
+                        apred=load.apred)
+        if load.exists('Hist',num=planstr['mjd'])==False:
+            raise ValueError(load.filename('Hist',num=planstr['mjd'],chips=True)+' NOT FOUND')
+        histfile = load.filename('Hist',num=planstr['mjd'],chips=True)
+        histfiles = [histfile.replace('Hist-','Hist-'+ch+'-') for ch in chips]
+  
+    # Are there enough files
+    if 'APEXP' not in planstr:
+        print('APEXP not found in planstr')
+        return [],logfile
+    nframes = len(planstr['APEXP'])
+    if nframes < 1:
+        print('No frames to process')
+        return [],logfile
+
+    # Loop over the frames
+    #---------------------
+    for j in range(nframes):
+        framenum = planstr['APEXP']['name'][j]
+        rawfile = load.filename('R',num=planstr['APEXP']['name'][j],chips=True)
+        chipfiles = [rawfile.replace('R-','R-'+ch+'-') for ch in chips]
+        if load.exists('R',num=framenum)==False:
+            print(rawfile+' NOT found')
+            continue
+        seq = str(j+1)+'/'+str(nframes)
+            
+        # Determine file TYPE
+        #----------------------
+        # dark - should be processed with 
+        # flat
+        # lamps
+        # object frame
+        exptype = planstr['APEXP']['flavor'][j]
+        if exptype == '' or exptype == '0':
+            error = 'NO OBSTYPE keyword found for '+str(framenum)
+            print(error)
+            continue
+        exptype = str(exptype).lower()
+
+        # This is a DARK frame
+        #----------------------
+        if exptype == 'dark':
+            print('This is a DARK frame.  This should be processed with APMKSUPERDARK.PRO')
+            continue
+
+        # Settings to use for each exposure type            
+        kws = {'usedet':True,'usebpm':True,'usedark':True,'useflat':True,'uselittrow':True,
+               'usepersist':True,'dopersistcorr':False,'nocr':True,'crfix':False,'criter':False,
+               'satfix':True,'uptheramp':False,'nfowler':1,'rd3satfix':False}
+        # Flat
+        if exptype=='psf':
+            pass   # default settings
+        # Lamp
+        elif exptype=='lamp':
+            kws['nocr'] = False
+            kws['crfix'] = True
+        # Wave
+        elif exptype=='wave':
+            kws['nocr'] = False
+            kws['crfix'] = True
+        # Object
+        elif exptype=='object':
+            kws['dopersistcorr'] = True
+            kws['nocr'] = False
+            kws['crfix'] = True
+            if planstr['platetype'] == 'single': kws['nocr']=True
+            kws['uptheramp'] = True
+            kws['nfowler'] = 0
+        # Flux
+        elif exptype=='flux':
+            pass   # default settings
+        else:
+            print(exptype+' NOT SUPPORTED')
+            continue
+        # Quick-look only uses the detector and bad pixel mask files
+        if quicklook:
+            kws.update({'usedark':False,'useflat':False,'uselittrow':False,'usepersist':False,
+                        'dopersistcorr':False})
+
+        #----------------------------------
+        # Looping through the three chips
+        #----------------------------------
+        for k in range(3):
+            chfile = chipfiles[k]
+            ckws = kws.copy()
+
+            # Check header
+            head = fits.getheader(chfile)
+            # Check that this is a data CUBE OR has extensions
+            naxis = head.get('NAXIS')
+            try:
+                dumim,dumhead = fits.getdata(chfile,1,header=True)
+                read_message = ''
+            except:
+                read_message = 'problem'
+            if naxis != 3 and read_message != '':
+                error = 'FILE must contain a 3D DATACUBE OR image extensions'
+                print(error)
+                continue
+
+            # Chip specific calibration filenames
+            ckws['histcorr'] = None
+            calflag = ['usedet','usedark','useflat','usebpm','uselittrow','usepersist','dopersistcorr']
+            gotcals = True
+            for id1,calid1,calflag1 in zip(ids,calid,calflag):
+                caltype1 = id1[:-2]
+                calfile = None
+                if ckws[calflag1] and planstr[id1]!=0:
+                    if calid1=='Littrow' and chips[k]!='b':
+                        ckws[caltype1+'corr'] = None
+                        continue
+                    if calid1=='PersistModel' and chips[k]!='c':
+                        ckws[caltype1+'corr'] = None
+                        continue
+                    if calid1=='PersistModel' and chips[k]=='c':
+                        ckws['histcorr'] = histfiles[k]
+                    calfile = load.filename(calid1,num=planstr[id1],chips=True)
+                    calfile = calfile.replace(calid1+'-',calid1+'-'+chips[k]+'-')
+                    # Does the file exist
+                    #  quick-look goes on without it
+                    if load.exists(calid1,num=planstr[id1])==False:
+                        print(calfile+' NOT found')
+                        if quicklook:
+                            ckws[caltype1+'corr'] = None
+                            continue
+                        gotcals = False
+                        continue
+                ckws[caltype1+'corr'] = calfile
+            # Do not have all the cals
+            if gotcals==False:
+                print('Do not have all the calibration files that we need')
+                continue
+
+            # note this q3fix still fails for apo1m flat/PSF processing, which calls ap3dproc directly
+            q3fix = False
+            if 'q3fix' in planstr:
+                if k==2 and planstr['q3fix']==1:
+                    q3fix = True
+            if k==2 and planstr['mjd'] > 56930 and planstr['mjd'] < 57600:
+                q3fix = True
+            ckws['q3fix'] = q3fix
+
+            if 'usereference' in planstr:
+                ckws['usereference'] = bool(planstr['usereference'])
+            else:
+                ckws['usereference'] = True
+            if 'maxread' in planstr:
+                ckws['maxread'] = planstr['maxread']
+            else:
+                ckws['maxread'] = None
+            ckws['seq'] = seq
+            ckws['fitsdir'] = utils.localdir()
+            ckws['cleanuprawfile'] = 1
+
+            # Output file
+            outfile = load.filename('2D',num=framenum,mjd=planstr['mjd'],chips=True)
+            outfile = outfile.replace('2D-','2D-'+chips[k]+'-')
+
+            calkey = tuple([ckws.get(c+'corr') for c in caltypes]+[ckws['histcorr']])
+            tasks.append({'planfile':planfile,'mjd':planstr['mjd'],'framenum':framenum,'seq':seq,
+                          'exptype':exptype,'chip':chips[k],'rawfile':chfile,'outfile':outfile,
+                          'logfile':logfile,'calkey':calkey,'kws':ckws})
+
+    return tasks,logfile
+
+
+def ap3d(planfiles,verbose=False,rogue=False,clobber=False,refonly=False,unlock=False,nworkers=1,
+         quicklook=False,writetiming=False):
     """
     This program processes all of the APOGEE RAW datacubes for
     a single night.
@@ -2515,6 +3838,11 @@ def ap3d(planfiles,verbose=False,rogue=False,clobber=False,refonly=False,unlock=
     /verbose  Print a lot of information to the screen
     /stp      Stop at the end of the prrogram
     /unlock      Delete lock file and start fresh
+    nworkers  Number of worker processes to use for each chip
+    quicklook  Quick-look mode, only the first and last reads with reference
+                 and bad pixel corrections.  The output files are ap2Dql-.
+    writetiming  Write the per-stage timing record of each chip file
+                 next to the output file (_timing.json).
 
     Returns
     -------
@@ -2542,8 +3870,6 @@ def ap3d(planfiles,verbose=False,rogue=False,clobber=False,refonly=False,unlock=
     print('')
     print(str(nplanfiles),' PLAN files')
 
-    chips = ['a','b','c']
-
     #--------------------------------------------
     # Loop through the unique PLATE Observations
     #--------------------------------------------
@@ -2557,251 +3883,246 @@ def ap3d(planfiles,verbose=False,rogue=False,clobber=False,refonly=False,unlock=
         print(str(i+1),'/',str(nplanfiles),'  Processing Plan file ',planfile)
         print('=========================================================================')
         
-        # Load the plan file
-        #--------------------
-        print('')
-        print('Plan file information:')
-        planstr = plan.load(planfile,np=True,verbose=True)
-        if 'apred_vers' not in planstr:
-            print('apred_vers not found in planfile')
-            continue
-        if 'telescope' not in planstr:
-            print('telescope not found in planfile')
-            continue
-        load = apload.ApLoad(apred=planstr['apred_vers'],telescope=planstr['telescope'])
-        logfile = load.filename('Diag',plate=planstr['plateid'],mjd=planstr['mjd'])        
-
-        # Check that we have all of the calibration IDs in the plan file
-        ids = ['detid','darkid','flatid','bpmid','littrowid','persistid','persistmodelid']
-        calid = ['Detector','Dark','Flat','BPM','Littrow','Persist','PersistModel']
-        for id1,calid1 in zip(ids,calid):
-            if id1 not in planstr:
-                print(id1+' not in planstr')
-                continue
-            print('%-10s %s' % (str(id1)+':',planstr[id1]))
-        
-        # Try to make the required calibration files (if not already made)
-        # Then check if the calibration files exist
-        #--------------------------------------
-
-        caltypes = ['det','dark','flat','bpm','littrow','persist','persistmodel']
-        calnames = ['Detector','Dark','Flat','BPM','Littrow','Persist','PersistModel']
-        for i in range(len(caltypes)):
-            caltype = caltypes[i]
-            calid = caltype+'id'
-            calname = calnames[i]
-            if planstr[calid] != 0:
-                if load.exists(calname,num=planstr[calid]):
-                    print(load.filename(calname,num=planstr[calid],chips=True)+' already exists')
-                else:
-                    out = subprocess.run(['makecal','--'+calname.lower(),planstr[calid]],shell=False)
-                    if load.exists(calname,num=planstr[calid])==False:
-                        raise ValueError(load.filename(calname,num=planstr[calid],chips=True)+' NOT FOUND')
-
-        # apHist file
-        if planstr['persistmodelid']>0:
-            if load.exists('Hist',num=planstr['mjd']):
-                print(load.filename('Hist',num=planstr['mjd'],chips=True)+' already exists')
-            else:
-                mjdcube.mjdcube(planstr['mjd'],dark=planstr['darkid'])
-                if load.exists('Hist',num=planstr['mjd'])==False:
-                    raise ValueError(load.filename('Hist',num=planstr['mjd'],chips=True)+' NOT FOUND')
-
-  
-        # Are there enough files
-        if 'APEXP' not in planstr:
-            print('APEXP not found in planstr')
-            continue
-        nframes = len(planstr['APEXP'])
-        if nframes < 1:
-            print('No frames to process')
+        # Load the plan file and get the chip files to process
+        tasks,logfile = ap3d_plantasks(planfile,quicklook=quicklook)
+        if len(tasks)==0:
             continue
 
-        # Process each frame
-        #-------------------
-        for j in range(nframes):
-            framenum = planstr['APEXP']['name'][j]
-            rawfile = load.filename('R',num=planstr['APEXP']['name'][j],chips=True)
-            chipfiles = [rawfile.replace('R-','R-'+ch+'-') for ch in chips]
-            if load.exists('R',num=framenum)==False:
-                print(rawfile+' NOT found')
-                continue
+        # Process each frame and chip
+        #-----------------------------
+        lastframe = None
+        for task in tasks:
+            if task['framenum'] != lastframe:
+                print('')
+                print('--------------------------------------------------------')
+                print(task['seq'],'  Processing files for Frame Number >>',str(task['framenum']),'<<')
+                print('--------------------------------------------------------')
+                print('This is a '+task['exptype'].upper()+' frame')
+                lastframe = task['framenum']
 
             print('')
-            print('--------------------------------------------------------')
-            print(str(j+1),'/',str(nframes),'  Processing files for Frame Number >>',str(framenum),'<<')
-            seq = str(j+1)+'/'+str(nframes)
-            print('--------------------------------------------------------')
-            
-            # Determine file TYPE
-            #----------------------
-            # dark - should be processed with 
-            # flat
-            # lamps
-            # object frame
-            exptype = planstr['APEXP']['flavor'][j]
-            if exptype == '' or exptype == '0':
-                error = 'NO OBSTYPE keyword found for '+str(framenum)
-                print(error)
-                continue
-            exptype = str(exptype).lower()
+            print('-----------------------------------------')
+            print(' Processing chip '+task['chip']+' - '+os.path.basename(task['rawfile']))
+            print('-----------------------------------------')
+            print('')
 
-            # This is a DARK frame
-            #----------------------
-            if exptype == 'dark':
-                print('This is a DARK frame.  This should be processed with APMKSUPERDARK.PRO')
+            # Does the output directory exist?
+            if os.path.exists(os.path.dirname(task['outfile']))==False:
+                os.makedirs(os.path.dirname(task['outfile']))
+
+            # Quick-look, low-fidelity product
+            if quicklook:
+                qlfile = os.path.dirname(task['outfile'])+'/'+os.path.basename(task['outfile']).replace('2D-','2Dql-')
+                kws = task['kws']
+                ap3dproc_quicklook(task['rawfile'],qlfile,detcorr=kws.get('detcorr'),bpmcorr=kws.get('bpmcorr'),
+                                   maxread=kws.get('maxread'),q3fix=kws.get('q3fix'),clobber=clobber)
                 continue
 
-            # Settings to use for each exposure type            
-            kws = {'usedet':True,'usebpm':True,'usedark':True,'useflat':True,'uselittrow':True,
-                   'usepersist':True,'dopersistcorr':False,'nocr':True,'crfix':False,'criter':False,
-                   'satfix':True,'uptheramp':False,'nfowler':1,'rd3satfix':False}
-            # Flat
-            if exptype=='psf':
-                print('This is a FLAT frame')
-                # default settings
-            # Lamp
-            elif exptype=='lamp':
-                print('This is a LAMP frame')
-                kws['nocr'] = False
-                kws['crfix'] = True
-            # Wave
-            elif exptype=='wave':
-                print('This is a WAVE frame')
-                kws['nocr'] = False
-                kws['crfix'] = True
-            # Object
-            elif exptype=='object':
-                print('This is an OBJECT frame')
-                kws['dopersistcorr'] = True
-                kws['nocr'] = False
-                kws['crfix'] = True
-                if planstr['platetype'] == 'single': kws['nocr']=True
-                kws['uptheramp'] = True
-                kws['nflower'] = 0
-            # Flux
-            elif exptype=='flux':
-                print('This is an FLUX frame')
-                # default settings
-            else:
-                print(exptype+' NOT SUPPORTED')
+            # PROCESS the file
+            #-------------------
+            ap3dproc(task['rawfile'],task['outfile'],verbose=verbose,clobber=clobber,
+                     logfile=logfile,refonly=refonly,unlock=unlock,nworkers=nworkers,
+                     writetiming=writetiming,**task['kws'])
+
+        utils.writelog(logfile,'AP3D: '+os.path.basename(planfile)+('%8.2f' % time.time()))
+
+    print('AP3D finished')
+    dt = time.time()-t0
+    print('dt = %.1f sec ' % dt)
+
+
+def ap3d_readtask(task):
+    """ Read/decompress the raw datacube for an ap3d task."""
+    rawfile = task['rawfile']
+    maxread = task['kws'].get('maxread')
+    if rawfile.endswith('.apz'):
+        cube,head = apzip.unzip_to_array(rawfile,maxread=maxread,silent=True)
+    else:
+        cube,head = ap3dproc_readcube(rawfile,maxread=maxread,silent=True)
+    return cube,head
+
+
+def ap3dbatch(planfiles,verbose=False,clobber=False,refonly=False,unlock=False,nworkers=1,
+              nprefetch=1,writetiming=False):
+    """
+    Process all of the exposures of a night in one process.  The chip
+    files are grouped by their calibration files so the calibration
+    products are only loaded once (see calcache_setup), and they are run
+    through a three-stage pipeline: the next datacube is read/decompressed
+    in a background thread while the current one is processed, and the
+    output of the previous one is written in another background thread.
+
+    Parameters
+    ----------
+    planfiles : str or list
+       List of plan files, e.g. the single-exposure ap3d plan files for
+         all the exposures of an MJD.
+    verbose : boolean, optional
+       Print a lot of information to the screen.  Default is False.
+    clobber : boolean, optional
+       Overwrite existing output files.  Default is False.
+    refonly : boolean, optional
+       Only perform the reference pixel subtraction.  Default is False.
+    unlock : boolean, optional
+       Delete lock files and start fresh.  Default is False.
+    nworkers : int, optional
+       Number of worker processes to use for each chip.  Default is 1.
+    nprefetch : int, optional
+       Number of datacubes to read ahead and the number of outputs that
+         can be waiting to be written.  Default is 1.
+    writetiming : boolean, optional
+       Write the per-stage timing record of each chip file next to
+         the output file (_timing.json).  Default is False.
+
+    Returns
+    -------
+    nfailed : int
+       The number of chip files that failed to be read, processed or
+         written.  Their output files are removed so they are not
+         mistaken for good outputs.  The RAW APOGEE 3D datacube files
+         are processed and 2D images are output.
+
+    Example
+    -------
+
+    nfailed = ap3dbatch(planfiles,nworkers=4)
+
+    """
+
+    import threading
+    import queue
+
+    t0 = time.time()
+
+    if type(planfiles) is str:
+        planfiles = [planfiles]
+    nplanfiles = len(planfiles)
+
+    print('')
+    print('RUNNING AP3D BATCH')
+    print('')
+    print(str(nplanfiles),' PLAN files')
+
+    # Get all of the chip files to process
+    #--------------------------------------
+    tasks = []
+    logfiles = {}
+    for i in range(nplanfiles):
+        tasks1,logfile = ap3d_plantasks(planfiles[i])
+        if logfile is not None:
+            logfiles[planfiles[i]] = logfile
+        for t in tasks1:
+            if os.path.exists(t['outfile']) and clobber==False:
+                print(t['outfile']+' already exists and clobber==False')
                 continue
+            tasks.append(t)
+    ntasks = len(tasks)
+    if ntasks==0:
+        print('No files to process')
+        return 0
+
+    # Group by the calibration files, keep the original order within each group
+    calkeys = []
+    for t in tasks:
+        if t['calkey'] not in calkeys:
+            calkeys.append(t['calkey'])
+    tasks.sort(key=lambda t: calkeys.index(t['calkey']))
+    print('')
+    print(str(ntasks)+' chip files in '+str(len(calkeys))+' calibration groups')
+
+    readq = queue.Queue(maxsize=nprefetch)
+    writeq = queue.Queue(maxsize=nprefetch)
+    failed = []    # output files of the tasks that failed
+
+    def taskfailed(outfile,error):
+        print(error)
+        failed.append(outfile)
+        # Don't leave a partial or old output behind
+        if os.path.exists(outfile): os.remove(outfile)
+
+    # Stage 1: read/decompress the datacubes
+    def reader():
+        for t in tasks:
+            try:
+                cube,head = ap3d_readtask(t)
+            except:
+                traceback.print_exc()
+                taskfailed(t['outfile'],'ERROR reading '+t['rawfile'])
+                cube,head = None,None
+            readq.put((t,cube,head))
+        readq.put(None)
+
+    # Stage 3: write the outputs
+    def writer():
+        while True:
+            item = writeq.get()
+            if item is None:
+                break
+            hdu,outfile = item
+            try:
+                hdu.writeto(outfile,overwrite=True)
+            except:
+                traceback.print_exc()
+                taskfailed(outfile,'ERROR writing '+outfile)
+            hdu.close()
 
-            #----------------------------------
-            # Looping through the three chips
-            #----------------------------------
-            for k in range(3):
-                chfile = chipfiles[k]
-
-                # Check header
-                head = fits.getheader(chfile)
-                # Check that this is a data CUBE OR has extensions
-                naxis = head.get('NAXIS')
-                try:
-                    dumim,dumhead = fits.getdata(chfile,1,header=True)
-                    read_message = ''
-                except:
-                    read_message = 'problem'
-                if naxis != 3 and read_message != '':
-                    error = 'FILE must contain a 3D DATACUBE OR image extensions'
-                    print(error)
-                    continue
-
-                # Chip specific calibration filenames
-                kws['histcorr'] = None
-                ids = ['detid','darkid','flatid','bpmid','littrowid','persistid','persistmodelid']
-                calid = ['Detector','Dark','Flat','BPM','Littrow','Persist','PersistModel']
-                calflag = ['usedet','usedark','useflat','usebpm','uselittrow','usepersist','dopersistcorr']
-                gotcals = True
-                for id1,calid1,calflag1 in zip(ids,calid,calflag):
-                    caltype1 = id1[:-2]
-                    calfile = None
-                    if kws[calflag1] and planstr[id1]!=0:
-                        if calid1=='Littrow' and chips[k]!='b':
-                            continue
-                        if calid1=='PersistModel' and chips[k]!='c':
-                            continue
-                        if calid1=='PersistModel' and chips[k]=='c':
-                            kws['histcorr'] = histfiles[k]
-                        calfile = load.filename(calid1,num=planstr[id1],chips=True)
-                        calfile = calfile.replace(calid1+'-',calid1+'-'+chips[k]+'-')
-                        # Does the file exist
-                        if load.exists(calid1,num=planstr[id1])==False:
-                            print(calfile+' NOT found')
-                            gotcals = False
-                            continue
-                    kws[caltype1+'corr'] = calfile
-                # Do not have all the cals
-                if gotcals==False:
-                    print('Do not have all the calibration files that we need')
-                    continue
+    def queuewrite(hdu,outfile):
+        writeq.put((hdu,outfile))
+
+    rthread = threading.Thread(target=reader,daemon=True)
+    wthread = threading.Thread(target=writer,daemon=True)
+    rthread.start()
+    wthread.start()
+
+    # Stage 2: process the datacubes
+    count = 0
+    while True:
+        item = readq.get()
+        if item is None:
+            break
+        t,cube,head = item
+        count += 1
+        if cube is None:
+            continue
 
-                # Do not have all the cals
-                
-                #if usedet and planstr['detid'] != 0:
-                #      detcorr = detfiles[k]
-                #if usebpm and planstr['bpmid'] != 0:
-                #      bpmcorr = bpmfiles[k]
-                #if usedark and planstr['darkid'] != 0:
-                #      darkcorr = darkfiles[k]
-                #if useflat and planstr['flatid'] != 0:
-                #      flatcorr = flatfiles[k]
-                #if uselittrow and planstr['littrowid'] != 0 and k == 1:
-                #      littrowcorr = littrowfiles
-                #if usepersist and planstr['persistid'] != 0:
-                #      persistcorr = persistfiles[k]
-                #if dopersistcorr and (planstr['persistmodelid'] != 0) and (chips[k] == 'c'):
-                #    #        and (chiptag[k] == 'b' or (chiptag[k] == 'c' and planstr.mjd < 56860L)):
-                #    persistmodelcorr = persistmodelfiles[k-1]
-                #    histcorr = histfiles[k]
-                #else:
-                #    persistmodelcorr = None
-
-                # note this q3fix still fails for apo1m flat/PSF processing, which calls ap3dproc directly
-                q3fix = False
-                if 'q3fix' in planstr:
-                    if k==2 and planstr['q3fix']==1:
-                        q3fix = True
-                if k==2 and planstr['mjd'] > 56930 and planstr['mjd'] < 57600:
-                    q3fix = True
+        print('')
+        print('-----------------------------------------')
+        print(str(count)+'/'+str(ntasks)+' Processing chip '+t['chip']+' - '+os.path.basename(t['rawfile']))
+        print('-----------------------------------------')
+        print('')
 
-                if 'usereference' in planstr:
-                      usereference = bool(planstr['usereference'])
-                else:
-                      usereference = True
-                if 'maxread' in planstr:
-                      maxread = planstr['maxread']
-                else:
-                      maxread = None
+        # Does the output directory exist?
+        if os.path.exists(os.path.dirname(t['outfile']))==False:
+            os.makedirs(os.path.dirname(t['outfile']))
 
-                print('')
-                print('-----------------------------------------')
-                print(' Processing chip '+chips[k]+' - '+os.path.basename(chfile))
-                print('-----------------------------------------')
-                print('')
+        # PROCESS the file
+        #-------------------
+        try:
+            ap3dproc(t['rawfile'],t['outfile'],cube=cube,head=head,verbose=verbose,clobber=clobber,
+                     logfile=t['logfile'],refonly=refonly,unlock=unlock,nworkers=nworkers,
+                     writer=queuewrite,writetiming=writetiming,**t['kws'])
+        except:
+            traceback.print_exc()
+            taskfailed(t['outfile'],'ERROR processing '+t['rawfile'])
+        del cube
 
-                # Output file
-                outfile = load.filename('2D',num=framenum,mjd=planstr['mjd'],chips=True)
-                outfile = outfile.replace('2D-','2D-'+chips[k]+'-')
-                # Does the output directory exist?
-                fitsdir = utils.localdir()
-                if os.path.exists(os.path.dirname(outfile))==False:
-                    os.makedirs(os.path.dirname(outfile))
-                # Does the file exist already
-                #if os.path.exists(outfile) and clobber==False:
-                #    print(outfile,' exists already and clobber not set')
-                #    continue
-
-                # PROCESS the file
-                #-------------------
-                ap3dproc(chfile,outfile,cleanuprawfile=1,verbose=verbose,clobber=clobber,
-                         logfile=logfile,q3fix=q3fix,maxread=maxread,fitsdir=fitsdir,
-                         usereference=usereference,refonly=refonly,seq=seq,unlock=unlock,**kws)
-
-    utils.writelog(logfile,'AP3D: '+os.path.basename(planfile)+('%8.2f' % time.time()))
+    # Wait for the outputs to be written
+    writeq.put(None)
+    wthread.join()
+    rthread.join()
 
-    print('AP3D finished')
+    for planfile in planfiles:
+        if planfile in logfiles:
+            utils.writelog(logfiles[planfile],'AP3D: '+os.path.basename(planfile)+('%8.2f' % time.time()))
+
+    nfailed = len(failed)
+    if nfailed > 0:
+        print('')
+        print(str(nfailed)+'/'+str(ntasks)+' chip files FAILED:')
+        for outfile in failed:
+            print('  '+outfile)
+    print('AP3D BATCH finished')
     dt = time.time()-t0
     print('dt = %.1f sec ' % dt)
 
-            
+    return nfailed
@@ -1,17 +1,84 @@
 import sys
 import os
 import glob
+import time
 import pdb
 import numpy as np
 from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from ..utils import apzip
 
-def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False) :
+def histindex(histfile) :
+
+  """
+  Return a table with the information on the exposures in an apHist file,
+  one row per extension, taken from the extension headers
+  """
+
+  dt = [('ext',int),('apzfile',(str,100)),('expnum',int),('exptype',(str,20)),('exptime',float),
+        ('nread',int),('dateobs',(str,30)),('jd',float),('plateid',int)]
+  if not os.path.exists(histfile) : return Table(np.zeros(0,dtype=np.dtype(dt)))
+
+  with fits.open(histfile) as hd :
+    tab = Table(np.zeros(len(hd)-1,dtype=np.dtype(dt)))
+    for i in range(1,len(hd)) :
+      head = hd[i].header
+      filename = os.path.basename(str(head.get('APZFILE',head.get('FILENAME',''))))
+      tab['ext'][i-1] = i
+      tab['apzfile'][i-1] = filename
+      try : tab['expnum'][i-1] = int(filename[6:14])
+      except : tab['expnum'][i-1] = -1
+      tab['exptype'][i-1] = str(head.get('EXPTYPE','')).strip().upper()
+      tab['exptime'][i-1] = head.get('EXPTIME',0.0)
+      tab['nread'][i-1] = head.get('NREAD',0)
+      tab['dateobs'][i-1] = head.get('DATE-OBS','')
+      try : tab['jd'][i-1] = Time(tab['dateobs'][i-1],format='isot',scale='utc').jd
+      except : tab['jd'][i-1] = np.nan
+      try : tab['plateid'][i-1] = int(head.get('PLATEID',0))
+      except : tab['plateid'][i-1] = 0
+  return tab
+
+def loadhist(histfile, rows=None) :
+
+  """
+  Return the index table and CDS images of an apHist file
+  ims[i] is the CDS image of the exposure in row rows[i] of the table
+  (all of the rows by default), the file is closed before returning
+  """
+
+  # wait if the file is being built by mjdcube
+  lockfile = histfile+'.lock'
+  while os.path.exists(lockfile) :
+    print('Waiting for lockfile '+lockfile)
+    time.sleep(10)
+
+  tab = histindex(histfile)
+  if rows is None : rows = range(len(tab))
+  with fits.open(histfile,memmap=True) as hd :
+    ims = [hd[tab['ext'][r]].data.copy() for r in rows]
+  return tab,ims
+
+def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False, dark=None, unlock=False) :
 
   """
   Make a cube for a given night with the CDS images of all frames
   Optionally, write out individual uncompressed data cubes
+
+  The cube is built incrementally: exposures that are already in the
+  apHist file (by APZFILE/FILENAME in the extension headers) are skipped
+  and only the new ones are decompressed and appended to the file, so
+  this can be rerun as the exposures of the night come in.
+  With clobber the cube is rebuilt from scratch.
+
+  Every plan file of the night calls this, so the apHist file is locked
+  (apHist-*.fits.lock) while it is being updated and the other jobs
+  wait for it.  With unlock an existing lock file is removed first.
   """
 
+  # ap3d passes the dark id as "dark"
+  if darkid is None and dark is not None and dark != 0 : darkid = dark
+
   print('mjd: ', mjd)
   print('apred: ', apred)
   print('write: ', write)
@@ -24,78 +91,85 @@ def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False) :
 
     # output file name for CDS cube
     outfile = outdir+'apHist-'+chip+'-'+str(mjd)+'.fits'
+    if not os.path.exists(outdir) : os.makedirs(outdir)
 
-    # does output file already exist?
-    if not clobber and os.path.exists(outfile) : return
+    # lock the file, if another job is working on it wait
+    #  the lock is next to the file so jobs on all nodes see it
+    lockfile = outfile+'.lock'
+    if unlock and os.path.exists(lockfile) : os.remove(lockfile)
+    while True :
+      try :
+        os.close(os.open(lockfile,os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        break
+      except FileExistsError :
+        print('Waiting for lockfile '+lockfile)
+        time.sleep(10)
+    try :
+      mjdcube_chip(outfile,files,darkid=darkid,write=write,apred=apred,clobber=clobber,chip=chip)
+    finally :
+      if os.path.exists(lockfile) : os.remove(lockfile)
 
-    out=fits.HDUList(fits.PrimaryHDU())
+def mjdcube_chip(outfile, files, darkid=None, write=False, apred='current', clobber=False, chip='a') :
+
+  """
+  Add the CDS images of the new exposures of one chip to an apHist file,
+  the caller (mjdcube) holds the lock on the file
+  """
 
-    # get dark frame if requested
+  # start a new file, or find the exposures that are already in it
+  if clobber or not os.path.exists(outfile) :
+    fits.HDUList(fits.PrimaryHDU()).writeto(outfile,overwrite=True, checksum = True)
+    done = []
+  else :
+    done = list(histindex(outfile)['apzfile'])
+  files = [f for f in files if os.path.basename(f) not in done]
+  print(len(done),' exposures already in ',outfile,', ',len(files),' new')
+  if len(files) == 0 : return
+
+  # get dark frame if requested
+  if darkid is not None :
+      with fits.open(os.environ['APOGEE_REDUX']+'/'+apred+'/cal/darkcorr/apDark-'+chip+'-'+str(darkid)+'.fits') as hd :
+          darkim=hd[1].data.copy()
+
+  # loop over the new files
+  for file in files :
+    print('file: ',file)
+
+    # only the second and last reads are needed for the CDS image
+    if write :
+      cube,header = apzip.unzip_to_array(file,silent=True)
+    else :
+      cube,header = apzip.unzip_to_array(file,reads=[1,-1],silent=True)
+    nreads = header.get('NREAD',0)
+    if write :
+      nreads = cube.shape[2]
+      # output file name for individual uncompressed images
+      rawfile = os.path.basename(file.replace('.apz','.fits'))
+      hdout=fits.HDUList(fits.PrimaryHDU(header=header))
+      for read in range(nreads) :
+        hdout.append(fits.ImageHDU(cube[:,:,read]))
+      hdout.writeto(rawfile,overwrite=True, checksum = True, output_verify='fix')
+      hdout.close()
+      cube = cube[:,:,[1,-1]]
+    if nreads == 0 : nreads = cube.shape[2]
+
+    # compute and add the cdsframe (last read - second read), subtract dark if we have one
+    cds = (cube[0:2048,0:2048,1] - cube[0:2048,0:2048,0]).astype(float)
     if darkid is not None :
-        dark=fits.open(os.environ['APOGEE_REDUX']+'/'+apred+'/cal/darkcorr/apDark-'+chip+'-'+darkid+'.fits')[1].data
-
-    # loop over all files
-    for file in files :
-      print(file)
-      print('file: ',file)
-      if write :
-        # output file name for individual uncompressed images
-        outfile = os.path.basename(file.strip('apz')+'fits')
-        hdout=fits.HDUList(fits.PrimaryHDU())
-
-      # open file and confirm checksums
-      hd=fits.open(file, do_not_scale_image_data = True, uint = True, checksum = True)
-
-      # file has initial header, avg_dcounts, then nreads
-      nreads = len(hd)-2
-      try:
-          avg_dcounts=hd[1].data
-      except:
-          # fix header if there is a problem (e.g., MJD=55728, 01660046)
-          hd[1].verify('fix')
-          avg_dcounts=hd[1].data
-
-      # first read is in extension 2
-      ext = 2
-  
-      # loop over reads, processing into raw reads, and appending
-      for read in range(1,nreads+1) :
-        header = hd[ext].header
-        try:
-          raw = hd[ext].data
+        # if we don't have enough reads in the dark, do nothing
+        try :
+            cds -= (darkim[nreads-1,:,:] - darkim[2,:,:])
         except:
-          hd[ext].verify('fix')
-          raw = hd[ext].data
-        if read == 1 :
-          data = np.copy(raw)
-        else :
-          data = np.add(data,raw,dtype=np.int16)
-          data = np.add(data,avg_dcounts,dtype=np.int16)
-          if read == 2 : first = data
-  
-        if write : hdout.append(fits.ImageHDU(data,header))
-          
-        ext += 1
- 
-      # compute and add the cdsframe, subtract dark if we have one
-      cds = (data[0:2048,0:2048] - first[0:2048,0:2048] ).astype(float)
-      print(cds.shape)
-      if darkid is not None :
-          print(dark.shape,nreads)
-          # if we don't have enough reads in the dark, do nothing
-          try :
-              cds -= (dark[nreads-1,:,:] - dark[2,:,:])
-          except:
-              print('not halting: not enough reads in dark, skipping dark subtraction for mjdcube')
-              pass
-      out.append(fits.ImageHDU(cds,header))
-      if write :
-        hdout.writeto(outfile,overwrite=True, checksum = True, output_verify='fix')
-        hd.close()
-
-    # write out the CDS frame
-    out.writeto(outfile,overwrite=True, checksum = True, output_verify='fix')
-    out.close()
+            print('not halting: not enough reads in dark, skipping dark subtraction for mjdcube')
+            pass
+    header['APZFILE'] = os.path.basename(file)
+    if header.get('FILENAME') is None : header['FILENAME'] = os.path.basename(file)
+    if header.get('NREAD') is None : header['NREAD'] = nreads
+    for key in ['SIMPLE','EXTEND'] :
+      if key in header : del header[key]
+
+    # append the CDS frame to the file
+    fits.append(outfile, cds, header, checksum = True)
 
 if __name__ == "__main__" :
-    mjdcube(sys.argv[1],sys.argv[2:]) 
+    mjdcube(sys.argv[1],sys.argv[2:])
@@ -5,6 +5,10 @@ import numpy as np
 import os
 import shutil
 import time
+import hashlib
+import itertools
+import multiprocessing as mp
+from collections import OrderedDict
 from dlnpyutils import utils as dln, bindata
 from astropy.io import fits
 from scipy.interpolate import interp1d
@@ -172,7 +176,7 @@ class PSF(object):
         if kind=='ann':
             # coeffs = (w_array_0, w_array_1, w_array_2, b_array_0, b_array_1, b_array_2, x_min, x_max, y)
             self.kind = kind
-            coefs = data
+            coeffs = data
             self._log = log
             self._coeffs = coeffs
             self.xmin = coeffs['xmin']
@@ -253,8 +257,14 @@ class PSF(object):
             return self.gridinterp(inlabels)
         
     def ann_model(self,inlabels):
-        """ Make a brand-new full profile model with input labels and ANN model."""
-        if inlabels[0]<0 or inlabels[0]>2047 or inlabels[1]<0 or inlabels[1]>2047:
+        """
+        Make a brand-new full profile model with input labels and ANN model.
+        The labels can be a single [X,Y] pair or an array of pairs [N,2], then
+        all of the profiles [N,Npix] are computed with one matrix multiplication
+        per layer.
+        """
+        inlabels = np.asarray(inlabels,float)
+        if np.any(inlabels<0) or np.any(inlabels>2047):
             raise ValueError('X/Y must be between 0 and 2047')
         labels = self.scaled_labels(inlabels) # scale the labels
         # We input the scaled stellar labels (not in the original unit).
@@ -265,9 +275,9 @@ class PSF(object):
         b_array_1 = self._coeffs['bias2']
         w_array_2 = self._coeffs['weight4']
         b_array_2 = self._coeffs['bias4']                
-        inside = np.einsum('ij,j->i', w_array_0, labels) + b_array_0
-        outside = np.einsum('ij,j->i', w_array_1, leaky_relu(inside)) + b_array_1
-        m = np.einsum('ij,j->i', w_array_2, leaky_relu(outside)) + b_array_2
+        inside = labels @ w_array_0.T + b_array_0
+        outside = leaky_relu(inside) @ w_array_1.T + b_array_1
+        m = leaky_relu(outside) @ w_array_2.T + b_array_2
         return m
 
     def gridinterp(self,labels):
@@ -379,6 +389,163 @@ class PSF(object):
         
         return profile
 
+    def _gridval(self,g,xind,yind):
+        """ Helper function for gridinterp_array(), values of the X or Y label grid."""
+        if self.kind=='grid':
+            return g[xind,yind]
+        elif g is self._xgrid:
+            return g[xind]
+        else:
+            return g[yind]
+
+    def gridinterp_array(self,xs,ys):
+        """
+        Interpolate the model in the grid for arrays of labels.  This gives
+        the same profiles as gridinterp() for each (X,Y) pair, but for all
+        of them at once.
+
+        Parameters
+        ----------
+        xs : numpy array
+           X (column) labels [N].
+        ys : numpy array
+           Y (row) labels [N].
+
+        Returns
+        -------
+        profile : numpy array
+           The profiles [N,Npix].
+
+        Example
+        -------
+
+        profile = psf.gridinterp_array(xs,ys)
+
+        """
+        xs = np.atleast_1d(np.asarray(xs,float))
+        ys = np.atleast_1d(np.asarray(ys,float))
+        if np.any(xs<0) or np.any(xs>2047) or np.any(ys<0) or np.any(ys>2047):
+            raise ValueError('X/Y must be between 0 and 2047')
+
+        if self._grid is None:
+            self.mkgrid()
+        nx,ny = self._nxgrid,self._nygrid
+        xg,yg = self._xgrid,self._ygrid
+
+        # Same as np.searchsorted() but with a different sorted array for each point
+        def searchrows(arr,val):
+            return np.sum(arr < val[:,None],axis=1)
+
+        if self.kind=='grid':
+            # xgrid/ygrid are 2D [Nx,Ny] and not quite a regular rectangular grid
+            # Find closest X position
+            xind = np.searchsorted(xg[:,ny//2],xs)
+            yind = searchrows(yg[np.minimum(xind,nx-1),:],ys)
+            xind = searchrows(xg[:,np.minimum(yind,ny-1)].T,xs)
+            yind = searchrows(yg[np.minimum(xind,nx-1),:],ys)
+        else:
+            xind = np.searchsorted(xg,xs)
+            yind = np.searchsorted(yg,ys)
+
+        # The profile is the weighted sum of (up to) four grid points
+        #  start with the middle, then the edges and corners
+        xind1 = np.clip(xind-1,0,nx-1)
+        xind2 = np.clip(xind,0,nx-1)
+        yind1 = np.clip(yind-1,0,ny-1)
+        yind2 = np.clip(yind,0,ny-1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            # -- In the middle --
+            ix = np.stack([xind1,xind1,xind2,xind2])
+            iy = np.stack([yind1,yind2,yind1,yind2])
+            wtdx = self._gridval(xg,xind2,yind1)-self._gridval(xg,xind1,yind1)
+            wtdy = self._gridval(yg,xind1,yind2)-self._gridval(yg,xind1,yind1)
+            wt = np.abs(xs-self._gridval(xg,ix,iy))*np.abs(ys-self._gridval(yg,ix,iy))/(wtdx*wtdy)
+            wt /= np.sum(wt,axis=0)
+
+            # -- Edges, use two points --
+            zero = np.zeros(len(xs),int)
+            last = zero+nx-1
+            top = zero+ny-1
+            # Left and right, interpolate only in Y
+            for edge,ixe,ixw in [(xind==0,zero,zero),(xind==nx,last,last)]:
+                wt1 = (ys-self._gridval(yg,ixw,yind1))/(self._gridval(yg,ixw,yind2)-self._gridval(yg,ixw,yind1))
+                ix[:,edge] = np.stack([ixe,ixe,ixe,ixe])[:,edge]
+                iy[:,edge] = np.stack([yind1,yind2,yind2,yind2])[:,edge]
+                wt[:,edge] = np.stack([1-wt1,wt1,0*wt1,0*wt1])[:,edge]
+            # Bottom and top, interpolate only in X
+            for edge,iye,iyw in [((yind==0) & (xind>0) & (xind<nx),zero,zero),
+                                 ((yind==ny) & (xind>0) & (xind<nx),top,top)]:
+                wt1 = (xs-self._gridval(xg,xind1,iyw))/(self._gridval(xg,xind2,iyw)-self._gridval(xg,xind1,iyw))
+                ix[:,edge] = np.stack([xind1,xind2,xind2,xind2])[:,edge]
+                iy[:,edge] = np.stack([iye,iye,iye,iye])[:,edge]
+                wt[:,edge] = np.stack([1-wt1,wt1,0*wt1,0*wt1])[:,edge]
+
+            # -- At corners, use corner values --
+            corner = ((xind==0) | (xind==nx)) & ((yind==0) | (yind==ny))
+            ix[:,corner] = np.where(xind[corner]==0,0,nx-1)
+            iy[:,corner] = np.where(yind[corner]==0,0,ny-1)
+            wt[:,corner] = np.array([1.0,0.0,0.0,0.0])[:,None]
+
+        profile = np.zeros((len(xs),self.npix),float)
+        for i in range(4):
+            use = (wt[i] != 0)
+            profile[use] += wt[i][use,None]*self._grid[ix[i][use],iy[i][use]]
+
+        return profile
+
+    def evaluate(self,xs,ys,y=None,ycen=None):
+        """
+        Make the PSF for arrays of labels.  This gives the same profiles
+        as calling the PSF for each (X,Y) pair, but for all of them at once.
+
+        Parameters
+        ----------
+        xs : numpy array
+           X (column) labels [N].
+        ys : numpy array
+           Y (row) labels [N].
+        y : numpy array, optional
+           Pixel values [Ny] or [N,Ny].  The profiles are shifted and
+             interpolated onto these.
+        ycen : numpy array, optional
+           The centers of the profiles [N].  Default is ys.
+
+        Returns
+        -------
+        profile : numpy array
+           The profiles [N,Npix], or [N,Ny] if y is input.
+
+        Example
+        -------
+
+        profile = psf.evaluate(np.arange(2048),ycen,y=y)
+
+        """
+        xs = np.atleast_1d(np.asarray(xs,float))
+        ys = np.atleast_1d(np.asarray(ys,float))
+
+        # Interpolate in the grid
+        profile = self.gridinterp_array(xs,ys)
+
+        # Pixel values input, shift and interpolate
+        #  the same as np.interp() with the edge values outside the range
+        if y is not None:
+            if ycen is None:
+                ycen = ys
+            ycen = np.atleast_1d(np.asarray(ycen,float))
+            dy = np.clip(np.atleast_2d(y)-ycen[:,None],self.y[0],self.y[-1])
+            ind = np.clip(np.searchsorted(self.y,dy)-1,0,self.npix-2)
+            y1 = self.y[ind]
+            y2 = self.y[ind+1]
+            wt = (dy-y1)/(y2-y1)
+            profile = (1-wt)*np.take_along_axis(profile,ind,axis=1) + wt*np.take_along_axis(profile,ind+1,axis=1)
+
+        # Take to the power of
+        if self._log:
+            profile = 10**profile
+
+        return profile
+
     # Make a new method that does the interpolation for an entire fiber all at once (all 2048 pixels)
     # might allow for some speedups.  Would need to have y values (trace) input.
     def fiber(self,y):
@@ -448,14 +615,11 @@ class PSF(object):
         x0 = self.xmin[0]
         y0 = self.xmin[1]
         
-        # Loop over X and Y points and fill in the 3D grid
+        # Compute all of the X and Y points at once and fill in the 3D grid
         xgrid = np.linspace(self.xmin[0],self.xmax[0],nx)
         ygrid = np.linspace(self.xmin[1],self.xmax[1],ny)
-        grid = np.zeros((nx,ny,self.npix),float)
-        for i,x1 in enumerate(xgrid):
-            for j,y1 in enumerate(ygrid):
-                m1 = self.model([x1,y1])
-                grid[i,j,:] = m1
+        xx,yy = np.meshgrid(xgrid,ygrid,indexing='ij')
+        grid = self.ann_model(np.stack([xx.ravel(),yy.ravel()],axis=1)).reshape(nx,ny,-1)
 
         # Save the information
         self._xgrid = xgrid
@@ -573,8 +737,8 @@ def getprofdata(fibs,cols,hdulist,fiber2hdu):
             y1 = np.arange(ny)
             ymn = np.sum(y1.reshape(-1,1)*subim,axis=0)/np.sum(subim,axis=0)
             dy = y1.reshape(-1,1)-ymn.reshape(1,-1)
-            col2d = (np.arange(ncols)+cols[0]).reshape(-1,1) + np.zeros(ny).reshape(1,-1)
-            y2d = psfcat['CENT'][0,cols[0]:cols[1]].reshape(-1,1) + np.zeros(ny).reshape(1,-1)
+            col2d = (np.arange(ncols)+cols[0]).reshape(1,-1) + np.zeros(ny).reshape(-1,1)
+            y2d = psfcat['CENT'][0,cols[0]:cols[1]].reshape(1,-1) + np.zeros(ny).reshape(-1,1)
             data[cnt:cnt+ncols*ny,0] = dy.ravel()      # dy        
             data[cnt:cnt+ncols*ny,1] = subim.ravel()   # flux
             data[cnt:cnt+ncols*ny,2] = col2d.ravel()   # X
@@ -638,19 +802,7 @@ def avgprofile(fibs,cols,hdulist,fiber2hdu):
     xbin = bin_edges[0:-1]+0.5*binsize
 
     # Use Gaussian smoothing
-    gd, = np.where(np.isfinite(ybin) & (ybin>0))
-    temp = ybin.copy()
-    temp[~np.isfinite(ybin) | (ybin<=0)] = np.nan
-    ybinsm = dln.gsmooth(temp,5)
-    bad = ~np.isfinite(ybinsm)
-    if np.sum(bad)>0:
-        bd, = np.where(bad)
-        gd, = np.where(~bad)
-        fill_value = (ybinsm[gd[0]],ybinsm[gd[1]])
-        ybinsm[bd] = interp1d(xbin[~bad],ybinsm[~bad],bounds_error=False,fill_value=fill_value)(bd)
-
-    # Make sure it's normalized
-    ybinsm /= np.sum(ybinsm)*binsize
+    ybinsm = smoothprofile(xbin,ybin,binsize)
         
     # Use LOWESS to generate empirical template
     # it will use closest frac*N data points to a given point to estimate the smooth version
@@ -666,6 +818,251 @@ def avgprofile(fibs,cols,hdulist,fiber2hdu):
     return data, xbin, ybin, ybinsm
 
 
+def smoothprofile(xbin,ybin,binsize):
+    """
+    Gaussian smooth and normalize a binned profile, the bad bins are
+    filled in by interpolation.
+
+    Parameters
+    ----------
+    xbin : numpy array
+      Binned X-values.
+    ybin : numpy array
+      Binned Y-values.
+    binsize : float
+      Size of the bins.
+
+    Returns
+    -------
+    ybinsm : numpy array
+      The smoothed and normalized profile.
+
+    Example
+    -------
+
+    ybinsm = smoothprofile(xbin,ybin,0.1)
+
+    """
+    temp = ybin.copy()
+    temp[~np.isfinite(ybin) | (ybin<=0)] = np.nan
+    ybinsm = dln.gsmooth(temp,5)
+    bad = ~np.isfinite(ybinsm)
+    if np.sum(bad)>0:
+        bd, = np.where(bad)
+        gd, = np.where(~bad)
+        fill_value = (ybinsm[gd[0]],ybinsm[gd[1]])
+        ybinsm[bd] = interp1d(xbin[~bad],ybinsm[~bad],bounds_error=False,fill_value=fill_value)(bd)
+
+    # Make sure it's normalized
+    ybinsm /= np.sum(ybinsm)*binsize
+        
+    return ybinsm
+
+
+def loadprofdata(psffile):
+    """
+    Load all of the traces of an apEPSF file at once for makeprofilegrid().
+    The trace images are packed (as in EPSF) and the centroid of each
+    trace and column is computed for all of them at once.
+
+    Parameters
+    ----------
+    psffile : str
+      Filename of apEPSF file with empirical PSF profiles.
+
+    Returns
+    -------
+    prof : dict
+      Dictionary with the fiber numbers [Ntrace], packed images
+        [Ntrace,Maxheight,2048], trace heights [Ntrace], trace centers
+        CENT [Ntrace,2048] and profile centroids YMN [Ntrace,2048].
+
+    Example
+    -------
+
+    prof = loadprofdata(psffile)
+
+    """
+    hdulist = fits.open(psffile)
+    ntrace = len(hdulist)-1
+    epsflist = []
+    cent = np.zeros((ntrace,2048),float)
+    for i in range(ntrace):
+        psfcat = hdulist[i+1].data
+        epsflist.append({'fiber':psfcat['FIBER'][0], 'lo':psfcat['LO'][0], 'hi':psfcat['HI'][0],
+                         'img':psfcat['IMG'][0,:,:]})
+        cent[i,:] = psfcat['CENT'][0,:]
+    hdulist.close()
+    epsf = EPSF.fromlist(epsflist,filename=psffile)
+    img = epsf.img
+    # Centroid of each column, the rows beyond the trace height are zero
+    y1 = np.arange(epsf.maxheight).reshape(1,-1,1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ymn = np.sum(y1*img,axis=1)/np.sum(img,axis=1)
+    prof = {'fiber':epsf.fiber, 'img':img, 'height':epsf.height, 'cent':cent, 'ymn':ymn}
+    return prof
+
+
+def groupmedian(group,values,ngroup,weights=None):
+    """
+    Median of the values in each group, all of the groups at once.
+    Same as np.median() of each group, empty groups are NaN.
+
+    Parameters
+    ----------
+    group : numpy array
+      Group index of each value (0 to ngroup-1).
+    values : numpy array
+      The values.
+    ngroup : int
+      Number of groups.
+    weights : numpy array, optional
+      Integer number of times each value is repeated.
+
+    Returns
+    -------
+    med : numpy array
+      The median of each group [Ngroup].
+
+    Example
+    -------
+
+    med = groupmedian(group,values,ngroup)
+
+    """
+    med = np.zeros(ngroup,float)+np.nan
+    # Positive float32 values, sort on a 64-bit key with the group in the
+    #  upper and the value bits in the lower 32 bits, the bits of positive
+    #  floats sort in the same order as the values
+    if weights is None and values.dtype==np.float32 and np.all(values>=0):
+        key = (group.astype(np.uint64) << np.uint64(32)) | values.view(np.uint32).astype(np.uint64)
+        key.sort()
+        svalues = (key & np.uint64(0xffffffff)).astype(np.uint32).view(np.float32)
+        count = np.bincount(group,minlength=ngroup)
+        start = np.cumsum(count)-count
+        gd, = np.where(count>0)
+        med[gd] = 0.5*(svalues[start[gd]+(count[gd]-1)//2].astype(float) +
+                       svalues[start[gd]+count[gd]//2].astype(float))
+        return med
+    # General case, sort by value and then (stable) by group
+    if weights is None:
+        weights = np.ones(len(values),int)
+    order = np.argsort(values,kind='stable')
+    order = order[np.argsort(group[order],kind='stable')]
+    svalues = values[order]
+    cweights = np.cumsum(weights[order])
+    count = np.bincount(group,weights=weights,minlength=ngroup).astype(int)
+    start = np.cumsum(count)-count
+    gd, = np.where(count>0)
+    # values that cover the two middle positions of each group
+    ind1 = np.searchsorted(cweights,start[gd]+(count[gd]-1)//2,side='right')
+    ind2 = np.searchsorted(cweights,start[gd]+count[gd]//2,side='right')
+    med[gd] = 0.5*(svalues[ind1]+svalues[ind2])
+    return med
+
+
+def binprofiles(prof,fibers,columns,nfbin=5,ncbin=200,xr=[-7.0,7.0],binsize=0.1):
+    """
+    Binned median profiles on the grid of fiber and column bins, from the
+    output of loadprofdata().  This gives the same results as avgprofile()
+    for each grid point, but all of the pixels are binned at once.
+
+    Parameters
+    ----------
+    prof : dict
+      Packed profile data from loadprofdata().
+    fibers : numpy array
+      First fiber of each fiber bin, the bin includes fibers fiber to fiber+nfbin.
+    columns : numpy array
+      First column of each column bin, the bin includes columns column to column+ncbin-1.
+    nfbin : int
+      Number of fibers to bin.  Default is 5.
+    ncbin : int
+      Number of columns to bin.  Default is 200.
+    xr : list
+      Range of the profile bins.  Default is [-7.0,7.0].
+    binsize : float
+      Size of the profile bins.  Default is 0.1.
+
+    Returns
+    -------
+    xbin : numpy array
+      Binned X-values [Nbins].
+    ybin : numpy array
+      Binned median profiles [Ncols,Nfibers,Nbins].
+    mnx : numpy array
+      Median X value of each grid point [Ncols,Nfibers].
+    mny : numpy array
+      Median Y value of each grid point [Ncols,Nfibers].
+
+    Example
+    -------
+
+    xbin,ybin,mnx,mny = binprofiles(prof,fibers,columns)
+
+    """
+    img = prof['img']
+    ntrace,maxheight,npix = img.shape
+    nfib = len(fibers)
+    ncol = len(columns)
+    ncell = ncol*nfib
+    nbins = int(np.ceil((xr[1]-xr[0])/binsize)+1)
+    edges = np.linspace(xr[0],xr[1],nbins)
+    xbin = edges[0:-1]+0.5*binsize
+
+    # Fiber and column bins of each trace and column, a trace can be in two fiber bins
+    fiber2trace = dict(zip(prof['fiber'],np.arange(ntrace)))
+    tracebins = [[] for k in range(ntrace)]
+    for j,f in enumerate(fibers):
+        for f1 in range(f,f+nfbin+1):
+            if f1 in fiber2trace:
+                tracebins[fiber2trace[f1]].append(j)
+    colbin = np.zeros(npix,int)-1
+    for i,c in enumerate(columns):
+        colbin[c:c+ncbin] = i
+
+    # Trace and fiber bin of each trace that is in more than one fiber bin
+    nb = np.array([len(b) for b in tracebins])
+    bins = np.zeros((ntrace,np.maximum(np.max(nb),1)),int)
+    for k,b in enumerate(tracebins):
+        bins[k,0:len(b)] = b
+    def expand(kind):
+        rep = np.repeat(np.arange(len(kind)),nb[kind])
+        nth = np.arange(len(rep))-np.repeat(np.cumsum(nb[kind])-nb[kind],nb[kind])
+        return rep,bins[kind[rep],nth]
+
+    # All of the good pixels in the bins
+    y1 = np.arange(maxheight).reshape(1,-1,1)
+    good = (y1 < prof['height'].reshape(-1,1,1)) & (img > 0) & (colbin >= 0).reshape(1,1,-1)
+    good &= (nb > 0).reshape(-1,1,1)
+
+    # Median X and Y of each grid point, all pixels
+    #  use the number of good pixels in each trace and column as weights
+    ngood = np.sum(good,axis=1)
+    kind,xind = np.where(ngood > 0)
+    rep,fbin = expand(kind)
+    kind,xind = kind[rep],xind[rep]
+    cell = colbin[xind]*nfib + fbin
+    mnx = groupmedian(cell,xind.astype(float),ncell,weights=ngood[kind,xind]).reshape(ncol,nfib)
+    mny = groupmedian(cell,prof['cent'][kind,xind],ncell,weights=ngood[kind,xind]).reshape(ncol,nfib)
+
+    kind,yind,xind = np.where(good)
+    flux = img[kind,yind,xind]
+    dy = yind-prof['ymn'][kind,xind]
+    rep,fbin = expand(kind)
+    xind,flux,dy = xind[rep],flux[rep],dy[rep]
+    cell = colbin[xind]*nfib + fbin
+
+    # Median profile in the dy bins, same binning as bindata.binned_statistic()
+    dbin = np.searchsorted(edges,dy,side='right')-1
+    decimal = int(-np.log10(np.min(np.diff(edges)))) + 6
+    dbin[np.around(dy,decimal)==np.around(edges[-1],decimal)] = nbins-2
+    gd, = np.where((dbin >= 0) & (dbin < nbins-1))
+    ybin = groupmedian(cell[gd]*(nbins-1)+dbin[gd],flux[gd],ncell*(nbins-1)).reshape(ncol,nfib,nbins-1)
+
+    return xbin,ybin,mnx,mny
+
+
 def makeprofilegrid(psffile,sparsefile,nfbin=5,ncbin=200,verbose=False):
     """
     Construct a grid in X and Y across the detector of average
@@ -715,20 +1112,22 @@ def makeprofilegrid(psffile,sparsefile,nfbin=5,ncbin=200,verbose=False):
 
     allim,head = fits.getdata(sparsefile,0,header=True)
     sim = allim[1,:,:]
-    psfhdu = fits.open(psffile)
 
-    # Get fiber numbers for each hdu
-    fiber2hdu = mkfiber2hdu(psfhdu)
+    # Load all of the EPSF profile data at once
+    prof = loadprofdata(psffile)
+    fiber2trace = dict(zip(prof['fiber'],np.arange(len(prof['fiber']))))
+    medcent = np.median(prof['cent'],axis=1)
     
     fibers = np.arange(0,300,nfbin)
     columns = np.arange(10,2000,ncbin)
 
+    # Binned profiles for all grid points
+    xbin,ybinall,mnx,mny = binprofiles(prof,fibers,columns,nfbin=nfbin,ncbin=ncbin)
+
     # Get sparse data
     
     #data = np.zeros((len(fibers),len(columns),700),float)
     data = []
-    mnx = np.zeros((len(columns),len(fibers)),float)
-    mny = np.zeros((len(columns),len(fibers)),float)
     profiles = np.zeros((len(columns),len(fibers),300),float)
     binsize = 0.1
     xx = np.arange(300)*binsize-14.95
@@ -757,15 +1156,14 @@ def makeprofilegrid(psffile,sparsefile,nfbin=5,ncbin=200,verbose=False):
 
             if verbose:
                 print(f,c)
-            #data1, xbin,ybin,lowess,ylowess = avgprofile([f,f+nfbin],[c,c+ncbin],psfhdu,fiber2hdu)
-            data1, xbin,ybin,ybinsm = avgprofile([f,f+nfbin],[c,c+ncbin],psfhdu,fiber2hdu)            
+            ybin = ybinall[i,j,:]
+            ybinsm = smoothprofile(xbin,ybin,binsize)
             
             # Get closest sparse fiber
             ytracearr = []
             for k in np.arange(f,f+nfbin):
-                if fiber2hdu.get(k) is not None:
-                    psfcat = psfhdu[fiber2hdu[k]].data
-                    ytracearr.append(np.median(psfcat['CENT']))
+                if fiber2trace.get(k) is not None:
+                    ytracearr.append(medcent[fiber2trace[k]])
             ytrace = np.median(np.array(ytracearr))
             diff = linestr['pars'][:,1]-ytrace
             bestind = np.argmin(np.abs(diff))
@@ -854,14 +1252,23 @@ def makeprofilegrid(psffile,sparsefile,nfbin=5,ncbin=200,verbose=False):
             #plt.title('fiber='+str(f)+' column='+str(c))
 
             data.append( [xbin,ybin,ybinsm,f,c] )
-            mnx[i,j] = np.median(data1[:,2])
-            mny[i,j] = np.median(data1[:,3])
             profiles[i,j,:] = yprofile 
 
     return data,mnx,mny,profiles,xx
 
 
-def mkmodelpsf(name,psfid,sparseid,apred,telescope,nfbin=5,ncbin=200,verbose=False):
+def _mkmodelpsf_chip(args):
+    """ Make and write the Model PSF of one chip, for mkmodelpsf()."""
+    psffile,sparsefile,outfile,nfbin,ncbin,verbose = args
+    data,mnx,mny,profiles,y = makeprofilegrid(psffile,sparsefile,nfbin=nfbin,ncbin=ncbin,verbose=verbose)
+    labels = [mnx,mny]
+    p = PSF((profiles,labels,y),kind='grid',log=False)
+    print('Writing to '+outfile)
+    p.write(outfile)
+    return outfile
+
+
+def mkmodelpsf(name,psfid,sparseid,apred,telescope,nfbin=5,ncbin=200,nworkers=1,verbose=False):
     """
     Makes the Model PSF calibration file.
 
@@ -881,6 +1288,8 @@ def mkmodelpsf(name,psfid,sparseid,apred,telescope,nfbin=5,ncbin=200,verbose=Fal
       Number of fibers to bin/average.  Default is 5.
     ncbin : int
       Number of column to bin/average.  Default is 200.
+    nworkers : int, optional
+      Number of processes to use to run the chips in parallel.  Default is 1.
     verbose : boolean, optional
       Verbose output to the screen.
 
@@ -903,14 +1312,17 @@ def mkmodelpsf(name,psfid,sparseid,apred,telescope,nfbin=5,ncbin=200,verbose=Fal
     load = apload.ApLoad(apred=apred,telescope=telescope)
     sparsefile = load.filename('Sparse',num=sparseid,chips=True)
     psffile = load.filename('EPSF',num=psfid,chips=True)
+    chipargs = []
     for ch in chips:
         psffile1 = psffile.replace('EPSF-','EPSF-'+ch+'-')
-        data,mnx,mny,profiles,y = makeprofilegrid(psffile1,sparsefile,verbose=verbose)
-        labels = [mnx,mny]
-        p = PSF((profiles,labels,y),kind='grid',log=False)
         outfile = load.filename('PSFModel',num=name,chips=True).replace('PSFModel-','PSFModel-'+ch+'-')
-        print('Writing to '+outfile)
-        p.write(outfile)
+        chipargs.append((psffile1,sparsefile,outfile,nfbin,ncbin,verbose))
+    if nworkers > 1:
+        with mp.Pool(np.minimum(nworkers,len(chips))) as pool:
+            pool.map(_mkmodelpsf_chip,chipargs)
+    else:
+        for args in chipargs:
+            _mkmodelpsf_chip(args)
 
 
 #####  EXTRACTION #######
@@ -924,20 +1336,181 @@ def loadframe(infile):
     frame = {'flux':flux, 'err':err, 'mask':mask, 'header':head}
     return frame
 
-def loadepsf(infile):
+class EPSF(object):
+    """
+    Empirical PSF of all of the traces of a chip.
+
+    The trace images are packed into one contiguous [Ntrace,Maxheight,2048]
+    float32 array.  Row j of trace k is at Y=lo[k]+j and rows beyond the
+    height of a trace (hi[k]-lo[k]+1) are zero.  Indexing returns the old
+    dictionary format with 'fiber', 'lo', 'hi' and 'img' (a view).
+
+    Parameters
+    ----------
+    fiber : numpy array
+       Fiber number of each trace [Ntrace].
+    lo : numpy array
+       Lowest Y row of each trace [Ntrace].
+    hi : numpy array
+       Highest Y row of each trace [Ntrace].
+    img : numpy array
+       Packed trace images [Ntrace,Maxheight,2048].
+    filename : str, optional
+       Name of the apEPSF file.
+
+    Example
+    -------
+
+    epsf = EPSF.read('apEPSF-a-35410004.fits')
+    img = epsf.trace(10)    # [height,2048]
+
+    """
+
+    def __init__(self,fiber,lo,hi,img,filename=None):
+        self.fiber = np.asarray(fiber).astype(int)
+        self.lo = np.asarray(lo).astype(int)
+        self.hi = np.asarray(hi).astype(int)
+        self.img = img
+        self.filename = filename
+        # key for the extraction matrix cache, see extract_matrix()
+        self.cachekey = None
+
+    def __repr__(self):
+        """ String representation of the EPSF."""
+        return self.__class__.__name__+'(Ntrace=%d, Maxheight=%d)' % (self.ntrace,self.maxheight)
+
+    def __len__(self):
+        return self.ntrace
+
+    def __getitem__(self,k):
+        """ Dictionary for one trace, the image is a view."""
+        return {'fiber':self.fiber[k], 'lo':self.lo[k], 'hi':self.hi[k], 'img':self.trace(k)}
+
+    @property
+    def ntrace(self):
+        return len(self.fiber)
+
+    @property
+    def maxheight(self):
+        return self.img.shape[1]
+
+    @property
+    def height(self):
+        return self.hi-self.lo+1
+
+    def trace(self,k):
+        """ Image of trace k [height,2048], this is a view."""
+        return self.img[k,0:self.hi[k]-self.lo[k]+1,:]
+
+    def copy(self,tag=None):
+        """
+        Copy with a writable in-memory image array.  The copy gets its own
+        extraction matrix cache key.  If tag is given (e.g. the shift that
+        will be applied to the images) the key is derived from the key of
+        this EPSF and the tag, so the same modification of the same EPSF
+        reuses its cached matrices.
+        """
+        new = EPSF(self.fiber.copy(),self.lo.copy(),self.hi.copy(),np.array(self.img),filename=self.filename)
+        if tag is not None and self.cachekey is not None:
+            new.cachekey = (self.cachekey,tag)
+        return new
+
+    @classmethod
+    def fromlist(cls,epsflist,filename=None):
+        """ Pack a list of trace dictionaries (fiber, lo, hi, img)."""
+        ntrace = len(epsflist)
+        fiber = np.array([e['fiber'] for e in epsflist])
+        lo = np.array([e['lo'] for e in epsflist])
+        hi = np.array([e['hi'] for e in epsflist])
+        maxheight = np.max(hi-lo+1) if ntrace>0 else 0
+        img = np.zeros((ntrace,maxheight,2048),np.float32)
+        for k,e in enumerate(epsflist):
+            img[k,0:hi[k]-lo[k]+1,:] = e['img']
+        return cls(fiber,lo,hi,img,filename=filename)
+
+    @staticmethod
+    def sidecarfiles(infile):
+        """ Names of the sidecar files (.npy trace images and .npz fiber/lo/hi) of an apEPSF file."""
+        base = infile[:-5] if infile.endswith('.fits') else infile
+        return base+'.npy',base+'_trace.npz'
+
+    @staticmethod
+    def fitsstamp(infile):
+        """ Size and modification time of an apEPSF file, (-1,-1) if it does not exist."""
+        if os.path.exists(infile)==False:
+            return np.array([-1,-1],float)
+        return np.array([os.path.getsize(infile),os.path.getmtime(infile)],float)
+
+    def write(self,outfile):
+        """
+        Write the packed EPSF to the sidecar files of an apEPSF file.  The
+        size and modification time of the FITS file are saved with the
+        fiber/lo/hi so the sidecar files can be checked against it.
+        """
+        imgfile,tracefile = self.sidecarfiles(outfile)
+        # write to temporary names and rename so other processes never see partial files
+        tag = '.'+str(os.getpid())
+        np.save(imgfile+tag+'.npy',np.ascontiguousarray(self.img,np.float32))
+        np.savez(tracefile+tag+'.npz',fiber=self.fiber,lo=self.lo,hi=self.hi,
+                 stamp=self.fitsstamp(outfile))
+        os.replace(imgfile+tag+'.npy',imgfile)
+        os.replace(tracefile+tag+'.npz',tracefile)
+
+    @classmethod
+    def read(cls,infile,cache=True):
+        """
+        Load an apEPSF file.  With cache=True the packed sidecar files are
+        memory-mapped if they were written from this version of the FITS
+        file (same size and modification time), otherwise the FITS file is
+        read and the sidecar files are written for next time.
+        """
+        imgfile,tracefile = cls.sidecarfiles(infile)
+        if cache and os.path.exists(imgfile) and os.path.exists(tracefile):
+            with np.load(tracefile) as tab:
+                fiber,lo,hi,stamp = tab['fiber'],tab['lo'],tab['hi'],tab['stamp']
+            if np.array_equal(stamp,cls.fitsstamp(infile)):
+                img = np.load(imgfile,mmap_mode='r')
+                epsf = cls(fiber,lo,hi,img,filename=infile)
+                epsf.cachekey = (os.path.abspath(infile),os.path.getmtime(infile))
+                return epsf
+        phead = fits.getheader(infile,0)
+        ntrace = phead.get('ntrace')
+        if ntrace is None:
+            print('No NTRACE in header')
+            return cls([],[],[],np.zeros((0,0,2048),np.float32),filename=infile)
+        epsflist = []
+        hdu = fits.open(infile)
+        for itrace in range(ntrace):
+            ptmp = hdu[itrace+1].data
+            epsflist.append({'fiber': ptmp['FIBER'][0], 'lo': ptmp['LO'][0], 'hi': ptmp['HI'][0], 'img': ptmp['IMG'][0]})
+        hdu.close()
+        epsf = cls.fromlist(epsflist,filename=infile)
+        epsf.cachekey = (os.path.abspath(infile),os.path.getmtime(infile))
+        if cache:
+            try:
+                epsf.write(infile)
+            except OSError as e:
+                print('Could not write EPSF cache files for '+infile+': '+str(e))
+        return epsf
+
+
+def loadepsf(infile,cache=True):
     """
     Load Empirical PSF data
-    this takes a while
+    the packed version is cached in sidecar files next to the apEPSF
+    file and memory-mapped on later calls
 
     Parameters
     ----------
     infile : str
        Filename of apEPSF file.
+    cache : boolean, optional
+       Use (and write) the sidecar files.  Default is True.
 
     Returns
     -------
-    epsf : list
-       List of dictionaries with information on each trace.
+    epsf : EPSF
+       EPSF object with the information on all the traces.
 
     Example
     -------
@@ -945,19 +1518,7 @@ def loadepsf(infile):
     epsf = loadepsf(infile)
  
     """
-    phead = fits.getheader(infile,0)
-    ntrace = phead.get('ntrace')
-    if ntrace is None:
-        print('No NTRACE in header')
-        return []
-    epsf = []
-    hdu = fits.open(infile)
-    for itrace in range(ntrace):
-        ptmp = hdu[itrace+1].data
-        data = {'fiber': ptmp['FIBER'][0], 'lo': ptmp['LO'][0], 'hi': ptmp['HI'][0], 'img': ptmp['IMG'][0]}
-        epsf.append(data)
-    hdu.close()
-    return epsf
+    return EPSF.read(infile,cache=cache)
 
 def scat_remove(a,scat=None,mask=None):
     """
@@ -980,56 +1541,41 @@ def scat_remove(a,scat=None,mask=None):
 
     else:
         # variable scattered light, but only works for sparse exposures
-        sz = a.ndim
         t = np.copy(a)
         bad = (~np.isfinite(t) | (t < -10))
         t[bad] = 1e10
         nbox = 51
-        grid = np.zeros((41,41),float)
-        ii = 0
-        for i in range(4,2045,nbox):
-            print(i)
-            jj = 0
-            for j in range(4,2045,nbox):
-                i1 = i-nbox//2
-                i2 = i+nbox//2
-                j1 = j-nbox//2
-                j2 = j+nbox//2
-                i1 = np.max([4,i1])
-                i2 = np.min([2044,i2])
-                j1 = np.max([4,j1])
-                j2 = np.min([2044,j2])
-                sky = t[i1:i2+1,j1:j2+1]
-                val,sig,skew = mmm.mmm(sky.ravel(),highbad=1e5)
-                if sig > 0: grid[ii,jj]=val
-                jj += 1
-            ii += 1
-  
-        vec1 = np.arange(nbox).astype(int)
-        vec2 = np.ones(nbox,float)
-        xramp = vec1.reshape(-1,1)*vec2.reshape(1,-1)
-        yramp = vec1.reshape(1,-1)*vec2.reshape(-1,1)
-        
-        w1 = (nbox-xramp)/nbox*(nbox-yramp)/nbox
-        w2 = xramp/nbox*(nbox-yramp)/nbox
-        w3 = (nbox-xramp)/nbox*yramp/nbox
-        w4 = xramp/nbox*yramp/nbox
-        
+        hbox = nbox//2
+        ngrid = 41
+
+        # The boxes are centered on 4, 4+nbox, ..., 2044 and clipped to
+        # the 4-2044 range, so they tile this range exactly.  Pad with
+        # NaNs (ignored by mmm) so all of the boxes are nbox x nbox and
+        # get views of the boxes [ngrid,ngrid,nbox*nbox]
+        tpad = np.zeros((ngrid*nbox,ngrid*nbox),float)+np.nan
+        tpad[hbox:hbox+2041,hbox:hbox+2041] = t[4:2045,4:2045]
+        boxes = tpad.reshape(ngrid,nbox,ngrid,nbox).transpose(0,2,1,3).reshape(ngrid,ngrid,nbox*nbox)
+
+        # Robust mode of all the boxes at once
+        val,sig,skew = mmm.mmm_array(boxes,highbad=1e5)
+        grid = np.where(sig > 0,val,0.0)
+
+        # Bilinear interpolation between the box centers, each nbox x nbox
+        # cell starts at a grid point
+        ramp = np.arange(nbox)/nbox
+        v1 = grid[:-1,:-1]
+        v2 = grid[1:,:-1]
+        v3 = grid[:-1,1:]
+        v4 = grid[1:,1:]
+        v1 = np.where(v1 > 1e9,v2,v1)
+        v2 = np.where(v2 > 1e9,v1,v2)
+        # first along y, then along x  [ngrid-1,nbox,ngrid-1,nbox]
+        lo = v1[:,:,None]*(1-ramp) + v3[:,:,None]*ramp
+        hi = v2[:,:,None]*(1-ramp) + v4[:,:,None]*ramp
+        cells = lo[:,None,:,:]*(1-ramp)[None,:,None,None] + hi[:,None,:,:]*ramp[None,:,None,None]
+        ncell = (ngrid-1)*nbox
         out = np.zeros((2048,2048),float)
-        ii = 0
-
-        for i in range(4+nbox//2,2045-nbox//2,nbox):
-            jj = 0
-            for j in range(4+nbox//2,2045-nbox//2,nbox):            
-                v1 = grid[ii,jj]
-                v2 = grid[ii+1,jj]
-                v3 = grid[ii,jj+1]
-                v4 = grid[ii+1,jj+1]
-                if v1 > 1e9: v1=v2
-                if v2 > 1e9: v2=v1
-                out[i-nbox//2:i+nbox//2+1,j-nbox//2:j+nbox//2+1] = v1*w1+v2*w2+v3*w3+v4*w4
-                jj += 1
-            ii += 1
+        out[4:4+ncell,4:4+ncell] = cells.reshape(ncell,ncell)
 
         flux = np.copy(a)
         flux -= out
@@ -1037,18 +1583,17 @@ def scat_remove(a,scat=None,mask=None):
     return flux
 
 
-def extract_pmul(p1lo,p1hi,img,p2):
-    """ Helper function for extract()."""
+def extract_pmul(p1lo,p1hi,img,p2lo,p2hi,img2):
+    """ Helper function for extract(), overlap of two (transposed) trace images."""
     
-    lo = np.max([p1lo,p2['lo']])
+    lo = np.max([p1lo,p2lo])
     k1 = lo-p1lo
-    l1 = lo-p2['lo']
-    hi = np.min([p1hi,p2['hi']])
+    l1 = lo-p2lo
+    hi = np.min([p1hi,p2hi])
     k2 = hi-p1lo
-    l2 = hi-p2['lo']
+    l2 = hi-p2lo
     if lo>hi:
-        out = np.zeros(2048,float)
-    img2 = p2['img'].T  # transpose
+        return np.zeros(img.shape[0],float)
     if lo==hi:
         out = img[:,k1:k2+1]*img2[:,l1:l2+1]
     else:
@@ -1057,17 +1602,210 @@ def extract_pmul(p1lo,p1hi,img,p2):
         out = out.flatten()   # make sure it's 1D
     return out
 
-@njit
-def solvefibers(x,xvar,ngood,v,b,c,vvar):
-    for j in np.flip(np.arange(0,ngood-1)):
-        x[j] = (v[j]-c[j]*x[j+1])/b[j]
-        xvar[j] = (vvar[j]+c[j]**2*xvar[j+1])/b[j]**2            
+def solvetridiag(a,b,c,v,vvar,good=None):
+    """
+    Solve the tridiagonal fiber systems of all the columns at once.
+
+    The Thomas algorithm is run over the fibers (first dimension) with
+    all of the columns (second dimension) done together.  Rows that are
+    not good are decoupled from their neighbors and return zero.
+
+    Parameters
+    ----------
+    a, b, c : numpy array
+       The lower, main and upper diagonals [Nfibers,Ncolumns].
+    v : numpy array
+       The right-hand side [Nfibers,Ncolumns].
+    vvar : numpy array
+       The variance of the right-hand side [Nfibers,Ncolumns].
+    good : numpy array, optional
+       Boolean mask of the rows to use [Nfibers,Ncolumns].  By default
+         all rows are used.
+
+    Returns
+    -------
+    x : numpy array
+       The solution [Nfibers,Ncolumns].
+    xvar : numpy array
+       The variance of the solution [Nfibers,Ncolumns].
+
+    Example
+    -------
+
+    x,xvar = solvetridiag(a,b,c,v,vvar,good)
+
+    """
+    a = np.array(a,float)
+    b = np.array(b,float)
+    c = np.array(c,float)
+    v = np.array(v,float)
+    vvar = np.array(vvar,float)
+    # Decouple bad rows, identity row with zero right-hand side
+    if good is not None:
+        bad = ~good
+        a[bad] = 0.0
+        b[bad] = 1.0
+        c[bad] = 0.0
+        v[bad] = 0.0
+        vvar[bad] = 0.0
+        # and remove their coupling to the neighboring rows
+        a[1:][bad[:-1]] = 0.0
+        c[:-1][bad[1:]] = 0.0
+    nrow = b.shape[0]
+    # Forward sweep
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for j in range(1,nrow):
+            m = a[j]/b[j-1]
+            b[j] -= m*c[j-1]
+            v[j] -= m*v[j-1]
+            vvar[j] += m**2*vvar[j-1]
+        # Back substitution
+        x = np.zeros(b.shape,float)
+        xvar = np.zeros(b.shape,float)
+        x[nrow-1] = v[nrow-1]/b[nrow-1]
+        xvar[nrow-1] = vvar[nrow-1]/b[nrow-1]**2
+        for j in range(nrow-2,-1,-1):
+            x[j] = (v[j]-c[j]*x[j+1])/b[j]
+            xvar[j] = (vvar[j]+c[j]**2*xvar[j+1])/b[j]**2
     return x,xvar
 
+def extract_tridiag1(epsf,k,badim,cols=None):
+    """
+    Helper function for extract_matrix().  The PSF total and the
+    tridiagonal terms of trace k for some columns.
+
+    Parameters
+    ----------
+    epsf : EPSF
+       The empirical PSF.
+    k : int
+       Trace index.
+    badim : numpy array
+       Boolean bad pixel image [2048(X),2048(Y)] (transposed).
+    cols : numpy array, optional
+       Column (X) indices.  Default is all columns.
+
+    Returns
+    -------
+    psftot : numpy array
+       Total of the trace PSF, without the bad pixels [Ncols].
+    tri : numpy array
+       The three tridiagonal terms [3,Ncols].
+
+    """
+    if cols is None:
+        cols = slice(None)
+    ntrace = len(epsf)
+    lo = epsf.lo[k]
+    hi = epsf.hi[k]
+    # get EPSF and set bad pixels to NaN
+    img = epsf.trace(k).T[cols].astype(float)   # transpose
+    bad = badim[cols,lo:hi+1]
+    if np.sum(bad) > 0:
+        img = np.where(bad,np.nan,img)
+    psftot = np.nansum(img,axis=1)
+    # overlap with the neighboring traces, only the trace itself is masked
+    tri = np.zeros((3,len(psftot)),float)
+    for l in range(np.maximum(k-1,0),np.minimum(k+2,ntrace)):
+        tri[l-k+1] = extract_pmul(lo,hi,img,epsf.lo[l],epsf.hi[l],epsf.trace(l).T[cols].astype(float))
+    return psftot,tri
+
+
+# Cache of the extraction matrices, keyed by the EPSF and a hash of the bad pixel mask
+extract_cache_settings = {'enabled':True, 'nmax':4}
+_extract_cache = OrderedDict()
+_extract_cache_counter = itertools.count()
+
+def extract_matrix(epsf,badim,doback=False):
+    """
+    The tridiagonal extraction matrix and PSF totals for an EPSF and bad
+    pixel mask.  These only depend on the EPSF and the mask, so they are
+    cached.  For a new mask the matrix of the last mask used with the same
+    EPSF is updated, only the columns of the traces where the mask
+    changed are recomputed.
+
+    Parameters
+    ----------
+    epsf : EPSF
+       The empirical PSF.
+    badim : numpy array
+       Boolean bad pixel image [2048(X),2048(Y)] (transposed).
+    doback : boolean, optional
+       Add the background term.  Default is False.
+
+    Returns
+    -------
+    tridiag : numpy array
+       The lower, main and upper diagonals [3,Ntrace+Nback,2048].
+    psftot : numpy array
+       The PSF total of each trace [Ntrace+Nback,2048].
+
+    Example
+    -------
+
+    tridiag,psftot = extract_matrix(epsf,badim)
+
+    """
+    ntrace = len(epsf)
+    badim = np.asarray(badim,bool)
+    # EPSF key, the file for a loaded EPSF, otherwise unique to this object
+    if epsf.cachekey is None:
+        epsf.cachekey = ('EPSF',next(_extract_cache_counter))
+    epsfkey = epsf.cachekey
+    maskhash = hashlib.md5(np.packbits(badim).tobytes()).hexdigest()
+    key = (epsfkey,maskhash)
+
+    if extract_cache_settings['enabled'] and key in _extract_cache:
+        _extract_cache.move_to_end(key)
+        refbad,tridiag,psftot = _extract_cache[key]
+
+    else:
+        # Last matrix for this EPSF
+        ref = None
+        if extract_cache_settings['enabled']:
+            for k1 in reversed(_extract_cache):
+                if k1[0]==epsfkey:
+                    ref = _extract_cache[k1]
+                    break
+        # Update the changed columns
+        if ref is not None:
+            refbad,tridiag,psftot = ref
+            tridiag = tridiag.copy()
+            psftot = psftot.copy()
+            # X/Y of the pixels where the mask changed
+            cx,cy = np.nonzero(badim != refbad)
+            for k in range(ntrace):
+                cols = np.unique(cx[(cy >= epsf.lo[k]) & (cy <= epsf.hi[k])])
+                if len(cols)>0:
+                    psftot[k,cols],tridiag[:,k,cols] = extract_tridiag1(epsf,k,badim,cols)
+        # Compute from scratch
+        else:
+            tridiag = np.zeros((3,ntrace,2048),float)
+            psftot = np.zeros((ntrace,2048),float)
+            for k in range(ntrace):
+                psftot[k],tridiag[:,k] = extract_tridiag1(epsf,k,badim)
+        tridiag.flags.writeable = False
+        psftot.flags.writeable = False
+        if extract_cache_settings['enabled']:
+            _extract_cache[key] = (badim.copy(),tridiag,psftot)
+            while len(_extract_cache) > extract_cache_settings['nmax']:
+                _extract_cache.popitem(last=False)
+
+    # Background terms
+    if doback:
+        tridiag = np.concatenate((tridiag,np.zeros((3,1,2048),float)),axis=1)
+        tridiag[1,ntrace,:] = epsf.hi[-1]-epsf.lo[-1]+1
+        psftot = np.concatenate((psftot,np.ones((1,2048),float)),axis=0)
+
+    return tridiag,psftot
+
+
 def epsfmodel(epsf,spec,skip=False,subonly=False,fibers=None,yrange=[0,2048]):
     """ Create model image using EPSF and best-fit values."""
     # spec [2048,300], best-fit flux values
     
+    if isinstance(epsf,EPSF)==False:
+        epsf = EPSF.fromlist(epsf)
     ntrace = len(epsf)
     if fibers is None:
         fibers = np.arange(ntrace)
@@ -1093,13 +1831,10 @@ def epsfmodel(epsf,spec,skip=False,subonly=False,fibers=None,yrange=[0,2048]):
             junk, = np.where(skip==k)
             ns = len(junk)
         if nf > 0 and ns==0:
-            p1 = epsf[k]
-            lo = epsf[k]['lo']
-            hi = epsf[k]['hi']
-            img = p1['img'].T
-            rows = np.ones(hi-lo+1,int)
-            fiber = epsf[k]['fiber']
-            model[:,lo-ylo:hi+1-ylo] += img[:,:]*(rows.reshape(-1,1)*t[:,fiber]).T                                    
+            lo = epsf.lo[k]
+            hi = epsf.hi[k]
+            img = epsf.trace(k).T
+            model[:,lo-ylo:hi+1-ylo] += img*t[:,epsf.fiber[k]].reshape(-1,1)
     model = model.T
 
     return model
@@ -1116,8 +1851,8 @@ def extract(frame,epsf,doback=False,skip=False,scat=None,subonly=False,guess=Non
     ----------
     frame : dict
        The 2D input structure with flux, err, mask and header.
-    epsf : list
-       A list with the empirical PSF.
+    epsf : EPSF
+       The empirical PSF.
     doback : boolean, optional
        Subtract the background.  False by default.
     guess : dict
@@ -1144,9 +1879,11 @@ def extract(frame,epsf,doback=False,skip=False,scat=None,subonly=False,guess=Non
     """
     
     nframe = len(frame)
+    if isinstance(epsf,EPSF)==False:
+        epsf = EPSF.fromlist(epsf)
     ntrace = len(epsf)
 
-    fibers = np.array([e['fiber'] for e in epsf])
+    fibers = epsf.fiber
     flux = np.copy(frame['flux'].T)
     red = np.copy(frame['flux'].T)    
     var = np.copy(frame['err'].T**2)
@@ -1175,139 +1912,78 @@ def extract(frame,epsf,doback=False,skip=False,scat=None,subonly=False,guess=Non
     back = np.zeros(2048,float)        
     beta = np.zeros((ntrace+nback,2048),float)
     betavar = np.zeros((ntrace+nback,2048),float)
-    psftot = np.zeros((ntrace+nback,2048),float)
-    tridiag = np.zeros((3,ntrace+nback,2048),float)
     warnmasked = np.zeros((ntrace+nback,2048),int)
     badmasked = np.zeros((ntrace+nback,2048),int)
     inmask_warn = (inmask & WARNMASK)
     inmask_bad = (inmask & BADMASK)
+    badim = (~np.isfinite(flux) | (flux == 0) | (inmask_bad > 0))
+
+    # The tridiagonal matrix only depends on the EPSF and the bad pixels
+    tridiag,psftot = extract_matrix(epsf,badim,doback=doback)
 
     for k in np.arange(0,ntrace+nback):        
         # Background
         if k > ntrace-1:
             beta[k,:] = np.nansum(red[:,lo:hi+1],axis=1)
             betavar[k,:] = np.nansum(var[:,lo:hi+1],axis=1)
-            psftot[k,:] = 1.
 
         # Fibers
         else:
-            # Initial guess, add flux back in for this fiber and neighbors
-            if guess is not None:
-                if k==0:
-                    fibs = [k,k+1]
-                elif k==ntrace-1:
-                    fibs = [k-1,k]
-                else:
-                    fibs = [k-1,k,k+1]
-                ylo = 2048
-                yhi = 0
-                for j in fibs:
-                    ylo = np.minimum(epsf[j]['lo'],ylo)
-                    yhi = np.maximum(epsf[j]['hi'],yhi)
-                yhi += 1
-                gmodel1 = epsfmodel(epsf,guess,fibers=fibs,yrange=[ylo,yhi])
-                gmodel1 = gmodel1.T
-                red[:,ylo:yhi] += gmodel1
-                    
             # get EPSF and set bad pixels to NaN
-            p1 = epsf[k]
-            lo = epsf[k]['lo']
-            hi = epsf[k]['hi']
-            bad = (~np.isfinite(flux[:,lo:hi+1]) | (flux[:,lo:hi+1] == 0) |
-                   ((inmask[:,lo:hi+1] & BADMASK) > 0) )
+            lo = epsf.lo[k]
+            hi = epsf.hi[k]
+            bad = badim[:,lo:hi+1]
             nbad = np.sum(bad)
-            img = np.copy(p1['img'].T)   # transpose
+            img = epsf.trace(k).T   # transpose, a view
             if nbad > 0:
-                img[bad] = np.nan
+                img = np.where(bad,np.nan,img)
                 
             # are there any warning flags for this trace? If so, flag the output
             warnmasked[k,:] = np.bitwise_or.reduce(inmask_warn[:,lo:hi+1],axis=1)
             badmasked[k,:] = np.bitwise_or.reduce(inmask_bad[:,lo:hi+1],axis=1)
             
-            psftot[k,:] = np.nansum(img,axis=1)
             beta[k,:] = np.nansum(red[:,lo:hi+1]*img,axis=1)
             betavar[k,:] = np.nansum(var[:,lo:hi+1]*img**2,axis=1)
-            
-            # Initial guess, subtract model back out
-            if guess is not None:
-                red[:,ylo:yhi] -= gmodel1                
-                
-        # First fiber (on the bottom edge)
-        if k==0:
-            ll = 1
-            for l in np.arange(k,k+2):
-                tridiag[ll,k,:] = extract_pmul(p1['lo'],p1['hi'],img,epsf[l])
-                ll += 1
-
-        # Last fiber (on top edge)
-        elif k == ntrace-1:
-            ll = 0
-            for l in np.arange(k-1,k+1):
-                tridiag[ll,k,:] = extract_pmul(p1['lo'],p1['hi'],img,epsf[l])
-                ll += 1
-
-        # Background terms
-        elif k > ntrace-1:
-            tridiag[1,k,:] = hi-lo+1
-
-        # Middle fibers (not first or last)
-        else:
-            ll = 0
-            for l in np.arange(k-1,k+2):
-                tridiag[ll,k,:] = extract_pmul(p1['lo'],p1['hi'],img,epsf[l])
-                ll += 1
-
-    for i in np.arange(4,2044):
-        # Good fibers
-        good, = np.where(psftot[:,i] > 0.5)
-        ngood = len(good)
-        bad, = np.where(psftot[:,i] <= 0.5)
-        nbad = len(bad)
-        if nbad > 0:
-            bad0, = np.where(bad>0)
-            nbad0 = len(bad0)
-            if nbad0 > 0:
-                tridiag[2,bad[bad0]-1,i]=0 
-            bad1, = np.where(bad < ntrace-1)
-            nbad1 = len(bad1)
-            if nbad1 > 0:
-                tridiag[0,bad[bad1]+1,i] = 0 
-        if ngood>0:
-            a = tridiag[0,good,i]
-            b = tridiag[1,good,i]
-            c = tridiag[2,good,i]
-            v = beta[good,i]
-            vvar = betavar[good,i]
-            m = a[1:ngood]/b[0:ngood-1]
-            b[1:] = b[1:]-m*c[0:ngood-1]
-            v[1:] = v[1:]-m*v[0:ngood-1]
-            vvar[1:] = vvar[1:]+m**2*vvar[0:ngood-1]
-            x = np.zeros(ngood,float)
-            xvar = np.zeros(ngood,float)
-            x[ngood-1] = v[ngood-1]/b[ngood-1]
-            xvar[ngood-1] = vvar[ngood-1]/b[ngood-1]**2
-            # Use numba to speed up this slow lopp
-            #for j in np.flip(np.arange(0,ngood-1)):
-            #    x[j] = (v[j]-c[j]*x[j+1])/b[j]
-            #    xvar[j] = (vvar[j]+c[j]**2*xvar[j+1])/b[j]**2
-            x,xvar = solvefibers(x,xvar,ngood,v,b,c,vvar)
-            spec[i,fibers[good]] = x
-            err[i,fibers[good]] = np.sqrt(xvar)
-            # mask the bad pixels
-            outmask[i,fibers[good]] = 0
-            if nbad > 0:
-                outmask[i,fibers[bad]] = maskval['NOT_ENOUGH_PSF'] | badmasked[bad,i]
-            # put the warning bits into the mask
-            outmask[i,fibers] = outmask[i,fibers] | warnmasked[:,i]
-            
-        # No good fibers for this column
-        else:
-            spec[i,:] = 0
-            err[i,:] = BADERR
-            outmask[i,fibers] = maskval['NOT_ENOUGH_PSF'] | badmasked[:,i]
 
-        if doback:
-            back[i] = x[ngood-1]
+    # Initial guess, add the flux of this fiber and its neighbors back in
+    #  the overlap of trace k with the model of trace l, over the good
+    #  pixels of trace k, is g[l]*tridiag[l-k+1,k], so this is the same as
+    #  adding the model of fibers k-1, k and k+1 back into the image
+    if guess is not None:
+        g = np.copy(guess)
+        g[g<=0] = 0    # as in epsfmodel()
+        g = g[:,fibers].T    # [Ntrace,2048]
+        beta[0:ntrace,:] += tridiag[1,0:ntrace,:]*g
+        beta[1:ntrace,:] += tridiag[0,1:ntrace,:]*g[0:ntrace-1,:]
+        beta[0:ntrace-1,:] += tridiag[2,0:ntrace-1,:]*g[1:ntrace,:]
+
+    # Solve all of the columns at once
+    #  the first and last 4 columns are reference pixels
+    cols = np.arange(4,2044)
+    good = (psftot[:,cols] > 0.5)
+    # Fibers with bad pixels are decoupled from their neighbors
+    x,xvar = solvetridiag(tridiag[0][:,cols],tridiag[1][:,cols],tridiag[2][:,cols],
+                          beta[:,cols],betavar[:,cols],good=good)
+    ngood = np.sum(good,axis=0)
+    fgood = good[0:ntrace,:]
+    # mask the bad pixels, and put the warning bits into the mask
+    cmask = np.where(fgood,0,maskval['NOT_ENOUGH_PSF'] | badmasked[0:ntrace,cols])
+    cmask |= warnmasked[0:ntrace,cols]
+    cspec = np.where(fgood,x[0:ntrace,:],spec[cols][:,fibers].T)
+    cerr = np.where(fgood,np.sqrt(np.maximum(xvar[0:ntrace,:],0)),err[cols][:,fibers].T)
+    # No good fibers for this column
+    nogood = (ngood==0)
+    if np.sum(nogood)>0:
+        cmask[:,nogood] = maskval['NOT_ENOUGH_PSF'] | badmasked[0:ntrace,cols[nogood]]
+        cspec[:,nogood] = 0
+        spec[cols[nogood],:] = 0
+        err[cols[nogood],:] = BADERR
+        cerr[:,nogood] = BADERR
+    spec[cols[:,None],fibers[None,:]] = cspec.T
+    err[cols[:,None],fibers[None,:]] = cerr.T
+    outmask[cols[:,None],fibers[None,:]] = cmask.T
+    if doback:
+        back[cols] = x[ntrace,:]
 
     # Catch any NaNs (shouldn't be there, but ....)
     bad = ~np.isfinite(spec)
@@ -1343,7 +2019,146 @@ def func_poly2d(inp,*args):
         raise Exception('Only 0, 3, and 4 parameters supported')
     return a
     
-def getoffset(frame,traceim):
+def getoffset_fft(frame,traceim,nxblock=16,nyblock=8,maxshift=5,minncc=0.3,verbose=True):
+    """
+    Measure the spatial offset of an object exposure and the PSF model/traces
+    by cross-correlation.  The image is split into blocks of columns and
+    rows, the median (column-collapsed) profile of each block is
+    cross-correlated with a model of the traces using FFTs for all of the
+    blocks at once, and the 2D linear offset surface is fit to the
+    sub-pixel offsets of the blocks.  Only fibers detected at 5 sigma
+    (from the errors) are used in the model, so an exposure without
+    signal has no good blocks.
+
+    Parameters
+    ----------
+    frame : dict
+       The 2D input structure with flux, err, mask and header.
+    traceim : numpy array
+       APOGEE trace information (Y-position) from a trace file [Nfibers, 2048].
+    nxblock : int, optional
+       Number of column blocks.  Default is 16.
+    nyblock : int, optional
+       Number of row blocks.  Default is 8.
+    maxshift : int, optional
+       Maximum offset in pixels.  Default is 5.
+    minncc : float, optional
+       Minimum normalized cross-correlation peak of a good block.  Default is 0.3.
+    verbose : boolean, optional
+       Verbose output to the screen.
+
+    Returns
+    -------
+    offcoef : numpy array
+       Additive offset coefficients (4-elements) of the 2D linear equation:
+          c0 + c1*X + c2*X*Y + c3*Y
+       None if there are not enough good blocks.
+    medoff : float
+       Median offset.
+
+    Example
+    -------
+
+    offcoef,medoff = getoffset_fft(frame,traceim)
+
+    """
+
+    flux = np.asarray(frame['flux'],float)
+    err = np.asarray(frame['err'],float)
+    nfibers = traceim.shape[0]
+    seglen = 2048//nyblock
+    npix = nyblock*seglen
+
+    # Median profile and trace centers of each column block
+    xedges = np.linspace(4,2044,nxblock+1).astype(int)
+    xcen = 0.5*(xedges[0:-1]+xedges[1:]-1)
+    prof = np.zeros((nxblock,2048),float)
+    cent = np.zeros((nxblock,nfibers),float)
+    proferr = np.zeros(nxblock,float)
+    for i in range(nxblock):
+        prof[i,:] = np.nanmedian(flux[:,xedges[i]:xedges[i+1]],axis=1)
+        # error of the median profile
+        proferr[i] = 1.25*np.nanmedian(err[:,xedges[i]:xedges[i+1]])/np.sqrt(xedges[i+1]-xedges[i])
+    for i in range(nxblock):
+        cent[i,:] = np.median(traceim[:,xedges[i]:xedges[i+1]],axis=1)
+    prof[~np.isfinite(prof)] = 0.0
+
+    # Model of the traces, Gaussians with the flux of the fibers
+    #  the profile is symmetric so its width does not matter much
+    icent = np.round(cent).astype(int)
+    bw = np.arange(-6,7)
+    yind = np.clip(icent[:,:,None]+bw,0,2047)
+    fflux = np.take_along_axis(prof,np.clip(icent,0,2047),axis=1)
+    fflux = np.maximum(fflux-np.median(prof,axis=1).reshape(-1,1),0)
+    # leave out fibers without significant signal, otherwise the noise
+    #  in the model correlates with itself in the data at zero offset
+    fflux[fflux < 5*proferr.reshape(-1,1)] = 0.0
+    vals = fflux[:,:,None]*np.exp(-0.5*((yind-cent[:,:,None])/1.2)**2)
+    model = np.zeros((nxblock,2048),float)
+    bind = np.zeros(yind.shape,int)+np.arange(nxblock).reshape(-1,1,1)
+    np.add.at(model,(bind.ravel(),yind.ravel()),vals.ravel())
+
+    # Split into row blocks [Nxblock,Nyblock,Seglen] and remove the background
+    dblock = prof[:,0:npix].reshape(nxblock,nyblock,seglen)
+    mblock = model[:,0:npix].reshape(nxblock,nyblock,seglen)
+    dblock = dblock-np.median(dblock,axis=2,keepdims=True)
+    mblock = mblock-np.mean(mblock,axis=2,keepdims=True)
+    ycen = np.sum(np.arange(npix).reshape(nyblock,seglen)*np.maximum(mblock,0),axis=2)
+    ycen /= np.maximum(np.sum(np.maximum(mblock,0),axis=2),1e-30)
+
+    # Cross-correlate all of the blocks at once, zero-padded
+    #  cc[k] = sum(data[y+k]*model[y]), the peak is at the offset
+    nfft = 2*seglen
+    cc = np.fft.irfft(np.fft.rfft(dblock,n=nfft,axis=2)*np.conj(np.fft.rfft(mblock,n=nfft,axis=2)),n=nfft,axis=2)
+    lags = np.arange(-maxshift-1,maxshift+2)
+    cc = cc[:,:,lags % nfft]
+    norm = np.sqrt(np.sum(dblock**2,axis=2)*np.sum(mblock**2,axis=2))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ncc = cc/norm[:,:,None]
+    ipeak = np.argmax(cc[:,:,1:-1],axis=2)+1
+    c0 = np.take_along_axis(cc,ipeak[:,:,None],axis=2)[:,:,0]
+    cm = np.take_along_axis(cc,ipeak[:,:,None]-1,axis=2)[:,:,0]
+    cp = np.take_along_axis(cc,ipeak[:,:,None]+1,axis=2)[:,:,0]
+    peakncc = np.take_along_axis(ncc,ipeak[:,:,None],axis=2)[:,:,0]
+    # Sub-pixel peak, Gaussian through the three points, or parabola
+    with np.errstate(divide='ignore',invalid='ignore'):
+        gpeak = (cm > 0) & (c0 > 0) & (cp > 0)
+        lm,l0,lp = np.log(np.where(gpeak,cm,1)),np.log(np.where(gpeak,c0,1)),np.log(np.where(gpeak,cp,1))
+        dgauss = 0.5*(lm-lp)/(lm-2*l0+lp)
+        dpar = 0.5*(cm-cp)/(cm-2*c0+cp)
+        delta = np.where(gpeak,dgauss,dpar)
+    offset = lags[ipeak]+delta
+    good = (np.isfinite(offset) & (peakncc > minncc) & (np.abs(delta) <= 1) &
+            (ipeak > 1) & (ipeak < len(lags)-2))
+    if verbose:
+        print(str(np.sum(good))+'/'+str(good.size)+' good blocks')
+    if np.sum(good) < 8:
+        return None,np.nan
+
+    # Fit 2D linear model with outlier rejection
+    xvals = (np.zeros((nxblock,nyblock),float)+xcen.reshape(-1,1))[good]
+    yvals = ycen[good]
+    zvals = offset[good]
+    amat = np.vstack((np.ones(len(xvals)),xvals,xvals*yvals,yvals)).T
+    gd = np.ones(len(zvals),bool)
+    for niter in range(3):
+        coef2,_,_,_ = np.linalg.lstsq(amat[gd],zvals[gd],rcond=None)
+        resid = zvals-amat @ coef2
+        sig = np.maximum(dln.mad(resid[gd]),0.01)
+        newgd = (np.abs(resid) < 3*sig)
+        if np.sum(newgd) < 8 or np.array_equal(newgd,gd):
+            break
+        gd = newgd
+
+    medoff = np.median(zvals[gd])
+    if verbose:
+        print('Median offset = %.3f pixels' % medoff)
+        print('Offset coefficients = ',coef2)
+
+    return coef2,medoff
+
+
+def getoffset(frame,traceim,method='fft'):
     """
     Measure the spatial offset of an object exposure and the PSF model/traces.
 
@@ -1353,6 +2168,10 @@ def getoffset(frame,traceim):
        The 2D input structure with flux, err, mask and header.
     traceim : numpy array
        APOGEE trace information (Y-position) from a trace file [Nfibers, 2048].
+    method : str, optional
+       'fft' to cross-correlate blocks of the image with a model of the traces
+         (getoffset_fft), or 'peak' to fit the peaks of bright fibers.  The peak
+         fitting is used if the cross-correlation fails.  Default is 'fft'.
 
     Returns
     -------
@@ -1368,6 +2187,13 @@ def getoffset(frame,traceim):
     offcoef,medoff = getoffset(frame,traceim)
 
     """
+
+    # Cross-correlation
+    if method=='fft':
+        coef2,medoff = getoffset_fft(frame,traceim)
+        if coef2 is not None:
+            return coef2,medoff
+        print('Not enough good blocks for the cross-correlation, fitting the peaks')
     
     # Find bright fibers and measure the centroid
     nfibers = traceim.shape[0]
@@ -1464,7 +2290,7 @@ def fullepsfgrid(psf,traceim,fibers,offcoef,verbose=True):
 
     Returns
     -------
-    epsf : list
+    epsf : EPSF
       Empirical PSF model for the full image.
 
     Example
@@ -1491,21 +2317,15 @@ def fullepsfgrid(psf,traceim,fibers,offcoef,verbose=True):
         yhi = np.minimum(yhi,2047)
         ny = yhi-ylo+1
         y = np.arange(ny)+ylo        
-        img = np.zeros((ny,2048),float)
-        # Column loop
-        for j in range(2048):
-            try:
-                m1 = psf([j,ycen[j]],y=y,ycen=ycen[j])
-            except:
-                print('problem')
-                import pdb; pdb.set_trace()
-            m1 /= np.sum(m1)
-            img[:,j] = m1
-                
+        # All columns at once
+        m = psf.evaluate(np.arange(2048),ycen,y=y,ycen=ycen)
+        m /= np.sum(m,axis=1).reshape(-1,1)
+        img = m.T
+
         data = {'fiber':fibers[i], 'lo':ylo, 'hi':yhi, 'img':img, 'ycen':ycen}
         epsf.append(data)
         
-    return epsf
+    return EPSF.fromlist(epsf)
         
 
 def extractwing(frame,modelpsffile,epsffile,tracefile):
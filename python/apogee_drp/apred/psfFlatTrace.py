@@ -6,6 +6,7 @@ import subprocess
 import math
 import time
 import pdb
+import warnings
 import fitsio
 import numpy as np
 from pathlib import Path
@@ -30,11 +31,12 @@ import matplotlib.colors as mplcolors
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 from mpl_toolkits.axes_grid1.colorbar import colorbar
 from scipy.signal import medfilt, convolve, boxcar, argrelextrema, find_peaks
+from scipy.spatial import cKDTree
 
 
 ###################################################################################################
 # Program for matching a sequence of exposures to the PSF flat lookup table.
-# Calls "findBestFlatExposure" to do the matching.
+# Calls "measureTraceCenters" and "matchFlats" to do the matching.
 #
 # Inputs can be:
 #     (1) an array of exposure numbers, e.g. [36880094, 36880095], or [36880094] for single exposure
@@ -87,19 +89,11 @@ def findBestFlatSequence(ims=None, imtype='QuartzFlat', libFile=None, planfile=N
     apodir = os.environ.get('APOGEE_REDUX') + '/' + apred + '/'
     mdir = apodir + 'monitor/'
 
-    # Read in the dome flat lookup table and master exposure table
-    flatTable = fits.getdata(mdir + instrument + imtype + 'Trace-all.fits')
-    if libFile is not None: flatTable = fits.getdata(mdir + libFile)
+    # Read in the dome flat lookup table (cached) and master exposure table
+    tablefile = mdir + instrument + imtype + 'Trace-all.fits'
+    if libFile is not None: tablefile = mdir + libFile
+    lib = loadLookupTable(tablefile)
     expTable = fits.getdata(mdir + instrument + 'Exp.fits')
-
-    # Restrict to valid data with at least nchips*290 Gaussian fits
-    gd, = np.where((flatTable['MJD'] > 0) & (np.sum(flatTable['GAUSS_NPEAKS'], axis=1) > 870))
-    flatTable = flatTable[gd]
-    # separate into plates and FPS era
-    gdplates = np.where(flatTable['MJD']<59556)
-    flatTablePlates = flatTable[gdplates]
-    gdfps = np.where(flatTable['MJD']>=59556)
-    flatTableFPS = flatTable[gdfps]
     #if medianrad != 100: flatTable = fits.getdata(mdir + instrument + 'DomeFlatTrace-all_medrad' + str(medianrad) + '.fits')
 
     if ims is None:
@@ -120,35 +114,31 @@ def findBestFlatSequence(ims=None, imtype='QuartzFlat', libFile=None, planfile=N
 
     print(str(int(round(n_ims))) + " exposures\n")
 
-    flatnums = np.empty(n_ims).astype(int)
-    flatmjds = np.empty(n_ims).astype(int)
-    rms =      np.empty(n_ims)
-
+    # Measure the trace centers of all the exposures
+    cents = np.zeros((n_ims, 3, 300)) + np.nan
+    expmjds = np.zeros(n_ims, int)
     for i in range(n_ims):
         # Find the ap2D files for this exposure
         file2d = load_exp.filename('2D', mjd=mjd, num=ims[i], chips='c')
         twodfiles = np.array([file2d.replace('2D-', '2D-a-'),
                               file2d.replace('2D-', '2D-b-'),
                               file2d.replace('2D-', '2D-c-')])
+        cents[i] = measureTraceCenters(twodfiles=twodfiles, refpix=refpix, medianrad=medianrad,
+                                       minflux=minflux, highfluxfrac=highfluxfrac, silent=silent)
+        expmjds[i] = int(load.cmjd(ims[i]))
 
-        # Use plate-era flats for plate exposures and and FPS-era flats for FPS exposures
-        mjd = int(load.cmjd(ims[i]))
-        if mjd>=59556:
-            flatTable1 = flatTableFPS
-        else:
-            flatTable1 = flatTablePlates
-        
-        # Run findBestFlatExposure on this exposure
-        flatnums[i], flatmjds[i], rms[i] = findBestFlatExposure(flatTable=flatTable1, imtype=imtype, refpix=refpix, 
-                                                                twodfiles=twodfiles, medianrad=medianrad,
-                                                                minflux=minflux, highfluxfrac=highfluxfrac, silent=silent)
+    # Match all of the exposures to the lookup table at once
+    #  plate-era flats for plate exposures and FPS-era flats for FPS exposures
+    flatind, rms = matchFlats(lib, cents, expmjds)
+    flatnums = lib['psfid'][flatind].astype(int)
+    flatmjds = lib['mjd'][flatind].astype(int)
+
+    for i in range(n_ims):
         # Print info about this exposure and the matching dome flat
-        pflat, = np.where(flatnums[i] == flatTable1['PSFID'])
         psci, = np.where(ims[i] == expTable['NUM'])
         if len(psci) > 0:
             p1 = '(' + str(i+1).rjust(2) + ') sci exposure ' + str(ims[i]) + ' ----> ' + imtype + ' ' + str(int(round(flatnums[i]))) + ' (MJD ' + str(int(round(flatmjds[i]))) + '),  '
-            #p2 = 'alt [' + str("%.3f" % round(expTable['ALT'][psci][0],3)) + ', ' + str("%.3f" % round(flatTable['ALT'][pflat][0],3)) + '],  '
-            p3 = 'ln2level [' + str("%.3f" % round(expTable['LN2LEVEL'][psci][0],3)) + ', ' + str("%.3f" % round(flatTable1['LN2LEVEL'][pflat][0],3)) + '],   '
+            p3 = 'ln2level [' + str("%.3f" % round(expTable['LN2LEVEL'][psci][0],3)) + ', ' + str("%.3f" % round(lib['ln2level'][flatind[i]],3)) + '],   '
             p4 = 'rms = ' + str("%.4f" % round(rms[i],4))
             print(p1 + p3 + p4)
         else:
@@ -203,48 +193,52 @@ def findBestFlatSequence(ims=None, imtype='QuartzFlat', libFile=None, planfile=N
 def findBestFlatExposure(flatTable=None, imtype=None, refpix=None, twodfiles=None, medianrad=100, 
                          minflux=None, highfluxfrac=None, silent=True):
 
+    # Trace centers of this exposure, NaN for the failed and discrepant fits
+    cent = measureTraceCenters(twodfiles=twodfiles, refpix=refpix, medianrad=medianrad,
+                               minflux=minflux, highfluxfrac=highfluxfrac, silent=silent)
+    expnum = int(twodfiles[0].split('-')[-1].split('.')[0])
+
+    # Robust RMS of the differences for all of the chips and flats at once
+    rms = flatRMS(cent, flatTable['GAUSS_CENT']).T   # [nchips, nflats]
+
+    rmsMean = np.nanmean(rms, axis=0)
+    gd, = np.where(rmsMean == np.nanmin(rmsMean))
+    if silent is False: print("   rms:  " + str(rms[:, gd[0]]))
+
+    gdrms = str("%.5f" % round(rmsMean[gd][0],5))
+    if silent is False: print("   Best " + imtype + " for exposure " + str(expnum) + ": " + str(flatTable['PSFID'][gd][0]) + " (<rms> = " + str(gdrms) + ")")
+
+    return flatTable['PSFID'][gd][0], flatTable['MJD'][gd][0], rmsMean[gd][0]
+
+
+###################################################################################################
+# Function for measuring the trace centers of an exposure for the matching
+# Calls "gaussFitAll" to do the Gaussian fitting, the fits are cached
+#
+# Output is the array of trace centers [nchips, nfibers], NaN for fibers that are not used.
+#
+###################################################################################################
+def measureTraceCenters(twodfiles=None, refpix=None, medianrad=100, minflux=None, highfluxfrac=None, silent=True):
+
     chips = np.array(['a', 'b', 'c'])
     nchips = len(chips)
     nfibers = 300
-    nflats = len(flatTable)
-
-    medFWHM = np.nanmedian(flatTable['GAUSS_SIGMA'], axis=2) * 2.354
 
-    # Loop over the chips
-    rms = np.full([nchips, nflats], 50).astype(np.float64)
+    cent = np.zeros((nchips, nfibers)) + np.nan
     for ichip in range(nchips):
-        # ap2D file for this chip
-        twodfile = twodfiles[ichip]
-
-        # Get exposure number from the filename
-        expnum = int(twodfile.split('-')[-1].split('.')[0])
-
         # Get reference pixels for this chip
         pix0 = np.array(refpix[chips[ichip]])
         # Fit Gaussians to the trace positions
-        gpeaks = gaussFitAll(infile=twodfile, medianrad=medianrad, pix0=pix0)
+        gpeaks = gaussFitAll(infile=twodfiles[ichip], medianrad=medianrad, pix0=pix0, cache=True)
 
         # Remove failed and discrepant peakfits
         gd, = np.where(gpeaks['success'] == True)
         gpeaks = gpeaks[gd]
-
-        #for k in range(len(gpeaks)):
-        #    print(str(gpeaks['num'][k]) + '   ' + str(gpeaks['pars'][k, 1]))
-
-        # Remove discrepant peakfits
         medcenterr = np.nanmedian(gpeaks['perr'][:, 1])
         gd, = np.where(gpeaks['perr'][:, 1] < medcenterr)
         gpeaks = gpeaks[gd]
         ngpeaks = len(gd)
 
-        # Find median gaussian FWHM and restrict lookup table to similar values
-        #medFWHM = np.nanmedian(gpeaks['pars'][:, 2]) * 2.354
-        #print('Median Science FWHM (chip ' + chips[ichip] + ') = ' + str("%.5f" % round(medFWHM,5)))
-        #medFWHM = np.nanmedian(flatTable['GAUSS_SIGMA'][:, ichip, gpeaks['num']], axis=1)*2.354
-        #gd, = np.where(np.absolute(medFWHM - medFWHM[:, ichip]) < 0.05)
-        flatTable1 = flatTable#[gd]
-        nflats1 = len(flatTable1)
-
         # Option to only use fibers with flux higher than average dome flat flux
         if highfluxfrac is not None:
             if (highfluxfrac < 0) | (highfluxfrac > 1):
@@ -254,8 +248,6 @@ def findBestFlatExposure(flatTable=None, imtype=None, refpix=None, twodfiles=Non
             # Sort by flux sum and keep the highest flux fibers
             fluxord = np.argsort(gpeaks['sumflux'])[::-1]
             gpeaks = gpeaks[fluxord][:nkeep]
-            numord = np.argsort(gpeaks['num'])
-            gpeaks = gpeaks[numord]
             ngpeaks = len(gpeaks)
         else:
             if silent is False: print("   " + str(ngpeaks) + " successful peakfits")
@@ -267,27 +259,149 @@ def findBestFlatExposure(flatTable=None, imtype=None, refpix=None, twodfiles=Non
             ngpeaks = len(gpeaks)
             if silent is False: print("   Keeping " + str(ngpeaks) + " fibers with flux > " + str(minflux))
 
-        dcent = flatTable1['GAUSS_CENT'][:, ichip, gpeaks['num']]
-        for iflat in range(nflats1):
-            diff = np.absolute(dcent[iflat] - gpeaks['pars'][:, 1])
-            gd, = np.where(np.isnan(diff) == False)
-            if len(gd) < 5: continue
-            diff = diff[gd]
-            ndiff = len(diff)
-            rms[ichip, iflat] = dln.mad(diff,zero=True)  # use robust RMS
-            #rms[ichip, iflat] = np.sqrt(np.nansum(diff**2)/ndiff)
-        #if silent is False: print("   Final match based on " + str(ndiff) + " fibers:")
+        cent[ichip, gpeaks['num']] = gpeaks['pars'][:, 1]
 
-    rmsMean = np.nanmean(rms, axis=0)
-    gd, = np.where(rmsMean == np.nanmin(rmsMean))
-    if silent is False: print("   rms:  " + str(rms[:, gd[0]]))
+    return cent
 
-    gdrms = str("%.5f" % round(rmsMean[gd][0],5))
-    if silent is False: print("   Best " + imtype + " for exposure " + str(expnum) + ": " + str(flatTable1['PSFID'][gd][0]) + " (<rms> = " + str(gdrms) + ")")
 
-    #print(medFWHM[gd][0])
+###################################################################################################
+# Function for the robust r.m.s. of the trace center differences of exposures and flats
+#
+# cent is [nchips, nfibers] and flatcent [nflats, nchips, nfibers], or any shapes that broadcast.
+# Output is the robust r.m.s. [nflats, nchips], 50 if there are fewer than 5 good fibers.
+#
+###################################################################################################
+def flatRMS(cent, flatcent):
+
+    diff = np.absolute(np.asarray(flatcent, float) - np.asarray(cent, float))
+    ndiff = np.sum(np.isfinite(diff), axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        rms = 1.482602218505602 * np.nanmedian(diff, axis=-1)   # robust RMS, same as dln.mad(zero=True)
+    rms[ndiff < 5] = 50.0
+
+    return rms
+
+
+###################################################################################################
+# Functions for loading the PSF flat lookup table made by "makeLookupTable"
+#
+# The valid entries of the table (MJD>0 and at least nchips*290 Gaussian fits) with the columns
+# needed for the matching are saved to a .npy file next to the table, this is memory-mapped
+# on later calls and the loaded tables are cached in memory.  There is a k-d tree index of
+# each era (plates and FPS) on the median trace centers of groups of fibers, this is used to
+# pick the candidate flats for the matching.
+#
+###################################################################################################
+_lookup_cache = {}
+_gaussfit_cache = {}
+FPSMJD = 59556
+
+def traceFeatures(cent, refcent, ngroup=3):
+    # Median offset from the reference trace centers of ngroup groups of fibers for each
+    # chip [..., nchips*ngroup], the offsets do not depend on which fibers are missing
+    cent = np.asarray(cent, float) - refcent
+    shape = cent.shape[:-2]
+    nchips, nfibers = cent.shape[-2:]
+    group = cent[..., 0:(nfibers//ngroup)*ngroup].reshape(shape + (nchips, ngroup, nfibers//ngroup))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        feat = np.nanmedian(group, axis=-1)
+    return feat.reshape(shape + (nchips*ngroup,))
+
+def loadLookupTable(tablefile, cache=True):
+
+    tablefile = os.path.abspath(tablefile)
+    mtime = os.path.getmtime(tablefile)
+    key = (tablefile, mtime)
+    if key in _lookup_cache: return _lookup_cache[key]
+
+    npyfile = tablefile[:-5] + '.npy' if tablefile.endswith('.fits') else tablefile + '.npy'
+    if cache and os.path.exists(npyfile) and os.path.getmtime(npyfile) >= mtime:
+        tab = np.load(npyfile, mmap_mode='r')
+    else:
+        flatTable = fits.getdata(tablefile)
+        # Restrict to valid data with at least nchips*290 Gaussian fits
+        gd, = np.where((flatTable['MJD'] > 0) & (np.sum(flatTable['GAUSS_NPEAKS'], axis=1) > 870))
+        flatTable = flatTable[gd]
+        nchips, nfibers = flatTable['GAUSS_CENT'].shape[1:]
+        dt = np.dtype([('PSFID', np.int32), ('MJD', np.int32), ('LN2LEVEL', np.float32),
+                       ('GAUSS_CENT', np.float64, (nchips, nfibers)), ('GAUSS_NPEAKS', np.int16, nchips)])
+        tab = np.zeros(len(flatTable), dtype=dt)
+        for name in dt.names: tab[name] = flatTable[name]
+        if cache:
+            # write to a temporary name and rename so other processes never see a partial file
+            try:
+                tmpfile = npyfile + '.' + str(os.getpid()) + '.npy'
+                np.save(tmpfile, tab)
+                os.replace(tmpfile, npyfile)
+            except OSError as e:
+                print('Could not write lookup table cache file ' + npyfile + ': ' + str(e))
+
+    lib = {'file': tablefile, 'psfid': tab['PSFID'], 'mjd': tab['MJD'], 'ln2level': tab['LN2LEVEL'],
+           'cent': tab['GAUSS_CENT'], 'index': {}}
+    # k-d tree index of each era on the trace features, NaNs are replaced by the median
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        lib['refcent'] = np.nanmedian(tab['GAUSS_CENT'], axis=0)
+    feat = traceFeatures(tab['GAUSS_CENT'], lib['refcent'])
+    medfeat = np.nanmedian(feat, axis=0)
+    feat = np.where(np.isfinite(feat), feat, medfeat)
+    lib['medfeat'] = medfeat
+    for fps in [False, True]:
+        ind, = np.where((tab['MJD'] >= FPSMJD) == fps)
+        if len(ind) > 0:
+            lib['index'][fps] = (ind, cKDTree(feat[ind]))
+    _lookup_cache[key] = lib
+
+    return lib
+
 
-    return flatTable1['PSFID'][gd][0], flatTable1['MJD'][gd][0], rmsMean[gd][0]
+###################################################################################################
+# Function for matching a batch of exposures to the PSF flat lookup table
+#
+# cents are the trace centers of the exposures [nexp, nchips, nfibers] from "measureTraceCenters"
+# and mjds their MJDs.  By default all of the flats of the same era are scored, as in the
+# original search.  With ncand set, only the ncand nearest flats in the k-d tree index are the
+# candidates; this is faster but is not guaranteed to find the same flat.  The best flat is
+# the one with the lowest robust r.m.s. averaged over the chips.
+#
+# Output is the index of the best flat in the lookup table and its r.m.s. for each exposure.
+#
+###################################################################################################
+def matchFlats(lib, cents, mjds, ncand=None):
+
+    if ncand is not None and (int(ncand) != ncand or ncand < 1):
+        raise ValueError('ncand must be a positive integer or None')
+    cents = np.asarray(cents, float)
+    if cents.ndim == 2: cents = cents[np.newaxis]
+    mjds = np.atleast_1d(mjds)
+    nexp = len(cents)
+    flatind = np.zeros(nexp, int) - 1
+    rms = np.zeros(nexp) + np.nan
+
+    feat = traceFeatures(cents, lib['refcent'])
+    feat = np.where(np.isfinite(feat), feat, lib['medfeat'])
+    for fps in [False, True]:
+        eind, = np.where((mjds >= FPSMJD) == fps)
+        if len(eind) == 0: continue
+        if fps not in lib['index']:
+            print('No ' + ('FPS' if fps else 'plate') + '-era flats in ' + os.path.basename(lib['file']))
+            continue
+        ind, tree = lib['index'][fps]
+        # Candidates, in table order so ties go to the first flat as before
+        if ncand is None or ncand >= len(ind):
+            cand = np.zeros((len(eind), len(ind)), int) + np.arange(len(ind))
+        else:
+            _, cand = tree.query(feat[eind], k=ncand)
+            cand = np.sort(cand.reshape(len(eind), -1), axis=1)
+        flatcent = lib['cent'][ind[cand]]     # [nexp, ncand, nchips, nfibers]
+        rms1 = np.nanmean(flatRMS(cents[eind][:, np.newaxis], flatcent), axis=-1)   # [nexp, ncand]
+        best = np.argmin(rms1, axis=1)
+        flatind[eind] = ind[cand[np.arange(len(eind)), best]]
+        rms[eind] = rms1[np.arange(len(eind)), best]
+
+    return flatind, rms
 
 
 ###################################################################################################
@@ -535,7 +649,14 @@ def makeLookupTable(apred='daily', telescope='apo25m', imtype='QuartzFlat', medi
 ###################################################################################################
 # Function for fitting Gaussians to trace positions of all 300 fibers
 ###################################################################################################
-def gaussFitAll(infile=None, medianrad=None, pix0=None):
+def gaussFitAll(infile=None, medianrad=None, pix0=None, cache=False):
+    # Option to reuse the fits of a file that was already done
+    if cache:
+        key = (os.path.abspath(infile), os.path.getmtime(infile), medianrad, tuple(np.atleast_1d(pix0)))
+        if key not in _gaussfit_cache:
+            _gaussfit_cache[key] = gaussFitAll(infile=infile, medianrad=medianrad, pix0=pix0)
+        return _gaussfit_cache[key].copy()
+
     flux = fits.getdata(infile,1)
     error = fits.getdata(infile,2)
     npix = flux.shape[0]
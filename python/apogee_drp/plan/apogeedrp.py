@@ -1689,7 +1689,7 @@ def mkmastercals(load,mjds,slurmpars,clobber=False,linkvers=None,logger=None):
     # Need to check if the master calibration files actually got made
 
     
-def runap3d(load,mjds,slurmpars,clobber=False,logger=None):
+def runap3d(load,mjds,slurmpars,clobber=False,batch=False,logger=None):
     """
     Run AP3D on all exposures for a list of MJDs.
 
@@ -1703,6 +1703,9 @@ def runap3d(load,mjds,slurmpars,clobber=False,logger=None):
        Dictionary of slurmpars settings.
     clobber : boolean, optional
        Overwrite existing files.  Default is False.
+    batch : boolean, optional
+       Run one batch job per MJD (ap3d --mjd) instead of one job per
+         exposure.  Default is False.
     logger : logger, optional
        Logging object.  If not is input, then a default one will be created.
 
@@ -1758,7 +1761,25 @@ def runap3d(load,mjds,slurmpars,clobber=False,logger=None):
         logger.info('Slurm settings: '+str(slurmpars1))
         queue = pbsqueue(verbose=True)
         queue.create(label='ap3d', **slurmpars1)
-        for i in range(ntorun):
+        # One batch job per MJD
+        batchlogs = []
+        if batch:
+            runmjds = np.unique([int(load.cmjd(num)) for num in expinfo['num'][torun]])
+            for i,mjd in enumerate(runmjds):
+                logfile1 = os.path.dirname(load.filename('2D',num=0,mjd=mjd,chips=True))
+                logfile1 += '/logs/ap3D-'+str(mjd)+'_pbs.'+logtime+'.log'
+                if os.path.exists(os.path.dirname(logfile1))==False:
+                    os.makedirs(os.path.dirname(logfile1))
+                cmd1 = 'ap3d --mjd {0} --vers {1} --telescope {2} --unlock'.format(mjd,apred,telescope)
+                if clobber:
+                    cmd1 += ' --clobber'
+                logger.info('MJD %d : %d' % (i+1,mjd))
+                logger.info('Command : '+cmd1)
+                logger.info('Logfile : '+logfile1)
+                queue.append(cmd1,outfile=logfile1,errfile=logfile1.replace('.log','.err'))
+                batchlogs.append((mjd,logfile1))
+            torun = []
+        for i in range(len(torun)):
             num = expinfo['num'][torun[i]]
             mjd = int(load.cmjd(num))
             logfile1 = load.filename('2D',num=num,mjd=mjd,chips=True).replace('2D','3D')
@@ -1776,6 +1797,17 @@ def runap3d(load,mjds,slurmpars,clobber=False,logger=None):
         queue.commit(hard=True,submit=True)
         logger.info('PBS key is '+queue.key)
         queue_wait(queue,sleeptime=60,verbose=True,logger=logger)  # wait for jobs to complete
+        # Check the batch jobs, "ap3d --mjd" ends with the number of failed chip files
+        #  the failed outputs are removed so check_ap3d also flags their exposures
+        for mjd,logfile1 in batchlogs:
+            status = None
+            if os.path.exists(logfile1):
+                with open(logfile1) as f:
+                    status = [l.strip() for l in f if l.startswith('AP3D BATCH: ')]
+            if status is None or len(status)==0:
+                logger.error('MJD %d : ap3d batch job did not finish, see %s' % (mjd,logfile1))
+            elif status[-1] != 'AP3D BATCH: 0 FAILED':
+                logger.error('MJD %d : %s, see %s' % (mjd,status[-1],logfile1))
         # This should check if the ap3d ran okay and puts the status in the database
         chk3d = check_ap3d(expinfo,queue.key,apred,telescope,verbose=True,logger=logger)
         del queue
@@ -686,3 +686,131 @@ def unzip(input,clobber=False,delete=False,silent=False,no_checksum=True,fitsdir
     dt = time.time()-t0
     if silent==False:
         print('dt = %.1f sec' % dt)
+
+
+def unzip_to_array(input,maxread=None,reads=None,cubefile=None,silent=False):
+    """
+    This program uncompresses a raw APOGEE file that was
+    compressed with APZIP directly into a numpy datacube.
+
+    The tile-compressed HDUs are decoded in-process by astropy
+    one read at a time and the reads are reconstructed by
+    cumulatively adding the residuals and the average dCounts
+    to the first read.  No funpack or temporary files are needed.
+
+    Parameters
+    ----------
+    input : str
+       The compressed raw APOGEE file with ending of .apz.
+    maxread : int, optional
+       The maximum number of reads to use.  Default is to use all reads.
+    reads : list, optional
+       Only return these reads (0-based, negative indices count from the
+         last read).  All of the residuals still have to be decoded but
+         only the requested reads are kept.  Default is to return all reads.
+    cubefile : str, optional
+       Filename of a memory-mapped file to use for the output cube.
+         By default the cube is held in memory.
+    silent : boolean, optional
+       Don't print anything to the screen.  Default is False.
+
+    Returns
+    -------
+    cube : numpy array
+       The reconstructed datacube [Ny,Nx,Nreads] as 32-bit integers.
+         With reads the last dimension is the number of requested reads.
+    head : header
+       The primary header of the original raw file.
+
+    Example
+    -------
+
+    cube,head = unzip_to_array('apR-a-00000085.apz')
+
+    """
+
+    t0 = time.time()
+
+    # Does file exist
+    if os.path.exists(input)==False:
+        raise FileNotFoundError(input+' NOT FOUND')
+
+    if silent==False:
+        print('Uncompressing >>'+input+'<< (%.2f MB)' % (os.path.getsize(input)/1e6))
+
+    hdul = fits.open(input)
+    # fpack moves the primary image into the first extension,
+    #  skip the empty primary HDU
+    hdus = [h for h in hdul if h.header.get('NAXIS',0)>0]
+    nreads = len(hdus)-1
+    if nreads < 1:
+        hdul.close()
+        raise ValueError(input+' has no reads')
+    if maxread:
+        nreads = np.minimum(nreads,maxread)
+    if silent==False:
+        print('        Nreads = ',str(nreads))
+
+    # Load average dCounts image
+    #  use sections so the reads are decoded one at a time
+    avg_dcounts = hdus[0].section[:,:].astype(np.int32)
+    head0 = hdus[0].header.copy()
+    todel = ['NAXIS1','NAXIS2','PCOUNT','GCOUNT','CHECKSUM','DATASUM','BZERO','BSCALE']
+    for nd in todel:
+        if head0.get(nd) is not None:
+            del head0[nd]
+    head0['BITPIX'] = 16,''
+    head0['NAXIS'] = 0
+
+    # Load read=1 (first one)
+    read1 = hdus[1].section[:,:]
+    ny,nx = read1.shape
+    if avg_dcounts.shape != read1.shape:
+        hdul.close()
+        raise ValueError('Images dimensions of AVERAGE DCOUNTS (in exten=0) and READ1 (in exten=1) do NOT MATCH')
+
+    # Reads to keep, index in the output cube for each read
+    if reads is not None:
+        reads = np.unique(np.atleast_1d(reads) % nreads)
+        outind = np.zeros(nreads,int)-1
+        outind[reads] = np.arange(len(reads))
+        nlastread = np.max(reads)+1   # don't need to decode beyond this
+    else:
+        outind = np.arange(nreads)
+        nlastread = nreads
+    nout = np.sum(outind>=0)
+
+    # Initialize the cube
+    if cubefile is not None:
+        cube = np.memmap(cubefile,dtype=np.int32,mode='w+',shape=(ny,nx,nout))
+    else:
+        cube = np.zeros((ny,nx,nout),np.int32)
+    if outind[0] >= 0:
+        cube[:,:,outind[0]] = read1
+
+    # Re-construct the original counts
+    #----------------------------------
+    #  This is how the dcounts/resid were created:
+    #    dcounts[i] = read[i+1]-read[i]
+    #    resid[i] = dcounts[i] - avg_dcounts
+    #  So, adding avg_dcounts to resid gives back dcounts
+    #  and the cumulative sum of the dCounts added to the
+    #  first read gives all of the reads.
+    lastim = read1.astype(np.int32)
+    for i in np.arange(2,nlastread+1):
+        residim = hdus[i].section[:,:]
+        if residim.shape != read1.shape:
+            hdul.close()
+            raise ValueError('Images dimensions of READ1 (in exten=1) and RESID'+str(i-1)+' (in exten='+str(i)+') do NOT MATCH')
+        lastim += residim
+        lastim += avg_dcounts
+        if outind[i-1] >= 0:
+            cube[:,:,outind[i-1]] = lastim
+    hdul.close()
+
+    # Time elapsed
+    dt = time.time()-t0
+    if silent==False:
+        print('dt = %.1f sec' % dt)
+
+    return cube,head0
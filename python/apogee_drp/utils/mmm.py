@@ -307,3 +307,159 @@ def mmm( sky_vector, highbad = False, debug = False,
         print('% MMM: Mode, Sigma, Skew of sky vector:', skymod, sigma, skew   )
 
     return(skymod,sigma,skew)
+
+
+def mmm_array( sky_array, highbad = False, mxiter = 50, minsky = 20):
+    """Run MMM on many sky vectors at once.
+
+    This does the same as mmm() (without the readnoise option) on each
+    vector along the last axis of SKY_ARRAY, e.g. [Nbox,Npix], but all
+    of the vectors are processed together with array operations.  The
+    accepted pixels are always a contiguous range of the sorted vector,
+    so the sums are taken from cumulative sums and each rejection step
+    is just a search for the new range limits.  NaNs are ignored.
+
+    CALLING SEQUENCE:
+         skymod,sigma,skew = mmm.mmm_array( sky, highbad= , mxiter=, minsky=)
+
+    INPUTS:
+         sky - Array of sky values, the last axis holds the sky vectors.
+
+    RETURNS:
+         skymod, sigma, skew - Arrays with the shape of sky without the
+                   last axis.  SIGMA = -1.0 where the mode could not be
+                   derived.
+    """
+
+    sky_array = np.asarray(sky_array,float)
+    shape = sky_array.shape[:-1]
+    sky = np.sort(sky_array.reshape(-1,sky_array.shape[-1]),axis=1)   # NaNs are sorted to the end
+    nvec,npix = sky.shape
+    rows = np.arange(nvec)
+    nsky = np.sum(np.isfinite(sky),axis=1)
+    nlast = nsky-1
+    skymod = np.zeros(nvec,float)
+    sigma = np.zeros(nvec,float)
+    skew = np.zeros(nvec,float)
+
+    def getsky(ind):
+        return sky[rows,np.clip(ind,0,npix-1)]
+
+    # Too few sky elements
+    bad = (nsky < minsky)
+    skymod[bad] = np.nan
+    sigma[bad] = -1.0
+
+    skymid = 0.5*getsky((nsky-1)//2) + 0.5*getsky(nsky//2)  #Median value of all sky values
+    cut1 = np.minimum(skymid-sky[:,0], getsky(nlast)-skymid)
+    if highbad:
+        cut1 = np.minimum(cut1, (highbad - skymid))
+    cut2 = skymid + cut1
+    cut1 = skymid - cut1
+
+    # Cumulative sums of the (median subtracted) sky values, the sum over
+    # the accepted range minimm+1..maximm is cs[maximm+1]-cs[minimm+1]
+    delta = np.where(np.isfinite(sky),sky-skymid[:,None],0.0)
+    cs = np.zeros((nvec,npix+1),float)
+    cs[:,1:] = np.cumsum(delta,axis=1)
+    cssq = np.zeros((nvec,npix+1),float)
+    cssq[:,1:] = np.cumsum(delta**2,axis=1)
+    def rangesum(c,lo,hi):
+        return c[rows,hi+1]-c[rows,lo+1]
+
+    # Number of finite sky values below (or equal to) the cut in each
+    # vector, a binary search of all the vectors at once
+    def countbelow(cut,right=False):
+        lo = np.zeros(nvec,int)
+        hi = nsky.copy()
+        cut = np.where(np.isfinite(cut),cut,-np.inf)
+        while np.any(lo < hi):
+            mid = (lo+hi)//2
+            val = getsky(mid)
+            below = (val <= cut) if right else (val < cut)
+            below &= (mid < hi)
+            lo = np.where(below,mid+1,lo)
+            hi = np.where(below | (mid >= hi),hi,mid)
+        return lo
+
+    # Select the pixels between Cut1 and Cut2
+    minimm = countbelow(cut1)-1              #Highest value rejected at lower end of vector
+    maximm = countbelow(cut2,right=True)-1   #Highest value accepted at upper end of vector
+    bad2 = ~bad & (maximm-minimm <= 0)
+    skymod[bad2] = 0.0
+    sigma[bad2] = -1.0
+    active = ~(bad | bad2)
+
+    # Compute mean and sigma (from the first pass).
+    ngood = np.maximum(maximm-minimm,1)
+    skymed = 0.5*getsky((minimm+maximm+1)//2) + 0.5*getsky((minimm+maximm)//2 + 1)
+    skymn = rangesum(cs,minimm,maximm)/ngood
+    with np.errstate(invalid='ignore'):
+        sigma = np.where(active,np.sqrt(rangesum(cssq,minimm,maximm)/ngood-skymn**2),sigma)
+    skymn = skymn + skymid
+    skymod = np.where(active,np.where(skymed < skymn,3.*skymed - 2.*skymn,skymn),skymod)
+
+    # Rejection and recomputation loop, only the vectors that are
+    # still changing are kept active
+    clamp = np.ones(nvec,float)
+    old = np.zeros(nvec,float)
+    niter = 0
+    while np.sum(active) > 0:
+        niter += 1
+        if niter > mxiter:
+            sigma[active] = -1.0
+            break
+
+        # Too few valid sky elements
+        few = active & (maximm-minimm < minsky)
+        sigma[few] = -1.0
+        active &= ~few
+
+        # Compute Chauvenet rejection criterion.
+        r = np.log10(np.maximum(maximm-minimm,1).astype(float))
+        r = np.maximum(2., ( -0.1042*r + 1.1695)*r + 0.8895 )
+
+        # Compute rejection limits (symmetric about the current mode).
+        cut = r*sigma + 0.5*np.abs(skymn-skymod)
+        cut1 = skymod - cut ; cut2 = skymod + cut
+
+        # New limits of the accepted range
+        newmin = countbelow(cut1)-1
+        newmax = countbelow(cut2,right=True)-1
+        newmin = np.where(active,np.clip(newmin,-1,nlast-1),minimm)
+        newmax = np.where(active,np.clip(newmax,0,nlast),maximm)
+        redo = active & ((newmin != minimm) | (newmax != maximm))
+        minimm,maximm = newmin,newmax
+
+        # Compute mean and sigma (from this pass).
+        n = maximm - minimm
+        few = active & (n < minsky)
+        sigma[few] = -1.0
+        active &= ~few
+        n = np.maximum(n,1)
+        mn = rangesum(cs,minimm,maximm)/n
+        var = np.maximum(rangesum(cssq,minimm,maximm)/n - mn**2, 0)
+        skymn = np.where(active,mn+skymid,skymn)
+        sigma = np.where(active,np.sqrt(var),sigma)
+
+        # Determine a more robust median by averaging the central 20% of pixels.
+        center = (minimm + 1 + maximm)/2.
+        side = np.round(0.2*(maximm-minimm))/2.  + 0.25
+        j = np.round(center-side).astype(int)
+        k = np.round(center+side).astype(int)
+        med = rangesum(cs,j-1,k)/(k-j+1) + skymid
+
+        #  If the mean is less than the median, then the problem of contamination
+        #  is slight, and the mean is what we really want.
+        dmod = np.where(med < skymn, 3.*med-2.*skymn-skymod, skymn-skymod)
+
+        # prevent oscillations by clamping down if sky adjustments are changing sign
+        clamp = np.where(active & (dmod*old < 0), 0.5*clamp, clamp)
+        skymod = np.where(active, skymod + clamp*dmod, skymod)
+        old = np.where(active, dmod, old)
+        active &= redo
+
+    ok = (sigma >= 0)
+    skew[ok] = (skymn[ok]-skymod[ok])/np.maximum(1.,sigma[ok])
+
+    return(skymod.reshape(shape),sigma.reshape(shape),skew.reshape(shape))
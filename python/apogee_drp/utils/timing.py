@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""TIMING.PY - Per-stage timing and memory instrumentation for the processing steps.
+
+"""
+
+from __future__ import print_function
+
+__authors__ = 'David Nidever <dnidever@montana.edu>'
+__version__ = '20221001'  # yyyymmdd
+
+import os
+import time
+import json
+import socket
+import resource
+from contextlib import contextmanager
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+
+def maxrss():
+    """ Peak resident set size (in MB) of this process and of its finished child processes."""
+    # ru_maxrss is in kilobytes on Linux, bytes on Mac
+    scale = 1024.0**2 if os.uname().sysname=='Darwin' else 1024.0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return self_rss,child_rss
+
+
+class StageTimer(object):
+    """
+    Lightweight timer for the stages of a processing step.  For each stage
+    the wall-clock time, CPU time, number of calls and the peak RSS at the
+    end of the stage are recorded.  Stages that are run more than once
+    (e.g. once per block or chip) are accumulated.
+
+    Parameters
+    ----------
+    name : str
+       Name of the processing step, e.g. 'ap3dproc'.
+    **meta
+       Other information to add to the record, e.g. the file name.
+
+    Example
+    -------
+
+    timer = StageTimer('ap3dproc',file=filename)
+    timer.start('load')
+    ...
+    timer.start('refcorr')     # stops "load"
+    ...
+    with timer.stage('cr'):
+        ...
+    timer.stop()
+    timer.write(outfile.replace('.fits','_timing.json'))
+
+    """
+
+    def __init__(self,name,**meta):
+        self.name = name
+        self.meta = meta
+        self.stages = OrderedDict()
+        self.t0 = time.time()
+        self.cpu0 = time.process_time()
+        self._current = None
+
+    def __repr__(self):
+        out = self.__class__.__name__+'('+self.name+')\n'
+        for k,v in self.stages.items():
+            out += '%-12s %10.3f sec %10.3f cpu %5d calls %10.1f MB\n' % (k,v['time'],v['cpu'],v['ncalls'],v['maxrss'])
+        return out
+
+    def _add(self,name,dt,dcpu):
+        """ Add a measurement to a stage."""
+        rss,child_rss = maxrss()
+        if name not in self.stages:
+            self.stages[name] = {'time':0.0,'cpu':0.0,'ncalls':0,'maxrss':0.0,'maxrss_children':0.0}
+        st = self.stages[name]
+        st['time'] += dt
+        st['cpu'] += dcpu
+        st['ncalls'] += 1
+        st['maxrss'] = np.maximum(st['maxrss'],rss)
+        st['maxrss_children'] = np.maximum(st['maxrss_children'],child_rss)
+
+    def start(self,name):
+        """ Start a stage, this stops the currently running stage."""
+        self.stop()
+        self._current = (name,time.time(),time.process_time())
+
+    def stop(self):
+        """ Stop the currently running stage."""
+        if self._current is not None:
+            name,t0,cpu0 = self._current
+            self._add(name,time.time()-t0,time.process_time()-cpu0)
+            self._current = None
+
+    @contextmanager
+    def stage(self,name):
+        """ Context manager to time a (sub)stage, independent of start/stop."""
+        t0 = time.time()
+        cpu0 = time.process_time()
+        try:
+            yield self
+        finally:
+            self._add(name,time.time()-t0,time.process_time()-cpu0)
+
+    def merge(self,other):
+        """ Add the stages of another timer, e.g. one run in a worker process."""
+        for name,st in other.stages.items():
+            if name not in self.stages:
+                self.stages[name] = {'time':0.0,'cpu':0.0,'ncalls':0,'maxrss':0.0,'maxrss_children':0.0}
+            mst = self.stages[name]
+            mst['time'] += st['time']
+            mst['cpu'] += st['cpu']
+            mst['ncalls'] += st['ncalls']
+            mst['maxrss'] = np.maximum(mst['maxrss'],st['maxrss'])
+            mst['maxrss_children'] = np.maximum(mst['maxrss_children'],st['maxrss_children'])
+
+    def record(self):
+        """ Return the timing record as a dictionary."""
+        self.stop()
+        rss,child_rss = maxrss()
+        rec = OrderedDict()
+        rec['name'] = self.name
+        for k,v in self.meta.items():
+            rec[k] = v
+        rec['host'] = socket.gethostname()
+        rec['pid'] = os.getpid()
+        rec['date'] = datetime.now().isoformat()
+        rec['time'] = time.time()-self.t0
+        rec['cpu'] = time.process_time()-self.cpu0
+        rec['maxrss'] = rss
+        rec['maxrss_children'] = child_rss
+        rec['stages'] = OrderedDict()
+        for k,v in self.stages.items():
+            rec['stages'][k] = {kk:float(vv) if kk!='ncalls' else int(vv) for kk,vv in v.items()}
+        return rec
+
+    def write(self,outfile):
+        """ Write the timing record to a JSON file."""
+        rec = self.record()
+        with open(outfile,'w') as f:
+            json.dump(rec,f,indent=1)
+        return rec
+
+    def save(self,outfile,silent=True):
+        """ Write the JSON file, errors are only printed so they do not stop the processing."""
+        rec = None
+        try:
+            rec = self.write(outfile)
+            if silent==False:
+                print('Timing information written to '+outfile)
+        except Exception as e:
+            print('Problem writing timing file '+str(outfile)+': '+str(e))
+        return rec
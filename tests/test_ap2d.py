@@ -0,0 +1,115 @@
+# encoding: utf-8
+#
+# test_ap2d.py
+
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from pytest import fixture, raises
+
+from apogee_drp.utils import plan
+from apogee_drp.apred import ap2d, psf
+
+
+class FakeLoad(object):
+    """ Minimal ApLoad with the ap2D frame and the PSF files of a directory."""
+
+    prefix = 'ap'
+    apred = 'test'
+
+    def __init__(self, root, frame):
+        self.root = root
+        self.frame = frame
+
+    def filename(self, kind, num=None, chips=False, **kwargs):
+        return os.path.join(self.root, 'ap'+kind+'-'+str(num)+'.fits')
+
+    def exists(self, kind, num, **kwargs):
+        return True
+
+    def ap2D(self, num):
+        return self.frame
+
+    def cmjd(self, num):
+        return '59000'
+
+
+def make_chip(chip, psfdir, rng, nfiber=15):
+    """ Synthetic apPSF/apEPSF files and 2D image of one chip."""
+    epsflist = []
+    trace = np.zeros(nfiber, dtype=np.dtype([('FIBER', int), ('COEF', float, 3)]))
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
+    hdulist[0].header['NTRACE'] = nfiber
+    for f in range(nfiber):
+        ycen = 500 + 7*f + rng.uniform(-0.3, 0.3)
+        lo, hi = int(ycen)-6, int(ycen)+6
+        y = np.arange(lo, hi+1)[:, None]
+        img = np.exp(-0.5*((y-ycen)/rng.uniform(1.0, 1.4))**2)*np.ones((1, 2048))
+        img /= img.sum(axis=0)
+        epsflist.append({'fiber': f, 'lo': lo, 'hi': hi, 'img': img})
+        tab = np.zeros(1, dtype=np.dtype([('FIBER', int), ('LO', int), ('HI', int),
+                                          ('IMG', np.float32, img.shape)]))
+        tab['FIBER'], tab['LO'], tab['HI'], tab['IMG'][0] = f, lo, hi, img
+        hdulist.append(fits.table_to_hdu(Table(tab)))
+        trace['FIBER'][f], trace['COEF'][f, 0] = f, ycen
+    hdulist.writeto(os.path.join(psfdir, 'apEPSF-'+chip+'-12345678.fits'))
+    fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(Table(trace))]).writeto(
+        os.path.join(psfdir, 'apPSF-'+chip+'-12345678.fits'))
+    spec = np.zeros((2048, nfiber))
+    spec[:] = rng.uniform(1000, 5000, nfiber)
+    flux = psf.epsfmodel(psf.EPSF.fromlist(epsflist), spec) + 10 + rng.normal(0, 3, (2048, 2048))
+    head = fits.Header()
+    head['NREAD'] = 10
+    head['IMAGETYP'] = 'Object'
+    return fits.HDUList([fits.PrimaryHDU(header=head), fits.ImageHDU(flux.astype(np.float32)),
+                         fits.ImageHDU(np.full((2048, 2048), 3.0, np.float32)),
+                         fits.ImageHDU(np.zeros((2048, 2048), np.int16))])
+
+
+@fixture
+def ap2denv(tmp_path, monkeypatch):
+    """ Synthetic ap2D exposure and EPSF files of the three chips."""
+    monkeypatch.setenv('APOGEE_LOCALDIR', str(tmp_path))
+    monkeypatch.setattr(plan, 'getgitvers', lambda: 'test')
+    rng = np.random.default_rng(1)
+    frame = {}
+    for chip in ['a', 'b', 'c']:
+        frame[chip] = make_chip(chip, str(tmp_path), rng)
+        frame[chip].writeto(str(tmp_path / ('ap2D-'+chip+'-12345678.fits')))
+    yield str(tmp_path), FakeLoad(str(tmp_path), frame)
+    ap2d.closechippool()
+
+
+class TestAp2dproc(object):
+    """Tests for ``ap2dproc``."""
+
+    def test_nchipworkers(self, ap2denv):
+        root, load = ap2denv
+        inpfile = os.path.join(root, '12345678')
+        psffile = os.path.join(root, '12345678')
+        out1, model1 = ap2d.ap2dproc(inpfile, psffile, extract_type=4, load=load,
+                                     outdir=os.path.join(root, 'out1'), silent=True)
+        out2, model2 = ap2d.ap2dproc(inpfile, psffile, extract_type=4, load=load, clobber=True,
+                                     outdir=os.path.join(root, 'out2'), silent=True,
+                                     nchipworkers=3)
+        for ichip, chip in enumerate(['a', 'b', 'c']):
+            for key in ['flux', 'err', 'mask']:
+                assert np.array_equal(out1[ichip][key], out2[ichip][key])
+            assert np.array_equal(model1[ichip], model2[ichip])
+            f1 = fits.getdata(os.path.join(root, 'out1', 'ap1D-'+chip+'-12345678.fits'), 1)
+            f2 = fits.getdata(os.path.join(root, 'out2', 'ap1D-'+chip+'-12345678.fits'), 1)
+            assert np.array_equal(f1, f2)
+        # the pool is kept for the next exposure
+        pool = ap2d._chippool
+        assert pool is not None
+        ap2d.ap2dproc(inpfile, psffile, extract_type=4, load=load, clobber=True,
+                      outdir=os.path.join(root, 'out2'), silent=True, nchipworkers=3)
+        assert ap2d._chippool is pool
+
+    def test_badfibers(self, ap2denv):
+        root, load = ap2denv
+        inpfile = os.path.join(root, '12345678')
+        with raises(ValueError):
+            ap2d.ap2dproc(inpfile, inpfile, extract_type=4, load=load, fibers=[0, 20],
+                          outdir=os.path.join(root, 'out'), silent=True)
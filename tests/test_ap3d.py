@@ -0,0 +1,487 @@
+# encoding: utf-8
+#
+# test_ap3d.py
+
+import os
+import json
+import numpy as np
+from astropy.io import fits
+from pytest import fixture, mark
+
+from apogee_drp.utils import plan, apload
+from apogee_drp.apred import ap3d
+
+
+def make_rawfile(filename, nreads=5, seed=1, crs=True):
+    """ Write a small synthetic raw datacube with CRs and saturated pixels."""
+    rng = np.random.default_rng(seed)
+    base = rng.normal(12000, 30, (2048, 2560))
+    rate = np.zeros((2048, 2560))
+    rate[4:2044, 4:2048] = rng.uniform(5, 300, (2040, 2044))
+    rate[500:510, 800:810] = 20000
+    cube = np.zeros((nreads, 2048, 2560), np.int32)
+    for k in range(nreads):
+        cube[k] = np.round(base + rate*k + rng.normal(0, 10, (2048, 2560)))
+    for y, x, r in [(100, 200, 3), (1500, 1500, 3), (700, 300, 3)]:
+        if crs:
+            cube[r:, y, x] += 5000
+    head = fits.Header()
+    head['CHIP'] = 'a'
+    head['DATE-OBS'] = '2020-01-01T03:00:00.000'
+    head['NFRAMES'] = nreads
+    head['EXPTIME'] = nreads*10.647
+    fits.PrimaryHDU(np.minimum(cube, 65535), head).writeto(filename)
+    return filename
+
+
+@fixture(scope='module')
+def rawfile(tmp_path_factory):
+    return make_rawfile(str(tmp_path_factory.mktemp('raw') / 'apR-a-12345678.fits'))
+
+
+@fixture
+def ap3denv(tmp_path, monkeypatch):
+    monkeypatch.setenv('APOGEE_LOCALDIR', str(tmp_path))
+    monkeypatch.setattr(plan, 'getgitvers', lambda: 'test')
+    return tmp_path
+
+
+def runap3dproc(rawfile, outfile, **kwargs):
+    """ Run ap3dproc and return the flux, error and mask planes."""
+    ap3d.ap3dproc(rawfile, outfile, crfix=True, satfix=True, criter=True, silent=True, **kwargs)
+    with fits.open(outfile) as hdu:
+        return [hdu[i].data.copy() for i in (1, 2, 3)]
+
+
+class TestAp3dproc(object):
+    """Tests for ``ap3dproc``."""
+
+    def test_nworkers(self, rawfile, ap3denv):
+        out1 = runap3dproc(rawfile, str(ap3denv / 'ap2D-1.fits'))
+        out3 = runap3dproc(rawfile, str(ap3denv / 'ap2D-3.fits'), nworkers=3)
+        for plane1, plane3 in zip(out1, out3):
+            assert np.array_equal(plane1, plane3)
+        assert np.sum((out1[2] & ap3d.maskval('CRPIX')) > 0) >= 3
+
+    def test_silent(self, rawfile, ap3denv, capsys):
+        runap3dproc(rawfile, str(ap3denv / 'ap2D-silent.fits'))
+        assert capsys.readouterr().out == ''
+
+    def test_writetiming(self, rawfile, ap3denv):
+        outfile = str(ap3denv / 'ap2D-timing.fits')
+        runap3dproc(rawfile, outfile, writetiming=True)
+        with open(outfile.replace('.fits', '_timing.json')) as f:
+            rec = json.load(f)
+        assert rec['name'] == 'ap3dproc'
+        for name in ['read', 'load', 'refcorr', 'blocks', 'sampling', 'write']:
+            assert rec['stages'][name]['ncalls'] >= 1
+
+    def test_crfix(self, rawfile, ap3denv, tmp_path):
+        flux, err, mask = runap3dproc(rawfile, str(ap3denv / 'ap2D-cr.fits'))
+        nocrfile = make_rawfile(str(tmp_path / 'apR-a-00000000.fits'), crs=False)
+        flux0, err0, mask0 = runap3dproc(nocrfile, str(ap3denv / 'ap2D-nocr.fits'))
+        for y, x in [(100, 200), (1500, 1500), (700, 300)]:
+            assert (mask[y, x] & ap3d.maskval('CRPIX')) > 0
+            assert (mask0[y, x] & ap3d.maskval('CRPIX')) == 0
+            assert abs(flux[y, x]-flux0[y, x]) < 5*err[y, x]
+        crpix = (mask & ap3d.maskval('CRPIX')) > 0
+        assert np.sum(crpix & ((mask0 & ap3d.maskval('CRPIX')) == 0)) == 3
+
+    def test_float32(self, rawfile, ap3denv):
+        stats = ap3d.ap3dproc_compare(rawfile, outdir=str(ap3denv / 'compare'), silent=True,
+                                      crfix=True, satfix=True)
+        assert len(stats) == 1
+        assert stats[0]['flux_maxdiff'] < 0.1*stats[0]['rdnoise']
+        assert stats[0]['flux_rmsdiff'] < 0.01
+        assert stats[0]['var_maxreldiff'] < 1e-3
+        assert stats[0]['mask_ndiff'] == 0
+
+    def test_maxmem(self, rawfile, ap3denv):
+        out = runap3dproc(rawfile, str(ap3denv / 'ap2D-mem.fits'))
+        outstream = runap3dproc(rawfile, str(ap3denv / 'ap2D-stream.fits'), maxmem=0.2)
+        for plane, planestream in zip(out, outstream):
+            assert np.array_equal(plane, planestream)
+
+
+class FakeLoad(object):
+    """ Stand-in for ApLoad with all the files in one directory."""
+
+    def __init__(self, apred=None, telescope=None, root=None):
+        self.apred = apred
+        self.root = root
+
+    def filename(self, kind, num=None, mjd=None, plate=None, chips=False):
+        return os.path.join(self.root, 'ap'+kind+'-'+str(num if num is not None else mjd)+'.fits')
+
+    def exists(self, kind, num=None, mjd=None):
+        if kind == 'R':
+            return os.path.exists(self.filename(kind, num=num).replace('R-', 'R-a-'))
+        return True
+
+
+@fixture
+def plantasks(ap3denv, monkeypatch):
+    """ A plan file with one object exposure, the calibration files all exist."""
+    for ch in ['a', 'b', 'c']:
+        fits.PrimaryHDU(np.zeros((2, 4, 4), np.int32)).writeto(str(ap3denv / ('apR-'+ch+'-12345678.fits')))
+    apexp = np.zeros(1, dtype=[('name', int), ('flavor', 'U10')])
+    apexp['name'], apexp['flavor'] = 12345678, 'object'
+    planstr = {'apred_vers': 'test', 'telescope': 'apo25m', 'plateid': 1, 'mjd': 59000, 'platetype': 'normal',
+               'detid': 11, 'darkid': 12, 'flatid': 13, 'bpmid': 14, 'littrowid': 15, 'persistid': 16,
+               'persistmodelid': 0, 'APEXP': apexp}
+    monkeypatch.setattr(plan, 'load', lambda *args, **kwargs: planstr)
+    monkeypatch.setattr(apload, 'ApLoad', lambda **kwargs: FakeLoad(root=str(ap3denv), **kwargs))
+    return ap3denv
+
+
+class TestAp3dPlantasks(object):
+    """Tests for ``ap3d_plantasks``."""
+
+    def test_calfiles(self, plantasks):
+        tasks, logfile = ap3d.ap3d_plantasks('apPlan.par')
+        assert [t['chip'] for t in tasks] == ['a', 'b', 'c']
+        for t in tasks:
+            kws = t['kws']
+            assert kws['detcorr'] == str(plantasks / ('apDetector-'+t['chip']+'-11.fits'))
+            assert kws['darkcorr'] == str(plantasks / ('apDark-'+t['chip']+'-12.fits'))
+            assert kws['flatcorr'] == str(plantasks / ('apFlat-'+t['chip']+'-13.fits'))
+            assert kws['bpmcorr'] == str(plantasks / ('apBPM-'+t['chip']+'-14.fits'))
+            assert kws['persistcorr'] == str(plantasks / ('apPersist-'+t['chip']+'-16.fits'))
+            # only chip b has a Littrow mask
+            if t['chip'] == 'b':
+                assert kws['littrowcorr'] == str(plantasks / 'apLittrow-b-15.fits')
+            else:
+                assert kws['littrowcorr'] is None
+            assert kws['persistmodelcorr'] is None
+            assert t['rawfile'] == str(plantasks / ('apR-'+t['chip']+'-12345678.fits'))
+            assert t['outfile'] == str(plantasks / ('ap2D-'+t['chip']+'-12345678.fits'))
+
+    def test_quicklook(self, plantasks):
+        tasks, logfile = ap3d.ap3d_plantasks('apPlan.par', quicklook=True)
+        assert len(tasks) == 3
+        for t in tasks:
+            assert t['kws']['detcorr'] == str(plantasks / ('apDetector-'+t['chip']+'-11.fits'))
+            assert t['kws']['darkcorr'] is None
+            assert t['kws']['flatcorr'] is None
+
+
+class TestAp3dprocSample(object):
+    """Tests for ``ap3dproc_sample``."""
+
+    def makecube(self, nreads=8, seed=1):
+        rng = np.random.default_rng(seed)
+        rate = rng.uniform(10, 500, (20, 30))
+        cube = 1000 + rate[:, :, None]*np.arange(nreads) + rng.normal(0, 5, (20, 30, nreads))
+        return cube, rate
+
+    def test_uptheramp(self):
+        cube, rate = self.makecube()
+        gdreads = np.array([1, 2, 3, 5, 6, 7])
+        im, var, nfowler, slope, intercept = ap3d.ap3dproc_sample(cube, gdreads, uptheramp=True)
+        fit = np.polyfit(gdreads.astype(float), cube[:, :, gdreads].reshape(-1, len(gdreads)).T, 1)
+        assert np.allclose(slope, fit[0].reshape(20, 30), rtol=1e-10)
+        assert np.allclose(intercept, fit[1].reshape(20, 30), rtol=1e-10)
+        assert np.allclose(im, slope*(len(gdreads)-1))
+        im2, var2, nfowler2, slope2, intercept2 = ap3d.ap3dproc_sample(cube, gdreads, uptheramp=True, usenumba=True)
+        assert np.allclose(im2, im, rtol=1e-12)
+        assert np.allclose(var2, var, rtol=1e-12)
+
+    def test_saturated(self):
+        cube, rate = self.makecube()
+        satmask = np.zeros((20, 30, 3), int)
+        satmask[5, 6] = [1, 4, 0]
+        cube[5, 6, 4:] = 65535
+        gdreads = np.arange(8)
+        im, var, nfowler, slope, intercept = ap3d.ap3dproc_sample(cube, gdreads, satmask=satmask, satfix=False,
+                                                                  uptheramp=True)
+        fit = np.polyfit(np.arange(4.0), cube[5, 6, 0:4], 1)
+        assert np.isclose(slope[5, 6], fit[0], rtol=1e-10)
+        # the variance uses the number of reads in the fit
+        ngd = 4
+        var1 = 12*(ngd-1.)/(8*(ngd+1.))*12.0**2 + 6.*(ngd**2+1)/(5.*ngd*(ngd+1))*im[5, 6]
+        assert np.isclose(var[5, 6], var1, rtol=1e-12)
+
+    def test_fowler(self):
+        cube, rate = self.makecube()
+        gdreads = np.arange(8)
+        for uptheramp in [False, None]:
+            im, var, nfowler, slope, intercept = ap3d.ap3dproc_sample(cube, gdreads, uptheramp=uptheramp, nfowler=2)
+            assert nfowler == 2
+            assert slope is None
+            assert np.allclose(im, cube[:, :, 6:8].mean(axis=2)-cube[:, :, 0:2].mean(axis=2))
+
+
+class TestAp3dprocLindarkcorr(object):
+    """Tests for ``ap3dproc_lindarkcorr``."""
+
+    @mark.parametrize('dtype', ['float32', 'float64'])
+    @mark.parametrize('perpixel', [True, False])
+    def test_fallback(self, dtype, perpixel):
+        rng = np.random.default_rng(1)
+        slc = rng.uniform(10000, 60000, (2048, 8, 6)).astype(dtype)
+        if perpixel:
+            lindata = np.zeros((2048, 8, 3))
+            lindata[..., 1] = 1 + rng.normal(0, 0.01, (2048, 8))
+            lindata[..., 2] = rng.normal(0, 1e-7, (2048, 8))
+        else:
+            lindata = np.array([[0.0, 1.01, 2e-7], [0.0, 0.99, 1e-7], [1.0, 1.0, 0.0], [0.0, 1.02, -1e-7]])
+        darkslc = rng.uniform(0, 50, (2048, 8, 6))
+        out = ap3d.ap3dproc_darkcorr(ap3d.ap3dproc_lincorr(slc, lindata, None), darkslc, None)
+        out2 = ap3d.ap3dproc_lindarkcorr(slc.copy(), lindata, darkslc)
+        assert out2.dtype == np.dtype(dtype)
+        assert np.array_equal(out, out2)
+
+
+def make_block(nx=30, nrows=6, nreads=10, seed=1):
+    """ Block of ramps [Nx,Nrows,Nreads] with read noise."""
+    rng = np.random.default_rng(seed)
+    rate = rng.uniform(20, 400, (nx, nrows))
+    slc = 12000 + rate[:, :, None]*np.arange(nreads) + rng.normal(0, 5, (nx, nrows, nreads))
+    return slc, rate
+
+
+class TestAp3dprocBlock(object):
+    """Tests for ``ap3dproc_block``."""
+
+    def pixelloop(self, slc, mask, **kwargs):
+        """ ap3dproc_block() run one pixel at a time."""
+        nx, nrows, nreads = slc.shape
+        out = [np.zeros(slc.shape), np.zeros(mask.shape, int), np.zeros((nx, nrows, 3), int),
+               np.zeros((nx, nrows)), np.zeros((nx, nrows)), np.zeros((nx, nrows))]
+        ncr = 0
+        for i in range(nx):
+            for j in range(nrows):
+                out1 = ap3d.ap3dproc_block(slc[i:i+1, j:j+1], mask[i:i+1, j:j+1], **kwargs)
+                for k in range(6):
+                    out[k][i:i+1, j:j+1] = out1[k]
+                ncr += out1[6]['ncr']
+        return out, ncr
+
+    def test_cr(self):
+        slc, rate = make_block()
+        crpix = [(3, 1, 4), (10, 2, 7), (11, 2, 2), (25, 5, 9)]
+        for x, y, r in crpix:
+            slc[x, y, r:] += 3000
+        mask = np.zeros(slc.shape[0:2], int)
+        out = ap3d.ap3dproc_block(slc, mask)
+        crstr = out[6]
+        assert crstr['ncr'] == len(crpix)
+        assert sorted(zip(crstr['data']['x'], crstr['data']['y'], crstr['data']['read'])) == sorted(crpix)
+        for x, y, r in crpix:
+            assert (out[1][x, y] & ap3d.maskval('CRPIX')) > 0
+            # the jump is removed
+            assert abs(out[0][x, y, -1]-out[0][x, y, 0]-rate[x, y]*(slc.shape[2]-1)) < 100
+        # the same as pixel by pixel
+        loop, ncr = self.pixelloop(slc, mask)
+        assert ncr == crstr['ncr']
+        for k in range(6):
+            assert np.array_equal(out[k], loop[k])
+
+    def test_saturation(self):
+        slc, rate = make_block()
+        # saturated from different reads, and one unfixable pixel
+        for x, y, r in [(2, 0, 5), (7, 3, 8), (15, 4, 3), (20, 1, 1)]:
+            slc[x, y, r:] = 65535
+        mask = np.zeros(slc.shape[0:2], int)
+        for satfix in [True, False]:
+            out = ap3d.ap3dproc_block(slc, mask, satfix=satfix)
+            satmask = out[2]
+            assert np.array_equal(satmask[2, 0], [1, 5, 5])
+            assert np.array_equal(satmask[7, 3], [1, 8, 2])
+            assert (out[1][20, 1] & ap3d.maskval('UNFIXABLE')) > 0
+            assert (out[1][15, 4] & ap3d.maskval('UNFIXABLE')) == 0
+            if satfix:
+                # extrapolated with the median dCounts
+                assert abs(out[0][2, 0, -1]-out[0][2, 0, 0]-rate[2, 0]*(slc.shape[2]-1)) < 50
+                assert out[5][2, 0] > 0
+            loop, ncr = self.pixelloop(slc, mask, satfix=satfix)
+            for k in range(6):
+                assert np.array_equal(out[k], loop[k])
+
+
+class TestAp3dprocCriter(object):
+    """Tests for ``ap3dproc_criter``."""
+
+    def test_neighbors(self):
+        slc, rate = make_block(nx=20, nrows=20)
+        # a strong CR, a weaker one next to it and another one next to
+        #  that, and a weak jump that is not next to a CR
+        slc[10, 10, 5:] += 3000
+        slc[11, 10, 5:] += 150
+        slc[12, 11, 5:] += 150
+        slc[3, 15, 5:] += 150
+        mask = np.zeros((20, 20), int)
+        cube, mask, satmask, med_dCounts, variability, sat_extrap_error, crstr = ap3d.ap3dproc_block(slc, mask)
+        assert crstr['ncr'] == 1
+        crstr['data']['neicheck'] = False
+        cube, mask, crstr = ap3d.ap3dproc_criter(cube, mask, satmask, crstr, noise=17.0, silent=True)
+        found = sorted(zip(crstr['data']['x'], crstr['data']['y'], crstr['data']['read']))
+        assert found == [(10, 10, 5), (11, 10, 5), (12, 11, 5)]
+        for x, y in [(11, 10), (12, 11)]:
+            assert (mask[x, y] & ap3d.maskval('CRPIX')) > 0
+            assert abs(cube[x, y, -1]-cube[x, y, 0]-rate[x, y]*9) < 60
+        assert (mask[3, 15] & ap3d.maskval('CRPIX')) == 0
+        assert np.all(crstr['data']['neicheck'])
+
+
+class TestAprefcorr(object):
+    """Tests for ``aprefcorr``."""
+
+    def makecube(self, nreads=5, seed=1):
+        rng = np.random.default_rng(seed)
+        rate = np.zeros((2048, 2048))
+        rate[4:2044, 4:2044] = rng.uniform(0, 200, (2040, 2040))
+        bias = rng.uniform(-100, 100, nreads)
+        cube = np.zeros((2048, 2560, nreads), np.int32) + 10000
+        cube[:, 0:2048] += np.round(rate[:, :, None]*np.arange(nreads)).astype(np.int32)
+        cube += np.round(bias).astype(np.int32)
+        return cube, rate
+
+    def test_bias(self):
+        cube, rate = self.makecube()
+        mask = np.zeros((2048, 2048), int)
+        readmask = np.zeros(5, int)
+        out = ap3d.aprefcorr(cube, fits.Header(), mask, readmask=readmask, silent=True)
+        # the first read is rejected
+        assert np.array_equal(readmask, [1, 0, 0, 0, 0])
+        assert np.all(out[:, :, 0] == 0)
+        for k in range(1, 5):
+            assert np.allclose(out[:, :, k], np.round(rate*k)-np.round(rate), atol=1)
+
+    def test_nbatch(self, capsys):
+        cube, rate = self.makecube()
+        rng = np.random.default_rng(2)
+        cube += rng.integers(-20, 20, cube.shape).astype(np.int32)
+        cube[rng.uniform(0, 1, (2048, 2560)) > 0.9999, 3:] = 60000
+        mask, readmask = np.zeros((2048, 2048), int), np.zeros(5, int)
+        out = ap3d.aprefcorr(cube, fits.Header(), mask, readmask=readmask, silent=True)
+        assert capsys.readouterr().out == ''
+        # one read at a time
+        mask1, readmask1 = np.zeros((2048, 2048), int), np.zeros(5, int)
+        out1 = ap3d.aprefcorr(cube, fits.Header(), mask1, readmask=readmask1, silent=True, nbatch=1)
+        assert np.array_equal(out, out1)
+        assert np.array_equal(mask, mask1)
+        assert np.array_equal(readmask, readmask1)
+        assert np.sum((mask & ap3d.maskval('SATPIX')) > 0) > 0
+
+
+def make_bpmfile(filename, seed=1):
+    """ Write a bad pixel mask file with a few bad pixels."""
+    rng = np.random.default_rng(seed)
+    bpm = np.zeros((2048, 2048), np.int16)
+    bpm[rng.integers(0, 2048, 50), rng.integers(0, 2048, 50)] = 1
+    fits.PrimaryHDU(bpm).writeto(filename, overwrite=True)
+    return filename
+
+
+class TestCalcache(object):
+    """Tests for ``calcached`` loaders."""
+
+    @fixture(autouse=True)
+    def settings(self, monkeypatch):
+        monkeypatch.setitem(ap3d.calcache_settings, 'enabled', True)
+        monkeypatch.setitem(ap3d.calcache_settings, 'maxmem', 4.0)
+        monkeypatch.setitem(ap3d.calcache_settings, 'shareddir', None)
+        ap3d.calcache_clear()
+        yield
+        ap3d.calcache_clear()
+
+    def test_cached(self, tmp_path):
+        bpmfile = make_bpmfile(str(tmp_path / 'apBPM-a-1.fits'))
+        bpm1, head1 = ap3d.loadbpm(bpmfile)
+        bpm2, head2 = ap3d.loadbpm(bpmfile)
+        assert bpm1 is bpm2
+        assert bpm1.flags.writeable == False
+        # a new file is loaded again
+        st = os.stat(bpmfile)
+        make_bpmfile(bpmfile, seed=2)
+        os.utime(bpmfile, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+        bpm3, head3 = ap3d.loadbpm(bpmfile)
+        assert bpm3 is not bpm1
+        assert np.array_equal(bpm3, fits.getdata(bpmfile))
+
+    def test_disabled(self, tmp_path):
+        bpmfile = make_bpmfile(str(tmp_path / 'apBPM-a-1.fits'))
+        ap3d.calcache_setup(enabled=False)
+        bpm1, head1 = ap3d.loadbpm(bpmfile)
+        bpm2, head2 = ap3d.loadbpm(bpmfile)
+        assert bpm1 is not bpm2
+        assert bpm1.flags.writeable
+        assert len(ap3d._calcache) == 0
+
+    def test_maxmem(self, tmp_path):
+        bpmfile1 = make_bpmfile(str(tmp_path / 'apBPM-a-1.fits'))
+        bpmfile2 = make_bpmfile(str(tmp_path / 'apBPM-a-2.fits'))
+        bpm1, head1 = ap3d.loadbpm(bpmfile1)
+        # room for only one of them
+        ap3d.calcache_setup(maxmem=1.5*bpm1.nbytes/1e9)
+        ap3d.loadbpm(bpmfile2)
+        assert len(ap3d._calcache) == 1
+        assert list(ap3d._calcache.keys())[0][1] == os.path.abspath(bpmfile2)
+
+    def test_shareddir(self, tmp_path):
+        bpmfile = make_bpmfile(str(tmp_path / 'apBPM-a-1.fits'))
+        ap3d.calcache_setup(shareddir=str(tmp_path / 'shm'))
+        bpm1, head1 = ap3d.loadbpm(bpmfile)
+        assert isinstance(bpm1, np.memmap)
+        # another process finds the shared copy
+        ap3d.calcache_clear()
+        bpm2, head2 = ap3d.loadbpm(bpmfile)
+        assert isinstance(bpm2, np.memmap)
+        assert np.array_equal(bpm2, fits.getdata(bpmfile))
+        assert head2['NAXIS'] == 2
+
+
+class TestAp3dprocQuicklook(object):
+    """Tests for ``ap3dproc_quicklook``."""
+
+    def test_lastfirst(self, rawfile, ap3denv):
+        outfile = str(ap3denv / 'ap2Dql-a-12345678.fits')
+        im = ap3d.ap3dproc_quicklook(rawfile, outfile, nread=1, silent=True)
+        # the same as the last minus the second read of the whole cube
+        cube, head = ap3d.ap3dproc_readcube(rawfile)
+        cube = ap3d.aprefcorr(cube, head, np.zeros((2048, 2048), int), silent=True)
+        assert np.allclose(im, (cube[:, :, -1]-cube[:, :, 1])[:, 0:2048])
+        with fits.open(outfile) as hdu:
+            assert hdu[0].header['QUICKLOOK'] == True
+            assert hdu[0].header['QLNREAD'] == 1
+            assert np.allclose(hdu[1].data, im, rtol=1e-6)
+
+    def test_bpm(self, rawfile, ap3denv):
+        bpmfile = make_bpmfile(str(ap3denv / 'apBPM-a-1.fits'))
+        im = ap3d.ap3dproc_quicklook(rawfile, None, nread=2, bpmcorr=bpmfile, silent=True)
+        bpm = fits.getdata(bpmfile)
+        assert np.all(im[bpm > 0] == 0)
+        assert np.all(np.isfinite(im))
+
+
+class TestAppersist(object):
+    """Tests for ``appersist_coeffs`` and ``appersist_calc``."""
+
+    def test_stimuli(self):
+        rng = np.random.default_rng(1)
+        cc = np.zeros((15, 8, 8))
+        cc[0] = rng.integers(0, 2, (8, 8))
+        cc[1:] = rng.uniform(-0.5, 0.5, (14, 8, 8))*1e-3
+        cc[[2, 6, 11]] = rng.uniform(0.1, 1, (3, 8, 8))
+        cc[[4, 8, 13]] = rng.uniform(0.2, 0.8, (3, 8, 8))
+        cc[[9, 14]] = -rng.uniform(0.05, 0.5, (2, 8, 8))
+        flux = rng.uniform(-100, 30000, (3, 8, 8))
+        tend = np.array([100.0, 900.0, 2000.0])
+        coeffs = ap3d.appersist_coeffs(cc, flux)
+        pers = ap3d.appersist_calc(coeffs, 2500-tend[:, None, None], 3000-tend[:, None, None])
+        assert pers.shape == (3, 8, 8)
+        # one stimulus and pixel at a time
+        for s in range(3):
+            coeffs1 = ap3d.appersist_coeffs(cc, flux[s])
+            assert np.allclose(coeffs1, coeffs[:, s])
+            for y in range(8):
+                for x in range(8):
+                    f = max(flux[s, y, x], 0.0)
+                    c = cc[:, y, x]
+                    c0 = c[0]*np.array([c[1]+c[2]*np.exp(c[3]*f)*f**c[4], c[5]+c[6]*np.exp(c[7]*f)*f**c[8],
+                                        c[9], c[10]+c[11]*np.exp(c[12]*f)*f**c[13], c[14]])
+                    assert np.allclose(coeffs[:, s, y, x], c0)
+                    r0, r1 = (2500-tend[s])/10.6, (3000-tend[s])/10.6
+                    p = c0[1]*(np.exp(c0[2]*r1)-np.exp(c0[2]*r0)) + c0[3]*(np.exp(c0[4]*r1)-np.exp(c0[4]*r0))
+                    assert np.isclose(pers[s, y, x], p)
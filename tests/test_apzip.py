@@ -0,0 +1,57 @@
+# encoding: utf-8
+#
+# test_apzip.py
+
+import numpy as np
+from astropy.io import fits
+from pytest import raises
+
+from apogee_drp.utils import apzip
+
+
+def make_apzfile(filename, nreads=6, shape=(64, 80), seed=1, head=None):
+    """ Write a small apz file like apzip.zip() and fpack make, return the reads [Nreads,Ny,Nx]."""
+    rng = np.random.default_rng(seed)
+    reads = 10000 + np.cumsum(rng.integers(0, 300, (nreads,)+shape), axis=0)
+    dcounts = np.diff(reads, axis=0)
+    avg_dcounts = np.round(dcounts.mean(axis=0)).astype(np.int32)
+    if head is None:
+        head = fits.Header()
+    head['NREAD'] = nreads
+    hdulist = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(avg_dcounts, head),
+                            fits.CompImageHDU(reads[0].astype(np.int32))])
+    for k in range(nreads-1):
+        hdulist.append(fits.CompImageHDU((dcounts[k]-avg_dcounts).astype(np.int32)))
+    hdulist.writeto(filename)
+    return reads
+
+
+class TestUnzipToArray(object):
+    """Tests for ``unzip_to_array``."""
+
+    def test_reads(self, tmp_path):
+        apzfile = str(tmp_path / 'apR-a-12345678.apz')
+        reads = make_apzfile(apzfile)
+        cube, head = apzip.unzip_to_array(apzfile, silent=True)
+        assert cube.dtype == np.int32
+        assert np.array_equal(np.moveaxis(cube, 2, 0), reads)
+        assert head['NREAD'] == 6
+        assert head['NAXIS'] == 0
+        cube, head = apzip.unzip_to_array(apzfile, maxread=4, silent=True)
+        assert np.array_equal(np.moveaxis(cube, 2, 0), reads[0:4])
+        # memory-mapped output cube
+        cube, head = apzip.unzip_to_array(apzfile, cubefile=str(tmp_path / 'cube.dat'), silent=True)
+        assert isinstance(cube, np.memmap)
+        assert np.array_equal(np.moveaxis(cube, 2, 0), reads)
+
+    def test_someread(self, tmp_path):
+        apzfile = str(tmp_path / 'apR-a-12345678.apz')
+        reads = make_apzfile(apzfile)
+        cube, head = apzip.unzip_to_array(apzfile, reads=[1, -1], silent=True)
+        assert np.array_equal(np.moveaxis(cube, 2, 0), reads[[1, -1]])
+        cube, head = apzip.unzip_to_array(apzfile, reads=[0, 1, 2, -2, -1], maxread=5, silent=True)
+        assert np.array_equal(np.moveaxis(cube, 2, 0), reads[[0, 1, 2, 3, 4]])
+
+    def test_missing(self, tmp_path):
+        with raises(FileNotFoundError):
+            apzip.unzip_to_array(str(tmp_path / 'apR-a-00000000.apz'), silent=True)
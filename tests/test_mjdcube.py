@@ -0,0 +1,59 @@
+# encoding: utf-8
+#
+# test_mjdcube.py
+
+import os
+import numpy as np
+from astropy.io import fits
+
+from apogee_drp.apred import mjdcube
+from tests.test_apzip import make_apzfile
+
+
+def make_exposure(root, num, exptype, dateobs, seed):
+    """ Write a small apz exposure with the header cards used by histindex."""
+    head = fits.Header()
+    head['EXPTYPE'] = exptype
+    head['EXPTIME'] = 50*10.647
+    head['DATE-OBS'] = dateobs
+    head['PLATEID'] = 1234
+    apzfile = os.path.join(root, 'apR-a-'+str(num)+'.apz')
+    reads = make_apzfile(apzfile, seed=seed, head=head)
+    return apzfile, reads
+
+
+class TestMjdcubeChip(object):
+    """Tests for ``mjdcube_chip``."""
+
+    def test_incremental(self, tmp_path):
+        root = str(tmp_path)
+        histfile = os.path.join(root, 'apHist-a-59000.fits')
+        file1, reads1 = make_exposure(root, 12345678, 'OBJECT', '2020-01-01T03:00:00.000', 1)
+        file2, reads2 = make_exposure(root, 12345679, 'DomeFlat', '2020-01-01T03:15:00.000', 2)
+        mjdcube.mjdcube_chip(histfile, [file1])
+        # only the new exposure is added
+        mjdcube.mjdcube_chip(histfile, [file1, file2])
+        with fits.open(histfile) as hd:
+            assert len(hd) == 3
+        tab = mjdcube.histindex(histfile)
+        assert list(tab['ext']) == [1, 2]
+        assert list(tab['apzfile']) == ['apR-a-12345678.apz', 'apR-a-12345679.apz']
+        assert list(tab['expnum']) == [12345678, 12345679]
+        assert list(tab['exptype']) == ['OBJECT', 'DOMEFLAT']
+        assert list(tab['nread']) == [6, 6]
+        assert list(tab['plateid']) == [1234, 1234]
+        assert np.isclose((tab['jd'][1]-tab['jd'][0])*24*60, 15.0)
+        # CDS images, last minus second read
+        tab, ims = mjdcube.loadhist(histfile)
+        assert np.array_equal(ims[0], reads1[-1]-reads1[1])
+        assert np.array_equal(ims[1], reads2[-1]-reads2[1])
+        tab, ims = mjdcube.loadhist(histfile, rows=[1])
+        assert len(ims) == 1
+        assert np.array_equal(ims[0], reads2[-1]-reads2[1])
+        # rebuild from scratch
+        mjdcube.mjdcube_chip(histfile, [file2], clobber=True)
+        assert list(mjdcube.histindex(histfile)['apzfile']) == ['apR-a-12345679.apz']
+
+    def test_missing(self, tmp_path):
+        tab = mjdcube.histindex(str(tmp_path / 'apHist-a-59000.fits'))
+        assert len(tab) == 0
@@ -0,0 +1,28 @@
+# encoding: utf-8
+#
+# test_mmm.py
+
+import numpy as np
+
+from apogee_drp.utils import mmm
+
+
+class TestMmmArray(object):
+    """Tests for ``mmm_array``."""
+
+    def test_mmm(self):
+        rng = np.random.default_rng(1)
+        nvec, npix = 300, 400
+        sky = rng.normal(100, 10, (nvec, npix)) * rng.uniform(0.1, 3, (nvec, 1))
+        # contaminating sources, high bad pixels and vectors of different lengths
+        sky += rng.exponential(50, (nvec, npix)) * (rng.uniform(0, 1, (nvec, npix)) > 0.8)
+        sky[rng.uniform(0, 1, (nvec, npix)) > 0.98] = 1e10
+        nsky = rng.integers(10, npix+1, nvec)
+        sky[np.arange(npix)[None, :] >= nsky[:, None]] = np.nan
+        skymod, sigma, skew = mmm.mmm_array(sky, highbad=1e5)
+        for i in range(nvec):
+            val, sig, sk = mmm.mmm(sky[i, 0:nsky[i]], highbad=1e5)
+            if sig < 0:
+                assert sigma[i] < 0
+            else:
+                assert np.allclose([skymod[i], sigma[i], skew[i]], [val, sig, sk], rtol=1e-10, atol=1e-10)
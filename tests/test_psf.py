@@ -0,0 +1,381 @@
+# encoding: utf-8
+#
+# test_psf.py
+
+import os
+import numpy as np
+from collections import OrderedDict
+from astropy.io import fits
+from astropy.table import Table
+from pytest import mark
+
+from apogee_drp.apred import psf
+from apogee_drp.utils import mmm
+
+
+def tridiagsystem(nrow=30, ncol=50, seed=1):
+    """ Random diagonally dominant tridiagonal systems, one per column."""
+    rng = np.random.default_rng(seed)
+    a = rng.uniform(0, 1, (nrow, ncol))
+    c = rng.uniform(0, 1, (nrow, ncol))
+    a[0] = 0
+    c[-1] = 0
+    b = a + c + rng.uniform(1, 2, (nrow, ncol))
+    v = rng.normal(0, 100, (nrow, ncol))
+    vvar = rng.uniform(1, 10, (nrow, ncol))
+    return a, b, c, v, vvar
+
+
+def densesolve(a, b, c, v, rows):
+    """ Solve the system of some of the rows of one column with a dense matrix."""
+    mat = np.diag(b) + np.diag(a[1:], -1) + np.diag(c[:-1], 1)
+    return np.linalg.solve(mat[np.ix_(rows, rows)], v[rows])
+
+
+class TestSolvetridiag(object):
+    """Tests for ``solvetridiag``."""
+
+    def test_dense(self):
+        a, b, c, v, vvar = tridiagsystem()
+        x, xvar = psf.solvetridiag(a, b, c, v, vvar)
+        for i in range(v.shape[1]):
+            xdense = densesolve(a[:, i], b[:, i], c[:, i], v[:, i], np.arange(v.shape[0]))
+            assert np.allclose(x[:, i], xdense, rtol=1e-13, atol=1e-13)
+        assert np.all(xvar > 0)
+
+    def test_good(self):
+        a, b, c, v, vvar = tridiagsystem(seed=2)
+        good = np.random.default_rng(3).uniform(0, 1, v.shape) > 0.2
+        x, xvar = psf.solvetridiag(a, b, c, v, vvar, good=good)
+        assert np.all(x[~good] == 0)
+        assert np.all(xvar[~good] == 0)
+        for i in range(v.shape[1]):
+            rows, = np.where(good[:, i])
+            xdense = densesolve(a[:, i], b[:, i], c[:, i], v[:, i], rows)
+            assert np.allclose(x[rows, i], xdense, rtol=1e-13, atol=1e-13)
+
+
+def make_epsf(ntrace=10, seed=1):
+    """ Synthetic EPSF of overlapping Gaussian traces."""
+    rng = np.random.default_rng(seed)
+    epsflist = []
+    for k in range(ntrace):
+        ycen = 100 + 6*k + rng.uniform(-0.5, 0.5)
+        lo, hi = int(ycen)-6, int(ycen)+6
+        y = np.arange(lo, hi+1)[:, None]
+        sigma = rng.uniform(1.0, 1.5, 2048)
+        img = np.exp(-0.5*((y-ycen)/sigma)**2)
+        epsflist.append({'fiber': 2*k, 'lo': lo, 'hi': hi, 'img': img/img.sum(axis=0)})
+    return psf.EPSF.fromlist(epsflist)
+
+
+class TestExtractMatrix(object):
+    """Tests for ``extract_matrix``."""
+
+    def test_cache(self, monkeypatch):
+        epsf = make_epsf()
+        rng = np.random.default_rng(2)
+        badim1 = rng.uniform(0, 1, (2048, 2048)) > 0.995
+        badim2 = badim1.copy()
+        badim2[rng.integers(0, 2048, 500), rng.integers(90, 170, 500)] ^= True
+        tridiag1, psftot1 = psf.extract_matrix(epsf, badim1)
+        # updated from the cached matrix of the first mask
+        tridiag2, psftot2 = psf.extract_matrix(epsf, badim2)
+        # from scratch
+        monkeypatch.setitem(psf.extract_cache_settings, 'enabled', False)
+        for badim, tridiag, psftot in [(badim1, tridiag1, psftot1), (badim2, tridiag2, psftot2)]:
+            tridiag0, psftot0 = psf.extract_matrix(epsf, badim)
+            assert np.allclose(tridiag, tridiag0, rtol=0, atol=1e-13)
+            assert np.allclose(psftot, psftot0, rtol=0, atol=1e-13)
+        assert not np.array_equal(psftot1, psftot2)
+
+    def test_copy(self, monkeypatch):
+        monkeypatch.setattr(psf, '_extract_cache', OrderedDict())
+        epsf = make_epsf()
+        badim = np.random.default_rng(2).uniform(0, 1, (2048, 2048)) > 0.995
+        psf.extract_matrix(epsf, badim)
+        # the same shift of the same EPSF uses the same cache entry
+        copy1 = epsf.copy(tag=('shift', '0.1000'))
+        copy2 = epsf.copy(tag=('shift', '0.1000'))
+        copy3 = epsf.copy(tag=('shift', '0.2000'))
+        assert copy1.cachekey == copy2.cachekey
+        assert copy1.cachekey != copy3.cachekey
+        assert epsf.copy().cachekey is None
+        psf.extract_matrix(copy1, badim)
+        assert len(psf._extract_cache) == 2
+        psf.extract_matrix(copy2, badim)
+        assert len(psf._extract_cache) == 2
+        psf.extract_matrix(copy3, badim)
+        assert len(psf._extract_cache) == 3
+
+
+def scat_remove_loop(a):
+    """ The variable scattered light removal of scat_remove() done box by box."""
+    t = np.copy(a)
+    bad = (~np.isfinite(t) | (t < -10))
+    t[bad] = 1e10
+    nbox = 51
+    grid = np.zeros((41, 41), float)
+    for ii, i in enumerate(range(4, 2045, nbox)):
+        for jj, j in enumerate(range(4, 2045, nbox)):
+            i1, i2 = max(4, i-nbox//2), min(2044, i+nbox//2)
+            j1, j2 = max(4, j-nbox//2), min(2044, j+nbox//2)
+            val, sig, skew = mmm.mmm(t[i1:i2+1, j1:j2+1].ravel(), highbad=1e5)
+            if sig > 0:
+                grid[ii, jj] = val
+    ramp = np.arange(nbox)
+    xramp = ramp.reshape(-1, 1)*np.ones((1, nbox))
+    yramp = ramp.reshape(1, -1)*np.ones((nbox, 1))
+    w1 = (nbox-xramp)/nbox*(nbox-yramp)/nbox
+    w2 = xramp/nbox*(nbox-yramp)/nbox
+    w3 = (nbox-xramp)/nbox*yramp/nbox
+    w4 = xramp/nbox*yramp/nbox
+    out = np.zeros((2048, 2048), float)
+    for ii, i in enumerate(range(4+nbox//2, 2045-nbox//2, nbox)):
+        for jj, j in enumerate(range(4+nbox//2, 2045-nbox//2, nbox)):
+            v1, v2, v3, v4 = grid[ii, jj], grid[ii+1, jj], grid[ii, jj+1], grid[ii+1, jj+1]
+            if v1 > 1e9: v1 = v2
+            if v2 > 1e9: v2 = v1
+            out[i-nbox//2:i+nbox//2+1, j-nbox//2:j+nbox//2+1] = v1*w1+v2*w2+v3*w3+v4*w4
+    return a - out
+
+
+class TestScatRemove(object):
+    """Tests for ``scat_remove``."""
+
+    def test_loop(self):
+        rng = np.random.default_rng(1)
+        y, x = np.mgrid[0:2048, 0:2048]
+        a = 20 + 10*np.sin(x/400.) + 0.005*y + rng.normal(0, 2, (2048, 2048))
+        # sparse fiber traces, bad pixels and saturated pixels
+        a[(y % 60) < 3] += 500
+        a[rng.uniform(0, 1, a.shape) > 0.999] = np.nan
+        a[rng.uniform(0, 1, a.shape) > 0.999] = 2e5
+        flux = psf.scat_remove(a)
+        flux0 = scat_remove_loop(a)
+        good = np.isfinite(flux0)
+        assert np.array_equal(good, np.isfinite(flux))
+        assert np.allclose(flux[good], flux0[good], rtol=1e-12, atol=1e-12)
+
+
+def extract_guess_loop(frame, epsf, guess):
+    """ Fluxes of extract() with the guess model of each fiber and its
+    neighbors added back into the image fiber by fiber."""
+    ntrace = len(epsf)
+    red = frame['flux'].T - psf.epsfmodel(epsf, guess).T
+    badim = ~np.isfinite(frame['flux'].T) | (frame['flux'].T == 0) | ((frame['mask'].T & psf.BADMASK) > 0)
+    beta = np.zeros((ntrace, 2048), float)
+    for k in range(ntrace):
+        lo, hi = epsf.lo[k], epsf.hi[k]
+        img = np.where(badim[:, lo:hi+1], np.nan, epsf.trace(k).T)
+        fibs = list(range(max(k-1, 0), min(k+2, ntrace)))
+        ylo, yhi = np.min(epsf.lo[fibs]), np.max(epsf.hi[fibs])+1
+        red1 = red.copy()
+        red1[:, ylo:yhi] += psf.epsfmodel(epsf, guess, fibers=fibs, yrange=[ylo, yhi]).T
+        beta[k] = np.nansum(red1[:, lo:hi+1]*img, axis=1)
+    tridiag, psftot = psf.extract_matrix(epsf, badim)
+    x, xvar = psf.solvetridiag(tridiag[0], tridiag[1], tridiag[2], beta, beta, good=(psftot > 0.5))
+    return x
+
+
+class TestExtract(object):
+    """Tests for ``extract``."""
+
+    def test_guess(self):
+        epsf = make_epsf(seed=3)
+        rng = np.random.default_rng(4)
+        spec = np.zeros((2048, 300), float)
+        spec[:, epsf.fiber] = rng.uniform(100, 1000, (2048, len(epsf)))
+        flux = psf.epsfmodel(epsf, spec) + 10 + rng.normal(0, 1, (2048, 2048))
+        mask = np.zeros((2048, 2048), int)
+        mask[rng.uniform(0, 1, mask.shape) > 0.99] = 1
+        frame = {'flux': flux, 'err': np.ones((2048, 2048)), 'mask': mask, 'header': {}}
+        guess = spec * rng.uniform(0.9, 1.1, spec.shape)
+        guess[0:10] = -1
+        out, back, model = psf.extract(frame, epsf, guess=guess)
+        x = extract_guess_loop(frame, epsf, guess)
+        good = (out['mask'][4:2044][:, epsf.fiber] == 0)
+        assert np.sum(good) > 0.9*good.size
+        assert np.allclose(out['flux'][4:2044][:, epsf.fiber][good], x[:, 4:2044].T[good], rtol=1e-10, atol=1e-8)
+
+
+def make_epsffile(filename, nfiber=30, seed=1):
+    """ Write a small synthetic apEPSF file, one fiber is missing."""
+    rng = np.random.default_rng(seed)
+    hdulist = fits.HDUList([fits.PrimaryHDU()])
+    for f in range(nfiber):
+        if f == 12:
+            continue
+        cent = 20 + 7*f + 0.001*np.arange(2048) + rng.uniform(-0.3, 0.3)
+        lo, hi = int(np.min(cent))-7, int(np.max(cent))+8
+        y = np.arange(lo, hi+1)[:, None]
+        img = np.exp(-0.5*((y-cent)/rng.uniform(1.0, 1.5))**2) + rng.normal(0, 0.01, (len(y), 2048))
+        tab = np.zeros(1, dtype=np.dtype([('FIBER', int), ('LO', int), ('HI', int), ('CENT', float, 2048),
+                                          ('IMG', np.float32, (hi-lo+1, 2048))]))
+        tab['FIBER'], tab['LO'], tab['HI'], tab['CENT'][0], tab['IMG'][0] = f, lo, hi, cent, img
+        hdulist.append(fits.table_to_hdu(Table(tab)))
+    hdulist[0].header['NTRACE'] = len(hdulist)-1
+    hdulist.writeto(filename)
+    return filename
+
+
+class TestLoadepsf(object):
+    """Tests for ``loadepsf``."""
+
+    def test_sidecar(self, tmp_path):
+        psffile = make_epsffile(str(tmp_path / 'apEPSF-a-12345678.fits'))
+        imgfile, tracefile = psf.EPSF.sidecarfiles(psffile)
+        epsf1 = psf.loadepsf(psffile)
+        assert os.path.exists(imgfile) and os.path.exists(tracefile)
+        assert not isinstance(epsf1.img, np.memmap)
+        # loaded from the sidecar files
+        epsf2 = psf.loadepsf(psffile)
+        assert isinstance(epsf2.img, np.memmap)
+        assert epsf2.cachekey == epsf1.cachekey
+        for name in ['fiber', 'lo', 'hi', 'img']:
+            assert np.array_equal(getattr(epsf1, name), getattr(epsf2, name))
+        assert 12 not in epsf2.fiber
+        with fits.open(psffile) as hdu:
+            for k in range(len(epsf2)):
+                assert np.array_equal(epsf2.trace(k), hdu[k+1].data['IMG'][0])
+        assert np.array_equal(psf.loadepsf(psffile, cache=False).img, epsf2.img)
+
+    def test_stale(self, tmp_path):
+        psffile = make_epsffile(str(tmp_path / 'apEPSF-a-12345678.fits'))
+        psf.loadepsf(psffile)
+        # the FITS file is touched, the sidecar files are rebuilt
+        mtime = os.path.getmtime(psffile)
+        os.utime(psffile, (mtime+10, mtime+10))
+        epsf = psf.loadepsf(psffile)
+        assert not isinstance(epsf.img, np.memmap)
+        assert isinstance(psf.loadepsf(psffile).img, np.memmap)
+        # a FITS file older than the sidecar files (e.g. restored
+        # with its old time) is not matched by them either
+        make_epsffile(psffile+'.new', seed=2)
+        os.replace(psffile+'.new', psffile)
+        os.utime(psffile, (mtime-100, mtime-100))
+        epsf = psf.loadepsf(psffile)
+        assert not isinstance(epsf.img, np.memmap)
+        with fits.open(psffile) as hdu:
+            assert np.array_equal(epsf.trace(0), hdu[1].data['IMG'][0])
+
+
+class TestBinprofiles(object):
+    """Tests for ``binprofiles``."""
+
+    def test_avgprofile(self, tmp_path):
+        psffile = make_epsffile(str(tmp_path / 'apEPSF-a-12345678.fits'))
+        fibers = np.arange(0, 30, 5)
+        columns = np.arange(10, 2000, 200)
+        xbin, ybin, mnx, mny = psf.binprofiles(psf.loadprofdata(psffile), fibers, columns)
+        with fits.open(psffile) as psfhdu:
+            fiber2hdu = {psfhdu[i].data['FIBER'][0]: i for i in range(1, len(psfhdu))}
+            for i, c in enumerate(columns):
+                for j, f in enumerate(fibers):
+                    data1, xbin1, ybin1, ybinsm1 = psf.avgprofile([f, f+5], [c, c+200], psfhdu, fiber2hdu)
+                    assert np.array_equal(xbin, xbin1)
+                    assert np.array_equal(ybin[i, j], ybin1, equal_nan=True)
+                    assert mnx[i, j] == np.median(data1[:, 2])
+                    assert mny[i, j] == np.median(data1[:, 3])
+
+
+def make_psf(kind, npix=71, nhidden=10, seed=1):
+    """ Small synthetic ANN or grid PSF."""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(-7, 7, npix)
+    if kind == 'ann':
+        coeffs = {'weight0': rng.normal(0, 1, (nhidden, 2)), 'bias0': rng.normal(0, 1, nhidden),
+                  'weight2': rng.normal(0, 1, (nhidden, nhidden)), 'bias2': rng.normal(0, 1, nhidden),
+                  'weight4': rng.normal(0, 0.1, (npix, nhidden)), 'bias4': -0.1*y**2,
+                  'xmin': np.array([0.0, 0.0]), 'xmax': np.array([2047.0, 2047.0]), 'y': y}
+        return psf.PSF(coeffs, kind='ann', nxgrid=8, nygrid=12)
+    # irregular grid that does not cover the whole chip, so the
+    # edges and corners are used too
+    nx, ny = 8, 12
+    xgrid, ygrid = np.meshgrid(np.linspace(100, 1900, nx), np.linspace(50, 2000, ny), indexing='ij')
+    xgrid = xgrid + rng.uniform(-10, 10, xgrid.shape)
+    ygrid = ygrid + rng.uniform(-10, 10, ygrid.shape)
+    grid = -0.1*y**2 + rng.normal(0, 0.05, (nx, ny, npix))
+    return psf.PSF((grid, np.stack([xgrid, ygrid]), y), kind='grid')
+
+
+class TestPSF(object):
+    """Tests for ``PSF``."""
+
+    @mark.parametrize('kind', ['ann', 'grid'])
+    def test_evaluate(self, kind):
+        p = make_psf(kind)
+        rng = np.random.default_rng(2)
+        xs = np.concatenate([rng.uniform(0, 2047, 200), [0, 0, 2047, 2047, 30, 1000]])
+        ys = np.concatenate([rng.uniform(0, 2047, 200), [0, 2047, 0, 2047, 1000, 2040]])
+        prof = p.evaluate(xs, ys)
+        for i in range(len(xs)):
+            assert np.allclose(prof[i], p([xs[i], ys[i]]), rtol=1e-12, atol=0)
+        # shifted onto pixels
+        ycen = ys + rng.uniform(-0.5, 0.5, len(ys))
+        y = np.arange(-10, 11)
+        prof = p.evaluate(xs, ys, y=y+np.round(ycen)[:, None], ycen=ycen)
+        for i in range(len(xs)):
+            prof1 = p([xs[i], ys[i]], y=y+np.round(ycen[i]), ycen=ycen[i])
+            assert np.allclose(prof[i], prof1, rtol=1e-12, atol=0)
+
+    def test_ann_model(self):
+        p = make_psf('ann')
+        labels = np.random.default_rng(3).uniform(0, 2047, (50, 2))
+        m = p.ann_model(labels)
+        for i in range(len(labels)):
+            assert np.allclose(m[i], p.ann_model(labels[i]), rtol=1e-12, atol=1e-14)
+
+    def test_mkgrid(self):
+        p = make_psf('ann')
+        p.mkgrid()
+        for i, x in enumerate(p._xgrid):
+            for j, y in enumerate(p._ygrid):
+                assert np.allclose(p._grid[i, j], p.ann_model([x, y]), rtol=1e-12, atol=1e-14)
+
+
+def make_offsetframe(shift, nfiber=300, seed=1):
+    """ Synthetic frame with Gaussian traces offset from the trace image."""
+    rng = np.random.default_rng(seed)
+    x = np.arange(2048)
+    traceim = 20 + 6.75*np.arange(nfiber)[:, None] + 1e-6*(x-1024)**2
+    fflux = rng.uniform(2000, 8000, nfiber)
+    y = np.arange(2048)[:, None]
+    flux = np.zeros((2048, 2048), float)
+    for f in range(nfiber):
+        cent = traceim[f] + shift[0] + shift[1]*x + shift[2]*traceim[f]
+        lo, hi = max(int(np.min(cent))-8, 0), min(int(np.max(cent))+9, 2048)
+        flux[lo:hi] += fflux[f]*np.exp(-0.5*((y[lo:hi]-cent)/1.2)**2)
+    flux += 20 + rng.normal(0, 5, flux.shape)
+    return {'flux': flux, 'err': np.full(flux.shape, 5.0), 'mask': np.zeros(flux.shape, int), 'header': {}}, traceim
+
+
+class TestGetoffset(object):
+    """Tests for ``getoffset_fft`` and ``getoffset``."""
+
+    @mark.parametrize('shift', [[0.37, 0, 0], [-1.6, 0, 0], [0.2, 1e-4, 2e-4]])
+    def test_fft(self, shift):
+        frame, traceim = make_offsetframe(shift)
+        coef, medoff = psf.getoffset_fft(frame, traceim, verbose=False)
+        assert coef is not None
+        # offset at positions across the chip
+        for xx, yy in [(100, 100), (1024, 1024), (1900, 200), (200, 1900), (1900, 1900)]:
+            truth = shift[0] + shift[1]*xx + shift[2]*yy
+            assert abs(psf.func_poly2d([xx, yy], *coef)-truth) < 0.05
+        # the same as the peak fitting
+        coef0, medoff0 = psf.getoffset(frame, traceim, method='peak')
+        assert abs(medoff-medoff0) < 0.05
+
+    def test_fallback(self, monkeypatch, capsys):
+        # no signal, not enough good blocks
+        frame, traceim = make_offsetframe([0.3, 0, 0])
+        blank = dict(frame, flux=np.random.default_rng(2).normal(20, 5, frame['flux'].shape))
+        coef, medoff = psf.getoffset_fft(blank, traceim, verbose=False)
+        assert coef is None and np.isnan(medoff)
+        # getoffset() falls back to the peak fitting
+        monkeypatch.setattr(psf, 'getoffset_fft', lambda frame, traceim: (None, np.nan))
+        coef, medoff = psf.getoffset(frame, traceim)
+        assert 'fitting the peaks' in capsys.readouterr().out
+        coef0, medoff0 = psf.getoffset(frame, traceim, method='peak')
+        assert np.array_equal(coef, coef0)
+        assert abs(medoff-0.3) < 0.05
@@ -0,0 +1,80 @@
+# encoding: utf-8
+#
+# test_psfflattrace.py
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from dlnpyutils import utils as dln
+from pytest import raises
+
+from apogee_drp.apred import psfFlatTrace
+
+
+def make_tablefile(filename, nflat=500, seed=1):
+    """ Write a small synthetic PSF flat lookup table, half plate and half FPS era."""
+    rng = np.random.default_rng(seed)
+    fiber = np.arange(300)
+    tab = Table()
+    tab['PSFID'] = np.arange(nflat) + 30000000
+    tab['MJD'] = np.where(np.arange(nflat) < nflat//2, 57000, psfFlatTrace.FPSMJD+100)
+    tab['LN2LEVEL'] = rng.uniform(80, 90, nflat).astype(np.float32)
+    # shifts and tilts of the traces, and a little noise
+    shift = rng.normal(0, 2, (nflat, 3, 1))
+    tilt = rng.normal(0, 0.005, (nflat, 3, 1))
+    cent = 30 + 6.6*fiber + shift + tilt*(fiber-150) + rng.normal(0, 0.02, (nflat, 3, 300))
+    cent[rng.uniform(0, 1, cent.shape) > 0.99] = np.nan
+    tab['GAUSS_CENT'] = cent
+    tab['GAUSS_NPEAKS'] = np.zeros((nflat, 3), np.int16) + 295
+    # an invalid entry
+    tab['MJD'][10] = 0
+    tab.write(filename)
+    return filename
+
+
+def matchFlatsLoop(lib, cents, mjds):
+    """ Best flat of each exposure by scoring every flat of its era, chip by chip."""
+    flatind = np.zeros(len(cents), int) - 1
+    rms = np.zeros(len(cents))
+    for i in range(len(cents)):
+        ind, = np.where((lib['mjd'] >= psfFlatTrace.FPSMJD) == (mjds[i] >= psfFlatTrace.FPSMJD))
+        rms1 = np.full([3, len(ind)], 50).astype(np.float64)
+        for ichip in range(3):
+            num, = np.where(np.isfinite(cents[i, ichip]))
+            for j, iflat in enumerate(ind):
+                diff = np.absolute(lib['cent'][iflat, ichip, num] - cents[i, ichip, num])
+                diff = diff[np.isfinite(diff)]
+                if len(diff) < 5: continue
+                rms1[ichip, j] = dln.mad(diff, zero=True)
+        rmsMean = np.nanmean(rms1, axis=0)
+        best, = np.where(rmsMean == np.nanmin(rmsMean))
+        flatind[i] = ind[best[0]]
+        rms[i] = rmsMean[best[0]]
+    return flatind, rms
+
+
+class TestMatchFlats(object):
+    """Tests for ``matchFlats``."""
+
+    def test_exhaustive(self, tmp_path):
+        lib = psfFlatTrace.loadLookupTable(make_tablefile(str(tmp_path / 'apQuartzFlatTrace-all.fits')))
+        assert len(lib['psfid']) == 499
+        # exposures close to some of the flats, with missing fibers
+        rng = np.random.default_rng(2)
+        nexp = 40
+        ref = rng.choice(len(lib['psfid']), nexp, replace=False)
+        cents = lib['cent'][ref] + rng.normal(0, 0.05, (nexp, 3, 300))
+        cents[rng.uniform(0, 1, cents.shape) > 0.7] = np.nan
+        mjds = lib['mjd'][ref]
+        flatind0, rms0 = matchFlatsLoop(lib, cents, mjds)
+        # the default is the exhaustive search
+        for kwargs in [{}, {'ncand': None}, {'ncand': 100}]:
+            flatind, rms = psfFlatTrace.matchFlats(lib, cents, mjds, **kwargs)
+            assert np.array_equal(flatind, flatind0)
+            assert np.allclose(rms, rms0, rtol=1e-12, atol=0)
+
+    def test_ncand(self, tmp_path):
+        lib = psfFlatTrace.loadLookupTable(make_tablefile(str(tmp_path / 'apQuartzFlatTrace-all.fits')))
+        for ncand in [0, -5, 2.5]:
+            with raises(ValueError):
+                psfFlatTrace.matchFlats(lib, lib['cent'][0:2], lib['mjd'][0:2], ncand=ncand)
@@ -0,0 +1,51 @@
+# encoding: utf-8
+#
+# test_timing.py
+
+import json
+import time
+
+from apogee_drp.utils import timing
+
+
+class TestStageTimer(object):
+    """Tests for ``StageTimer``."""
+
+    def test_stages(self):
+        timer = timing.StageTimer('test', file='apR-a-12345678.fits')
+        timer.start('load')
+        time.sleep(0.01)
+        timer.start('cr')     # stops "load"
+        for i in range(3):
+            with timer.stage('sat'):
+                pass
+        timer.stop()
+        rec = timer.record()
+        assert list(rec['stages']) == ['load', 'sat', 'cr']
+        assert rec['stages']['load']['time'] >= 0.01
+        assert rec['stages']['sat']['ncalls'] == 3
+        assert rec['file'] == 'apR-a-12345678.fits'
+        assert rec['maxrss'] > 0
+
+    def test_merge(self):
+        timer = timing.StageTimer('test')
+        other = timing.StageTimer('chip')
+        for t in [timer, other]:
+            with t.stage('extract'):
+                pass
+        timer.merge(other)
+        assert timer.stages['extract']['ncalls'] == 2
+
+    def test_save(self, tmp_path, capsys):
+        timer = timing.StageTimer('test')
+        with timer.stage('load'):
+            pass
+        outfile = str(tmp_path / 'ap2D-a-12345678_timing.json')
+        timer.save(outfile)
+        with open(outfile) as f:
+            rec = json.load(f)
+        assert rec['name'] == 'test'
+        assert rec['stages']['load']['ncalls'] == 1
+        # errors are only printed
+        assert timer.save(str(tmp_path / 'nodir' / 'timing.json')) is None
+        assert 'Problem writing timing file' in capsys.readouterr().out